@@ -7,6 +7,8 @@ import re
 import os
 import time
 import glob
+import json
+import tempfile
 import collections
 from operator import itemgetter
 
@@ -18,7 +20,7 @@ from scipy.interpolate import interp1d
 from scipy.interpolate import splrep, splev
 
 from pybar_fei4_interpreter import analysis_utils
-from pybar.daq.fei4_record import FEI4Record
+from pybar.daq.fei4_record import decode_fei4_records, get_record_string, record_types
 from pybar.analysis.plotting import plotting
 from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
 
@@ -300,19 +302,125 @@ def get_rate_normalization(hit_file, parameter, reference='event', cluster_file=
     return np.amax(np.array(normalization_rate)).astype('f16') / np.array(normalization_rate)
 
 
-def get_total_n_data_words(files_dict, precise=False):
+file_info_cache_file_name = 'file_info_cache.json'  # sidecar file in the data folder
+
+
+def _read_file_info(file_name):
+    '''Reads the table sizes, the first and last meta data row and the scan parameter values of one data file.
+    '''
+    file_info = collections.OrderedDict()
+    with tb.open_file(file_name, mode="r") as in_file_h5:
+        try:
+            file_info['n_raw_data'] = in_file_h5.root.raw_data.shape[0]
+        except tb.NoSuchNodeError:
+            file_info['n_raw_data'] = None
+        try:
+            meta_data = in_file_h5.root.meta_data
+        except tb.NoSuchNodeError:
+            file_info['n_meta_data'] = None
+            file_info['meta_data_first'] = None
+            file_info['meta_data_last'] = None
+        else:
+            file_info['n_meta_data'] = meta_data.shape[0]
+            file_info['meta_data_first'] = collections.OrderedDict(zip(meta_data.dtype.names, meta_data[0].tolist())) if meta_data.shape[0] else None
+            file_info['meta_data_last'] = collections.OrderedDict(zip(meta_data.dtype.names, meta_data[-1].tolist())) if meta_data.shape[0] else None
+        try:
+            scan_parameters = in_file_h5.root.scan_parameters[:]
+        except tb.NoSuchNodeError:
+            file_info['scan_parameters'] = None
+        else:
+            file_info['scan_parameters'] = collections.OrderedDict([(name, np.unique(scan_parameters[name]).tolist()) for name in scan_parameters.dtype.names])
+    return file_info
+
+
+def get_file_info(files, use_cache=False):
+    '''Returns the meta information of data files without reopening unchanged files.
+
+    If the cache is used, the meta information of each file is stored in a sidecar file (file_info_cache_file_name) in the folder of the data file.
+    Cache entries are keyed by the file name and are only used if the size and the modification time of the file did not change.
+    Entries of files which do not exist anymore are removed from the cache.
+
+    Parameters
+    ----------
+    files : string, list of strings
+        The data file names.
+    use_cache : bool
+        If True, the file info cache is used and stored in the data folders. If False, all files are opened and the cache is not used.
+
+    Returns
+    -------
+    collections.OrderedDict
+        The file names and the meta information of each file: number of raw data words (n_raw_data), number of readouts (n_meta_data),
+        the first and last meta data row (meta_data_first, meta_data_last) and the unique scan parameter values from the scan parameter table (scan_parameters).
+        The entries are None if the nodes do not exist.
+    '''
+    if isinstance(files, basestring):
+        files = (files, )
+    files_info = collections.OrderedDict()
+    caches = {}  # cache folder and cache content
+    changed_caches = set()
+    for file_name in files:
+        file_stat = os.stat(file_name)
+        if not use_cache:
+            files_info[file_name] = _read_file_info(file_name)
+            continue
+        cache_file_name = os.path.join(os.path.dirname(os.path.abspath(file_name)), file_info_cache_file_name)
+        if cache_file_name not in caches:
+            try:
+                with open(cache_file_name, 'r') as cache_file:
+                    caches[cache_file_name] = json.load(cache_file, object_pairs_hook=collections.OrderedDict)
+            except (IOError, ValueError):  # no cache or cache corrupted
+                caches[cache_file_name] = collections.OrderedDict()
+            cache_folder = os.path.dirname(cache_file_name)
+            for cache_key in [cache_key for cache_key in caches[cache_file_name].iterkeys() if not os.path.isfile(os.path.join(cache_folder, cache_key))]:  # remove files which do not exist anymore
+                del caches[cache_file_name][cache_key]
+                changed_caches.add(cache_file_name)
+        cache = caches[cache_file_name]
+        cache_key = os.path.basename(file_name)
+        try:
+            file_info = cache[cache_key]
+            if file_info['size'] != file_stat.st_size or file_info['mtime'] != file_stat.st_mtime:
+                raise KeyError
+            if file_info['scan_parameters'] is not None:  # json returns unicode names
+                file_info['scan_parameters'] = collections.OrderedDict([(str(name), values) for name, values in file_info['scan_parameters'].iteritems()])
+        except KeyError:  # file not cached or file changed
+            file_info = collections.OrderedDict([('size', file_stat.st_size), ('mtime', file_stat.st_mtime)])
+            file_info.update(_read_file_info(file_name))
+            cache[cache_key] = file_info
+            changed_caches.add(cache_file_name)
+        files_info[file_name] = file_info
+    for cache_file_name in changed_caches:
+        _write_file_info_cache(cache_file_name, caches[cache_file_name])
+    return files_info
+
+
+def _write_file_info_cache(cache_file_name, cache):
+    '''Writes the file info cache into a temporary file of the same folder and renames it. Readers never see a partially written cache.
+    '''
+    try:
+        fd, tmp_file_name = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(cache_file_name) + '.', dir=os.path.dirname(cache_file_name))  # unique for each writer
+    except (IOError, OSError):
+        logging.warning('Cannot write file info cache %s', cache_file_name)
+        return
+    try:
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        try:
+            os.rename(tmp_file_name, cache_file_name)  # atomic on POSIX
+        except OSError:  # os.rename does not overwrite on Windows
+            os.remove(cache_file_name)
+            os.rename(tmp_file_name, cache_file_name)
+    except (IOError, OSError):
+        logging.warning('Cannot write file info cache %s', cache_file_name)
+        if os.path.isfile(tmp_file_name):
+            os.remove(tmp_file_name)
+
+
+def get_total_n_data_words(files_dict, precise=False, use_file_info_cache=False):
     n_words = 0
-    if precise:  # open all files and determine the total number of words precicely, can take some time
-        if len(files_dict) > 10:
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(files_dict), term_width=80)
-            progress_bar.start()
-        for index, file_name in enumerate(files_dict.iterkeys()):
-            with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
-                n_words += in_file_h5.root.raw_data.shape[0]
-            if len(files_dict) > 10:
-                progress_bar.update(index)
-        if len(files_dict) > 10:
-            progress_bar.finish()
+    if precise:  # determine the total number of words precicely from the cached file info, can take some time if the files were not cached before
+        for file_info in get_file_info(files_dict.keys(), use_cache=use_file_info_cache).itervalues():
+            n_words += file_info['n_raw_data']
         return n_words
     else:  # open just first an last file and take the mean to estimate the total numbe rof words
         with tb.open_file(files_dict.keys()[0], mode="r") as in_file_h5:  # open the actual file
@@ -322,7 +430,7 @@ def get_total_n_data_words(files_dict, precise=False):
         return n_words * len(files_dict) / 2
 
 
-def create_parameter_table(files_dict):
+def create_parameter_table(files_dict, use_file_info_cache=False):
     if not check_parameter_similarity(files_dict):
         raise RuntimeError('Cannot create table from file with different scan parameters.')
     # create the parameter names / format for the parameter table
@@ -333,27 +441,28 @@ def create_parameter_table(files_dict):
     except AttributeError:  # no parameters given, return None
         return
     parameter_table = None
+    files_info = get_file_info(files_dict.keys(), use_cache=use_file_info_cache)
     # create a parameter table with an entry for every read out
     for file_name, parameters in files_dict.iteritems():
-        with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
-            n_parameter_settings = max([len(i) for i in files_dict[file_name].values()])  # determine the number of different parameter settings from the list length of parameter values of the first parameter
-            if n_parameter_settings == 0:  # no parameter values, first raw data file has only config info and no other data (meta, raw data, parameter data)
-                continue
-            try:  # try to combine the scan parameter tables
+        n_parameter_settings = max([len(i) for i in files_dict[file_name].values()])  # determine the number of different parameter settings from the list length of parameter values of the first parameter
+        if n_parameter_settings == 0:  # no parameter values, first raw data file has only config info and no other data (meta, raw data, parameter data)
+            continue
+        if files_info[file_name]['scan_parameters'] is not None:  # try to combine the scan parameter tables
+            with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
                 if parameter_table is None:  # final parameter_table does not exists, so create is
                     parameter_table = in_file_h5.root.scan_parameters[:]
                 else:  # final parameter table already exist, so append to existing
                     parameter_table.resize(parameter_table.shape[0] + in_file_h5.root.scan_parameters[:].shape[0], refcheck=False)  # fastest way to append, http://stackoverflow.com/questions/1730080/append-rows-to-a-numpy-record-array
                     parameter_table[-in_file_h5.root.scan_parameters.shape[0]:] = in_file_h5.root.scan_parameters[:]  # set table
-            except tb.NoSuchNodeError:  # there is no scan parameter table, so create one
-                read_out = in_file_h5.root.meta_data.shape[0]
-                if parameter_table is None:  # final parameter_table does not exists, so create is
-                    parameter_table = np.rec.fromarrays(arrayList, names=names, formats=formats)  # create recarray
-                    parameter_table.resize(read_out, refcheck=False)
-                    parameter_table[-read_out:] = np.rec.fromarrays(arrayList, names=names, formats=formats)
-                else:  # final parameter table already exist, so append to existing
-                    parameter_table.resize(parameter_table.shape[0] + read_out)  # fastest way to append, http://stackoverflow.com/questions/1730080/append-rows-to-a-numpy-record-array
-                    parameter_table[-read_out:] = np.rec.fromarrays([l for l in parameters.values()], names=names, formats=formats)
+        else:  # there is no scan parameter table, so create one
+            read_out = files_info[file_name]['n_meta_data']
+            if parameter_table is None:  # final parameter_table does not exists, so create is
+                parameter_table = np.rec.fromarrays(arrayList, names=names, formats=formats)  # create recarray
+                parameter_table.resize(read_out, refcheck=False)
+                parameter_table[-read_out:] = np.rec.fromarrays(arrayList, names=names, formats=formats)
+            else:  # final parameter table already exist, so append to existing
+                parameter_table.resize(parameter_table.shape[0] + read_out)  # fastest way to append, http://stackoverflow.com/questions/1730080/append-rows-to-a-numpy-record-array
+                parameter_table[-read_out:] = np.rec.fromarrays([l for l in parameters.values()], names=names, formats=formats)
 
     return parameter_table
 
@@ -404,7 +513,7 @@ def get_parameter_value_from_file_names(files, parameters=None, unique=False, so
     return collections.OrderedDict(sorted(result.iteritems(), key=itemgetter(1)) if sort else files_dict)  # with PEP 265 solution of sorting a dict by value
 
 
-def get_data_file_names_from_scan_base(scan_base, filter_str=['_analyzed.h5', '_interpreted.h5', '_cut.h5', '_result.h5', '_hists.h5'], sort_by_time=True, meta_data_v2=True):
+def get_data_file_names_from_scan_base(scan_base, filter_str=['_analyzed.h5', '_interpreted.h5', '_cut.h5', '_result.h5', '_hists.h5'], sort_by_time=True, meta_data_v2=True, use_file_info_cache=False):
     """
     Generate a list of .h5 files which have a similar file name.
 
@@ -418,6 +527,8 @@ def get_data_file_names_from_scan_base(scan_base, filter_str=['_analyzed.h5', '_
         If True, return file name list sorted from oldest to newest. The time from meta table will be used to sort the files.
     meta_data_v2 : bool
         True for new (v2) meta data format, False for the old (v1) format.
+    use_file_info_cache : bool
+        If True, the meta data of the files is taken from the file info cache (see get_file_info).
 
     Returns
     -------
@@ -441,22 +552,17 @@ def get_data_file_names_from_scan_base(scan_base, filter_str=['_analyzed.h5', '_
         data_files = filter(lambda data_file: not any([(True if x in data_file else False) for x in filter_str]), data_files)
     if sort_by_time and len(data_files) > 1:
         f_list = {}
-        for data_file in data_files:
-            with tb.open_file(data_file, mode="r") as h5_file:
-                try:
-                    meta_data = h5_file.root.meta_data
-                except tb.NoSuchNodeError:
-                    logging.warning("File %s is missing meta_data" % h5_file.filename)
+        for data_file, file_info in get_file_info(data_files, use_cache=use_file_info_cache).iteritems():
+            if file_info['n_meta_data'] is None:
+                logging.warning("File %s is missing meta_data" % data_file)
+            elif file_info['meta_data_first'] is None:
+                logging.info("File %s has empty meta_data" % data_file)
+            else:
+                if meta_data_v2:
+                    timestamp = file_info['meta_data_first']["timestamp_start"]
                 else:
-                    try:
-                        if meta_data_v2:
-                            timestamp = meta_data[0]["timestamp_start"]
-                        else:
-                            timestamp = meta_data[0]["timestamp"]
-                    except IndexError:
-                        logging.info("File %s has empty meta_data" % h5_file.filename)
-                    else:
-                        f_list[data_file] = timestamp
+                    timestamp = file_info['meta_data_first']["timestamp"]
+                f_list[data_file] = timestamp
 
         data_files = list(sorted(f_list, key=f_list.__getitem__, reverse=False))
     return data_files
@@ -477,7 +583,7 @@ def get_scan_parameter_names(scan_parameters):
     return scan_parameters.dtype.names if scan_parameters is not None else None
 
 
-def get_parameter_from_files(files, parameters=None, unique=False, sort=True):
+def get_parameter_from_files(files, parameters=None, unique=False, sort=True, use_file_info_cache=False):
     ''' Takes a list of files, searches for the parameter name in the file name and in the file.
     Returns a ordered dict with the file name in the first dimension and the corresponding parameter values in the second.
     If a scan parameter appears in the file name and in the file the first parameter setting has to be in the file name, otherwise a warning is shown.
@@ -490,6 +596,8 @@ def get_parameter_from_files(files, parameters=None, unique=False, sort=True):
     unique : boolean
         If set only one file per scan parameter value is used.
     sort : boolean
+    use_file_info_cache : boolean
+        If set the scan parameters are taken from the file info cache (see get_file_info).
 
     Returns
     -------
@@ -503,55 +611,49 @@ def get_parameter_from_files(files, parameters=None, unique=False, sort=True):
     if isinstance(parameters, basestring):
         parameters = (parameters, )
     parameter_values_from_file_names_dict = get_parameter_value_from_file_names(files, parameters, unique=unique, sort=sort)  # get the parameter from the file name
-    for file_name in files:
-        with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
-            scan_parameter_values = collections.OrderedDict()
-            try:
-                scan_parameters = in_file_h5.root.scan_parameters[:]  # get the scan parameters from the scan parameter table
-                if parameters is None:
-                    parameters = get_scan_parameter_names(scan_parameters)
-                for parameter in parameters:
+    for file_name, file_info in get_file_info(files, use_cache=use_file_info_cache).iteritems():
+        scan_parameter_values = collections.OrderedDict()
+        if file_info['scan_parameters'] is not None:  # get the scan parameters from the cached scan parameter table values
+            if parameters is None:
+                parameters = tuple(file_info['scan_parameters'].keys())
+            for parameter in parameters:
+                if parameter in file_info['scan_parameters']:  # the scan parameter exists
+                    scan_parameter_values[parameter] = file_info['scan_parameters'][parameter]  # different scan parameter values used
+        elif file_info['n_meta_data'] is not None:  # scan parameter table does not exist
+            with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
+                scan_parameters = get_scan_parameter(in_file_h5.root.meta_data[:])  # get the scan parameters from the meta data
+                if scan_parameters:
                     try:
-                        scan_parameter_values[parameter] = np.unique(scan_parameters[parameter]).tolist()  # different scan parameter values used
+                        scan_parameter_values = np.unique(scan_parameters[parameters]).tolist()  # different scan parameter values used
                     except ValueError:  # the scan parameter does not exists
                         pass
-            except tb.NoSuchNodeError:  # scan parameter table does not exist
-                try:
-                    scan_parameters = get_scan_parameter(in_file_h5.root.meta_data[:])  # get the scan parameters from the meta data
-                    if scan_parameters:
-                        try:
-                            scan_parameter_values = np.unique(scan_parameters[parameters]).tolist()  # different scan parameter values used
-                        except ValueError:  # the scan parameter does not exists
-                            pass
-                except tb.NoSuchNodeError:  # meta data table does not exist
-                    pass
-            if not scan_parameter_values:  # if no scan parameter values could be set from file take the parameter found in the file name
-                try:
-                    scan_parameter_values = parameter_values_from_file_names_dict[file_name]
-                except KeyError:  # no scan parameter found at all, neither in the file name nor in the file
-                    scan_parameter_values = None
-            else:  # use the parameter given in the file and cross check if it matches the file name parameter if these is given
-                try:
-                    for key, value in scan_parameter_values.items():
-                        if value and value[0] != parameter_values_from_file_names_dict[file_name][key][0]:  # parameter value exists: check if the first value is the file name value
-                            logging.warning('Parameter values in the file name and in the file differ. Take ' + str(key) + ' parameters ' + str(value) + ' found in %s.', file_name)
-                except KeyError:  # parameter does not exists in the file name
-                    pass
-                except IndexError:
-                    raise IncompleteInputError('Something wrong check!')
-            if unique and scan_parameter_values is not None:
-                existing = False
-                for parameter in scan_parameter_values:  # loop to determine if any value of any scan parameter exists already
-                    all_par_values = [values[parameter] for values in files_dict.values()]
-                    if any(x in [scan_parameter_values[parameter]] for x in all_par_values):
-                        existing = True
-                        break
-                if not existing:
-                    files_dict[file_name] = scan_parameter_values
-                else:
-                    logging.warning('Scan parameter value(s) from %s exists already, do not add to result', file_name)
-            else:
+        if not scan_parameter_values:  # if no scan parameter values could be set from file take the parameter found in the file name
+            try:
+                scan_parameter_values = parameter_values_from_file_names_dict[file_name]
+            except KeyError:  # no scan parameter found at all, neither in the file name nor in the file
+                scan_parameter_values = None
+        else:  # use the parameter given in the file and cross check if it matches the file name parameter if these is given
+            try:
+                for key, value in scan_parameter_values.items():
+                    if value and value[0] != parameter_values_from_file_names_dict[file_name][key][0]:  # parameter value exists: check if the first value is the file name value
+                        logging.warning('Parameter values in the file name and in the file differ. Take ' + str(key) + ' parameters ' + str(value) + ' found in %s.', file_name)
+            except KeyError:  # parameter does not exists in the file name
+                pass
+            except IndexError:
+                raise IncompleteInputError('Something wrong check!')
+        if unique and scan_parameter_values is not None:
+            existing = False
+            for parameter in scan_parameter_values:  # loop to determine if any value of any scan parameter exists already
+                all_par_values = [values[parameter] for values in files_dict.values()]
+                if any(x in [scan_parameter_values[parameter]] for x in all_par_values):
+                    existing = True
+                    break
+            if not existing:
                 files_dict[file_name] = scan_parameter_values
+            else:
+                logging.warning('Scan parameter value(s) from %s exists already, do not add to result', file_name)
+        else:
+            files_dict[file_name] = scan_parameter_values
     return collections.OrderedDict(sorted(files_dict.iteritems(), key=itemgetter(1)) if sort else files_dict)
 
 
@@ -572,7 +674,7 @@ def check_parameter_similarity(files_dict):
     return True
 
 
-def combine_meta_data(files_dict, meta_data_v2=True):
+def combine_meta_data(files_dict, meta_data_v2=True, use_file_info_cache=False):
     """
     Takes the dict of hdf5 files and combines their meta data tables into one new numpy record array.
 
@@ -580,14 +682,15 @@ def combine_meta_data(files_dict, meta_data_v2=True):
     ----------
     meta_data_v2 : bool
         True for new (v2) meta data format, False for the old (v1) format.
+    use_file_info_cache : bool
+        If True, the table sizes are taken from the file info cache (see get_file_info).
     """
     if len(files_dict) > 10:
         logging.info("Combine the meta data from %d files", len(files_dict))
     # determine total length needed for the new combined array, thats the fastest way to combine arrays
     total_length = 0  # the total length of the new table
-    for file_name in files_dict.iterkeys():
-        with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
-            total_length += in_file_h5.root.meta_data.shape[0]
+    for file_info in get_file_info(files_dict.keys(), use_cache=use_file_info_cache).itervalues():
+        total_length += file_info['n_meta_data']
 
     if meta_data_v2:
         meta_data_combined = np.empty((total_length, ), dtype=[
@@ -1155,6 +1258,71 @@ def index_event_number(table_with_event_numer):
         table_with_event_numer.cols.event_number.create_csindex(filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))  # this takes time (1 min. ~ 150. Mio entries) but immediately pays off
     else:
         logging.debug('Event_number index exists already, omit creation')
+    if get_event_index(table_with_event_numer) is None:
+        create_event_index(table_with_event_numer)
+
+
+def create_event_index(table, step=None):
+    '''Creates a compact event number index and stores it in the attributes of the table.
+
+    The index contains the event number of every step-th row. The index is only valid as long as no rows are added to the table.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data with sorted event_number column.
+    step : int
+        Number of rows between two index entries. If None, the step is chosen to limit the index size to 4096 entries.
+    '''
+    if step is None:
+        step = max(10000, int(np.ceil(table.nrows / 4096)))
+    event_index = table.read(start=0, stop=table.nrows, step=step, field='event_number').astype(np.int64)
+    table.attrs.event_index = event_index
+    table.attrs.event_index_step = step
+    table.attrs.event_index_nrows = table.nrows
+
+
+def get_event_index(table):
+    '''Returns the event number index and step of the index created by create_event_index(). Returns None if the index does not exist or is outdated.
+    '''
+    try:
+        if table.attrs.event_index_nrows != table.nrows:
+            return None
+        return table.attrs.event_index, table.attrs.event_index_step
+    except AttributeError:
+        return None
+
+
+def get_event_index_row(table, event_number, start_index=0, stop_index=None, event_index=None):
+    '''Returns the index of the first row with an event number equal or larger than event_number (equivalent to numpy.searchsorted with side left).
+
+    Only up to one step of the event number column is read when the event number index is available.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data with sorted event_number column.
+    event_number : int
+        The event number.
+    start_index, stop_index : int
+        The returned index is limited to the given range.
+    event_index : tuple
+        Event number index and step returned by get_event_index(). If None, the index is read from the table.
+    '''
+    stop_index = table.nrows if stop_index is None else stop_index
+    if event_index is None:
+        event_index = get_event_index(table)
+    if event_index is None:
+        raise InvalidInputError('Event number index not available')
+    event_numbers, step = event_index
+    index = np.searchsorted(event_numbers, event_number, side='left')
+    if index == 0:
+        row = 0
+    else:
+        block_start = (index - 1) * step
+        block_stop = min(index * step, table.nrows)
+        row = block_start + np.searchsorted(table.read(start=block_start, stop=block_stop, field='event_number'), event_number, side='left')
+    return min(max(row, start_index), stop_index)
 
 
 def data_aligned_at_events(table, start_event_number=None, stop_event_number=None, start_index=None, stop_index=None, chunk_size=10000000, try_speedup=False, first_event_aligned=True, fail_on_missing_events=True):
@@ -1163,6 +1331,7 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     Also the start and the stop indices limiting the table size can be specified to improve performance.
     The event_number column must be sorted.
     In case of try_speedup is True, it is important to create an index of event_number column with pytables before using this function. Otherwise the queries are slowed down.
+    If the table has an event number index (see create_event_index()), the index is used to find the start and stop event number.
 
     Parameters
     ----------
@@ -1216,8 +1385,22 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     if stop_event_number is not None and start_event_number is not None and stop_event_number < start_event_number:
         raise InvalidInputError('Invalid start/stop event number')
 
+    event_index = get_event_index(table)
+
     # set start stop indices from the event numbers for fast read if possible; not possible if the given event number does not exist in the data stream
-    if try_speedup and table.colindexed["event_number"]:
+    if try_speedup and event_index is not None:
+        if start_event_number is not None:
+            start_row = get_event_index_row(table, start_event_number, start_index=start_index, stop_index=stop_index, event_index=event_index)
+            if start_row < stop_index and table.read(start=start_row, stop=start_row + 1, field='event_number')[0] == start_event_number:  # set start index if possible
+                start_index = start_row
+                start_index_known = True
+
+        if stop_event_number is not None:
+            stop_row = get_event_index_row(table, stop_event_number, start_index=start_index, stop_index=stop_index, event_index=event_index)
+            if stop_row < stop_index and table.read(start=stop_row, stop=stop_row + 1, field='event_number')[0] == stop_event_number:  # set the stop index if possible, stop index is excluded
+                stop_index = stop_row
+                stop_index_known = True
+    elif try_speedup and table.colindexed["event_number"]:
         if start_event_number is not None:
             start_condition = 'event_number==' + str(start_event_number)
             start_indices = table.get_where_list(start_condition, start=start_index, stop=stop_index)
@@ -1239,6 +1422,9 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
         # search for begin
         current_start_index = start_index
         if start_event_number is not None:
+            if event_index is not None:  # skip all chunks before the chunk with the start event number
+                start_row = get_event_index_row(table, start_event_number, start_index=start_index, stop_index=stop_index, event_index=event_index)
+                current_start_index = start_index + ((start_row - start_index) // chunk_size) * chunk_size
             while current_start_index < stop_index:
                 current_stop_index = min(current_start_index + chunk_size, stop_index)
                 array_chunk = table.read(start=current_start_index, stop=current_stop_index)  # stop index is exclusive, so add 1
@@ -1428,6 +1614,115 @@ def get_pixel_thresholds_from_calibration_array(gdacs, calibration_gdacs, thresh
     return interpolation(gdacs)
 
 
+class TdcChargeCalibration(object):
+    '''Per pixel charge calibration of the TDC values. The charge is calculated from the TDC calibration of each pixel by piecewise linear interpolation.
+    The interpolation of all pixels is done at once by a sorted search of the calibration points, the TDC values outside of the calibration range return a charge of 0.
+
+    Parameters
+    ----------
+    tdc_pixel_calibration : numpy.array, shape=(80,336,# of calibration points)
+        The mean TDC value of each pixel at each calibration point. Not finite values are ignored.
+    tdc_calibration_values : array like
+        The calibration values (e.g. PlsrDAC) of the calibration points.
+    min_valid_points : int
+        The minimum number of valid calibration points. Pixels with less calibration points return a charge of 0.
+    '''
+    def __init__(self, tdc_pixel_calibration, tdc_calibration_values, min_valid_points=1):
+        tdc_pixel_calibration = np.asarray(tdc_pixel_calibration, dtype=np.float64)
+        tdc_calibration_values = np.asarray(tdc_calibration_values, dtype=np.float64)
+        if tdc_pixel_calibration.shape[2] != tdc_calibration_values.shape[0]:
+            raise ValueError('Length of the provided calibration values does not match the third dimension of the calibration array')
+        self.shape = tdc_pixel_calibration.shape[:2]
+        pixel_calibration = tdc_pixel_calibration.reshape(-1, tdc_pixel_calibration.shape[2])
+        valid_points = np.isfinite(pixel_calibration)
+        self.valid_pixels = np.logical_and(np.count_nonzero(pixel_calibration != 0, axis=1) >= min_valid_points, np.count_nonzero(valid_points, axis=1) >= min_valid_points)
+        valid_points &= self.valid_pixels[:, np.newaxis]
+        # Sort the calibration points of each pixel, invalid points are moved to the end
+        order = np.argsort(np.where(valid_points, pixel_calibration, np.inf), axis=1, kind='mergesort')
+        pixel_index = np.arange(pixel_calibration.shape[0])[:, np.newaxis]
+        valid_points = valid_points[pixel_index, order]
+        self.x = pixel_calibration[pixel_index, order][valid_points]  # calibration points of all pixels, pixel after pixel
+        self.y = tdc_calibration_values[order][valid_points]
+        self.n_points = np.count_nonzero(valid_points, axis=1)
+        self.first_point = np.cumsum(self.n_points) - self.n_points
+        # Search keys: calibration points shifted by the pixel index, the keys increase monotonically over all pixels
+        self.x_min = self.x.min() if self.x.shape[0] else 0.0
+        self.x_span = self.x.max() - self.x_min + 1.0 if self.x.shape[0] else 1.0
+        self.keys = self.x - self.x_min + np.repeat(np.arange(pixel_calibration.shape[0]), self.n_points) * self.x_span
+        self.valid_pixels = self.valid_pixels.reshape(self.shape)
+
+    def get_charge(self, column_index, row_index, tdc, dtype=np.float64):
+        '''Returns the charge of each hit (lazy lookup without creating the full calibration array).
+
+        Parameters
+        ----------
+        column_index, row_index : array like
+            The column and row index (starting at 0) of the hits.
+        tdc : array like
+            The TDC value of the hits.
+        dtype : numpy.dtype
+            The data type of the returned charge.
+
+        Returns
+        -------
+        numpy.array
+            The charge in units of the calibration values. 0 if the TDC value is outside the calibration range.
+        '''
+        pixel = np.ravel_multi_index((np.asarray(column_index), np.asarray(row_index)), self.shape)
+        tdc = np.asarray(tdc, dtype=np.float64)
+        pixel, tdc = np.broadcast_arrays(pixel, tdc)
+        charge = np.zeros(shape=tdc.shape, dtype=dtype)
+        # Select the hits of pixels with at least 2 calibration points
+        hit_index = np.nonzero(self.n_points[pixel] >= 2)
+        pixel, tdc = pixel[hit_index], tdc[hit_index]
+        first_point, last_point = self.first_point[pixel], self.first_point[pixel] + self.n_points[pixel] - 1
+        # Select the hits within the calibration range
+        in_range = np.logical_and(tdc >= self.x[first_point], tdc <= self.x[last_point])
+        hit_index = tuple(index[in_range] for index in hit_index)
+        pixel, tdc, first_point, last_point = pixel[in_range], tdc[in_range], first_point[in_range], last_point[in_range]
+        # Find the calibration interval of each hit
+        point = np.searchsorted(self.keys, tdc - self.x_min + pixel * self.x_span, side='right') - 1
+        point = np.clip(point, first_point, last_point - 1)
+        x_0, x_1, y_0, y_1 = self.x[point], self.x[point + 1], self.y[point], self.y[point + 1]
+        slope = np.zeros_like(tdc)
+        selection = x_1 != x_0
+        slope[selection] = (y_1[selection] - y_0[selection]) / (x_1[selection] - x_0[selection])
+        charge[hit_index] = y_0 + (tdc - x_0) * slope
+        return charge
+
+    def get_charge_calibration(self, max_tdc, dtype=np.float64):
+        '''Returns the charge of each pixel for the TDC values from 0 to max_tdc.
+
+        Parameters
+        ----------
+        max_tdc : int
+            The number of TDC values.
+        dtype : numpy.dtype
+            The data type of the calibration array, e.g. np.float32 to reduce the memory consumption.
+
+        Returns
+        -------
+        numpy.array, shape=(80,336,max_tdc)
+            The charge in units of the calibration values.
+        '''
+        charge_calibration = np.zeros(shape=self.shape + (max_tdc, ), dtype=dtype)
+        row_index, tdc = np.meshgrid(np.arange(self.shape[1]), np.arange(max_tdc), indexing='ij')
+        for column in range(self.shape[0]):  # column by column to limit the memory consumption
+            if np.any(self.valid_pixels[column]):
+                charge_calibration[column] = self.get_charge(column, row_index, tdc, dtype=dtype)
+        return charge_calibration
+
+    def get_max_charge(self, max_tdc):
+        '''Returns the maximum charge of all pixels for the TDC values from 0 to max_tdc.
+        '''
+        # The maximum of the linear interpolation is at the TDC values next to a calibration point or at the TDC range limits
+        pixel = np.repeat(np.arange(self.n_points.shape[0]), self.n_points)
+        tdc = np.clip(np.concatenate((np.floor(self.x), np.ceil(self.x), np.zeros_like(self.x), np.full_like(self.x, max_tdc - 1))), 0, max_tdc - 1)
+        column_index, row_index = np.unravel_index(np.tile(pixel, 4), self.shape)
+        charge = self.get_charge(column_index, row_index, tdc)
+        return max(0.0, charge.max()) if charge.shape[0] else 0.0
+
+
 class ETA(progressbar.Timer):
     '''Progressbar widget which estimate the time of arrival for the progress bar via exponential moving average.
     '''
@@ -1504,16 +1799,147 @@ def get_data_statistics(interpreted_files):
 
 
 def fix_raw_data(raw_data, lsb_byte=None):
-    if not lsb_byte:
+    """Fixing raw data words which are shifted by one byte.
+
+    Each data word is shifted by 8 bits and the most significant byte of the previous data word is used as the new least significant byte.
+    The raw data array is modified in-place.
+
+    Parameters
+    ----------
+    raw_data : numpy.array
+        The raw data words (uint32).
+    lsb_byte : int
+        The least significant byte of the first data word. If None, the first data word is used and will be removed.
+
+    Returns
+    -------
+    Tuple of fixed raw data and least significant byte for the next data word.
+    """
+    if lsb_byte is None:
+        if not raw_data.shape[0]:
+            return raw_data, lsb_byte
         lsb_byte = np.right_shift(raw_data[0], 24)
         raw_data = raw_data[1:]
+    if not raw_data.shape[0]:
+        return raw_data, lsb_byte
+    msb_bytes = np.right_shift(raw_data, 24)
+    np.left_shift(raw_data, 8, out=raw_data)
+    raw_data[0] |= lsb_byte
+    raw_data[1:] |= msb_bytes[:-1]
+    return raw_data, msb_bytes[-1]
+
+
+def fix_raw_data_chunk(raw_data, word_index, bad_word_ranges, lsb_byte=None):
+    """Fixing the bad data words of a chunk of raw data.
+
+    The chunks have to be processed in consecutive order. The first data word of each bad data range is used to fix the following data word and will be removed.
+
+    Parameters
+    ----------
+    raw_data : numpy.array
+        The raw data words (uint32) of the chunk.
+    word_index : int
+        Index of the first data word of the chunk.
+    bad_word_ranges : numpy.array
+        Array with shape (n, 2) of sorted and non-overlapping start and stop indices (exclusive) of the bad data words.
+    lsb_byte : int
+        Least significant byte returned for the previous chunk.
+
+    Returns
+    -------
+    Tuple of fixed raw data and least significant byte for the next chunk.
+    """
+    word_stop = word_index + raw_data.shape[0]
+    bad_word_ranges = bad_word_ranges[(bad_word_ranges[:, 1] > word_index) & (bad_word_ranges[:, 0] < word_stop)]
+    if not bad_word_ranges.shape[0]:
+        return raw_data, None
+    range_starts = np.clip(bad_word_ranges[:, 0] - word_index, 0, raw_data.shape[0])
+    range_stops = np.clip(bad_word_ranges[:, 1] - word_index, 0, raw_data.shape[0])
+    is_bad = np.zeros(shape=(raw_data.shape[0] + 1,), dtype=np.int8)
+    np.add.at(is_bad, range_starts, 1)
+    np.add.at(is_bad, range_stops, -1)
+    is_bad = np.cumsum(is_bad[:-1]).astype(np.bool_)
+    # the first data word of a bad data range is removed, except the bad data range is continued from the previous chunk
+    is_removed = np.zeros(shape=(raw_data.shape[0],), dtype=np.bool_)
+    is_removed[range_starts[bad_word_ranges[:, 0] >= word_index]] = True
+    if bad_word_ranges[0, 0] < word_index and lsb_byte is None:
+        is_removed[0] = True
+    msb_bytes = np.right_shift(raw_data, 24)
+    fixed_raw_data = raw_data.copy()
+    fixed_raw_data[is_bad] = np.left_shift(raw_data[is_bad], 8)
+    fixed_raw_data[1:][is_bad[1:]] |= msb_bytes[:-1][is_bad[1:]]
+    if is_bad[0] and not is_removed[0]:
+        fixed_raw_data[0] |= lsb_byte
+    # bad data range is continued in the next chunk
+    if bad_word_ranges[-1, 1] > word_stop:
+        lsb_byte = msb_bytes[-1]
+    else:
+        lsb_byte = None
+    return fixed_raw_data[~is_removed], lsb_byte
+
+
+def get_bad_word_ranges(bad_word_ranges):
+    """Merging overlapping and adjacent ranges of bad data words.
+
+    Parameters
+    ----------
+    bad_word_ranges : iterable
+        Iterable of tuples with start and stop indices (exclusive) of bad data words.
 
-    for i in range(raw_data.shape[0]):
-        msb_bytes = np.left_shift(raw_data[i], 8)
-        new_word = np.bitwise_or(msb_bytes, lsb_byte)
-        lsb_byte = np.right_shift(raw_data[i], 24)
-        raw_data[i] = new_word
-    return raw_data, lsb_byte
+    Returns
+    -------
+    Array with shape (n, 2) of sorted and non-overlapping start and stop indices.
+    """
+    bad_word_ranges = np.array(sorted(bad_word_ranges), dtype=np.int64).reshape(-1, 2)
+    bad_word_ranges = bad_word_ranges[bad_word_ranges[:, 1] > bad_word_ranges[:, 0]]
+    if not bad_word_ranges.shape[0]:
+        return bad_word_ranges
+    max_stops = np.maximum.accumulate(bad_word_ranges[:, 1])
+    new_range = np.r_[True, bad_word_ranges[1:, 0] > max_stops[:-1]]
+    return np.column_stack((bad_word_ranges[new_range, 0], max_stops[np.r_[new_range[1:], True]]))
+
+
+def iter_readouts(raw_data_table, index_start, index_stop, chunk_size=1000000):
+    """Iterating over the readouts of the raw data. The raw data is read in chunks of multiple readouts to reduce the number of read calls.
+
+    Parameters
+    ----------
+    raw_data_table : pytables.array
+        The raw data.
+    index_start, index_stop : numpy.array
+        Start and stop indices of each readout from the meta data.
+    chunk_size : int
+        Approximate number of data words per read.
+
+    Returns
+    -------
+    Iterator of tuples
+        Readout index, start index, stop index and raw data of the readout. Stops at missing raw data.
+    """
+    n_readouts = index_start.shape[0]
+    readout_index = 0
+    while readout_index < n_readouts:
+        chunk_start = index_start[readout_index]
+        # readouts to be read at once, at least one readout
+        readout_stop_index = max(readout_index + 1, np.searchsorted(index_stop, chunk_start + chunk_size, side='right'))
+        chunk_stop = index_stop[readout_index:readout_stop_index].max()
+        try:
+            raw_data = raw_data_table.read(chunk_start, chunk_stop)
+        except tb.exceptions.HDF5ExtError:
+            if readout_stop_index - readout_index == 1:
+                return
+            # reading readouts one by one until raw data is missing
+            for index in range(readout_index, readout_stop_index):
+                try:
+                    raw_data = raw_data_table.read(index_start[index], index_stop[index])
+                except tb.exceptions.HDF5ExtError:
+                    return
+                yield index, index_start[index], index_stop[index], raw_data
+            readout_index = readout_stop_index
+            continue
+        for index in range(readout_index, readout_stop_index):
+            yield index, index_start[index], index_stop[index], raw_data[index_start[index] - chunk_start:index_stop[index] - chunk_start]
+        readout_index = readout_stop_index
 
 
 def contiguous_regions(condition):
@@ -1594,7 +2020,7 @@ def check_bad_data(raw_data, prepend_data_headers=None, trig_count=None):
         fe_dh_idx += (prepend_data_headers + 1)
         # for histogramming add trigger at index 0
         trigger_idx = np.r_[0, trigger_idx]
-        fe_dh_idx = np.r_[range(1, prepend_data_headers + 1), fe_dh_idx]
+        fe_dh_idx = np.r_[np.arange(1, prepend_data_headers + 1), fe_dh_idx]
 
     event_hist, bins = np.histogram(fe_dh_idx, trigger_idx)
     if consecutive_triggers is None and np.any(event_hist == 0):
@@ -1637,15 +2063,15 @@ def print_raw_data(raw_data, start_index=0, limit=200, flavor='fei4b', index_off
     """
     if not select:
         select = ['DH', 'TW', "AR", "VR", "SR", "DR", 'TDC', 'UNKNOWN FE WORD', 'UNKNOWN WORD']
-    total_words = 0
-    for index in range(start_index, raw_data.shape[0]):
-        dw = FEI4Record(raw_data[index], chip_flavor=flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode)
-        if dw in select:
-            print index + index_offset, '{0:12d} {1:08b} {2:08b} {3:08b} {4:08b}'.format(raw_data[index], (raw_data[index] & 0xFF000000) >> 24, (raw_data[index] & 0x00FF0000) >> 16, (raw_data[index] & 0x0000FF00) >> 8, (raw_data[index] & 0x000000FF) >> 0), dw
-            total_words += 1
-            if limit and total_words >= limit:
-                break
-    return total_words
+    records = decode_fei4_records(raw_data[start_index:], chip_flavor=flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode)
+    selected_record_types = [record_types.index(record_type.upper()) for record_type in select if record_type.upper() in record_types]
+    selected_indices = np.where(np.in1d(records['record_type'], selected_record_types))[0]
+    if limit:
+        selected_indices = selected_indices[:max(limit, 1)]  # at least one word is printed
+    for index in selected_indices:
+        word = records['word'][index]
+        print index + start_index + index_offset, '{0:12d} {1:08b} {2:08b} {3:08b} {4:08b}'.format(word, (word & 0xFF000000) >> 24, (word & 0x00FF0000) >> 16, (word & 0x0000FF00) >> 8, (word & 0x000000FF) >> 0), get_record_string(records[index], chip_flavor=flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode)
+    return selected_indices.shape[0]
 
 
 if __name__ == "__main__":
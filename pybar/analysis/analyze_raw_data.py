@@ -6,6 +6,7 @@ import warnings
 import os
 import multiprocessing as mp
 from functools import partial
+from collections import deque
 
 from matplotlib.backends.backend_pdf import PdfPages
 import tables as tb
@@ -25,8 +26,8 @@ from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 
 from pybar.analysis import analysis_utils
 from pybar.analysis.plotting import plotting
-from pybar.analysis.analysis_utils import check_bad_data, fix_raw_data, consecutive
-from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
+from pybar.analysis.analysis_utils import check_bad_data, fix_raw_data, fix_raw_data_chunk, get_bad_word_ranges, iter_readouts
+from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, is_address_record, is_value_record, logical_and, logical_or
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
@@ -52,11 +53,174 @@ def fit_scurve(scurve_data, PlsrDAC):  # data of some pixels to fit, has to be g
     return popt[1:3]
 
 
+def fit_scurves_vectorized(scurve_data, PlsrDAC, max_iterations=100, tolerance=1e-10):
+    '''Fits the S-curves of all pixels at once with a batched Levenberg-Marquardt algorithm.
+
+    The start values and the handling of failed fits are the same as in fit_scurve.
+
+    Parameters
+    ----------
+    scurve_data : numpy.ndarray
+        The occupancy with shape (number of pixels, number of PlsrDAC values).
+    PlsrDAC : array like
+        The increasing PlsrDAC values.
+    max_iterations : int
+        Maximum number of iterations.
+    tolerance : float
+        The fit of a pixel is finished if the relative change of chi2 is below tolerance.
+
+    Returns
+    -------
+    numpy.ndarray with shape (number of pixels, 2) containing the threshold and the noise.
+    '''
+    scurve_data = np.asarray(scurve_data, dtype=np.float64)
+    x = np.asarray(PlsrDAC, dtype=np.float64)
+    if x.shape[0] < 3:
+        raise analysis_utils.NotSupportedError('Less than 3 points found for S-curve fit.')
+    n_pixels = scurve_data.shape[0]
+    result = np.zeros(shape=(n_pixels, 2), dtype=np.float64)
+    # start values, see fit_scurve
+    index = np.argmax(np.diff(scurve_data, axis=1), axis=1)
+    masked_data = np.ma.array(scurve_data, mask=np.arange(x.shape[0])[np.newaxis, :] < index[:, np.newaxis])
+    max_occ = np.ma.median(masked_data, axis=1).filled(0.0)
+    selection = np.abs(max_occ) > 1e-08  # occupancy is zero or close to zero
+    if not np.any(selection):
+        return result
+    y = scurve_data[selection]
+    parameters = np.column_stack((max_occ[selection], x[index[selection]], np.full(y.shape[0], 2.5)))
+    with np.errstate(all='ignore'):  # diverging fits are set to zero
+        chi2 = np.sum((scurve(x[np.newaxis, :], parameters[:, 0:1], parameters[:, 1:2], parameters[:, 2:3]) - y) ** 2, axis=1)
+        damping = np.full(y.shape[0], 1e-3)
+        active = np.ones(y.shape[0], dtype=np.bool)
+        for _ in range(max_iterations):
+            active_indices = np.flatnonzero(active)
+            p, y_active = parameters[active_indices], y[active_indices]
+            z = (x[np.newaxis, :] - p[:, 1:2]) / (np.sqrt(2) * p[:, 2:3])
+            residuals = scurve(x[np.newaxis, :], p[:, 0:1], p[:, 1:2], p[:, 2:3]) - y_active
+            derivative = p[:, 0:1] / np.sqrt(np.pi) * np.exp(-z ** 2)  # d/dz of 0.5 * A * erf(z)
+            jacobian = np.dstack((0.5 * erf(z) + 0.5, -derivative / (np.sqrt(2) * p[:, 2:3]), -derivative * z / p[:, 2:3]))
+            jtj = np.einsum('ijk,ijl->ikl', jacobian, jacobian)
+            jtr = np.einsum('ijk,ij->ik', jacobian, residuals)
+            jtj[:, np.arange(3), np.arange(3)] *= (1.0 + damping[active_indices, np.newaxis])
+            jtj[:, np.arange(3), np.arange(3)] += 1e-12  # prevent singular matrix
+            step = np.linalg.solve(jtj, -jtr[:, :, np.newaxis])[:, :, 0]
+            new_p = p + step
+            new_chi2 = np.sum((scurve(x[np.newaxis, :], new_p[:, 0:1], new_p[:, 1:2], new_p[:, 2:3]) - y_active) ** 2, axis=1)
+            improved = np.logical_and(np.isfinite(new_chi2), new_chi2 <= chi2[active_indices])
+            converged = np.logical_and(improved, chi2[active_indices] - new_chi2 <= tolerance * chi2[active_indices])
+            parameters[active_indices[improved]] = new_p[improved]
+            chi2[active_indices[improved]] = new_chi2[improved]
+            damping[active_indices] = np.where(improved, damping[active_indices] / 10.0, damping[active_indices] * 10.0)
+            active[active_indices[np.logical_or(converged, damping[active_indices] > 1e10)]] = False
+            if not np.any(active):
+                break
+    fit_result = parameters[:, 1:3]
+    fit_result[np.logical_or(active, ~np.all(np.isfinite(fit_result), axis=1))] = 0.0  # fit failed, not converged
+    fit_result[fit_result[:, 0] < 0] = 0.0  # threshold < 0 rarely happens if fit does not work
+    result[selection] = fit_result
+    return result
+
+
+def set_saturated_pixels_occupancy(occupancy_array, saturated_pixels, PlsrDAC, n_injections):
+    '''Sets the occupancy of the pixels which were not injected anymore during the adaptive threshold scan to the number of injections.
+
+    Parameters
+    ----------
+    occupancy_array : numpy.ndarray
+        The occupancy with shape (336, 80, number of PlsrDAC values). The array is changed in place.
+    saturated_pixels : numpy.ndarray
+        The PlsrDAC value from which on the pixel was not injected anymore (-1: always injected) with shape (80, 336).
+    PlsrDAC : array like
+        The PlsrDAC value of each scan parameter index of the occupancy.
+    n_injections : int
+        The number of injections.
+    '''
+    saturated_pixels = np.swapaxes(saturated_pixels, 0, 1)  # swap axis col,row --> row, col
+    for index, plsr_dac in enumerate(PlsrDAC[:occupancy_array.shape[2]]):
+        occupancy_array[np.logical_and(saturated_pixels >= 0, saturated_pixels <= plsr_dac), index] = n_injections
+
+
+def interpret_raw_data_chunk(raw_data_file, word_start, word_stop, meta_data, settings):  # has to be global for the multiprocessing module
+    '''Interprets the raw data words from word_start to word_stop of one raw data file with an independent interpreter.
+
+    Parameters
+    ----------
+    raw_data_file : string
+        The file name of the raw data file.
+    word_start, word_stop : int
+        The raw data word range. The first word has to be the first word of an event.
+    meta_data : numpy.ndarray
+        The meta data of all read outs of the word range. The indices are relative to word_start.
+    settings : dict
+        The interpreter settings (AnalyzeRawData property names and values).
+
+    Returns
+    -------
+    Dictionary with the hits, the meta event index and the interpreter counters.
+    '''
+    with AnalyzeRawData() as analyze_raw_data:
+        for name, value in settings.iteritems():
+            setattr(analyze_raw_data, name, value)
+        interpreter = analyze_raw_data.interpreter
+        interpreter.set_meta_data(meta_data)
+        meta_event_index = np.zeros((meta_data.shape[0],), dtype=[('metaEventIndex', np.uint64)])
+        interpreter.set_meta_event_data(meta_event_index)
+        hits = []
+        with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+            for word_index in range(word_start, word_stop, analyze_raw_data.chunk_size):
+                raw_data = in_file_h5.root.raw_data.read(word_index, min(word_index + analyze_raw_data.chunk_size, word_stop))
+                interpreter.interpret_raw_data(raw_data)
+                if word_index + analyze_raw_data.chunk_size >= word_stop:  # the first word of the next chunk would close the last event
+                    interpreter.store_event()
+                hits.append(interpreter.get_hits().copy())
+        return {
+            'hits': np.concatenate(hits),
+            'meta_event_index': meta_event_index,
+            'n_meta_data_event': interpreter.get_n_meta_data_event(),
+            'n_events': interpreter.get_n_events(),
+            'service_records_counters': interpreter.get_service_records_counters().copy(),
+            'tdc_counters': interpreter.get_tdc_counters().copy(),
+            'error_counters': interpreter.get_error_counters().copy(),
+            'trigger_error_counters': interpreter.get_trigger_error_counters().copy()}
+
+
+class InterpreterResults(object):
+
+    """Sums up the interpreter counters of several interpreter runs, provides the getters of PyDataInterpreter"""
+
+    def __init__(self, meta_table_v2):
+        self.meta_table_v2 = meta_table_v2
+        self.n_meta_data_event = 0
+        self.counters = {}
+
+    def add(self, result):
+        for name in ('service_records_counters', 'tdc_counters', 'error_counters', 'trigger_error_counters'):
+            if name in self.counters:
+                self.counters[name] += result[name]
+            else:
+                self.counters[name] = result[name].copy()
+
+    def get_n_meta_data_event(self):
+        return self.n_meta_data_event
+
+    def get_service_records_counters(self):
+        return self.counters['service_records_counters']
+
+    def get_tdc_counters(self):
+        return self.counters['tdc_counters']
+
+    def get_error_counters(self):
+        return self.counters['error_counters']
+
+    def get_trigger_error_counters(self):
+        return self.counters['trigger_error_counters']
+
+
 class AnalyzeRawData(object):
 
     """A class to analyze FE-I4 raw data"""
 
-    def __init__(self, raw_data_file=None, analyzed_data_file=None, create_pdf=True, scan_parameter_name=None):
+    def __init__(self, raw_data_file=None, analyzed_data_file=None, create_pdf=True, scan_parameter_name=None, use_file_info_cache=False):
         '''Initialize the AnalyzeRawData object:
             - The c++ objects (Interpreter, Histogrammer, Clusterizer) are constructed
             - Create one scan parameter table from all provided raw data files
@@ -77,7 +241,11 @@ class AnalyzeRawData(object):
         scan_parameter_name : string or iterable
             The name/names of scan parameter(s) to be used during analysis. If None, the scan parameter
             table is used to extract the scan parameters. Otherwise no scan parameter is set.
+        use_file_info_cache : boolean
+            If True, the meta information of the raw data files is cached in a sidecar file in the data folder (see analysis_utils.get_file_info)
+            and unchanged files are not opened again to get their meta data and scan parameters.
         '''
+        self.use_file_info_cache = use_file_info_cache
         self.interpreter = PyDataInterpreter()
         self.histogram = PyDataHistograming()
 
@@ -85,7 +253,7 @@ class AnalyzeRawData(object):
         if isinstance(raw_data_file, basestring):
             # normalize path
             raw_data_file = os.path.abspath(raw_data_file)
-            f_list = analysis_utils.get_data_file_names_from_scan_base(raw_data_file, sort_by_time=True, meta_data_v2=self.interpreter.meta_table_v2)
+            f_list = analysis_utils.get_data_file_names_from_scan_base(raw_data_file, sort_by_time=True, meta_data_v2=self.interpreter.meta_table_v2, use_file_info_cache=self.use_file_info_cache)
             if f_list:
                 raw_data_files = f_list
             else:
@@ -129,10 +297,10 @@ class AnalyzeRawData(object):
 
         # create a scan parameter table from all raw data files
         if raw_data_files is not None:
-            self.files_dict = analysis_utils.get_parameter_from_files(raw_data_files, parameters=scan_parameter_name)
+            self.files_dict = analysis_utils.get_parameter_from_files(raw_data_files, parameters=scan_parameter_name, use_file_info_cache=self.use_file_info_cache)
             if not analysis_utils.check_parameter_similarity(self.files_dict):
                 raise analysis_utils.NotSupportedError('Different scan parameters in multiple files are not supported.')
-            self.scan_parameters = analysis_utils.create_parameter_table(self.files_dict)
+            self.scan_parameters = analysis_utils.create_parameter_table(self.files_dict, use_file_info_cache=self.use_file_info_cache)
             scan_parameter_names = analysis_utils.get_scan_parameter_names(self.scan_parameters)
             logging.info('Scan parameter(s) from raw data file(s): %s', (', ').join(scan_parameter_names) if scan_parameter_names else 'None',)
         else:
@@ -269,6 +437,7 @@ class AnalyzeRawData(object):
         self._setup_clusterizer()
         self.chunk_size = 3000000
         self.n_injections = None
+        self.saturated_pixels = None  # PlsrDAC value from which on the pixel was not injected anymore (adaptive threshold scan)
         self.trig_count = 0  # 0 trig_count = 16 BCID per trigger
         self.max_tot_value = 13
         self.vcal_c0, self.vcal_c1 = None, None
@@ -299,6 +468,7 @@ class AnalyzeRawData(object):
         self.create_threshold_mask = True  # Threshold/noise histogram mask: masking all pixels out of bounds
         self.create_fitted_threshold_mask = True  # Fitted threshold/noise histogram mask: masking all pixels out of bounds
         self.create_fitted_threshold_hists = False
+        self.vectorized_scurve_fit = True  # fit all S-curves at once, False: fit each pixel with scipy curve_fit in a multiprocessing pool
         self.create_cluster_hit_table = False
         self.create_cluster_table = False
         self.create_cluster_size_hist = False
@@ -310,6 +480,7 @@ class AnalyzeRawData(object):
         self.max_tdc_delay = 255
         self.max_trigger_number = 2 ** 16 - 1
         self.set_stop_mode = False  # The FE is read out with stop mode, therefore the BCID plot is different
+        self.n_workers = 1  # number of processes used for the raw data interpretation, None: number of CPU cores
 
     def reset(self):
         '''Reset the c++ libraries for new analysis.
@@ -446,6 +617,14 @@ class AnalyzeRawData(object):
     def create_fitted_threshold_hists(self, value):
         self._create_fitted_threshold_hists = value
 
+    @property
+    def vectorized_scurve_fit(self):
+        return self._vectorized_scurve_fit
+
+    @vectorized_scurve_fit.setter
+    def vectorized_scurve_fit(self, value):
+        self._vectorized_scurve_fit = value
+
     @property
     def correct_corrupted_data(self):
         return self._correct_corrupted_data
@@ -640,9 +819,20 @@ class AnalyzeRawData(object):
     def set_stop_mode(self, value):
         self._set_stop_mode = value
 
+    @property
+    def n_workers(self):
+        """Get the number of worker processes used for the raw data interpretation."""
+        return self._n_workers
+
+    @n_workers.setter
+    def n_workers(self, value):
+        """Set the number of worker processes used for the raw data interpretation. 1 disables the parallel interpretation, None uses all CPU cores."""
+        self._n_workers = mp.cpu_count() if value is None else value
+
     def interpret_word_table(self, analyzed_data_file=None, use_settings_from_file=True, fei4b=None):
         '''Interprets the raw data word table of all given raw data files with the c++ library.
-        Creates the h5 output file and PDF plots.
+        Creates the h5 output file and PDF plots. If n_workers is not 1, the raw data is split at event boundaries
+        and interpreted in n_workers processes, the hits are histogrammed and clustered in order.
 
         Parameters
         ----------
@@ -663,7 +853,7 @@ class AnalyzeRawData(object):
         self.interpreter.reset_event_variables()
         self.interpreter.reset_counters()
 
-        self.meta_data = analysis_utils.combine_meta_data(self.files_dict, meta_data_v2=self.interpreter.meta_table_v2)
+        self.meta_data = analysis_utils.combine_meta_data(self.files_dict, meta_data_v2=self.interpreter.meta_table_v2, use_file_info_cache=self.use_file_info_cache)
 
         if self.meta_data is None or self.meta_data.shape[0] == 0:
             raise analysis_utils.IncompleteInputError('Meta data is empty. Stopping interpretation.')
@@ -711,6 +901,7 @@ class AnalyzeRawData(object):
         else:
             self._analyzed_data_file is None
 
+        hit_table, meta_word_index_table, cluster_table, cluster_hit_table = None, None, None, None
         if self._analyzed_data_file is not None:
             if self._create_hit_table is True:
                 description = data_struct.HitInfoTable().columns.copy()
@@ -724,192 +915,160 @@ class AnalyzeRawData(object):
                 cluster_hit_table = self.out_file_h5.create_table(self.out_file_h5.root, name='ClusterHits', description=description, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
 
         logging.info("Interpreting raw data...")
-        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=analysis_utils.get_total_n_data_words(self.files_dict), term_width=80)
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=analysis_utils.get_total_n_data_words(self.files_dict, use_file_info_cache=self.use_file_info_cache), term_width=80)
         progress_bar.start()
         total_words = 0
 
-        for file_index, raw_data_file in enumerate(self.files_dict.keys()):  # loop over all raw data files
-            self.interpreter.reset_meta_data_counter()
-            with tb.open_file(raw_data_file, mode="r") as in_file_h5:
-                if use_settings_from_file:
-                    self._deduce_settings_from_file(in_file_h5)
-                else:
-                    self.fei4b = fei4b
-                if self.interpreter.meta_table_v2:
-                    index_start = in_file_h5.root.meta_data.read(field='index_start')
-                    index_stop = in_file_h5.root.meta_data.read(field='index_stop')
-                else:
-                    index_start = in_file_h5.root.meta_data.read(field='start_index')
-                    index_stop = in_file_h5.root.meta_data.read(field='stop_index')
-                bad_word_index = set()
-
-                # Check for bad data
-                if self._correct_corrupted_data:
-                    tw = 2147483648  # trigger word
-                    dh = 15269888  # data header
-                    is_fe_data_header = logical_and(is_fe_word, is_data_header)
-                    found_first_trigger = False
-                    readout_slices = np.column_stack((index_start, index_stop))
-                    previous_prepend_data_headers = None
-                    prepend_data_headers = None
-                    last_good_readout_index = None
-                    last_index_with_event_data = None
-                    for read_out_index, (index_start, index_stop) in enumerate(readout_slices):
-                        try:
-                            raw_data = in_file_h5.root.raw_data.read(index_start, index_stop)
-                        except OverflowError, e:
-                            pass
-                        except tb.exceptions.HDF5ExtError:
-                            break
-                        # previous data chunk had bad data, check for good data
-                        if (index_start - 1) in bad_word_index:
-                            bad_data, current_prepend_data_headers, _ , _ = check_bad_data(raw_data, prepend_data_headers=1, trig_count=None)
-                            if bad_data:
-                                bad_word_index = bad_word_index.union(range(index_start, index_stop))
+        tasks = self._get_interpretation_tasks(use_settings_from_file=use_settings_from_file, fei4b=fei4b) if self._n_workers != 1 else None
+        if tasks is not None:
+            interpreter = self._interpret_tasks(tasks, progress_bar=progress_bar, hit_table=hit_table, cluster_table=cluster_table, cluster_hit_table=cluster_hit_table)
+        else:
+            interpreter = self.interpreter
+            for file_index, raw_data_file in enumerate(self.files_dict.keys()):  # loop over all raw data files
+                self.interpreter.reset_meta_data_counter()
+                with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+                    if use_settings_from_file:
+                        self._deduce_settings_from_file(in_file_h5)
+                    else:
+                        self.fei4b = fei4b
+                    if self.interpreter.meta_table_v2:
+                        index_start = in_file_h5.root.meta_data.read(field='index_start')
+                        index_stop = in_file_h5.root.meta_data.read(field='index_stop')
+                    else:
+                        index_start = in_file_h5.root.meta_data.read(field='start_index')
+                        index_stop = in_file_h5.root.meta_data.read(field='stop_index')
+                    bad_word_ranges = []  # start and stop index of bad data words
+
+                    # Check for bad data
+                    if self._correct_corrupted_data:
+                        tw = 2147483648  # trigger word
+                        dh = 15269888  # data header
+                        is_fe_data_header = logical_and(is_fe_word, is_data_header)
+                        found_first_trigger = False
+                        readout_slices = np.column_stack((index_start, index_stop))
+                        previous_prepend_data_headers = None
+                        prepend_data_headers = None
+                        last_good_readout_index = None
+                        last_index_with_event_data = None
+                        for read_out_index, index_start, index_stop, raw_data in iter_readouts(in_file_h5.root.raw_data, readout_slices[:, 0], readout_slices[:, 1], chunk_size=self._chunk_size):
+                            # previous data chunk had bad data, check for good data (ranges are appended in read out order, only the last one can end at the current read out)
+                            if bad_word_ranges and bad_word_ranges[-1][1] == index_start:
+                                bad_data, current_prepend_data_headers, _ , _ = check_bad_data(raw_data, prepend_data_headers=1, trig_count=None)
+                                if bad_data:
+                                    bad_word_ranges.append((index_start, index_stop))
+                                else:
+    #                                 logging.info("found good data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
+                                    if last_good_readout_index + 1 == read_out_index - 1:
+                                        logging.warning("found bad data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, readout_slices[last_good_readout_index][1], readout_slices[read_out_index - 1][1], last_good_readout_index + 1, (readout_slices[read_out_index - 1][1] - readout_slices[last_good_readout_index][1])))
+                                    else:
+                                        logging.warning("found bad data in %s from index %d to %d (chunk %d to %d, length %d)" % (in_file_h5.filename, readout_slices[last_good_readout_index][1], readout_slices[read_out_index - 1][1], last_good_readout_index + 1, read_out_index - 1, (readout_slices[read_out_index - 1][1] - readout_slices[last_good_readout_index][1])))
+                                    previous_good_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_good_readout_index][0], readout_slices[last_good_readout_index][1] - 1)
+                                    previous_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_good_readout_index][1] - 1, readout_slices[read_out_index - 1][1])
+                                    fixed_raw_data, _ = fix_raw_data(previous_bad_raw_data, lsb_byte=None)
+                                    fixed_raw_data = np.r_[previous_good_raw_data, fixed_raw_data, raw_data]
+                                    _, prepend_data_headers, n_triggers, n_dh = check_bad_data(fixed_raw_data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
+                                    last_good_readout_index = read_out_index
+                                    if n_triggers != 0 or n_dh != 0:
+                                        last_index_with_event_data = read_out_index
+                                        last_event_data_prepend_data_headers = prepend_data_headers
+                                    fixed_previous_raw_data = np.r_[previous_good_raw_data, fixed_raw_data]
+                                    _, previous_prepend_data_headers, _ , _ = check_bad_data(fixed_previous_raw_data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
+                            # check for bad data
                             else:
-#                                 logging.info("found good data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
-                                if last_good_readout_index + 1 == read_out_index - 1:
-                                    logging.warning("found bad data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, readout_slices[last_good_readout_index][1], readout_slices[read_out_index - 1][1], last_good_readout_index + 1, (readout_slices[read_out_index - 1][1] - readout_slices[last_good_readout_index][1])))
+                                # workaround for first data chunk, might have missing trigger in some rare cases (already fixed in firmware)
+                                if read_out_index == 0 and (np.any(is_trigger_word(raw_data) >= 1) or np.any(is_fe_data_header(raw_data) >= 1)):
+                                    bad_data, current_prepend_data_headers, n_triggers , n_dh = check_bad_data(raw_data, prepend_data_headers=1, trig_count=None)
+                                    # check for full last event in data
+                                    if current_prepend_data_headers == self.trig_count:
+                                        current_prepend_data_headers = None
+                                # usually check for bad data happens here
                                 else:
-                                    logging.warning("found bad data in %s from index %d to %d (chunk %d to %d, length %d)" % (in_file_h5.filename, readout_slices[last_good_readout_index][1], readout_slices[read_out_index - 1][1], last_good_readout_index + 1, read_out_index - 1, (readout_slices[read_out_index - 1][1] - readout_slices[last_good_readout_index][1])))
-                                previous_good_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_good_readout_index][0], readout_slices[last_good_readout_index][1] - 1)
-                                previous_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_good_readout_index][1] - 1, readout_slices[read_out_index - 1][1])
-                                fixed_raw_data, _ = fix_raw_data(previous_bad_raw_data, lsb_byte=None)
-                                fixed_raw_data = np.r_[previous_good_raw_data, fixed_raw_data, raw_data]
-                                _, prepend_data_headers, n_triggers, n_dh = check_bad_data(fixed_raw_data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
-                                last_good_readout_index = read_out_index
+                                    bad_data, current_prepend_data_headers, n_triggers , n_dh = check_bad_data(raw_data, prepend_data_headers=prepend_data_headers, trig_count=self.trig_count)
+
+                                # do additional check with follow up data chunk and decide whether current chunk is defect or not
+                                if bad_data:
+                                    if read_out_index == 0:
+                                        fixed_raw_data_chunk, _ = fix_raw_data(raw_data, lsb_byte=None)
+                                        fixed_raw_data_list = [fixed_raw_data_chunk]
+                                    else:
+                                        previous_raw_data = in_file_h5.root.raw_data.read(*readout_slices[read_out_index - 1])
+                                        raw_data_with_previous_data_word = np.r_[previous_raw_data[-1], raw_data]
+                                        fixed_raw_data_chunk, _ = fix_raw_data(raw_data_with_previous_data_word, lsb_byte=None)
+                                        fixed_raw_data = np.r_[previous_raw_data[:-1], fixed_raw_data_chunk]
+                                        # last data word of chunk before broken chunk migh be a trigger word or data header which cannot be recovered
+                                        fixed_raw_data_with_tw = np.r_[previous_raw_data[:-1], tw, fixed_raw_data_chunk]
+                                        fixed_raw_data_with_dh = np.r_[previous_raw_data[:-1], dh, fixed_raw_data_chunk]
+                                        fixed_raw_data_list = [fixed_raw_data, fixed_raw_data_with_tw, fixed_raw_data_with_dh]
+                                    bad_fixed_data, _, _ , _ = check_bad_data(fixed_raw_data_with_dh, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
+                                    bad_fixed_data = map(lambda data: check_bad_data(data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)[0], fixed_raw_data_list)
+                                    if not all(bad_fixed_data): # good fixed data
+                                        # last word in chunk before currrent chunk is also bad
+                                        # adding all word from current chunk
+                                        bad_word_ranges.append((max(0, index_start - 1), index_stop))
+                                        last_good_readout_index = read_out_index - 1
+                                    else:
+                                        # a previous chunk might be broken and the last data word becomes a trigger word, so do additional checks
+                                        if last_index_with_event_data and last_event_data_prepend_data_headers != read_out_index:
+                                            before_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data - 1][0], readout_slices[last_index_with_event_data - 1][1] - 1)
+                                            previous_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data][0] - 1, readout_slices[last_index_with_event_data][1])
+                                            fixed_raw_data, _ = fix_raw_data(previous_bad_raw_data, lsb_byte=None)
+                                            previous_good_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data][1], readout_slices[read_out_index - 1][1])
+                                            fixed_raw_data = np.r_[before_bad_raw_data, fixed_raw_data, previous_good_raw_data, raw_data]
+                                            bad_fixed_previous_data, current_prepend_data_headers, _, _ = check_bad_data(fixed_raw_data, prepend_data_headers=last_event_data_prepend_data_headers, trig_count=self.trig_count)
+                                            if not bad_fixed_previous_data:
+                                                logging.warning("found bad data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, readout_slices[last_index_with_event_data][0], readout_slices[last_index_with_event_data][1], last_index_with_event_data, (readout_slices[last_index_with_event_data][1] - readout_slices[last_index_with_event_data][0])))
+                                                bad_word_ranges.append((readout_slices[last_index_with_event_data][0] - 1, readout_slices[last_index_with_event_data][1]))
+                                            else:
+                                                logging.warning("found bad data which cannot be corrected in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
+                                        else:
+                                            logging.warning("found bad data which cannot be corrected in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
                                 if n_triggers != 0 or n_dh != 0:
                                     last_index_with_event_data = read_out_index
                                     last_event_data_prepend_data_headers = prepend_data_headers
-                                fixed_previous_raw_data = np.r_[previous_good_raw_data, fixed_raw_data]
-                                _, previous_prepend_data_headers, _ , _ = check_bad_data(fixed_previous_raw_data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
-                        # check for bad data
-                        else:
-                            # workaround for first data chunk, might have missing trigger in some rare cases (already fixed in firmware)
-                            if read_out_index == 0 and (np.any(is_trigger_word(raw_data) >= 1) or np.any(is_fe_data_header(raw_data) >= 1)):
-                                bad_data, current_prepend_data_headers, n_triggers , n_dh = check_bad_data(raw_data, prepend_data_headers=1, trig_count=None)
-                                # check for full last event in data
-                                if current_prepend_data_headers == self.trig_count:
-                                    current_prepend_data_headers = None
-                            # usually check for bad data happens here
-                            else:
-                                bad_data, current_prepend_data_headers, n_triggers , n_dh = check_bad_data(raw_data, prepend_data_headers=prepend_data_headers, trig_count=self.trig_count)
+                                if not bad_data or (bad_data and bad_fixed_data):
+                                    previous_prepend_data_headers = prepend_data_headers
+                                    prepend_data_headers = current_prepend_data_headers
 
-                            # do additional check with follow up data chunk and decide whether current chunk is defect or not
-                            if bad_data:
-                                if read_out_index == 0:
-                                    fixed_raw_data_chunk, _ = fix_raw_data(raw_data, lsb_byte=None)
-                                    fixed_raw_data_list = [fixed_raw_data_chunk]
-                                else:
-                                    previous_raw_data = in_file_h5.root.raw_data.read(*readout_slices[read_out_index - 1])
-                                    raw_data_with_previous_data_word = np.r_[previous_raw_data[-1], raw_data]
-                                    fixed_raw_data_chunk, _ = fix_raw_data(raw_data_with_previous_data_word, lsb_byte=None)
-                                    fixed_raw_data = np.r_[previous_raw_data[:-1], fixed_raw_data_chunk]
-                                    # last data word of chunk before broken chunk migh be a trigger word or data header which cannot be recovered
-                                    fixed_raw_data_with_tw = np.r_[previous_raw_data[:-1], tw, fixed_raw_data_chunk]
-                                    fixed_raw_data_with_dh = np.r_[previous_raw_data[:-1], dh, fixed_raw_data_chunk]
-                                    fixed_raw_data_list = [fixed_raw_data, fixed_raw_data_with_tw, fixed_raw_data_with_dh]
-                                bad_fixed_data, _, _ , _ = check_bad_data(fixed_raw_data_with_dh, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)
-                                bad_fixed_data = map(lambda data: check_bad_data(data, prepend_data_headers=previous_prepend_data_headers, trig_count=self.trig_count)[0], fixed_raw_data_list)
-                                if not all(bad_fixed_data): # good fixed data
-                                    # last word in chunk before currrent chunk is also bad
-                                    if index_start != 0:
-                                        bad_word_index.add(index_start - 1)
-                                    # adding all word from current chunk
-                                    bad_word_index = bad_word_index.union(range(index_start, index_stop))
-                                    last_good_readout_index = read_out_index - 1
-                                else:
-                                    # a previous chunk might be broken and the last data word becomes a trigger word, so do additional checks
-                                    if last_index_with_event_data and last_event_data_prepend_data_headers != read_out_index:
-                                        before_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data - 1][0], readout_slices[last_index_with_event_data - 1][1] - 1)
-                                        previous_bad_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data][0] - 1, readout_slices[last_index_with_event_data][1])
-                                        fixed_raw_data, _ = fix_raw_data(previous_bad_raw_data, lsb_byte=None)
-                                        previous_good_raw_data = in_file_h5.root.raw_data.read(readout_slices[last_index_with_event_data][1], readout_slices[read_out_index - 1][1])
-                                        fixed_raw_data = np.r_[before_bad_raw_data, fixed_raw_data, previous_good_raw_data, raw_data]
-                                        bad_fixed_previous_data, current_prepend_data_headers, _, _ = check_bad_data(fixed_raw_data, prepend_data_headers=last_event_data_prepend_data_headers, trig_count=self.trig_count)
-                                        if not bad_fixed_previous_data:
-                                            logging.warning("found bad data in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, readout_slices[last_index_with_event_data][0], readout_slices[last_index_with_event_data][1], last_index_with_event_data, (readout_slices[last_index_with_event_data][1] - readout_slices[last_index_with_event_data][0])))
-                                            bad_word_index = bad_word_index.union(range(readout_slices[last_index_with_event_data][0] - 1, readout_slices[last_index_with_event_data][1]))
-                                        else:
-                                            logging.warning("found bad data which cannot be corrected in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
-                                    else:
-                                        logging.warning("found bad data which cannot be corrected in %s from index %d to %d (chunk %d, length %d)" % (in_file_h5.filename, index_start, index_stop, read_out_index, (index_stop - index_start)))
-                            if n_triggers != 0 or n_dh != 0:
-                                last_index_with_event_data = read_out_index
-                                last_event_data_prepend_data_headers = prepend_data_headers
-                            if not bad_data or (bad_data and bad_fixed_data):
-                                previous_prepend_data_headers = prepend_data_headers
-                                prepend_data_headers = current_prepend_data_headers
-
-                    consecutive_bad_words_list = consecutive(sorted(bad_word_index))
-
-                lsb_byte = None
-                # Loop over raw data in chunks
-                for word_index in range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size):  # loop over all words in the actual raw data file
-                    try:
-                        raw_data = in_file_h5.root.raw_data.read(word_index, word_index + self._chunk_size)
-                    except OverflowError, e:
-                        logging.error('%s: 2^31 xrange() limitation in 32-bit Python', e)
-                    except tb.exceptions.HDF5ExtError:
-                        logging.warning('Raw data file %s has missing raw data. Continue raw data analysis.', in_file_h5.filename)
-                        break
-                    total_words += raw_data.shape[0]
-                    # fix bad data
-                    if self._correct_corrupted_data:
-                        # increase word shift for every bad data chunk in raw data chunk
-                        word_shift = 0
-                        chunk_indices = np.arange(word_index, word_index + self._chunk_size)
-                        for consecutive_bad_word_indices in consecutive_bad_words_list:
-                            selected_words = np.intersect1d(consecutive_bad_word_indices, chunk_indices, assume_unique=True)
-                            if selected_words.shape[0]:
-                                fixed_raw_data, lsb_byte = fix_raw_data(raw_data[selected_words - word_index - word_shift], lsb_byte=lsb_byte)
-                                raw_data = np.r_[raw_data[:selected_words[0] - word_index - word_shift], fixed_raw_data, raw_data[selected_words[-1] - word_index + 1 - word_shift:]]
-                                # check if last word of bad data chunk in current raw data chunk
-                                if consecutive_bad_word_indices[-1] in selected_words:
-                                    lsb_byte = None
-                                    # word shift by removing data word at the beginning of each defect chunk
-                                    word_shift += 1
-                                # bad data chunk is at the end of current raw data chunk
-                                else:
-                                    break
+                        bad_word_ranges = get_bad_word_ranges(bad_word_ranges)
 
-                    self.interpreter.interpret_raw_data(raw_data)  # interpret the raw data
-                    # store remaining buffered event in the interpreter at the end of the last file
-                    if file_index == len(self.files_dict.keys()) - 1 and word_index == range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size)[-1]:  # store hits of the latest event of the last file
-                        self.interpreter.store_event()
-                    hits = self.interpreter.get_hits()
-                    if self.scan_parameters is not None:
-                        nEventIndex = self.interpreter.get_n_meta_data_event()
-                        self.histogram.add_meta_event_index(self.meta_event_index, nEventIndex)
-                    if self.is_histogram_hits():
-                        self.histogram_hits(hits)
-                    if self.is_cluster_hits():
-                        cluster_hits, clusters = self.cluster_hits(hits)
-                        if self._create_cluster_hit_table:
-                            cluster_hit_table.append(cluster_hits)
-                        if self._create_cluster_table:
-                            cluster_table.append(clusters)
-                        if self._create_cluster_size_hist:
-                            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_size_hist.shape[0]:
-                                self._cluster_size_hist.resize(np.max(clusters['size']) + 1)
-                            self._cluster_size_hist += fast_analysis_utils.hist_1d_index(clusters['size'], shape=self._cluster_size_hist.shape)
-                        if self._create_cluster_tot_hist:
-                            if clusters['tot'].shape[0] > 0 and np.max(clusters['tot']) + 1 > self._cluster_tot_hist.shape[0]:
-                                self._cluster_tot_hist.resize((np.max(clusters['tot']) + 1, self._cluster_tot_hist.shape[1]))
-                            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_tot_hist.shape[1]:
-                                self._cluster_tot_hist.resize((self._cluster_tot_hist.shape[0], np.max(clusters['size']) + 1))
-                            self._cluster_tot_hist += fast_analysis_utils.hist_2d_index(clusters['tot'], clusters['size'], shape=self._cluster_tot_hist.shape)
-                    if self._analyzed_data_file is not None and self._create_hit_table:
-                        hit_table.append(hits)
-                    if self._analyzed_data_file is not None and self._create_meta_word_index:
-                        size = self.interpreter.get_n_meta_data_word()
-                        meta_word_index_table.append(meta_word[:size])
-
-                    if total_words <= progress_bar.maxval:  # Otherwise exception is thrown
-                        progress_bar.update(total_words)
-                    self.out_file_h5.flush()
+                    lsb_byte = None
+                    # Loop over raw data in chunks
+                    for word_index in range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size):  # loop over all words in the actual raw data file
+                        try:
+                            raw_data = in_file_h5.root.raw_data.read(word_index, word_index + self._chunk_size)
+                        except OverflowError, e:
+                            logging.error('%s: 2^31 xrange() limitation in 32-bit Python', e)
+                        except tb.exceptions.HDF5ExtError:
+                            logging.warning('Raw data file %s has missing raw data. Continue raw data analysis.', in_file_h5.filename)
+                            break
+                        total_words += raw_data.shape[0]
+                        # fix bad data
+                        if self._correct_corrupted_data:
+                            # the first data word of each bad data range is removed
+                            raw_data, lsb_byte = fix_raw_data_chunk(raw_data, word_index, bad_word_ranges, lsb_byte=lsb_byte)
+
+                        self.interpreter.interpret_raw_data(raw_data)  # interpret the raw data
+                        # store remaining buffered event in the interpreter at the end of the last file
+                        if file_index == len(self.files_dict.keys()) - 1 and word_index == range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size)[-1]:  # store hits of the latest event of the last file
+                            self.interpreter.store_event()
+                        hits = self.interpreter.get_hits()
+                        if self.scan_parameters is not None:
+                            nEventIndex = self.interpreter.get_n_meta_data_event()
+                            self.histogram.add_meta_event_index(self.meta_event_index, nEventIndex)
+                        self._store_hits(hits, hit_table=hit_table, cluster_table=cluster_table, cluster_hit_table=cluster_hit_table)
+                        if self._analyzed_data_file is not None and self._create_meta_word_index:
+                            size = self.interpreter.get_n_meta_data_word()
+                            meta_word_index_table.append(meta_word[:size])
+
+                        if total_words <= progress_bar.maxval:  # Otherwise exception is thrown
+                            progress_bar.update(total_words)
+                        self.out_file_h5.flush()
         progress_bar.finish()
-        self._create_additional_data()
+        # event number index for fast event selection, see analysis_utils.data_aligned_at_events()
+        for table in (hit_table, cluster_table, cluster_hit_table):
+            if table is not None:
+                analysis_utils.create_event_index(table)
+        self._create_additional_data(interpreter=interpreter)
 
         if close_analyzed_data_file:
             self.out_file_h5.close()
@@ -920,13 +1079,235 @@ class AnalyzeRawData(object):
         else:
             self._analyzed_data_file = None
 
-    def _create_additional_data(self):
+    def _store_hits(self, hits, hit_table=None, cluster_table=None, cluster_hit_table=None):
+        '''Histograms and clusters the interpreted hits and appends them to the given tables.
+        '''
+        if self.is_histogram_hits():
+            self.histogram_hits(hits)
+        if self.is_cluster_hits():
+            cluster_hits, clusters = self.cluster_hits(hits)
+            if self._create_cluster_hit_table:
+                cluster_hit_table.append(cluster_hits)
+            if self._create_cluster_table:
+                cluster_table.append(clusters)
+            if self._create_cluster_size_hist:
+                if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_size_hist.shape[0]:
+                    self._cluster_size_hist.resize(np.max(clusters['size']) + 1)
+                self._cluster_size_hist += fast_analysis_utils.hist_1d_index(clusters['size'], shape=self._cluster_size_hist.shape)
+            if self._create_cluster_tot_hist:
+                if clusters['tot'].shape[0] > 0 and np.max(clusters['tot']) + 1 > self._cluster_tot_hist.shape[0]:
+                    self._cluster_tot_hist.resize((np.max(clusters['tot']) + 1, self._cluster_tot_hist.shape[1]))
+                if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_tot_hist.shape[1]:
+                    self._cluster_tot_hist.resize((self._cluster_tot_hist.shape[0], np.max(clusters['size']) + 1))
+                self._cluster_tot_hist += fast_analysis_utils.hist_2d_index(clusters['tot'], clusters['size'], shape=self._cluster_tot_hist.shape)
+        if hit_table is not None:
+            hit_table.append(hits)
+
+    def _get_interpretation_tasks(self, use_settings_from_file=True, fei4b=None):
+        '''Splits the raw data of all raw data files into tasks that can be interpreted independently.
+
+        A task starts at a read out where the event building of the interpreter does not depend on the previous data words.
+        The first event word of the read out (address and value records are skipped) has to be:
+        - aligned at trigger: a trigger word with consecutive trigger number and the previous event is complete
+        - not aligned: the first data header of an event (trig_count data headers of the previous event with constant LVL1ID)
+          and no trigger word is in the data before
+        Each task has at least chunk_size words and never spans several raw data files.
+
+        Returns
+        -------
+        List of tuples (raw data file, word start, word stop, meta data row start, meta data row stop, number of read outs
+        belonging to the last event of the previous task, settings) or None if the raw data cannot be split.
+        '''
+        if self._correct_corrupted_data or self._create_meta_word_index or self._align_at_tdc:
+            logging.info('Parallel interpretation not supported with correct_corrupted_data, create_meta_word_index and align_at_tdc, interpreting raw data on one CPU core')
+            return None
+        index_start_name, index_stop_name = self.meta_data.dtype.names[:2]
+        readout_length = self.meta_data[index_stop_name].astype(np.int64) - self.meta_data[index_start_name].astype(np.int64)
+        boundaries = []
+        is_fe_data_header = logical_and(is_fe_word, is_data_header)
+        is_fe_record = logical_and(is_fe_word, logical_or(is_address_record, is_value_record))  # words without influence on the event building
+        # state of the event building at the end of the previous raw data chunk
+        last_trigger_number = None
+        n_data_header_since_trigger = 0
+        trigger_word_found = False
+        n_data_header = 0
+        data_header_lvl1id_tail = np.zeros(shape=(0, ), dtype=np.uint32)
+        meta_data_row = 0
+        for file_index, raw_data_file in enumerate(self.files_dict.keys()):
+            with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+                if use_settings_from_file:
+                    self._deduce_settings_from_file(in_file_h5)
+                else:
+                    self.fei4b = fei4b
+                n_readouts = in_file_h5.root.meta_data.shape[0]
+                readout_rows = np.arange(meta_data_row, meta_data_row + n_readouts)[readout_length[meta_data_row:meta_data_row + n_readouts] > 0]  # skip empty read outs
+                readout_starts = self.meta_data[index_start_name][readout_rows].astype(np.int64)
+                readout_stops = self.meta_data[index_stop_name][readout_rows].astype(np.int64)
+                if readout_rows.shape[0] == 0 or readout_starts[0] != 0:
+                    logging.info('Raw data file %s does not start with a read out, interpreting raw data on one CPU core', in_file_h5.filename)
+                    return None
+                file_settings = {'fei4b': self._fei4b, 'trig_count': self._trig_count, 'max_tot_value': self._max_tot_value, 'chunk_size': self._chunk_size, 'create_empty_event_hits': self._create_empty_event_hits,
+                                 'align_at_trigger': self._align_at_trigger, 'trigger_data_format': self._trigger_data_format, 'use_tdc_trigger_time_stamp': self._use_tdc_trigger_time_stamp, 'max_tdc_delay': self._max_tdc_delay, 'max_trigger_number': self._max_trigger_number}
+                file_boundaries = []
+                for word_index in range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size):
+                    try:
+                        raw_data = in_file_h5.root.raw_data.read(word_index, word_index + self._chunk_size)
+                    except tb.exceptions.HDF5ExtError:
+                        logging.info('Raw data file %s has missing raw data, interpreting raw data on one CPU core', in_file_h5.filename)
+                        return None
+                    selection = np.logical_and(readout_starts >= word_index, readout_starts < word_index + raw_data.shape[0])
+                    candidates = readout_starts[selection] - word_index  # first words of the read outs in this raw data chunk
+                    candidate_rows = readout_rows[selection]
+                    # first event word of the read outs
+                    event_word_indices = np.flatnonzero(np.logical_not(is_fe_record(raw_data)))
+                    index = np.searchsorted(event_word_indices, candidates)
+                    event_word_found = index < event_word_indices.shape[0]
+                    candidates, candidate_rows, candidate_stops = candidates[event_word_found], candidate_rows[event_word_found], readout_stops[selection][event_word_found] - word_index
+                    event_starts = event_word_indices[index[event_word_found]]
+                    in_readout = event_starts < candidate_stops
+                    candidates, candidate_rows, event_starts = candidates[in_readout], candidate_rows[in_readout], event_starts[in_readout]
+                    is_trigger = is_trigger_word(raw_data)
+                    is_header = is_fe_data_header(raw_data)
+                    n_data_header_before = np.cumsum(is_header) - is_header  # number of data headers before each word
+                    trigger_word_indices = np.flatnonzero(is_trigger)
+                    if self._align_at_trigger:
+                        if self._trigger_data_format == 2:
+                            trigger_numbers = np.bitwise_and(raw_data[trigger_word_indices], 0x0000FFFF).astype(np.int64)
+                        else:
+                            trigger_numbers = np.bitwise_and(raw_data[trigger_word_indices], 0x7FFFFFFF).astype(np.int64)
+                        candidates, candidate_rows, event_starts = candidates[is_trigger[event_starts]], candidate_rows[is_trigger[event_starts]], event_starts[is_trigger[event_starts]]
+                        if candidates.shape[0]:
+                            index = np.searchsorted(trigger_word_indices, event_starts)  # index of the candidate trigger word
+                            previous_in_chunk = index > 0
+                            previous_index = np.maximum(index - 1, 0)
+                            previous_trigger_number = np.where(previous_in_chunk, trigger_numbers[previous_index], -1 if last_trigger_number is None else last_trigger_number)
+                            n_event_data_header = np.where(previous_in_chunk, n_data_header_before[event_starts] - n_data_header_before[trigger_word_indices[previous_index]], n_data_header_since_trigger + n_data_header_before[event_starts])
+                            valid = np.logical_and(np.logical_or(previous_in_chunk, last_trigger_number is not None), n_event_data_header >= self._trig_count)  # previous event is complete
+                            if self._trigger_data_format != 1:  # no trigger number check for time stamp format
+                                valid &= np.logical_or(previous_trigger_number + 1 == trigger_numbers[index], np.logical_and(previous_trigger_number == self._max_trigger_number, trigger_numbers[index] == 0))
+                        else:
+                            valid = np.zeros_like(candidates, dtype=np.bool)
+                        if trigger_word_indices.shape[0]:
+                            last_trigger_number = trigger_numbers[-1]
+                            n_data_header_since_trigger = np.count_nonzero(is_header[trigger_word_indices[-1]:])
+                        else:
+                            n_data_header_since_trigger += np.count_nonzero(is_header)
+                    else:
+                        if self._fei4b:
+                            lvl1id = np.right_shift(np.bitwise_and(raw_data[is_header], 0x00007C00), 10)
+                        else:
+                            lvl1id = np.right_shift(np.bitwise_and(raw_data[is_header], 0x00007F00), 8)
+                        lvl1id = np.r_[data_header_lvl1id_tail, lvl1id]
+                        n_lvl1id_changes = np.r_[0, np.cumsum(lvl1id[1:] != lvl1id[:-1])]
+                        candidates, candidate_rows, event_starts = candidates[is_header[event_starts]], candidate_rows[is_header[event_starts]], event_starts[is_header[event_starts]]
+                        data_header_index = n_data_header_before[event_starts] + data_header_lvl1id_tail.shape[0]  # index of the candidate data header in lvl1id array
+                        data_header_number = n_data_header + n_data_header_before[event_starts]
+                        valid = np.logical_and(data_header_number % self._trig_count == 0, data_header_number > 0)
+                        previous_event = valid.copy()
+                        # the previous event has trig_count data headers with constant LVL1ID, the LVL1ID changes with the candidate data header
+                        valid[previous_event] = np.logical_and(n_lvl1id_changes[data_header_index[previous_event] - 1] - n_lvl1id_changes[data_header_index[previous_event] - self._trig_count] == 0, lvl1id[data_header_index[previous_event]] != lvl1id[data_header_index[previous_event] - 1])
+                        if trigger_word_found:
+                            valid[:] = False
+                        elif trigger_word_indices.shape[0]:
+                            valid &= event_starts < trigger_word_indices[0]
+                            trigger_word_found = True
+                        n_data_header += np.count_nonzero(is_header)
+                        data_header_lvl1id_tail = lvl1id[-self._trig_count:]
+                    # the previous event is still open at the words before the first event word
+                    file_boundaries.extend(zip(candidate_rows[valid], candidates[valid] + word_index, event_starts[valid] != candidates[valid]))
+                if not file_boundaries or file_boundaries[0][0] != readout_rows[0]:
+                    if file_index != 0:
+                        logging.info('Raw data file %s does not start with a complete event, interpreting raw data on one CPU core', in_file_h5.filename)
+                        return None
+                    file_boundaries.insert(0, (readout_rows[0], 0, False))  # the very first word starts the first event
+                # select boundaries in steps of at least chunk_size words
+                boundary_words = np.array([word for _, word, _ in file_boundaries], dtype=np.int64)
+                selected = [0]
+                while True:
+                    next_boundary = np.searchsorted(boundary_words, boundary_words[selected[-1]] + self._chunk_size)
+                    if next_boundary >= boundary_words.shape[0]:
+                        break
+                    selected.append(next_boundary)
+                for file_boundary_index, next_file_boundary_index in zip(selected, selected[1:] + [None]):
+                    boundary_row, word_start, open_event = file_boundaries[file_boundary_index]
+                    if next_file_boundary_index is None:
+                        word_stop = in_file_h5.root.raw_data.shape[0]
+                    else:
+                        word_stop = file_boundaries[next_file_boundary_index][1]
+                    boundaries.append((raw_data_file, boundary_row, word_start, word_stop, open_event, file_settings))
+                meta_data_row += n_readouts
+
+        tasks = []
+        non_empty_rows = np.flatnonzero(readout_length > 0)
+        for task_index, (raw_data_file, boundary_row, word_start, word_stop, open_event, settings) in enumerate(boundaries):
+            # empty read outs before the boundary belong to the task, the interpreter sets their event index with the first word of the task
+            meta_data_start = 0 if task_index == 0 else non_empty_rows[np.searchsorted(non_empty_rows, boundary_row) - 1] + 1
+            meta_data_stop = self.meta_data.shape[0] if task_index == len(boundaries) - 1 else non_empty_rows[np.searchsorted(non_empty_rows, boundaries[task_index + 1][1]) - 1] + 1
+            tasks.append((raw_data_file, word_start, word_stop, meta_data_start, meta_data_stop, boundary_row - meta_data_start + 1 if open_event else 0, settings))
+        if len(tasks) < 2:
+            logging.info('Raw data cannot be split into several tasks, interpreting raw data on one CPU core')
+            return None
+        return tasks
+
+    def _interpret_tasks(self, tasks, progress_bar=None, hit_table=None, cluster_table=None, cluster_hit_table=None):
+        '''Interprets the tasks from _get_interpretation_tasks in worker processes. The hits are histogrammed, clustered and stored in order.
+
+        Returns
+        -------
+        InterpreterResults object with the summed interpreter counters.
+        '''
+        logging.info('Interpreting %d raw data chunks on %d CPU core(s)', len(tasks), self._n_workers)
+        index_start_name, index_stop_name = self.meta_data.dtype.names[:2]
+        interpreter_results = InterpreterResults(meta_table_v2=self.interpreter.meta_table_v2)
+        n_events = 0
+        total_words = 0
+        pool = mp.Pool(processes=self._n_workers)
+        try:
+            results = deque()
+            for task_index, (raw_data_file, word_start, word_stop, meta_data_start, meta_data_stop, n_open_event_readouts, settings) in enumerate(tasks):
+                meta_data = self.meta_data[meta_data_start:meta_data_stop].copy()
+                n_empty_readouts = np.argmax(meta_data[index_stop_name] != meta_data[index_start_name])  # leading empty read outs, might be from the previous raw data file
+                meta_data[index_start_name][:n_empty_readouts] = word_start
+                meta_data[index_stop_name][:n_empty_readouts] = word_start
+                meta_data[index_start_name] -= word_start
+                meta_data[index_stop_name] -= word_start
+                results.append((word_stop - word_start, meta_data_start, n_open_event_readouts, pool.apply_async(interpret_raw_data_chunk, (raw_data_file, word_start, word_stop, meta_data, settings))))
+                # process the results in order, limit the number of results held in memory
+                while results and (len(results) >= 2 * self._n_workers or task_index == len(tasks) - 1):
+                    n_words, meta_data_start, n_open_event_readouts, result = results.popleft()
+                    result = result.get()
+                    hits = result['hits']
+                    hits['event_number'] += n_events
+                    n_meta_data_event = result['n_meta_data_event']
+                    self.meta_event_index['metaEventIndex'][meta_data_start:meta_data_start + n_meta_data_event] = result['meta_event_index']['metaEventIndex'][:n_meta_data_event] + n_events
+                    self.meta_event_index['metaEventIndex'][meta_data_start:meta_data_start + min(n_open_event_readouts, n_meta_data_event)] -= 1  # the last event of the previous task is not finished yet for these read outs
+                    interpreter_results.n_meta_data_event = meta_data_start + n_meta_data_event
+                    interpreter_results.add(result)
+                    n_events += result['n_events']
+                    if self.scan_parameters is not None:
+                        self.histogram.add_meta_event_index(self.meta_event_index, interpreter_results.n_meta_data_event)
+                    self._store_hits(hits, hit_table=hit_table, cluster_table=cluster_table, cluster_hit_table=cluster_hit_table)
+                    total_words += n_words
+                    if progress_bar is not None and total_words <= progress_bar.maxval:
+                        progress_bar.update(total_words)
+                    if self.is_open(self.out_file_h5):
+                        self.out_file_h5.flush()
+        finally:
+            pool.close()
+            pool.join()
+        return interpreter_results
+
+    def _create_additional_data(self, interpreter=None):
+        '''Creates the meta data table and the interpreter histograms. The interpreter counters are taken from interpreter (default: self.interpreter).
+        '''
+        if interpreter is None:
+            interpreter = self.interpreter
         logging.info('Creating selected event histograms...')
         if self._analyzed_data_file is not None and self._create_meta_event_index:
             meta_data_size = self.meta_data.shape[0]
-            n_event_index = self.interpreter.get_n_meta_data_event()
+            n_event_index = interpreter.get_n_meta_data_event()
             if meta_data_size == n_event_index:
-                if self.interpreter.meta_table_v2:
+                if interpreter.meta_table_v2:
                     description = data_struct.MetaInfoEventTableV2().columns.copy()
                 else:
                     description = data_struct.MetaInfoEventTable().columns.copy()
@@ -938,7 +1319,7 @@ class AnalyzeRawData(object):
                 meta_data_out_table = self.out_file_h5.create_table(self.out_file_h5.root, name='meta_data', description=description, title='MetaData', filters=self._filter_table)
                 entry = meta_data_out_table.row
                 for i in range(0, n_event_index):
-                    if self.interpreter.meta_table_v2:
+                    if interpreter.meta_table_v2:
                         entry['event_number'] = self.meta_event_index[i][0]  # event index
                         entry['timestamp_start'] = self.meta_data[i][3]  # timestamp
                         entry['timestamp_stop'] = self.meta_data[i][4]  # timestamp
@@ -957,22 +1338,22 @@ class AnalyzeRawData(object):
             else:
                 logging.error('Meta data analysis failed')
         if self._create_service_record_hist:
-            self.service_record_hist = self.interpreter.get_service_records_counters()
+            self.service_record_hist = interpreter.get_service_records_counters()
             if self._analyzed_data_file is not None:
                 service_record_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistServiceRecord', title='Service Record Histogram', atom=tb.Atom.from_dtype(self.service_record_hist.dtype), shape=self.service_record_hist.shape, filters=self._filter_table)
                 service_record_hist_table[:] = self.service_record_hist
         if self._create_tdc_counter_hist:
-            self.tdc_counter_hist = self.interpreter.get_tdc_counters()
+            self.tdc_counter_hist = interpreter.get_tdc_counters()
             if self._analyzed_data_file is not None:
                 tdc_counter_hist = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTdcCounter', title='All Tdc word counter values', atom=tb.Atom.from_dtype(self.tdc_counter_hist.dtype), shape=self.tdc_counter_hist.shape, filters=self._filter_table)
                 tdc_counter_hist[:] = self.tdc_counter_hist
         if self._create_error_hist:
-            self.error_counter_hist = self.interpreter.get_error_counters()
+            self.error_counter_hist = interpreter.get_error_counters()
             if self._analyzed_data_file is not None:
                 error_counter_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistErrorCounter', title='Error Counter Histogram', atom=tb.Atom.from_dtype(self.error_counter_hist.dtype), shape=self.error_counter_hist.shape, filters=self._filter_table)
                 error_counter_hist_table[:] = self.error_counter_hist
         if self._create_trigger_error_hist:
-            self.trigger_error_counter_hist = self.interpreter.get_trigger_error_counters()
+            self.trigger_error_counter_hist = interpreter.get_trigger_error_counters()
             if self._analyzed_data_file is not None:
                 trigger_error_counter_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTriggerErrorCounter', title='Trigger Error Counter Histogram', atom=tb.Atom.from_dtype(self.trigger_error_counter_hist.dtype), shape=self.trigger_error_counter_hist.shape, filters=self._filter_table)
                 trigger_error_counter_hist_table[:] = self.trigger_error_counter_hist
@@ -1013,6 +1394,11 @@ class AnalyzeRawData(object):
                     rel_bcid_hist_table[:] = self.rel_bcid_hist
         if self._create_occupancy_hist:
             self.occupancy_array = np.swapaxes(self.histogram.get_occupancy(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
+            if self.saturated_pixels is not None:  # set the occupancy of the pixels which were not injected anymore during the adaptive threshold scan
+                _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
+                scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)][:self.occupancy_array.shape[2]]
+                self.occupancy_array = self.occupancy_array[:, :, np.argsort(scan_parameters)]  # intervals of coarse PlsrDAC steps are scanned again afterwards, sort by PlsrDAC
+                set_saturated_pixels_occupancy(self.occupancy_array, self.saturated_pixels, np.sort(scan_parameters), self._n_injection)
             if self._analyzed_data_file is not None and safe_to_file:
                 occupancy_array_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(self.occupancy_array.dtype), shape=self.occupancy_array.shape, filters=self._filter_table)
                 occupancy_array_table[0:336, 0:80, 0:self.histogram.get_n_parameters()] = self.occupancy_array
@@ -1022,6 +1408,8 @@ class AnalyzeRawData(object):
                 mean_tot_array_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistMeanTot', title='Mean ToT Histogram', atom=tb.Atom.from_dtype(self.mean_tot_array.dtype), shape=self.mean_tot_array.shape, filters=self._filter_table)
                 mean_tot_array_table[0:336, 0:80, 0:self.histogram.get_n_parameters()] = self.mean_tot_array
         if self._create_threshold_hists:
+            if self.saturated_pixels is not None:  # the fast algorithm uses the histogram of the interpreter and needs equidistant PlsrDAC steps
+                raise analysis_utils.NotSupportedError('Threshold histograms cannot be created for adaptive threshold scan data, use fitted threshold histograms')
             _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
             scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)]
             if scan_parameters[0] >= scan_parameters[-1]:
@@ -1039,7 +1427,9 @@ class AnalyzeRawData(object):
         if self._create_fitted_threshold_hists:
             _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
             scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)]
-            self.scurve_fit_results = self.fit_scurves_multithread(self.out_file_h5, PlsrDAC=scan_parameters)
+            if self.saturated_pixels is not None:  # occupancy of the adaptive threshold scan is sorted by PlsrDAC
+                scan_parameters = np.sort(scan_parameters)
+            self.scurve_fit_results = self.fit_scurves(self.out_file_h5, PlsrDAC=scan_parameters)
             if self._analyzed_data_file is not None and safe_to_file:
                 fitted_threshold_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistThresholdFitted', title='Threshold Fitted Histogram', atom=tb.Atom.from_dtype(self.scurve_fit_results.dtype), shape=(336, 80), filters=self._filter_table)
                 fitted_noise_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistNoiseFitted', title='Noise Fitted Histogram', atom=tb.Atom.from_dtype(self.scurve_fit_results.dtype), shape=(336, 80), filters=self._filter_table)
@@ -1190,6 +1580,11 @@ class AnalyzeRawData(object):
         if n_hits != table_size:
             raise analysis_utils.AnalysisError('Tables have different sizes. Not all hits were analyzed.')
 
+        # event number index for fast event selection, see analysis_utils.data_aligned_at_events()
+        if self._create_cluster_table:
+            analysis_utils.create_event_index(cluster_table)
+        if self._create_cluster_hit_table:
+            analysis_utils.create_event_index(cluster_hit_table)
         self._create_additional_hit_data()
         self._create_additional_cluster_data()
         if close_analyzed_data_out_file:
@@ -1309,6 +1704,8 @@ class AnalyzeRawData(object):
             if self._create_fitted_threshold_hists:
                 _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
                 scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)]
+                if self.saturated_pixels is not None:  # occupancy of the adaptive threshold scan is sorted by PlsrDAC
+                    scan_parameters = np.sort(scan_parameters)
                 plotting.plot_scurves(occupancy_hist=out_file_h5.root.HistOcc[:] if out_file_h5 is not None else self.occupancy_array[:], filename=output_pdf, scan_parameters=scan_parameters, scan_parameter_name="PlsrDAC")
             else:
                 hist = np.sum(out_file_h5.root.HistOcc[:], axis=2) if out_file_h5 is not None else np.sum(self.occupancy_array[:], axis=2)
@@ -1360,6 +1757,22 @@ class AnalyzeRawData(object):
             logging.info('Closing output PDF file: %s', str(output_pdf._file.fh.name))
             output_pdf.close()
 
+    def fit_scurves(self, hit_table_file=None, PlsrDAC=None):
+        '''Fits the S-curves of all pixels. Uses fit_scurves_vectorized or, if vectorized_scurve_fit is False, fit_scurves_multithread.
+        '''
+        if not self._vectorized_scurve_fit:
+            return self.fit_scurves_multithread(hit_table_file=hit_table_file, PlsrDAC=PlsrDAC)
+        logging.info("Start vectorized S-curve fit")
+        occupancy_hist = hit_table_file.root.HistOcc[:] if hit_table_file is not None else self.occupancy_array[:]  # take data from RAM if no file is opened
+        occupancy_hist_shaped = occupancy_hist.reshape(occupancy_hist.shape[0] * occupancy_hist.shape[1], occupancy_hist.shape[2])
+        # reverse data to fit s-curve
+        if PlsrDAC[0] > PlsrDAC[-1]:
+            occupancy_hist_shaped = np.flip(occupancy_hist_shaped, axis=1)
+            PlsrDAC = np.flip(PlsrDAC, axis=0)
+        result_array = fit_scurves_vectorized(occupancy_hist_shaped, PlsrDAC=PlsrDAC)
+        logging.info("S-curve fit finished")
+        return result_array.reshape(occupancy_hist.shape[0], occupancy_hist.shape[1], 2)
+
     def fit_scurves_multithread(self, hit_table_file=None, PlsrDAC=None):
         logging.info("Start S-curve fit on %d CPU core(s)", mp.cpu_count())
         occupancy_hist = hit_table_file.root.HistOcc[:] if hit_table_file is not None else self.occupancy_array[:]  # take data from RAM if no file is opened
@@ -1429,6 +1842,8 @@ class AnalyzeRawData(object):
                 logging.info('No settings provided in raw data file %s, use already set settings', opened_raw_data_file.filename)
         except IndexError:  # happens if setting is not available (e.g. repeat_command)
             pass
+        if 'saturated_pixels' in opened_raw_data_file.root:  # adaptive threshold scan
+            self.saturated_pixels = opened_raw_data_file.root.saturated_pixels[:]
 
     def _get_plsr_dac_charge(self, plsr_dac_array, no_offset=False):
         '''Takes the PlsrDAC calibration and the stored C-high/C-low mask to calculate the charge from the PlsrDAC array on a pixel basis
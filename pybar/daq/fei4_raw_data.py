@@ -1,9 +1,12 @@
 import logging
 import glob
-from threading import RLock
+from threading import RLock, Lock, Thread, Event
+from Queue import Queue, Full, Empty
 import os.path
 from os import remove
+from time import time
 
+import numpy as np
 import tables as tb
 import zmq
 
@@ -12,6 +15,8 @@ from pybar_fei4_interpreter.data_struct import MetaTableV2 as MetaTable, generat
 
 def send_meta_data(socket, conf, name):
     '''Sends the config via ZeroMQ to a specified socket. Is called at the beginning of a run and when the config changes. Conf can be any config dictionary.
+
+    Returns True if the message was sent, False if the message was dropped.
     '''
     meta_data = dict(
         name=name,
@@ -20,11 +25,15 @@ def send_meta_data(socket, conf, name):
     try:
         socket.send_json(meta_data, flags=zmq.NOBLOCK)
     except zmq.Again:
-        pass
+        return False
+    return True
 
 
-def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
+def send_data(socket, data, scan_parameters={}, name='ReadoutData', sequence_number=None, n_dropped=None):
     '''Sends the data of every read out (raw data and meta data) via ZeroMQ to a specified socket
+
+    If given, the sequence number of the read out and the number of dropped read outs are added to the header.
+    Returns True if the data was sent, False if the data was dropped.
     '''
     if not scan_parameters:
         scan_parameters = {}
@@ -37,14 +46,128 @@ def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
         readout_error=data[3],  # int
         scan_parameters=scan_parameters  # dict
     )
+    if sequence_number is not None:
+        data_meta_data['sequence_number'] = sequence_number  # int, gaps indicate dropped read outs
+    if n_dropped is not None:
+        data_meta_data['n_dropped'] = n_dropped  # int, total number of dropped read outs
     try:
         socket.send_json(data_meta_data, flags=zmq.SNDMORE | zmq.NOBLOCK)
         socket.send(data[0], flags=zmq.NOBLOCK)  # PyZMQ supports sending numpy arrays without copying any data
     except zmq.Again:
-        pass
+        return False
+    return True
+
+
+class DataSender(object):
+    '''Sending raw data and meta data via ZeroMQ from a dedicated thread.
+
+    The messages are put into a bounded send queue and are sent by the sender thread, so the caller never blocks on the socket.
+    Every read out gets a sequence number, which is sent together with the number of dropped read outs.
+
+    Parameters
+    ----------
+    socket_address : string
+        Address the socket is bound to.
+    mode : string
+        'pub': PUB socket, messages are dropped if the send queue is full. Messages that are dropped by ZeroMQ for slow subscribers
+        (high water mark reached) show up as gaps in the sequence numbers.
+        'push': PUSH socket, lossless. The sender thread waits for the receiver (PULL socket) at the high water mark
+        and send_data()/send_meta_data() block if the send queue is full (backpressure).
+    queue_size : int
+        Maximum number of messages in the send queue.
+    hwm : int
+        Send high water mark of the socket (number of messages). If None, the ZeroMQ default is used.
+    '''
+    modes = {'pub': zmq.PUB, 'push': zmq.PUSH}
+
+    def __init__(self, socket_address, mode='pub', queue_size=1000, hwm=None):
+        if mode not in self.modes:
+            raise ValueError('Unknown send mode: %s' % mode)
+        self.socket_address = socket_address
+        self.mode = mode
+        self.lossless = (mode == 'push')
+        self.sequence_number = 0  # sequence number of the next read out
+        self.n_dropped = 0  # number of dropped read outs
+        self._drop_lock = Lock()
+        self._queue = Queue(maxsize=queue_size)
+        self._closing = Event()  # sender thread stops when the send queue is empty
+        self._stop_sending = Event()  # remaining messages are dropped
+        context = zmq.Context.instance()
+        logging.info('Creating socket connection to server %s (%s)', socket_address, mode)
+        self.socket = context.socket(self.modes[mode])
+        if hwm is not None:
+            self.socket.set_hwm(hwm)
+        self.socket.bind(socket_address)
+        self._sender_thread = Thread(target=self._send_messages, name='DataSender %s' % socket_address)
+        self._sender_thread.daemon = True
+        self._sender_thread.start()
+
+    def send_meta_data(self, conf, name):
+        self._put((send_meta_data, (conf, name), {}))
+
+    def send_data(self, data, scan_parameters=None, name='ReadoutData'):
+        sequence_number = self.sequence_number
+        self.sequence_number += 1
+        self._put((send_data, (data, dict(scan_parameters) if scan_parameters else {}, name), {'sequence_number': sequence_number}))
+
+    def _put(self, message):
+        if self.lossless:
+            self._queue.put(message)
+        else:
+            try:
+                self._queue.put_nowait(message)
+            except Full:
+                self._drop(message)
 
+    def _drop(self, message):
+        if message[0] is send_data:
+            with self._drop_lock:
+                self.n_dropped += 1
 
-def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socket_address=None):
+    def _send_messages(self):
+        while True:
+            try:
+                message = self._queue.get(timeout=0.1)
+            except Empty:
+                if self._closing.is_set():
+                    break
+                continue
+            send_func, args, kwargs = message
+            if send_func is send_data:
+                kwargs['n_dropped'] = self.n_dropped
+            while not send_func(self.socket, *args, **kwargs):
+                if not self.lossless or self._stop_sending.is_set():
+                    self._drop(message)
+                    break
+                self.socket.poll(100, zmq.POLLOUT)  # wait for the receiver
+
+    def close(self, timeout=10.0):
+        '''Sends all queued messages and closes the socket.
+
+        Parameters
+        ----------
+        timeout : float
+            Timeout in seconds to wait for the receiver in lossless mode. Messages that are not sent within the timeout are dropped.
+            If None, wait until all messages are sent. Not used in 'pub' mode.
+        '''
+        self._closing.set()  # never put into the send queue, it may be full
+        self._sender_thread.join(timeout)
+        if self._sender_thread.is_alive():
+            self._stop_sending.set()
+            while True:  # remaining messages are dropped
+                try:
+                    message = self._queue.get_nowait()
+                except Empty:
+                    break
+                self._drop(message)
+            self._sender_thread.join()
+        if self.n_dropped:
+            logging.warning('%s: dropped %d of %d read out(s)', self.socket_address, self.n_dropped, self.sequence_number)
+        logging.info('Closing socket connection')
+        self.socket.close()
+
+
+def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socket_address=None, flush_bytes=None, flush_rows=None, flush_interval=None, send_mode='pub', send_queue_size=1000, send_hwm=None):
     '''Mimics pytables.open_file() and stores the configuration and run configuration
 
     Returns:
@@ -55,7 +178,7 @@ def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socke
         # do something here
         raw_data_file.append(self.readout.data, scan_parameters={scan_parameter:scan_parameter_value})
     '''
-    return RawDataFile(filename=filename, mode=mode, title=title, scan_parameters=scan_parameters, socket_address=socket_address)
+    return RawDataFile(filename=filename, mode=mode, title=title, scan_parameters=scan_parameters, socket_address=socket_address, flush_bytes=flush_bytes, flush_rows=flush_rows, flush_interval=flush_interval, send_mode=send_mode, send_queue_size=send_queue_size, send_hwm=send_hwm)
 
 
 class RawDataFile(object):
@@ -63,10 +186,30 @@ class RawDataFile(object):
     max_table_size = 2**31 - 1000000  # pytables bug not allowing more than 2^31 entries in a table, since the read function uses xrange which behaves differently on 32/64bit platforms, fixed in pytables 3.2.0 release
 
     '''Raw data file object. Saving data queue to HDF5 file.
+
+    If any of flush_bytes, flush_rows or flush_interval is given, the raw data and the meta data are kept in memory
+    and are written to the HDF5 file with a single append per table, as soon as one of the given limits is reached:
+    flush_bytes (size of the buffered raw data in bytes), flush_rows (number of buffered meta data rows),
+    flush_interval (seconds since the last flush). Buffered data is always written on flush() and close().
+    The buffered raw data is concatenated into a preallocated array, which is reused for every flush and grows to the largest
+    number of buffered data words (buffer_high_water_mark).
+
+    If socket_address is given, the data is sent via ZeroMQ by a DataSender (see DataSender for send_mode, send_queue_size and send_hwm).
     '''
 
-    def __init__(self, filename, mode="w", title='', scan_parameters=None, socket_address=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
+    def __init__(self, filename, mode="w", title='', scan_parameters=None, socket_address=None, flush_bytes=None, flush_rows=None, flush_interval=None, send_mode='pub', send_queue_size=1000, send_hwm=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
         self.lock = RLock()
+        self.flush_bytes = flush_bytes
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._raw_data_buffer = []
+        self._meta_data_buffer = []
+        self._scan_param_buffer = []
+        self._buffered_words = 0
+        self._buffered_bytes = 0
+        self._concatenate_buffer = None  # preallocated array for the concatenation of the buffered raw data
+        self.buffer_high_water_mark = 0  # maximum number of buffered data words
+        self._last_flush = time()
         if os.path.splitext(filename)[1].strip().lower() != '.h5':
             self.base_filename = filename
         else:
@@ -83,14 +226,9 @@ class RawDataFile(object):
         self.h5_file = None
 
         if socket_address:
-            context = zmq.Context.instance()
-
-        if socket_address and context:
-            logging.info('Creating socket connection to server %s', socket_address)
-            self.socket = context.socket(zmq.PUB)  # publisher socket
-            self.socket.bind(socket_address)
+            self.data_sender = DataSender(socket_address, mode=send_mode, queue_size=send_queue_size, hwm=send_hwm)
         else:
-            self.socket = None
+            self.data_sender = None
 
         if mode and mode[0] == 'w':
             h5_files = glob.glob(os.path.splitext(filename)[0] + '*.h5')
@@ -117,9 +255,9 @@ class RawDataFile(object):
             logging.info('Opening existing raw data file: %s', filename)
         else:
             logging.info('Opening new raw data file: %s', filename)
-        if self.socket:
-            send_meta_data(self.socket, None, name='Reset')  # send reset to indicate a new scan
-            send_meta_data(self.socket, os.path.basename(filename), name='Filename')
+        if self.data_sender:
+            self.data_sender.send_meta_data(None, name='Reset')  # send reset to indicate a new scan
+            self.data_sender.send_meta_data(os.path.basename(filename), name='Filename')
 
         filter_raw_data = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
         filter_tables = tb.Filters(complib='zlib', complevel=5, fletcher32=False)
@@ -142,13 +280,15 @@ class RawDataFile(object):
     def close(self, close_socket=True):
         with self.lock:
             self.flush()
-            logging.info('Closing raw data file: %s', self.h5_file.filename)
+            if self.is_buffered:
+                logging.info('Closing raw data file: %s (maximum buffered data words: %d)', self.h5_file.filename, self.buffer_high_water_mark)
+            else:
+                logging.info('Closing raw data file: %s', self.h5_file.filename)
             self.h5_file.close()
             self.h5_file = None
-        if self.socket and close_socket:
-            logging.info('Closing socket connection')
-            self.socket.close()  # close here, do not wait for garbage collector
-            self.socket = None
+        if self.data_sender and close_socket:
+            self.data_sender.close()  # close here, do not wait for garbage collector
+            self.data_sender = None
 
     def append_item(self, data_tuple, scan_parameters=None, new_file=False, flush=True):
         with self.lock:
@@ -175,7 +315,7 @@ class RawDataFile(object):
                             self.h5_file.copy_node(node, h5_file.root, overwrite=True, recursive=True)
                     self.close(close_socket=False)
                     self.open(filename, 'a', filename)
-            total_words = self.raw_data_earray.nrows
+            total_words = self.raw_data_earray.nrows + self._buffered_words
             raw_data = data_tuple[0]
             len_raw_data = raw_data.shape[0]
             if total_words + len_raw_data > self.max_table_size:
@@ -190,23 +330,19 @@ class RawDataFile(object):
                 self.close(close_socket=False)
                 self.open(filename, 'a', filename)
                 total_words = self.raw_data_earray.nrows  # in case of re-opening existing file
-            self.raw_data_earray.append(raw_data)
-            self.meta_data_table.row['timestamp_start'] = data_tuple[1]
-            self.meta_data_table.row['timestamp_stop'] = data_tuple[2]
-            self.meta_data_table.row['error'] = data_tuple[3]
-            self.meta_data_table.row['data_length'] = len_raw_data
-            self.meta_data_table.row['index_start'] = total_words
-            total_words += len_raw_data
-            self.meta_data_table.row['index_stop'] = total_words
-            self.meta_data_table.row.append()
+            self._raw_data_buffer.append(raw_data)
+            self._buffered_words += len_raw_data
+            self.buffer_high_water_mark = max(self.buffer_high_water_mark, self._buffered_words)
+            self._buffered_bytes += raw_data.nbytes
+            self._meta_data_buffer.append((total_words, total_words + len_raw_data, len_raw_data, data_tuple[1], data_tuple[2], data_tuple[3]))
             if self.scan_parameters:
-                for key in self.scan_parameters:
-                    self.scan_param_table.row[key] = self.scan_parameters[key]
-                self.scan_param_table.row.append()
-            if flush:
+                self._scan_param_buffer.append(tuple(self.scan_parameters[key] for key in self.scan_param_table.colnames))
+            if flush or self.is_flush_required():
                 self.flush()
-            if self.socket:
-                send_data(self.socket, data_tuple, self.scan_parameters)
+            elif not self.is_buffered:
+                self._write_buffer()
+            if self.data_sender:
+                self.data_sender.send_data(data_tuple, self.scan_parameters)
 
     def append(self, data_iterable, scan_parameters=None, new_file=False, flush=True):
         with self.lock:
@@ -215,8 +351,57 @@ class RawDataFile(object):
             if flush:
                 self.flush()
 
+    @property
+    def is_buffered(self):
+        return any(limit is not None for limit in (self.flush_bytes, self.flush_rows, self.flush_interval))
+
+    def is_flush_required(self):
+        '''Returns True if one of the limits of the flush policy is reached.
+        '''
+        if not self._meta_data_buffer:
+            return False
+        if self.flush_bytes is not None and self._buffered_bytes >= self.flush_bytes:
+            return True
+        if self.flush_rows is not None and len(self._meta_data_buffer) >= self.flush_rows:
+            return True
+        if self.flush_interval is not None and time() - self._last_flush >= self.flush_interval:
+            return True
+        return False
+
+    def _write_buffer(self):
+        '''Writing buffered data to the tables (one append per table).
+        '''
+        if len(self._raw_data_buffer) == 1:  # nothing to concatenate
+            self.raw_data_earray.append(self._raw_data_buffer[0])
+        elif self._raw_data_buffer:
+            self.raw_data_earray.append(self._concatenate_raw_data())
+        if self._meta_data_buffer:
+            meta_data = np.empty(shape=(len(self._meta_data_buffer),), dtype=self.meta_data_table.dtype)
+            for name, values in zip(('index_start', 'index_stop', 'data_length', 'timestamp_start', 'timestamp_stop', 'error'), zip(*self._meta_data_buffer)):
+                meta_data[name] = values
+            self.meta_data_table.append(meta_data)
+        if self._scan_param_buffer:
+            scan_param_data = np.empty(shape=(len(self._scan_param_buffer),), dtype=self.scan_param_table.dtype)
+            for name, values in zip(self.scan_param_table.colnames, zip(*self._scan_param_buffer)):
+                scan_param_data[name] = values
+            self.scan_param_table.append(scan_param_data)
+        self._raw_data_buffer = []
+        self._meta_data_buffer = []
+        self._scan_param_buffer = []
+        self._buffered_words = 0
+        self._buffered_bytes = 0
+
+    def _concatenate_raw_data(self):
+        '''Concatenates the buffered raw data into the preallocated array and returns a view of the used part.
+        '''
+        if self._concatenate_buffer is None or self._concatenate_buffer.shape[0] < self._buffered_words:
+            self._concatenate_buffer = np.empty(shape=(self.buffer_high_water_mark,), dtype=self._raw_data_buffer[0].dtype)
+        return np.concatenate(self._raw_data_buffer, out=self._concatenate_buffer[:self._buffered_words])
+
     def flush(self):
         with self.lock:
+            self._write_buffer()
+            self._last_flush = time()
             self.raw_data_earray.flush()
             self.meta_data_table.flush()
             if self.scan_parameters:
@@ -1,8 +1,10 @@
 from collections import OrderedDict
 
+import numpy as np
+
 from basil.utils.BitLogic import BitLogic
 
-from pybar.daq.readout_utils import is_data_header, is_address_record, is_value_record, is_service_record, is_data_record
+from pybar.daq.readout_utils import is_trigger_word, is_fe_word, is_data_header, is_address_record, is_value_record, is_service_record, is_data_record
 
 flavors = ('fei4a', 'fei4b')
 
@@ -103,3 +105,174 @@ class FEI4Record(object):
 
     def __repr__(self):
         return repr(self.__str__())
+
+
+record_types = ('UNKNOWN WORD', 'UNKNOWN FE WORD', 'DH', 'AR', 'VR', 'SR', 'DR', 'TW', 'TDC')  # the record_type field is the index of the record type name
+
+fei4_record_dtype = np.dtype([
+    ('word', np.uint32),
+    ('record_type', np.uint8),
+    ('channel', np.uint8),
+    ('start', np.uint8),
+    ('header', np.uint8),
+    ('flag', np.uint8),
+    ('lvl1id', np.uint16),
+    ('bcid', np.uint16),
+    ('type', np.uint8),
+    ('address', np.uint16),
+    ('value', np.uint16),
+    ('code', np.uint8),
+    ('counter', np.uint16),
+    ('sr_lvl1id', np.uint8),
+    ('sr_bcid', np.uint8),
+    ('skipped', np.uint16),
+    ('truncation_flag', np.uint8),
+    ('truncation_counter', np.uint8),
+    ('l1req', np.uint8),
+    ('column', np.uint8),
+    ('row', np.uint16),
+    ('tot1', np.uint8),
+    ('tot2', np.uint8),
+    ('trigger_number', np.uint32),
+    ('trigger_timestamp', np.uint32),
+    ('tdc_distance', np.uint8),
+    ('tdc_counter', np.uint16),
+    ('tdc_value', np.uint16)])
+
+
+def _get_bits(data, msb, lsb):
+    return np.bitwise_and(np.right_shift(data, lsb), (1 << (msb - lsb + 1)) - 1)
+
+
+def decode_fei4_records(data, chip_flavor, tdc_trig_dist=False, trigger_data_mode=0):
+    '''Decodes an array of raw data words in one pass. This is the vectorized version of FEI4Record.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The raw data words.
+    chip_flavor : string
+        The chip flavor ('fei4a' or 'fei4b').
+    tdc_trig_dist : bool
+        If True, the TDC words contain the TDC trigger distance.
+    trigger_data_mode : int
+        The trigger data format (0: trigger number, 1: time stamp, 2: combined).
+
+    Returns
+    -------
+    numpy.ndarray with fei4_record_dtype
+        One record per data word. The record type is the index in record_types. Fields which do not belong to the record type are 0.
+    '''
+    if chip_flavor not in flavors:
+        raise KeyError('Chip flavor is not of type {}'.format(', '.join('\'' + flav + '\'' for flav in flavors)))
+    data = np.asarray(data, dtype=np.uint32).reshape(-1)
+    records = np.zeros(shape=data.shape, dtype=fei4_record_dtype)
+    records['word'] = data
+
+    is_tw = is_trigger_word(data)
+    is_tdc = np.equal(np.bitwise_and(data, 0xF0000000), 0x40000000)
+    is_fe = is_fe_word(data)
+    is_dh = np.logical_and(is_fe, is_data_header(data))
+    is_ar = np.logical_and(is_fe, is_address_record(data))
+    is_vr = np.logical_and(is_fe, is_value_record(data))
+    is_sr = np.logical_and(is_fe, is_service_record(data))
+    is_dr = np.logical_and(is_fe, is_data_record(data))
+    records['record_type'] = np.select([is_tw, is_tdc, is_dh, is_ar, is_vr, is_sr, is_dr, is_fe], [record_types.index(record_type) for record_type in ('TW', 'TDC', 'DH', 'AR', 'VR', 'SR', 'DR', 'UNKNOWN FE WORD')], default=record_types.index('UNKNOWN WORD'))
+
+    # trigger words
+    if np.any(is_tw):
+        if trigger_data_mode == 0:
+            records['trigger_number'][is_tw] = _get_bits(data[is_tw], 30, 0)
+        elif trigger_data_mode == 1:
+            records['trigger_timestamp'][is_tw] = _get_bits(data[is_tw], 30, 0)
+        elif trigger_data_mode == 2:
+            records['trigger_timestamp'][is_tw] = _get_bits(data[is_tw], 30, 16)
+            records['trigger_number'][is_tw] = _get_bits(data[is_tw], 15, 0)
+        else:
+            raise ValueError("Unknown trigger data mode %d" % trigger_data_mode)
+
+    # TDC words
+    if tdc_trig_dist:
+        records['tdc_distance'][is_tdc] = _get_bits(data[is_tdc], 27, 20)
+        records['tdc_counter'][is_tdc] = _get_bits(data[is_tdc], 19, 12)
+    else:
+        records['tdc_counter'][is_tdc] = _get_bits(data[is_tdc], 27, 12)
+    records['tdc_value'][is_tdc] = _get_bits(data[is_tdc], 11, 0)
+
+    # FE words
+    records['channel'][is_fe] = _get_bits(data[is_fe], 27, 24)
+    is_header = is_dh | is_ar | is_vr | is_sr
+    records['start'][is_header] = _get_bits(data[is_header], 23, 19)
+    records['header'][is_header] = _get_bits(data[is_header], 18, 16)
+    records['flag'][is_dh] = _get_bits(data[is_dh], 15, 15)
+    if chip_flavor == 'fei4a':
+        records['lvl1id'][is_dh] = _get_bits(data[is_dh], 14, 8)
+        records['bcid'][is_dh] = _get_bits(data[is_dh], 7, 0)
+    else:
+        records['lvl1id'][is_dh] = _get_bits(data[is_dh], 14, 10)
+        records['bcid'][is_dh] = _get_bits(data[is_dh], 9, 0)
+    records['type'][is_ar] = _get_bits(data[is_ar], 15, 15)
+    records['address'][is_ar] = _get_bits(data[is_ar], 14, 0)
+    records['value'][is_vr] = _get_bits(data[is_vr], 15, 0)
+    records['code'][is_sr] = _get_bits(data[is_sr], 15, 10)
+    if chip_flavor == 'fei4a':
+        records['counter'][is_sr] = _get_bits(data[is_sr], 9, 0)
+    else:
+        is_sr_14 = is_sr & (records['code'] == 14)
+        is_sr_15 = is_sr & (records['code'] == 15)
+        is_sr_16 = is_sr & (records['code'] == 16)
+        is_sr_counter = is_sr & ~(is_sr_14 | is_sr_15 | is_sr_16)
+        records['sr_lvl1id'][is_sr_14] = _get_bits(data[is_sr_14], 9, 3)
+        records['sr_bcid'][is_sr_14] = _get_bits(data[is_sr_14], 2, 0)
+        records['skipped'][is_sr_15] = _get_bits(data[is_sr_15], 9, 0)
+        records['truncation_flag'][is_sr_16] = _get_bits(data[is_sr_16], 9, 9)
+        records['truncation_counter'][is_sr_16] = _get_bits(data[is_sr_16], 8, 4)
+        records['l1req'][is_sr_16] = _get_bits(data[is_sr_16], 3, 0)
+        records['counter'][is_sr_counter] = _get_bits(data[is_sr_counter], 9, 0)
+    records['column'][is_dr] = _get_bits(data[is_dr], 23, 17)
+    records['row'][is_dr] = _get_bits(data[is_dr], 16, 8)
+    records['tot1'][is_dr] = _get_bits(data[is_dr], 7, 4)
+    records['tot2'][is_dr] = _get_bits(data[is_dr], 3, 0)
+    return records
+
+
+def get_record_string(record, chip_flavor, tdc_trig_dist=False, trigger_data_mode=0):
+    '''Returns the string of a record from decode_fei4_records(). The string is the same as the string of FEI4Record.
+    '''
+    record_type = record_types[record['record_type']]
+    if record_type == 'TW':
+        if trigger_data_mode == 0:
+            fields = [('trigger number', 'trigger_number')]
+        elif trigger_data_mode == 1:
+            fields = [('trigger timestamp', 'trigger_timestamp')]
+        else:
+            fields = [('trigger timestamp', 'trigger_timestamp'), ('trigger number', 'trigger_number')]
+    elif record_type == 'TDC':
+        fields = [('tdc distance', 'tdc_distance'), ('tdc counter', 'tdc_counter'), ('tdc value', 'tdc_value')] if tdc_trig_dist else [('tdc counter', 'tdc_counter'), ('tdc value', 'tdc_value')]
+    elif record_type == 'UNKNOWN WORD':
+        fields = [('unknown', 'word')]
+    else:  # FE words
+        fields = [('channel', 'channel')]
+        if record_type in ('DH', 'AR', 'VR', 'SR'):
+            fields.extend([('start', 'start'), ('header', 'header')])
+        if record_type == 'DH':
+            fields.extend([('flag', 'flag'), ('lvl1id', 'lvl1id'), ('bcid', 'bcid')])
+        elif record_type == 'AR':
+            fields.extend([('type', 'type'), ('address', 'address')])
+        elif record_type == 'VR':
+            fields.append(('value', 'value'))
+        elif record_type == 'SR':
+            fields.append(('code', 'code'))
+            if chip_flavor == 'fei4b' and record['code'] == 14:
+                fields.extend([('lvl1id[11:5]', 'sr_lvl1id'), ('bcid[12:10]', 'sr_bcid')])
+            elif chip_flavor == 'fei4b' and record['code'] == 15:
+                fields.append(('skipped', 'skipped'))
+            elif chip_flavor == 'fei4b' and record['code'] == 16:
+                fields.extend([('truncation flag', 'truncation_flag'), ('truncation counter', 'truncation_counter'), ('l1req', 'l1req')])
+            else:
+                fields.append(('counter', 'counter'))
+        elif record_type == 'DR':
+            fields.extend([('column', 'column'), ('row', 'row'), ('tot1', 'tot1'), ('tot2', 'tot2')])
+        else:
+            fields.append(('word', 'word'))
+    return record_type + ' {}'.format(' '.join(label + ':' + str(record[field]) for label, field in fields))
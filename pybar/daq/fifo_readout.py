@@ -1,4 +1,5 @@
 import logging
+import tempfile
 from time import sleep, time
 from itertools import izip
 from threading import Thread, Event, Lock, Condition
@@ -35,6 +36,135 @@ class StopTimeout(Exception):
     pass
 
 
+class DataBufferFull(Exception):
+    pass
+
+
+class SpilledData(object):
+    '''Location of a data array in the spill file of the data buffer.
+    '''
+    __slots__ = ('offset', 'dtype', 'shape')
+
+    def __init__(self, offset, dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = shape
+
+
+class DataBuffer(object):
+    '''Buffer for the data tuples (data, timestamp_start, timestamp_stop, error) with optional size limit.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum size of the data kept in memory in bytes. The buffer size is unlimited if None.
+    policy : string
+        Policy if the buffer size limit is reached.
+        'error': DataBufferFull is raised once and further data is dropped.
+        'drop_oldest': The oldest data is dropped. Data larger than the size limit is kept if the buffer is empty.
+        'spill': Further data is written to a temporary file. Data that is not a numpy array is kept in memory.
+    spill_dir : string
+        Directory of the temporary spill file. If None, the default temporary directory is used.
+    '''
+    policies = ('error', 'drop_oldest', 'spill')
+
+    def __init__(self, max_size=None, policy='error', spill_dir=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown data buffer policy: %s' % policy)
+        self.max_size = max_size
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self._lock = Lock()
+        self._data = deque()
+        self._spill_file = None
+        self.size = 0  # size of the data in memory in bytes
+        self.n_dropped = 0  # number of dropped data tuples
+        self.n_spilled = 0  # number of data tuples written to the spill file
+        self.full = False
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        '''Iterates over the data tuples without removing them.
+
+        The iteration is done over a snapshot of the buffer, so data that is appended or consumed in the meantime does not change the iteration.
+        Spilled data is read from the spill file at every iteration.
+        '''
+        with self._lock:
+            data = list(self._data)
+        for data_tuple in data:
+            if isinstance(data_tuple[0], SpilledData):
+                with self._lock:
+                    if self._spill_file is None:  # buffer closed in the meantime
+                        break
+                    data_tuple = self._load(data_tuple)
+            yield data_tuple
+
+    @staticmethod
+    def _get_size(data):
+        if isinstance(data, np.ndarray):
+            return data.nbytes
+        elif isinstance(data, tuple):  # converter function returned multiple arrays
+            return sum(item.nbytes for item in data if isinstance(item, np.ndarray))
+        return 0
+
+    def _load(self, data_tuple):
+        if isinstance(data_tuple[0], SpilledData):
+            self._spill_file.seek(data_tuple[0].offset)
+            data = np.fromfile(self._spill_file, dtype=data_tuple[0].dtype, count=int(np.prod(data_tuple[0].shape))).reshape(data_tuple[0].shape)
+            return (data,) + tuple(data_tuple[1:])
+        return data_tuple
+
+    def _spill(self, data_tuple):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='pybar_data_buffer_', dir=self.spill_dir)
+        self._spill_file.seek(0, 2)  # append to the end of the file
+        spilled_data = SpilledData(offset=self._spill_file.tell(), dtype=data_tuple[0].dtype, shape=data_tuple[0].shape)
+        data_tuple[0].tofile(self._spill_file)
+        self.n_spilled += 1
+        return (spilled_data,) + tuple(data_tuple[1:])
+
+    def append(self, data_tuple):
+        '''Appends a data tuple. If the size limit is reached, the policy is applied.
+        '''
+        size = self._get_size(data_tuple[0])
+        with self._lock:
+            if self.max_size is not None and self.size + size > self.max_size:
+                if self.policy == 'spill' and isinstance(data_tuple[0], np.ndarray):
+                    self._data.append(self._spill(data_tuple))
+                    return
+                elif self.policy == 'drop_oldest':
+                    while self._data and self.size + size > self.max_size:
+                        self.size -= self._get_size(self._data.popleft()[0])
+                        self.n_dropped += 1
+                elif self.policy == 'error':
+                    self.n_dropped += 1
+                    if not self.full:
+                        self.full = True
+                        raise DataBufferFull('Data buffer size limit of %d bytes reached, dropping data' % self.max_size)
+                    return
+            self._data.append(data_tuple)
+            self.size += size
+
+    def popleft(self):
+        '''Removes and returns the oldest data tuple. Raises IndexError if the buffer is empty.
+        '''
+        with self._lock:
+            data_tuple = self._data.popleft()
+            if not isinstance(data_tuple[0], SpilledData):
+                self.size -= self._get_size(data_tuple[0])
+            return self._load(data_tuple)
+
+    def close(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            if self._spill_file is not None:
+                self._spill_file.close()  # the temporary file is deleted
+                self._spill_file = None
+
+
 class FifoReadout(object):
     def __init__(self, dut):
         self.dut = dut
@@ -63,6 +193,9 @@ class FifoReadout(object):
         self._data_deque = None  # stores data for writer thread
         self._data_conditions = None
         self._data_buffer = None  # stores data for later readout
+        self.buffer_size = None  # size limit of the data buffer (in bytes) for each writer thread, unlimited if None
+        self.buffer_policy = 'error'  # policy if the size limit of the data buffer is reached, see DataBuffer
+        self.buffer_spill_dir = None  # directory of the spill file of the data buffer
         self._data_deque = None
         self._words_per_read = []
         self.stop_readout = Event()
@@ -83,7 +216,18 @@ class FifoReadout(object):
                 result.append(sum([item[0] for item in words_per_read if item[1] > (curr_time - self._moving_average_time_period)]) / float(self._moving_average_time_period))
             return result
 
-    def start(self, fifos, callback=None, errback=None, reset_rx=False, reset_fifo=False, fill_buffer=False, no_data_timeout=None, filter_func=None, converter_func=None, fifo_select=None, enabled_fe_channels=None):
+    def start(self, fifos, callback=None, errback=None, reset_rx=False, reset_fifo=False, fill_buffer=False, no_data_timeout=None, filter_func=None, converter_func=None, fifo_select=None, enabled_fe_channels=None, buffer_size=None, buffer_policy=None):
+        '''Starting the FIFO readout.
+
+        Parameters
+        ----------
+        buffer_size : int
+            Size limit (in bytes) of the data buffer for each writer thread, if fill_buffer is True.
+            If None, the value from the buffer_size attribute is used. The data buffer is unlimited if both are None.
+        buffer_policy : string
+            Policy if the size limit of the data buffer is reached ('error', 'drop_oldest' or 'spill', see DataBuffer).
+            If None, the value from the buffer_policy attribute is used.
+        '''
         with self.is_running_lock:
             if self._is_running:
                 raise RuntimeError('FIFO readout threads already started: use stop()')
@@ -141,7 +285,14 @@ class FifoReadout(object):
             self._fifo_conditions = {fifo: Condition() for fifo in self.fifos}
             self._data_deque = [deque() for _ in self.filter_func]
             self._data_conditions = [Condition() for _ in self.filter_func]
-            self._data_buffer = [deque() for _ in self.filter_func]
+            if buffer_size is None:
+                buffer_size = self.buffer_size
+            if buffer_policy is None:
+                buffer_policy = self.buffer_policy
+            if self._data_buffer:
+                for data_buffer in self._data_buffer:  # delete spill files
+                    data_buffer.close()
+            self._data_buffer = [DataBuffer(max_size=buffer_size, policy=buffer_policy, spill_dir=self.buffer_spill_dir) for _ in self.filter_func]
             self.force_stop = {fifo: Event() for fifo in self.fifos}
             self.timestamp = {fifo: None for fifo in self.fifos}
             len_deque = int(self._moving_average_time_period / self.readout_interval)
@@ -232,6 +383,10 @@ class FifoReadout(object):
             if self.errback:
                 self.watchdog_thread.join()
                 self.watchdog_thread = None
+            if self.fill_buffer:
+                for index, data_buffer in enumerate(self._data_buffer):
+                    if data_buffer.n_dropped or data_buffer.n_spilled:
+                        logging.warning('Data buffer with index %d: %d read out(s) dropped, %d read out(s) written to spill file', index, data_buffer.n_dropped, data_buffer.n_spilled)
             # disabling FEI4 RX channels
             for fei4_rx_name in self.enabled_fe_channels:
                 self.dut[fei4_rx_name].ENABLE_RX = 0
@@ -335,8 +490,10 @@ class FifoReadout(object):
                 else:
                     for index, (filter_func, converter_func, fifo_select) in enumerate(izip(self.filter_func, self.converter_func, self.fifo_select)):
                         if fifo_select is None or fifo_select == fifo:
-                            # filter and do the conversion
-                            converted_data_tuple = convert_data_iterable((data_tuple,), filter_func=filter_func, converter_func=converter_func)[0]
+                            if filter_func is None and converter_func is None:  # no copy needed
+                                converted_data_tuple = data_tuple
+                            else:  # filter and do the conversion
+                                converted_data_tuple = (convert_data_array(data_tuple[0], filter_func=filter_func, converter_func=converter_func),) + data_tuple[1:]
                             n_data_words = converted_data_tuple[0].shape[0]
                             with self.data_words_per_second_lock:
                                 self._words_per_read[index].append((n_data_words, converted_data_tuple[1], converted_data_tuple[2]))
@@ -389,7 +546,13 @@ class FifoReadout(object):
                     else:
                         converted_data_tuple_list[index] = [converted_data_tuple]  # adding iterable
                     if self.fill_buffer:
-                        self._data_buffer[index].append(converted_data_tuple)
+                        try:
+                            self._data_buffer[index].append(converted_data_tuple)
+                        except DataBufferFull:
+                            if self.errback:
+                                self.errback(sys.exc_info())
+                            else:
+                                raise
                 if self.callback and ((self.write_interval and time() - time_write >= self.write_interval) or not self.write_interval):
                     if any(converted_data_tuple_list):
                         try:
@@ -424,6 +587,9 @@ class FifoReadout(object):
     def get_data_from_buffer(self, filter_func=None, converter_func=None):
         '''Reads local data buffer and returns data and meta data list.
 
+        The data is not removed from the buffer. Spilled data is read from the spill file at every call,
+        use consume_data_from_buffer() to read it only once.
+
         Returns
         -------
         data : list
@@ -438,6 +604,9 @@ class FifoReadout(object):
     def get_raw_data_from_buffer(self, filter_func=None, converter_func=None):
         '''Reads local data buffer and returns raw data array.
 
+        The data is not removed from the buffer. Spilled data is read from the spill file and concatenated at every call,
+        use consume_data_from_buffer() to read it only once and without concatenation.
+
         Returns
         -------
         data : np.array
@@ -449,6 +618,30 @@ class FifoReadout(object):
             logging.warning('Data buffer is not activated')
         return [convert_data_array(data_array_from_data_iterable(data_iterable), filter_func=filter_func, converter_func=converter_func) for data_iterable in self._data_buffer]
 
+    def consume_data_from_buffer(self, index=0, filter_func=None, converter_func=None):
+        '''Generator returning the data arrays of the local data buffer read out by read out. The data is removed from the buffer.
+
+        Can be used while the readout is running. The data arrays are not concatenated.
+
+        Parameters
+        ----------
+        index : int
+            Index of the data buffer (writer thread).
+
+        Returns
+        -------
+        data : np.array
+            Filtered and converted data array of one read out.
+        '''
+        if not self.fill_buffer:
+            logging.warning('Data buffer is not activated')
+        while True:
+            try:
+                data_tuple = self._data_buffer[index].popleft()
+            except IndexError:
+                break
+            yield convert_data_array(data_tuple[0], filter_func=filter_func, converter_func=converter_func)
+
     def read_raw_data_from_fifo(self, fifo, filter_func=None, converter_func=None):
         '''Reads FIFO data and returns raw data array.
 
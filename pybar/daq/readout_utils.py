@@ -1,5 +1,6 @@
 import logging
 import os
+from threading import Lock
 
 import numpy as np
 import tables as tb
@@ -380,6 +381,78 @@ def get_occupancy_mask_from_data_record_array(array, occupancy):
     pass  # TODO:
 
 
+class OccupancyAccumulator(object):
+    '''Readout callback histogramming the hits of the FE-I4 data records of each module while the data is arriving.
+
+    The histograms are identical to the histograms from np.histogram2d() and np.histogramdd() of the buffered data (see tuning scans), but the raw data is not kept.
+
+    Parameters
+    ----------
+    n_modules : int
+        Number of modules, i.e. length of the data list passed to the callback.
+    tot : bool
+        If True, the ToT histogram of each pixel is also filled.
+    callback : function
+        Readout callback function which is called afterwards with the same data, e.g. for writing the raw data.
+    '''
+    def __init__(self, n_modules=1, tot=False, callback=None):
+        self.n_modules = n_modules
+        self.tot = tot
+        self.callback = callback
+        self._locks = [Lock() for _ in range(n_modules)]
+        self.reset()
+
+    def reset(self):
+        '''Resetting the histograms of all modules.
+        '''
+        self._occupancy = [np.zeros(shape=(80 * 336,), dtype=np.int64) for _ in range(self.n_modules)]
+        self._tot_hist = [np.zeros(shape=(80 * 336 * 16,), dtype=np.int64) if self.tot else None for _ in range(self.n_modules)]
+
+    def add(self, data, index=0):
+        '''Adding the hits of the data records of a raw data array.
+
+        Parameters
+        ----------
+        data : numpy.array
+            Raw data array.
+        index : int
+            Index of the module.
+        '''
+        col, row, tot = get_col_row_tot_array_from_data_record_array(data[is_data_record(data)])
+        selection = np.logical_and(np.logical_and(col >= 1, col <= 80), np.logical_and(row >= 1, row <= 336))
+        pixel_index = (col[selection].astype(np.int64) - 1) * 336 + row[selection].astype(np.int64) - 1
+        occupancy = np.bincount(pixel_index, minlength=80 * 336)
+        if self.tot:
+            tot_hist = np.bincount(pixel_index * 16 + tot[selection].astype(np.int64), minlength=80 * 336 * 16)
+        with self._locks[index]:
+            self._occupancy[index] += occupancy
+            if self.tot:
+                self._tot_hist[index] += tot_hist
+
+    def __call__(self, data_tuple_list):
+        for index, data_tuples in enumerate(data_tuple_list):
+            if data_tuples is None:
+                continue
+            for data_tuple in data_tuples:
+                self.add(data_tuple[0], index=index)
+        if self.callback:
+            self.callback(data_tuple_list)
+
+    def get_occupancy(self, index=0):
+        '''Returns the occupancy histogram (column, row) of a module.
+        '''
+        with self._locks[index]:
+            return self._occupancy[index].reshape((80, 336)).copy()
+
+    def get_tot_hist(self, index=0):
+        '''Returns the ToT histogram (column, row, ToT) of a module.
+        '''
+        if not self.tot:
+            raise ValueError('ToT histogram is not filled')
+        with self._locks[index]:
+            return self._tot_hist[index].reshape((80, 336, 16)).copy()
+
+
 def get_col_row_iterator_from_data_records(array):  # generator
     for item in np.nditer(array):  # , flags=['multi_index']):
         yield np.right_shift(np.bitwise_and(item, 0x00FE0000), 17), np.right_shift(np.bitwise_and(item, 0x0001FF00), 8)
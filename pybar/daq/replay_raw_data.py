@@ -0,0 +1,149 @@
+''' Replaying raw data files via ZeroMQ. The raw data is streamed chunk by chunk and published with the same messages as during data taking (see fei4_raw_data.send_data()).
+'''
+import logging
+import time
+from optparse import OptionParser
+
+import tables as tb
+
+from pybar.daq.fei4_raw_data import DataSender
+
+
+def read_configuration(h5_file, name):
+    '''Returns the configuration table (name/value) of the raw data file as dictionary. Returns None if the table does not exist.
+    '''
+    try:
+        table = h5_file.get_node(h5_file.root.configuration, name)
+    except tb.NoSuchNodeError:
+        return None
+    return dict((row['name'], row['value']) for row in table[:])
+
+
+def iterate_readouts(files, chunk_size=10000):
+    '''Iterates over the read outs of one or more raw data files. The raw data is read chunk by chunk, which allows to replay large files.
+
+    Parameters
+    ----------
+    files : string, list
+        Raw data file name or list of raw data file names.
+    chunk_size : int
+        Number of read outs (meta data rows) read at once.
+
+    Returns
+    -------
+    Generator of tuples with file name, data tuple (raw data, time stamp start, time stamp stop, error) and scan parameters (dict).
+    '''
+    if isinstance(files, basestring):
+        files = [files]
+    for file_name in files:
+        with tb.open_file(file_name, mode="r") as in_file_h5:
+            meta_data_table = in_file_h5.root.meta_data
+            raw_data_table = in_file_h5.root.raw_data
+            try:
+                scan_parameter_table = in_file_h5.root.scan_parameters
+            except tb.NoSuchNodeError:
+                scan_parameter_table = None
+            for chunk_start in range(0, meta_data_table.shape[0], chunk_size):
+                meta_data = meta_data_table.read(chunk_start, chunk_start + chunk_size)
+                if meta_data.shape[0] == 0:
+                    break
+                offset = meta_data['index_start'][0]
+                raw_data = raw_data_table.read(offset, meta_data['index_stop'][-1])
+                if scan_parameter_table is not None:
+                    scan_parameters = scan_parameter_table.read(chunk_start, chunk_start + chunk_size)
+                for index, readout in enumerate(meta_data):
+                    data = (raw_data[readout['index_start'] - offset:readout['index_stop'] - offset], float(readout['timestamp_start']), float(readout['timestamp_stop']), int(readout['error']))
+                    if scan_parameter_table is not None:
+                        yield file_name, data, dict((name, int(scan_parameters[index][name])) for name in scan_parameters.dtype.names)
+                    else:
+                        yield file_name, data, {}
+
+
+def replay_raw_data(files, socket_address, speed=1.0, mode='pub', chunk_size=10000, send_queue_size=1000, send_hwm=None, report_interval=1.0):
+    '''Replays raw data files via ZeroMQ.
+
+    Parameters
+    ----------
+    files : string, list
+        Raw data file name or list of raw data file names.
+    socket_address : string
+        Address the socket is bound to.
+    speed : float
+        Replay speed. 1.0: original timing of the read outs, N: N times faster than the original timing,
+        0 or None: as fast as possible.
+    mode : string
+        'pub': PUB socket, read outs are dropped for slow receivers. 'push': PUSH socket, lossless. See fei4_raw_data.DataSender.
+    chunk_size : int
+        Number of read outs read at once from the raw data file.
+    send_queue_size : int
+        Maximum number of read outs in the send queue.
+    send_hwm : int
+        Send high water mark of the socket. If None, the ZeroMQ default is used.
+    report_interval : float
+        Time in seconds between two reports of the data rate.
+
+    Returns
+    -------
+    Dictionary with number of read outs, number of data words, replay time in seconds, data words per second and number of dropped read outs.
+    '''
+    data_sender = DataSender(socket_address, mode=mode, queue_size=send_queue_size, hwm=send_hwm)
+    n_readouts = 0
+    n_words = 0
+    last_n_words = 0
+    last_file_name = None
+    first_timestamp = None
+    try:
+        data_sender.send_meta_data(None, name='Reset')  # indicate a new scan
+        start_time = time.time()
+        last_report = start_time
+        for file_name, data, scan_parameters in iterate_readouts(files, chunk_size=chunk_size):
+            if file_name != last_file_name:
+                logging.info('Replaying %s', file_name)
+                with tb.open_file(file_name, mode="r") as in_file_h5:
+                    global_register_config = read_configuration(in_file_h5, 'global_register')
+                    run_config = read_configuration(in_file_h5, 'run_conf')
+                data_sender.send_meta_data(file_name, name='Filename')
+                if global_register_config is not None:
+                    data_sender.send_meta_data(global_register_config, name='GlobalRegisterConf')
+                if run_config is not None:
+                    data_sender.send_meta_data(run_config, name='RunConf')
+                last_file_name = file_name
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp = data[2]
+                delay = start_time + (data[2] - first_timestamp) / speed - time.time()  # time stamp stop is the time the read out was sent
+                if delay > 0:
+                    time.sleep(delay)
+            data_sender.send_data(data, scan_parameters=scan_parameters)
+            n_readouts += 1
+            n_words += data[0].shape[0]
+            now = time.time()
+            if now - last_report >= report_interval:
+                logging.info('Replayed %d read outs, %d words/s, %d dropped', n_readouts, (n_words - last_n_words) / (now - last_report), data_sender.n_dropped)
+                last_report = now
+                last_n_words = n_words
+    finally:
+        data_sender.close()
+    replay_time = time.time() - start_time
+    words_per_second = n_words / replay_time if replay_time > 0 else 0.0
+    logging.info('Replayed %d read outs (%d words) in %.1f s: %d words/s, %d dropped', n_readouts, n_words, replay_time, words_per_second, data_sender.n_dropped)
+    return {'n_readouts': n_readouts, 'n_words': n_words, 'replay_time': replay_time, 'words_per_second': words_per_second, 'n_dropped': data_sender.n_dropped}
+
+
+if __name__ == '__main__':
+    from pybar.analysis.analysis_utils import get_data_file_names_from_scan_base
+    usage = "Usage: %prog [options] SCAN_BASE [SCAN_BASE ...]"
+    description = "SCAN_BASE: Raw data file or scan base name. All raw data files of the scan base are replayed ordered by time."
+    parser = OptionParser(usage, description=description)
+    parser.add_option("--address", dest="socket_address", default='tcp://127.0.0.1:5678', help="Address the data is published on (default: tcp://127.0.0.1:5678).")
+    parser.add_option("--speed", type="float", dest="speed", default=1.0, help="Replay speed, 1: original timing, N: N times faster, 0: as fast as possible (default: 1).")
+    parser.add_option("--push", action="store_true", dest="push", default=False, help="Use a PUSH socket for a lossless transfer (online monitor option --pull).")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("incorrect number of arguments")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    files = get_data_file_names_from_scan_base(args)
+    if not files:
+        parser.error("no raw data files found")
+    replay_raw_data(files, socket_address=options.socket_address, speed=options.speed, mode='push' if options.push else 'pub')
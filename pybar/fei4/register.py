@@ -4,7 +4,6 @@ import os
 import struct
 from ast import literal_eval
 from collections import OrderedDict
-import copy
 import datetime
 from contextlib import contextmanager
 from importlib import import_module
@@ -20,6 +19,18 @@ from pybar.utils.utils import string_is_binary, flatten_iterable, iterable
 flavors = ('fei4a', 'fei4b')
 
 
+class RestorePoint(object):
+    '''Register values changed since the creation of a restore point.
+
+    Only the value before the first change of a register is stored (copy-on-write).
+    '''
+    __slots__ = ('global_registers', 'pixel_registers')
+
+    def __init__(self):
+        self.global_registers = {}
+        self.pixel_registers = {}
+
+
 class FEI4Register(object):
 
     def __init__(self, configuration_file=None, fe_type=None, chip_address=None, broadcast=False):
@@ -45,6 +56,7 @@ class FEI4Register(object):
             self.set_chip_address(chip_address, broadcast)
 
         self.config_state = OrderedDict()
+        self._written_addresses = None  # see record_written_addresses()
 
     def __repr__(self):
         return self.configuration_file
@@ -68,6 +80,9 @@ class FEI4Register(object):
         self.calibration_parameters = OrderedDict()
         self.miscellaneous = OrderedDict()
         self.commands = {}
+        # caches depending on register and command definitions only
+        self._command_templates = {}
+        self._global_register_names_by_address = None
         fei4_defines = import_module('pybar.fei4.fei4_defines')
         fe_type = getattr(fei4_defines, fe_type)
         if 'flavor' not in fe_type:
@@ -177,12 +192,14 @@ class FEI4Register(object):
         value = long(str(value), 0)  # value is decimal string or number or BitVector
         if not 0 <= value < 2 ** self.global_registers[name]['bitlength']:
             raise ValueError('Global register %s: value exceeds limits' % name)
+        self._store_global_register_value(name)
         self.global_registers[name]['value'] = value
 
     def get_global_register_value(self, name):
         return self.global_registers[name]['value']
 
     def set_pixel_register_value(self, name, value):
+        self._store_pixel_register_value(name)
         try:  # value is decimal string or number or array
             self.pixel_registers[name]['value'][:, :] = value
         except ValueError:  # value is path to pixel config
@@ -230,6 +247,8 @@ class FEI4Register(object):
         elif command_name == "WrRegister":
             register_addresses = self.get_global_register_attributes("addresses", **kwargs)
             register_bitsets = self.get_global_register_bitsets(register_addresses)
+            if self._written_addresses is not None:
+                self._written_addresses.update(register_addresses)
             commands.extend([self.build_command(command_name, Address=register_address, GlobalData=register_bitset, ChipID=chip_id, **kwargs) for register_address, register_bitset in zip(register_addresses, register_bitsets)])
         elif command_name == "RdRegister":
             register_addresses = self.get_global_register_attributes('addresses', **kwargs)
@@ -421,13 +440,37 @@ class FEI4Register(object):
         -----
         Receives: command name as defined inside xml file, key-value-pairs as defined inside bit stream filed for each command
         """
-#         command_name = command_name.lower()
-        command_bitvector = bitarray(0, endian='little')
+        command_template, command_fields = self._get_command_template(command_name)
+        command_bitvector = command_template.copy()
+        for part, offset, bitlength in command_fields:  # fill in command parts with any content of defined length, e.g. ChipID, Address, ...
+            if part in kwargs:
+                value = kwargs[part]
+            else:
+                raise ValueError('Value of command part %s not given' % part)
+            if not isinstance(value, bitarray):
+                value = self._get_command_part_bitvector(value, bitlength)
+            if value.length() != bitlength:
+                raise ValueError("Command has unexpected length")
+            command_bitvector[offset:offset + bitlength] = value
+        return command_bitvector
+
+    def _get_command_template(self, command_name):
+        '''Returns the precompiled template of a command.
+
+        The template is the bitarray of the command with all static parts (e.g. Slow, command field) set
+        and a list of (command part, bit offset, bit length) of the command parts given by the keyword values.
+        Templates are cached until the command definitions are changed by init_fe_type().
+        '''
+        try:
+            return self._command_templates[command_name]
+        except KeyError:
+            pass
         if command_name not in self.commands:
             raise ValueError('Unknown command %s' % command_name)
         command_object = self.commands[command_name]
+        command_template = bitarray(0, endian='little')
+        command_fields = []
         command_parts = re.split(r'\s*[+]\s*', command_object['bitstream'])
-        # for index, part in enumerate(command_parts, start = 1): # loop over command parts
         for part in command_parts:  # loop over command parts
             try:
                 command_part_object = self.commands[part]
@@ -435,34 +478,39 @@ class FEI4Register(object):
                 command_part_object = None
             if command_part_object and 'bitstream'in command_part_object:  # command parts of defined content and length, e.g. Slow, ...
                 if string_is_binary(command_part_object['bitstream']):
-                    command_bitvector += bitarray(command_part_object['bitstream'], endian='little')
+                    command_template += bitarray(command_part_object['bitstream'], endian='little')
                 else:
-                    command_bitvector += self.build_command(part, **kwargs)
+                    part_template, part_fields = self._get_command_template(part)
+                    command_fields.extend([(field_part, command_template.length() + offset, bitlength) for field_part, offset, bitlength in part_fields])
+                    command_template += part_template
             elif command_part_object:  # Command parts with any content of defined length, e.g. ChipID, Address, ...
-                if part in kwargs:
-                    value = kwargs[part]
-                else:
-                    raise ValueError('Value of command part %s not given' % part)
-                try:
-                    command_bitvector += value
-                except TypeError:  # value is no bitarray
-                    if string_is_binary(value):
-                        value = int(value, 2)
-                    try:
-                        command_bitvector += bitarray_from_value(value=int(value), size=command_part_object['bitlength'], fmt='I')
-                    except Exception:
-                        raise TypeError("Type of value not supported")
+                command_fields.append((part, command_template.length(), command_part_object['bitlength']))
+                command_template += bitarray(command_part_object['bitlength'] * '0', endian='little')
             elif string_is_binary(part):
-                command_bitvector += bitarray(part, endian='little')
-            # elif part in kwargs.keys():
-            #    command_bitvector += kwargs[command_name]
+                command_template += bitarray(part, endian='little')
             else:
                 raise ValueError("Cannot process command part %s" % part)
-        if command_bitvector.length() != command_object['bitlength']:
+        if command_template.length() != command_object['bitlength']:
             raise ValueError("Command has unexpected length")
-        if command_bitvector.length() == 0:
+        if command_template.length() == 0:
             raise ValueError("Command has length 0")
-        return command_bitvector
+        self._command_templates[command_name] = (command_template, command_fields)
+        return command_template, command_fields
+
+    def _get_command_part_bitvector(self, value, bitlength):
+        '''Converting the value of a command part (e.g. ChipID, Address, ...) to a bitarray.
+        '''
+        command_part_bitvector = bitarray(0, endian='little')
+        try:
+            command_part_bitvector += value
+        except TypeError:  # value is no bitarray
+            if string_is_binary(value):
+                value = int(value, 2)
+            try:
+                command_part_bitvector += bitarray_from_value(value=int(value), size=bitlength, fmt='I')
+            except Exception:
+                raise TypeError("Type of value not supported")
+        return command_part_bitvector
 
     def get_global_register_attributes(self, register_attribute, do_sort=True, **kwargs):
         """Calculating register numbers from register names.
@@ -525,9 +573,17 @@ class FEI4Register(object):
         Returns: list of register bitsets
 
         """
+        if self._global_register_names_by_address is None:  # register names do not change with the register values, restore points, etc.
+            self._global_register_names_by_address = {}
+            for register_object in self.global_registers.itervalues():
+                for register_address in register_object['addresses']:
+                    self._global_register_names_by_address.setdefault(register_address, []).append(register_object['name'])
         register_bitsets = []
         for register_address in register_addresses:
-            register_objects = self.get_global_register_objects(addresses=register_address)
+            try:
+                register_objects = [self.global_registers[name] for name in self._global_register_names_by_address[register_address]]
+            except KeyError:
+                raise ValueError('Global register objects empty')
             register_bitset = bitarray(16, endian='little')  # TODO remove hardcoded register size, see also below
             register_bitset.setall(0)
             register_littleendian = False
@@ -596,6 +652,21 @@ class FEI4Register(object):
         # bv = bv1+bv0
         return bv1 + bv0
 
+    @contextmanager
+    def record_written_addresses(self):
+        '''Records the addresses of the global registers which are written by the commands created inside the context.
+
+        Returns the set of addresses (see ScanLoopSequence).
+        '''
+        previous_written_addresses = self._written_addresses
+        self._written_addresses = set()
+        try:
+            yield self._written_addresses
+        finally:
+            if previous_written_addresses is not None:
+                previous_written_addresses.update(self._written_addresses)
+            self._written_addresses = previous_written_addresses
+
     @contextmanager
     def restored(self, name=None):
         name = self.create_restore_point(name=name)
@@ -607,6 +678,8 @@ class FEI4Register(object):
     def create_restore_point(self, name=None):
         '''Creating a configuration restore point.
 
+        Restore points can be nested. Only the registers changed with set_global_register_value() and set_pixel_register_value() are restored.
+
         Parameters
         ----------
         name : str
@@ -623,9 +696,30 @@ class FEI4Register(object):
                     pass
         if name in self.config_state:
             raise ValueError('Restore point %s already exists' % name)
-        self.config_state[name] = (copy.deepcopy(self.global_registers), copy.deepcopy(self.pixel_registers))
+        self.config_state[name] = RestorePoint()  # register values are stored when they are changed
         return name
 
+    def _store_global_register_value(self, name):
+        '''Storing the value of a global register in the restore points before changing it.
+        '''
+        for restore_point_name in reversed(self.config_state):
+            global_registers = self.config_state[restore_point_name].global_registers
+            if name in global_registers:  # older restore points have already stored the value
+                break
+            global_registers[name] = self.global_registers[name]['value']
+
+    def _store_pixel_register_value(self, name):
+        '''Storing the value of a pixel register in the restore points before changing it.
+        '''
+        value = None
+        for restore_point_name in reversed(self.config_state):
+            pixel_registers = self.config_state[restore_point_name].pixel_registers
+            if name in pixel_registers:  # older restore points have already stored the value
+                break
+            if value is None:
+                value = self.pixel_registers[name]['value'].copy()  # the copy is shared by the restore points and never changed
+            pixel_registers[name] = value
+
     def restore(self, name=None, keep=False, last=True, global_register=True, pixel_register=True):
         '''Restoring a configuration restore point.
 
@@ -645,19 +739,23 @@ class FEI4Register(object):
         if name is None:
             if keep:
                 name = next(reversed(self.config_state)) if last else next(iter(self.config_state))
-                value = self.config_state[name]
+                restore_point = self.config_state[name]
             else:
-                name, value = self.config_state.popitem(last=last)
+                name, restore_point = self.config_state.popitem(last=last)
         else:
-            value = self.config_state[name]
+            restore_point = self.config_state[name]
             if not keep:
-                value = copy.deepcopy(value)  # make a copy before deleting object
                 del self.config_state[name]
 
+        # only registers changed since the creation of the restore point are restored, the other restore points are storing the values before restoring
         if global_register:
-            self.global_registers = copy.deepcopy(value[0])
+            for register_name, value in restore_point.global_registers.iteritems():
+                self._store_global_register_value(register_name)
+                self.global_registers[register_name]['value'] = value
         if pixel_register:
-            self.pixel_registers = copy.deepcopy(value[1])
+            for register_name, value in restore_point.pixel_registers.iteritems():
+                self._store_pixel_register_value(register_name)
+                self.pixel_registers[register_name]['value'][:, :] = value
 
     def clear_restore_points(self, name=None):
         '''Deleting all/a configuration restore points/point.
@@ -5,7 +5,8 @@ import struct
 import os
 from ast import literal_eval
 from operator import itemgetter
-import itertools
+from collections import OrderedDict
+from threading import Lock
 
 from bitarray import bitarray
 import numpy as np
@@ -14,7 +15,7 @@ from basil.utils.BitLogic import BitLogic
 
 from pybar.utils.utils import bitarray_to_array
 from pybar.daq.readout_utils import interpret_pixel_data
-from pybar.daq.fei4_record import FEI4Record
+from pybar.daq.fei4_record import decode_fei4_records, get_record_string, record_types
 
 
 class CmdTimeoutError(Exception):
@@ -49,22 +50,39 @@ class FEI4RegisterUtils(object):
         else:
             return reduce(self.add_commands, commands)
 
+    def _iter_concatenated_commands(self, commands, byte_padding=False):
+        '''Concatenates the commands as long as the concatenated command fits into the command memory.
+        '''
+        commands_iter = iter(commands)
+        try:
+            concatenated_cmd = commands_iter.next()
+        except StopIteration:
+            logging.warning('No commands to be sent')
+            return
+        for command in commands_iter:
+            concatenated_cmd_tmp = self.concatenate_commands((concatenated_cmd, command), byte_padding=byte_padding)
+            if concatenated_cmd_tmp.length() > self.command_memory_byte_size * 8:
+                yield concatenated_cmd
+                concatenated_cmd = command
+            else:
+                concatenated_cmd = concatenated_cmd_tmp
+        # remaining commands
+        yield concatenated_cmd
+
+    def prepare_commands(self, commands, byte_padding=False):
+        '''Concatenates the commands like send_commands() and returns a list with the command data (see set_command_data()) and the command length.
+        '''
+        return [(bitarray_to_array(concatenated_cmd), concatenated_cmd.length()) for concatenated_cmd in self._iter_concatenated_commands(commands, byte_padding=byte_padding)]
+
+    def send_prepared_commands(self, prepared_commands, repeat=1, wait_for_finish=True, use_timeout=True):
+        '''Sends the commands prepared by prepare_commands().
+        '''
+        for data, command_length in prepared_commands:
+            self.send_command_data(data=data, command_length=command_length, repeat=repeat, wait_for_finish=wait_for_finish, set_length=True, use_timeout=use_timeout)
+
     def send_commands(self, commands, repeat=1, wait_for_finish=True, concatenate=True, byte_padding=False, clear_memory=False, use_timeout=True):
         if concatenate:
-            commands_iter = iter(commands)
-            try:
-                concatenated_cmd = commands_iter.next()
-            except StopIteration:
-                logging.warning('No commands to be sent')
-            else:
-                for command in commands_iter:
-                    concatenated_cmd_tmp = self.concatenate_commands((concatenated_cmd, command), byte_padding=byte_padding)
-                    if concatenated_cmd_tmp.length() > self.command_memory_byte_size * 8:
-                        self.send_command(command=concatenated_cmd, repeat=repeat, wait_for_finish=wait_for_finish, set_length=True, clear_memory=clear_memory, use_timeout=use_timeout)
-                        concatenated_cmd = command
-                    else:
-                        concatenated_cmd = concatenated_cmd_tmp
-                # send remaining commands
+            for concatenated_cmd in self._iter_concatenated_commands(commands, byte_padding=byte_padding):
                 self.send_command(command=concatenated_cmd, repeat=repeat, wait_for_finish=wait_for_finish, set_length=True, clear_memory=clear_memory, use_timeout=use_timeout)
         else:
             max_length = 0
@@ -77,10 +95,15 @@ class FEI4RegisterUtils(object):
                 self.clear_command_memory(length=max_length)
 
     def send_command(self, command, repeat=1, wait_for_finish=True, set_length=True, clear_memory=False, use_timeout=True):
+        self.send_command_data(data=bitarray_to_array(command), command_length=command.length(), repeat=repeat, wait_for_finish=wait_for_finish, set_length=set_length, clear_memory=clear_memory, use_timeout=use_timeout)
+
+    def send_command_data(self, data, command_length, repeat=1, wait_for_finish=True, set_length=True, clear_memory=False, use_timeout=True):
+        '''Sends a command from the command data (see set_command_data()).
+        '''
         if repeat is not None:
             self.dut['TX']['CMD_REPEAT'] = repeat
         # write command into memory
-        command_length = self.set_command(command, set_length=set_length)
+        self.set_command_data(data=data, command_length=command_length, set_length=set_length)
         # sending command
         self.dut['TX']['START']
         # wait for command to be finished
@@ -94,12 +117,22 @@ class FEI4RegisterUtils(object):
         self.set_command(self.register.get_commands("zeros", length=(self.command_memory_byte_size * 8) if length is None else length)[0], set_length=False)
 
     def set_command(self, command, set_length=True, byte_offset=0):
-        command_length = command.length()
+        return self.set_command_data(data=bitarray_to_array(command), command_length=command.length(), set_length=set_length, byte_offset=byte_offset)
+
+    def set_command_data(self, data, command_length, set_length=True, byte_offset=0):
+        '''Writes the command data into the command memory.
+
+        Parameters
+        ----------
+        data : string
+            Command data from bitarray_to_array().
+        command_length : int
+            Command length in bits.
+        '''
         # set command bit length
         if set_length:
             self.dut['TX']['CMD_SIZE'] = command_length
         # set command
-        data = bitarray_to_array(command)
         self.dut['TX'].set_data(data=data, addr=byte_offset)
         return command_length
 
@@ -293,13 +326,11 @@ def read_chip_sn(self):
         logging.error('Chip S/N: No data')
         return
     read_values = []
-    for index, word in enumerate(np.nditer(data)):
-        fei4_data_word = FEI4Record(word, self.register.chip_flavor)
-        if fei4_data_word == 'AR':
-            fei4_next_data_word = FEI4Record(data[index + 1], self.register.chip_flavor)
-            if fei4_next_data_word == 'VR':
-                read_value = fei4_next_data_word['value']
-                read_values.append(read_value)
+    records = decode_fei4_records(data, self.register.chip_flavor)
+    for index in np.where(records['record_type'][:-1] == record_types.index('AR'))[0]:
+        if records['record_type'][index + 1] == record_types.index('VR'):
+            read_value = int(records['value'][index + 1])
+            read_values.append(read_value)
 
 #     commands = []
 #     commands.extend(self.register.get_commands("RunMode"))
@@ -335,24 +366,23 @@ def test_global_register(self):
         return 1
     checked_address = []
     number_of_errors = 0
-    for index, word in enumerate(np.nditer(data)):
-        fei4_data_word = FEI4Record(word, self.register.chip_flavor)
-        if fei4_data_word == 'AR':
-            fei4_next_data_word = FEI4Record(data[index + 1], self.register.chip_flavor)
-            if fei4_next_data_word == 'VR':
-                read_value = fei4_next_data_word['value']
-                set_value_bitarray = self.register.get_global_register_bitsets([fei4_data_word['address']])[0]
-                set_value_bitarray.reverse()
-                set_value = struct.unpack('H', set_value_bitarray.tobytes())[0]
-                checked_address.append(fei4_data_word['address'])
-                if read_value == set_value:
-                    pass
-                else:
-                    number_of_errors += 1
-                    logging.warning('Global Register Test: Wrong data for Global Register at address %d (read: %d, expected: %d)', fei4_data_word['address'], read_value, set_value)
+    records = decode_fei4_records(data, self.register.chip_flavor)
+    for index in np.where(records['record_type'][:-1] == record_types.index('AR'))[0]:
+        read_address = int(records['address'][index])
+        if records['record_type'][index + 1] == record_types.index('VR'):
+            read_value = int(records['value'][index + 1])
+            set_value_bitarray = self.register.get_global_register_bitsets([read_address])[0]
+            set_value_bitarray.reverse()
+            set_value = struct.unpack('H', set_value_bitarray.tobytes())[0]
+            checked_address.append(read_address)
+            if read_value == set_value:
+                pass
             else:
                 number_of_errors += 1
-                logging.warning('Global Register Test: Expected Value Record but found %s', fei4_next_data_word)
+                logging.warning('Global Register Test: Wrong data for Global Register at address %d (read: %d, expected: %d)', read_address, read_value, set_value)
+        else:
+            number_of_errors += 1
+            logging.warning('Global Register Test: Expected Value Record but found %s', get_record_string(records[index + 1], self.register.chip_flavor))
 
 #     commands = []
 #     commands.extend(self.register.get_commands("RunMode"))
@@ -461,50 +491,48 @@ def test_pixel_register(self):
                 else:
                     expected_addresses = range(15, 672, 16)
                     seen_addresses = {}
-                    for index, word in enumerate(np.nditer(data)):
-                        fei4_data = FEI4Record(word, self.register.chip_flavor)
-                        if fei4_data == 'AR':
-                            read_value = bitarray()
-                            fei4_next_data_word = FEI4Record(data[index + 1], self.register.chip_flavor)
-                            if fei4_next_data_word == 'VR':
-                                read_value.frombytes(struct.pack('H', fei4_next_data_word['value']))
-                                if do_latch is True:
-                                    read_value.invert()
-                                read_value = struct.unpack('H', read_value.tobytes())[0]
-                                read_address = fei4_data['address']
-                                if read_address not in expected_addresses:
-                                    if do_latch:
-                                        logging.warning('Pixel Register Test: Wrong address for PxStrobes Bit %d at DC %d at address %d', pxstrobe + pxstrobe_bit_no, dc_no, read_address)
-                                    else:
-                                        logging.warning('Pixel Register Test: Wrong address for PxStrobes Bit SR at DC %d at address %d', dc_no, read_address)
-                                    number_of_errors += 1
+                    records = decode_fei4_records(data, self.register.chip_flavor)
+                    for index in np.where(records['record_type'][:-1] == record_types.index('AR'))[0]:
+                        read_value = bitarray()
+                        if records['record_type'][index + 1] == record_types.index('VR'):
+                            read_value.frombytes(struct.pack('H', int(records['value'][index + 1])))
+                            if do_latch is True:
+                                read_value.invert()
+                            read_value = struct.unpack('H', read_value.tobytes())[0]
+                            read_address = int(records['address'][index])
+                            if read_address not in expected_addresses:
+                                if do_latch:
+                                    logging.warning('Pixel Register Test: Wrong address for PxStrobes Bit %d at DC %d at address %d', pxstrobe + pxstrobe_bit_no, dc_no, read_address)
                                 else:
-                                    if read_address not in seen_addresses:
-                                        seen_addresses[read_address] = 1
-                                        set_value = register_bitset[read_address - 15:read_address + 1]
-                                        set_value = struct.unpack('H', set_value.tobytes())[0]
-                                        if read_value == set_value:
-                                            pass
-#                                             if do_latch:
-#                                                 print 'Register Test:', 'PxStrobes Bit', pxstrobe+pxstrobe_bit_no, 'DC', dc_no, 'Address', read_address, 'PASSED'
-#                                             else:
-#                                                 print 'Register Test:', 'PxStrobes Bit', 'SR', 'DC', dc_no, 'Address', read_address, 'PASSED'
-                                        else:
-                                            number_of_errors += 1
-                                            if do_latch:
-                                                logging.warning('Pixel Register Test: Wrong value at PxStrobes Bit %d at DC %d at address %d (read: %d, expected: %d)', pxstrobe + pxstrobe_bit_no, dc_no, read_address, read_value, set_value)
-                                            else:
-                                                logging.warning('Pixel Register Test: Wrong value at PxStrobes Bit SR at DC %d at address %d (read: %d, expected: %d)', dc_no, read_address, read_value, set_value)
+                                    logging.warning('Pixel Register Test: Wrong address for PxStrobes Bit SR at DC %d at address %d', dc_no, read_address)
+                                number_of_errors += 1
+                            else:
+                                if read_address not in seen_addresses:
+                                    seen_addresses[read_address] = 1
+                                    set_value = register_bitset[read_address - 15:read_address + 1]
+                                    set_value = struct.unpack('H', set_value.tobytes())[0]
+                                    if read_value == set_value:
+                                        pass
+#                                         if do_latch:
+#                                             print 'Register Test:', 'PxStrobes Bit', pxstrobe+pxstrobe_bit_no, 'DC', dc_no, 'Address', read_address, 'PASSED'
+#                                         else:
+#                                             print 'Register Test:', 'PxStrobes Bit', 'SR', 'DC', dc_no, 'Address', read_address, 'PASSED'
                                     else:
-                                        seen_addresses[read_address] = seen_addresses[read_address] + 1
                                         number_of_errors += 1
                                         if do_latch:
-                                            logging.warning('Pixel Register Test: Multiple occurrence of data for PxStrobes Bit %d at DC %d at address %d', pxstrobe + pxstrobe_bit_no, dc_no, read_address)
+                                            logging.warning('Pixel Register Test: Wrong value at PxStrobes Bit %d at DC %d at address %d (read: %d, expected: %d)', pxstrobe + pxstrobe_bit_no, dc_no, read_address, read_value, set_value)
                                         else:
-                                            logging.warning('Pixel Register Test: Multiple occurrence of data for PxStrobes Bit SR at DC %d at address %d', dc_no, read_address)
-                            else:
-                                # number_of_errors += 1  # will be increased later
-                                logging.warning('Pixel Register Test: Expected Value Record but found %s', fei4_next_data_word)
+                                            logging.warning('Pixel Register Test: Wrong value at PxStrobes Bit SR at DC %d at address %d (read: %d, expected: %d)', dc_no, read_address, read_value, set_value)
+                                else:
+                                    seen_addresses[read_address] = seen_addresses[read_address] + 1
+                                    number_of_errors += 1
+                                    if do_latch:
+                                        logging.warning('Pixel Register Test: Multiple occurrence of data for PxStrobes Bit %d at DC %d at address %d', pxstrobe + pxstrobe_bit_no, dc_no, read_address)
+                                    else:
+                                        logging.warning('Pixel Register Test: Multiple occurrence of data for PxStrobes Bit SR at DC %d at address %d', dc_no, read_address)
+                        else:
+                            # number_of_errors += 1  # will be increased later
+                            logging.warning('Pixel Register Test: Expected Value Record but found %s', get_record_string(records[index + 1], self.register.chip_flavor))
 
                     not_read_addresses = set.difference(set(expected_addresses), seen_addresses.iterkeys())
                     not_read_addresses = list(not_read_addresses)
@@ -562,17 +590,17 @@ def read_global_register(self, name, overwrite_config=False):
     value = BitLogic(register_object['addresses'] * 16)
     index = 0
     vr_count = 0
-    for word in np.nditer(data):
-        fei4_data_word = FEI4Record(word, self.register.chip_flavor)
-        if fei4_data_word == 'AR':
-            address_value = fei4_data_word['address']
+    records = decode_fei4_records(data, self.register.chip_flavor)
+    for record in records[np.in1d(records['record_type'], [record_types.index('AR'), record_types.index('VR')])]:
+        if record['record_type'] == record_types.index('AR'):
+            address_value = int(record['address'])
             if address_value != register_object['address'] + index:
                 raise Exception('Unexpected address from Address Record: read: %d, expected: %d' % (address_value, register_object['address'] + index))
-        elif fei4_data_word == 'VR':
+        else:
             vr_count += 1
             if vr_count >= 2:
                 raise RuntimeError("Read more than 2 value records")
-            read_value = BitLogic.from_value(fei4_data_word['value'], size=16)
+            read_value = BitLogic.from_value(int(record['value']), size=16)
             if register_object['register_littleendian']:
                 read_value.reverse()
             value[index * 16 + 15:index * 16] = read_value
@@ -652,7 +680,7 @@ def is_fe_ready(self):
     data = self.read_data()
 
     if len(data) != 0:
-        return True if FEI4Record(data[-1], self.register.chip_flavor) == 'VR' else False
+        return True if decode_fei4_records(data[-1:], self.register.chip_flavor)['record_type'][0] == record_types.index('VR') else False
     else:
         return False
 
@@ -675,6 +703,45 @@ def invert_pixel_mask(mask):
     return inverted_mask
 
 
+mask_cache_size = 1024  # max. number of cached masks (27kB per mask)
+_mask_cache = OrderedDict()  # least recently used masks first
+_mask_cache_lock = Lock()  # runs of different modules are generating masks in parallel
+
+
+def get_cached_mask(key, make_mask, *args):
+    '''Returns mask from the mask cache. The mask is generated by calling make_mask(*args) if not in the cache.
+
+    Parameters
+    ----------
+    key : tuple
+        Key of the mask, e.g. mask type and parameters.
+    make_mask : function
+        Function generating the mask.
+
+    Returns
+    -------
+    mask_array : numpy.ndarray
+        Mask array (read-only).
+    '''
+    with _mask_cache_lock:
+        try:
+            mask_array = _mask_cache.pop(key)
+        except KeyError:
+            mask_array = make_mask(*args)
+            mask_array.flags.writeable = False  # cached masks are shared
+            if len(_mask_cache) >= mask_cache_size:
+                _mask_cache.popitem(last=False)
+        _mask_cache[key] = mask_array
+    return mask_array
+
+
+def clear_mask_cache():
+    '''Deleting all cached masks.
+    '''
+    with _mask_cache_lock:
+        _mask_cache.clear()
+
+
 def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=None):
     '''Generate pixel mask.
 
@@ -696,7 +763,7 @@ def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=
     Returns
     -------
     mask_array : numpy.ndarray
-        Mask array.
+        Mask array. The array is read-only if no additional mask is given.
 
     Usage
     -----
@@ -711,8 +778,16 @@ def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=
         self.register_utils.send_commands(commands)
         # do something here
     '''
+    enable_columns = tuple(enable_columns) if enable_columns else None
+    mask_array = get_cached_mask(('pixel', steps, shift, default, value, enable_columns), _make_pixel_mask, steps, shift, default, value, enable_columns)
+    if mask is not None:
+        mask_array = mask_array.copy()
+        mask_array[np.asarray(mask, dtype=np.bool_)] = default
+    return mask_array
+
+
+def _make_pixel_mask(steps, shift, default, value, enable_columns):
     shape = (80, 336)
-    # value = np.zeros(dimension, dtype = np.uint8)
     mask_array = np.full(shape, default, dtype=np.uint8)
     # FE columns and rows are starting from 1
     if enable_columns:
@@ -725,16 +800,9 @@ def make_pixel_mask(steps, shift, default=0, value=1, enable_columns=None, mask=
     even_row_offset = ((steps // 2) + shift) % steps  # // integer devision
     even_rows = np.arange(even_row_offset, 336, steps)
     if odd_columns:
-        odd_col_rows = itertools.product(odd_columns, odd_rows)  # get any combination of column and row, no for loop needed
-        for odd_col_row in odd_col_rows:
-            mask_array[odd_col_row[0], odd_col_row[1]] = value  # advanced indexing
+        mask_array[np.ix_(odd_columns, odd_rows)] = value  # any combination of column and row
     if even_columns:
-        even_col_rows = itertools.product(even_columns, even_rows)
-        for even_col_row in even_col_rows:
-            mask_array[even_col_row[0], even_col_row[1]] = value
-    if mask is not None:
-        mask_array = np.ma.array(mask_array, mask=mask, fill_value=default)
-        mask_array = mask_array.filled()
+        mask_array[np.ix_(even_columns, even_rows)] = value
     return mask_array
 
 
@@ -827,18 +895,12 @@ def make_xtalk_mask(mask):
      [0 1 0 0 0 1 0 1 0 0 ... 0 0 0 1 0 1 0 0 0 1]
      [0 0 1 0 1 0 0 0 1 0 ... 1 0 1 0 0 0 1 0 1 0]]
     """
-    col, row = mask.nonzero()
-    row_plus_one = row + 1
-    del_index = np.where(row_plus_one > 335)
-    row_plus_one = np.delete(row_plus_one, del_index)
-    col_plus_one = np.delete(col.copy(), del_index)
-    row_minus_one = row - 1
-    del_index = np.where(row_minus_one > 335)
-    row_minus_one = np.delete(row_minus_one, del_index)
-    col_minus_one = np.delete(col.copy(), del_index)
-    col = np.concatenate((col_plus_one, col_minus_one))
-    row = np.concatenate((row_plus_one, row_minus_one))
-    return make_pixel_mask_from_col_row(col + 1, row + 1)
+    mask = np.asarray(mask) != 0
+    xtalk_mask = np.zeros(shape=(80, 336), dtype=np.uint8)
+    xtalk_mask[:, 1:] |= mask[:, :-1]  # row + 1
+    xtalk_mask[:, :-1] |= mask[:, 1:]  # row - 1
+    xtalk_mask[:, -1] |= mask[:, 0]  # row - 1 of the first row is wrapping around to the last row
+    return xtalk_mask
 
 
 def make_checkerboard_mask(column_distance, row_distance, column_offset=0, row_offset=0, default=0, value=1):
@@ -875,7 +937,13 @@ def make_checkerboard_mask(column_distance, row_distance, column_offset=0, row_o
      [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]
      [0 0 0 1 0 0 0 0 0 1 ... 0 1 0 0 0 0 0 1 0 0]
      [0 0 0 0 0 0 0 0 0 0 ... 0 0 0 0 0 0 0 0 0 0]]
+
+    The returned array is read-only.
     """
+    return get_cached_mask(('checkerboard', column_distance, row_distance, column_offset, row_offset, default, value), _make_checkerboard_mask, column_distance, row_distance, column_offset, row_offset, default, value)
+
+
+def _make_checkerboard_mask(column_distance, row_distance, column_offset, row_offset, default, value):
     col_shape = (336,)
     col = np.full(col_shape, fill_value=default, dtype=np.uint8)
     col[::row_distance] = value
@@ -949,304 +1017,414 @@ def scan_loop(self, command, repeat_command=100, use_delay=True, additional_dela
         Additional mask. Must be convertible to an array of booleans with the same shape as mask array. True indicates a masked pixel. Masked pixels will be disabled during shifting of the enable shift masks, and enabled during shifting disable shift mask.
     double_column_correction : str, bool, list, tuple
         Enables double column PlsrDAC correction. If value is a filename (string) or list/tuple, the default PlsrDAC correction will be overwritten. First line of the file must be a Python list ([0, 0, ...])
+
+    Note: When calling the scan loop repeatedly with the same configuration (e.g. during tuning), use ScanLoopSequence to create the commands only once.
     '''
-    if not isinstance(command, bitarray):
-        raise TypeError
-
-    if enable_shift_masks is None:
-        enable_shift_masks = ["Enable", "C_High", "C_Low"]
-
-    if disable_shift_masks is None:
-        disable_shift_masks = []
-
-    # get PlsrDAC correction
-    if isinstance(double_column_correction, basestring):  # from file
-        with open(double_column_correction) as fp:
-            plsr_dac_correction = list(literal_eval(fp.readline().strip()))
-    elif isinstance(double_column_correction, (list, tuple)):  # from list/tuple
-        plsr_dac_correction = list(double_column_correction)
-    else:  # default
-        if "C_High".lower() in map(lambda x: x.lower(), enable_shift_masks) and "C_Low".lower() in map(lambda x: x.lower(), enable_shift_masks):
-            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_High']
-        elif "C_High".lower() in map(lambda x: x.lower(), enable_shift_masks):
-            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_Med']
-        elif "C_Low".lower() in map(lambda x: x.lower(), enable_shift_masks):
-            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_Low']
-    # initial PlsrDAC value for PlsrDAC correction
-    initial_plsr_dac = self.register.get_global_register_value("PlsrDAC")
-    # create restore point
-    restore_point_name = str(self.run_number) + '_' + self.run_id + '_scan_loop'
-    with self.register.restored(name=restore_point_name):
-        # pre-calculate often used commands
-        conf_mode_command = self.register.get_commands("ConfMode")[0]
-        run_mode_command = self.register.get_commands("RunMode")[0]
-        if use_delay:
-            delay = self.register.get_commands("zeros", length=additional_delay + calculate_wait_cycles(mask_steps))[0]
-            scan_loop_command = command + delay
-        else:
-            scan_loop_command = command
-
-        def enable_columns(dc):
-            if digital_injection:
-                return [dc * 2 + 1, dc * 2 + 2]
-            else:  # analog injection
-                if dc == 0:
-                    return [1]
-                elif dc == 39:
-                    return [78, 79, 80]
-                else:
-                    return [dc * 2, dc * 2 + 1]
-
-        def write_double_columns(dc):
-            if digital_injection:
-                return [dc]
-            else:  # analog injection
-                if dc == 0:
-                    return [0]
-                elif dc == 39:
-                    return [38, 39]
-                else:
-                    return [dc - 1, dc]
+    ScanLoopSequence(command=command, repeat_command=repeat_command, use_delay=use_delay, additional_delay=additional_delay, mask_steps=mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop, digital_injection=digital_injection, enable_shift_masks=enable_shift_masks, disable_shift_masks=disable_shift_masks, mask=mask, double_column_correction=double_column_correction).run(self, bol_function=bol_function, eol_function=eol_function, restore_shift_masks=restore_shift_masks)
 
-        def get_dc_address_command(dc):
-            commands = []
-            commands.append(conf_mode_command)
-            self.register.set_global_register_value("Colpr_Addr", dc)
-            commands.append(self.register.get_commands("WrRegister", name=["Colpr_Addr"])[0])
-            if double_column_correction:
-                self.register.set_global_register_value("PlsrDAC", initial_plsr_dac + int(round(plsr_dac_correction[dc])))
-                commands.append(self.register.get_commands("WrRegister", name=["PlsrDAC"])[0])
-            commands.append(run_mode_command)
-            return self.register_utils.concatenate_commands(commands, byte_padding=True)
-
-        if not enable_mask_steps:
-            enable_mask_steps = range(mask_steps)
-
-        if not enable_double_columns:
-            enable_double_columns = range(40)
-
-        # preparing for scan
-        commands = []
-        commands.append(conf_mode_command)
+
+class ScanLoopSequence(object):
+    '''Scan loop (see scan_loop()) with commands created only once.
+
+    The commands of each mask step and double column are created when they are needed for the first time and are stored as command data (byte buffers).
+    When running the scan loop again, the stored command data is written into the command memory. Only the commands writing global registers which were changed since the last run
+    (e.g. PlsrDAC if double column correction is enabled) and the commands restoring the shift masks (if the pixel registers were changed) are created again.
+
+    Parameters
+    ----------
+    The parameters are the same as for scan_loop(). The parameters bol_function, eol_function and restore_shift_masks are given to run().
+    '''
+    def __init__(self, command, repeat_command=100, use_delay=True, additional_delay=0, mask_steps=3, enable_mask_steps=None, enable_double_columns=None, same_mask_for_all_dc=False, fast_dc_loop=True, digital_injection=False, enable_shift_masks=None, disable_shift_masks=None, mask=None, double_column_correction=False):
+        if not isinstance(command, bitarray):
+            raise TypeError
+        self.command = command
+        self.repeat_command = repeat_command
+        self.use_delay = use_delay
+        self.additional_delay = additional_delay
+        self.mask_steps = mask_steps
+        self.enable_mask_steps = list(enable_mask_steps) if enable_mask_steps else range(mask_steps)
+        self.enable_double_columns = list(enable_double_columns) if enable_double_columns else range(40)
+        self.same_mask_for_all_dc = same_mask_for_all_dc
+        self.fast_dc_loop = fast_dc_loop
+        self.digital_injection = digital_injection
+        self.enable_shift_masks = ["Enable", "C_High", "C_Low"] if enable_shift_masks is None else enable_shift_masks
+        self.disable_shift_masks = [] if disable_shift_masks is None else disable_shift_masks
+        self.mask = mask
+        self.double_column_correction = double_column_correction
         if digital_injection is True:
             # check if C_High and/or C_Low is in enable_shift_mask and/or disable_shift_mask
-            if "C_High".lower() in map(lambda x: x.lower(), enable_shift_masks) or "C_High".lower() in map(lambda x: x.lower(), disable_shift_masks):
+            if "C_High".lower() in map(lambda x: x.lower(), self.enable_shift_masks) or "C_High".lower() in map(lambda x: x.lower(), self.disable_shift_masks):
                 raise ValueError('C_High must not be shift mask when using digital injection')
-            if "C_Low".lower() in map(lambda x: x.lower(), enable_shift_masks) or "C_Low".lower() in map(lambda x: x.lower(), disable_shift_masks):
+            if "C_Low".lower() in map(lambda x: x.lower(), self.enable_shift_masks) or "C_Low".lower() in map(lambda x: x.lower(), self.disable_shift_masks):
                 raise ValueError('C_Low must not be shift mask when using digital injection')
-            # turn off all injection capacitors by default
-            self.register.set_pixel_register_value("C_High", 0)
-            self.register.set_pixel_register_value("C_Low", 0)
-            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=["C_Low", "C_High"], joint_write=True))
-            self.register.set_global_register_value("DIGHITIN_SEL", 1)
-    # self.register.set_global_register_value("CalEn", 1)  # for GlobalPulse instead Cal-Command
+        self._command_data = {}  # command data of each step of the scan loop
+        self._written_addresses = {}  # global register addresses written by each step of the scan loop
+        self._chip_id = None
+        self._global_register_values = None
+        self._plsr_dac_correction = None
+        self._restore_pixel_register_values = None
+
+    def _get_plsr_dac_correction(self, register):
+        if isinstance(self.double_column_correction, basestring):  # from file
+            with open(self.double_column_correction) as fp:
+                return list(literal_eval(fp.readline().strip()))
+        elif isinstance(self.double_column_correction, (list, tuple)):  # from list/tuple
+            return list(self.double_column_correction)
+        else:  # default
+            if "C_High".lower() in map(lambda x: x.lower(), self.enable_shift_masks) and "C_Low".lower() in map(lambda x: x.lower(), self.enable_shift_masks):
+                return register.calibration_parameters['Pulser_Corr_C_Inj_High']
+            elif "C_High".lower() in map(lambda x: x.lower(), self.enable_shift_masks):
+                return register.calibration_parameters['Pulser_Corr_C_Inj_Med']
+            elif "C_Low".lower() in map(lambda x: x.lower(), self.enable_shift_masks):
+                return register.calibration_parameters['Pulser_Corr_C_Inj_Low']
+
+    def _update(self, register, plsr_dac_correction):
+        '''Removes the command data which has to be created again because of changed register values.
+        '''
+        if self._chip_id != register.chip_id or self._plsr_dac_correction != plsr_dac_correction:
+            self._command_data.clear()
+            self._written_addresses.clear()
+            self._chip_id = register.chip_id
+            self._plsr_dac_correction = plsr_dac_correction
+        global_register_values = dict((name, register_object['value']) for name, register_object in register.global_registers.iteritems())
+        if self._global_register_values is not None:
+            changed_addresses = set()
+            for name, value in global_register_values.iteritems():
+                if value != self._global_register_values[name]:
+                    changed_addresses.update(register.global_registers[name]['addresses'])
+            if changed_addresses:
+                for key in [key for key, addresses in self._written_addresses.iteritems() if not addresses.isdisjoint(changed_addresses)]:
+                    del self._command_data[key]
+                    del self._written_addresses[key]
+        self._global_register_values = global_register_values
+        restore_pixel_register_values = [register.get_pixel_register_value(name).copy() for name in self.disable_shift_masks + self.enable_shift_masks + ["EnableDigInj"]]
+        if self._restore_pixel_register_values is None or not all(np.array_equal(value, restore_value) for value, restore_value in zip(self._restore_pixel_register_values, restore_pixel_register_values)):
+            self._command_data.pop('restore_shift_masks', None)
+            self._written_addresses.pop('restore_shift_masks', None)
+        self._restore_pixel_register_values = restore_pixel_register_values
+
+    def _get_command_data(self, run, key, get_commands, set_registers=None, concatenate=False):
+        '''Returns the command data of a step of the scan loop.
+
+        Parameters
+        ----------
+        run : pybar.fei4_run_base.Fei4RunBase
+            The run object.
+        key : tuple, string
+            Key of the step.
+        get_commands : function
+            Function returning the list of commands. The register values are set like during the scan loop.
+        set_registers : function
+            Function setting the register values like get_commands(), called if the command data already exists.
+        concatenate : bool
+            If True, the commands are concatenated like in send_commands().
+        '''
+        try:
+            command_data = self._command_data[key]
+        except KeyError:
+            pass
         else:
-            self.register.set_global_register_value("DIGHITIN_SEL", 0)
-            # setting EnableDigInj to 0 not necessary since DIGHITIN_SEL is turned off
-    #             self.register.set_pixel_register_value("EnableDigInj", 0)
-
-    # plotting registers
-    #     plt.clf()
-    #     plt.imshow(curr_en_mask.T, interpolation='nearest', aspect="auto")
-    #     plt.pcolor(curr_en_mask.T)
-    #     plt.colorbar()
-    #     plt.savefig('mask_step' + str(mask_step) + '.pdf')
-
-        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-        self.register_utils.send_commands(commands)
-
-        for mask_step in enable_mask_steps:
-            if self.abort_run.is_set():
-                break
-            commands = []
-            commands.append(conf_mode_command)
-            if same_mask_for_all_dc:  # generate and write first mask step
-                if disable_shift_masks:
-                    curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, mask=mask)
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=disable_shift_masks, joint_write=True))
-                if enable_shift_masks:
-                    curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, mask=mask)
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=enable_shift_masks, joint_write=True))
-                if digital_injection is True:  # write EnableDigInj last
+            if set_registers:
+                set_registers()
+            return command_data
+        with run.register.record_written_addresses() as written_addresses:
+            commands = get_commands()
+        if concatenate:
+            command_data = run.register_utils.prepare_commands(commands)
+        else:
+            command_data = [(bitarray_to_array(command), command.length()) for command in commands]
+        self._command_data[key] = command_data
+        self._written_addresses[key] = written_addresses
+        return command_data
+
+    def run(self, run, bol_function=None, eol_function=None, restore_shift_masks=True):
+        '''Runs the scan loop.
+
+        Parameters
+        ----------
+        run : pybar.fei4_run_base.Fei4RunBase
+            The run object (self in scan_loop()).
+        bol_function : function
+            Begin of loop function that will be called each time before sending command. Argument is a function pointer (without braces) or functor.
+        eol_function : function
+            End of loop function that will be called each time after sending command. Argument is a function pointer (without braces) or functor.
+        restore_shift_masks : bool
+            Writing the initial (restored) FE pixel configuration into FE after finishing the scan loop.
+        '''
+        register, register_utils, dut = run.register, run.register_utils, run.dut
+        # get PlsrDAC correction
+        plsr_dac_correction = self._get_plsr_dac_correction(register)
+        self._update(register, plsr_dac_correction)
+        # initial PlsrDAC value for PlsrDAC correction
+        initial_plsr_dac = register.get_global_register_value("PlsrDAC")
+        # create restore point
+        restore_point_name = str(run.run_number) + '_' + run.run_id + '_scan_loop'
+        with register.restored(name=restore_point_name):
+            # pre-calculate often used commands
+            conf_mode_command = register.get_commands("ConfMode")[0]
+            run_mode_command = register.get_commands("RunMode")[0]
+            if self.use_delay:
+                delay = register.get_commands("zeros", length=self.additional_delay + calculate_wait_cycles(self.mask_steps))[0]
+                scan_loop_command = self.command + delay
+            else:
+                scan_loop_command = self.command
+
+            def enable_columns(dc):
+                if self.digital_injection:
+                    return [dc * 2 + 1, dc * 2 + 2]
+                else:  # analog injection
+                    if dc == 0:
+                        return [1]
+                    elif dc == 39:
+                        return [78, 79, 80]
+                    else:
+                        return [dc * 2, dc * 2 + 1]
+
+            def write_double_columns(dc):
+                if self.digital_injection:
+                    return [dc]
+                else:  # analog injection
+                    if dc == 0:
+                        return [0]
+                    elif dc == 39:
+                        return [38, 39]
+                    else:
+                        return [dc - 1, dc]
+
+            def set_dc_address_registers(dc):
+                register.set_global_register_value("Colpr_Addr", dc)
+                if self.double_column_correction:
+                    register.set_global_register_value("PlsrDAC", initial_plsr_dac + int(round(plsr_dac_correction[dc])))
+
+            def get_dc_address_command(dc):
+                commands = []
+                commands.append(conf_mode_command)
+                register.set_global_register_value("Colpr_Addr", dc)
+                commands.append(register.get_commands("WrRegister", name=["Colpr_Addr"])[0])
+                if self.double_column_correction:
+                    register.set_global_register_value("PlsrDAC", initial_plsr_dac + int(round(plsr_dac_correction[dc])))
+                    commands.append(register.get_commands("WrRegister", name=["PlsrDAC"])[0])
+                commands.append(run_mode_command)
+                return register_utils.concatenate_commands(commands, byte_padding=True)
+
+            def get_dc_address_command_data(dc):
+                return self._get_command_data(run, ('dc_address', dc), lambda: [get_dc_address_command(dc)], lambda: set_dc_address_registers(dc))[0]
+
+            def get_dc_address_scan_loop_command_data(dc):
+                return self._get_command_data(run, ('dc_address_scan_loop', dc), lambda: [register_utils.concatenate_commands((get_dc_address_command(dc), scan_loop_command), byte_padding=False)], lambda: set_dc_address_registers(dc))[0]
+
+            def set_shift_mask_registers(mask_step, ec=None):
+                if self.disable_shift_masks:
+                    curr_dis_mask = make_pixel_mask(steps=self.mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=self.mask)
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, curr_dis_mask), self.disable_shift_masks)
+                if self.enable_shift_masks:
+                    curr_en_mask = make_pixel_mask(steps=self.mask_steps, shift=mask_step, enable_columns=ec, mask=self.mask)
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, curr_en_mask), self.enable_shift_masks)
+                if self.digital_injection is True:
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+
+            def get_shift_mask_commands(mask_step, ec=None, dcs=None):
+                commands = []
+                commands.append(conf_mode_command)
+                if self.disable_shift_masks:
+                    curr_dis_mask = make_pixel_mask(steps=self.mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=self.mask)
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, curr_dis_mask), self.disable_shift_masks)
+                    if dcs is None:
+                        commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if self.mask is not None else True, name=self.disable_shift_masks, joint_write=True))
+                    else:
+                        commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=self.disable_shift_masks, joint_write=True))
+                if self.enable_shift_masks:
+                    curr_en_mask = make_pixel_mask(steps=self.mask_steps, shift=mask_step, enable_columns=ec, mask=self.mask)
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, curr_en_mask), self.enable_shift_masks)
+                    if dcs is None:
+                        commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if self.mask is not None else True, name=self.enable_shift_masks, joint_write=True))
+                    else:
+                        commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=self.enable_shift_masks, joint_write=True))
+                if self.digital_injection is True:  # write EnableDigInj last
                     # write DIGHITIN_SEL since after mask writing it is disabled
-                    self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-            else:  # set masks to default values
-                if disable_shift_masks:
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 1), disable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=disable_shift_masks, joint_write=True))
-                if enable_shift_masks:
-                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 0), enable_shift_masks)
-                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=enable_shift_masks, joint_write=True))
-                if digital_injection is True:  # write EnableDigInj last
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+                    commands.extend(register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+                return commands
+
+            def get_loop_state():
+                # the pixel register writing restores the global registers at the written addresses, the values of these registers are changed inside the scan loop
+                return tuple(register.get_global_register_value(name) for name in ["Colpr_Addr", "PlsrDAC", "DIGHITIN_SEL"])
+
+            def get_dc_shift_mask_command_data(mask_step, index):
+                dc = self.enable_double_columns[index]
+                ec = enable_columns(dc)
+                dcs = write_double_columns(dc)
+                if index != 0:
+                    dcs.extend(write_double_columns(self.enable_double_columns[index - 1]))
+                return self._get_command_data(run, ('shift_masks', mask_step, index, get_loop_state()), lambda: get_shift_mask_commands(mask_step, ec=ec, dcs=dcs), lambda: set_shift_mask_registers(mask_step, ec=ec), concatenate=True)
+
+            def set_default_mask_registers():
+                if self.disable_shift_masks:
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, 1), self.disable_shift_masks)
+                if self.enable_shift_masks:
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, 0), self.enable_shift_masks)
+                if self.digital_injection is True:
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+
+            def get_default_mask_commands():
+                commands = []
+                commands.append(conf_mode_command)
+                if self.disable_shift_masks:
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, 1), self.disable_shift_masks)
+                    commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=self.disable_shift_masks, joint_write=True))
+                if self.enable_shift_masks:
+                    map(lambda mask_name: register.set_pixel_register_value(mask_name, 0), self.enable_shift_masks)
+                    commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=self.enable_shift_masks, joint_write=True))
+                if self.digital_injection is True:  # write EnableDigInj last
                     # write DIGHITIN_SEL since after mask writing it is disabled
-                    self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-            self.register_utils.send_commands(commands)
-            logging.info('%d injection(s): mask step %d %s', repeat_command, mask_step, ('[%d - %d]' % (enable_mask_steps[0], enable_mask_steps[-1])) if len(enable_mask_steps) > 1 else ('[%d]' % enable_mask_steps[0]))
-
-            if same_mask_for_all_dc:
-                if fast_dc_loop:  # fast DC loop with optimized pixel register writing
-                    # set repeat, should be 1 by default when arriving here
-                    self.dut['TX']['CMD_REPEAT'] = repeat_command
-
-                    # get DC command for the first DC in the list, DC command is byte padded
-                    # fill CMD memory with DC command and scan loop command, inside the loop only overwrite DC command
-                    dc_address_command = get_dc_address_command(enable_double_columns[0])
-                    self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                    self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
-
-                    for index, dc in enumerate(enable_double_columns):
-                        if self.abort_run.is_set():
-                            break
-                        if index != 0:  # full command is already set before loop
-                            # get DC command before wait to save some time
-                            dc_address_command = get_dc_address_command(dc)
-                            self.register_utils.wait_for_command()
-                            if eol_function:
-                                eol_function()  # do this after command has finished
-                            # only set command after FPGA is ready
-                            # overwrite only the DC command in CMD memory
-                            self.register_utils.set_command(dc_address_command, set_length=False)  # do not set length here, because it was already set up before the loop
-
-                        if bol_function:
-                            bol_function()
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+                    commands.extend(register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+                return commands
+
+            def set_preparation_registers():
+                if self.digital_injection is True:
+                    register.set_pixel_register_value("C_High", 0)
+                    register.set_pixel_register_value("C_Low", 0)
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+                else:
+                    register.set_global_register_value("DIGHITIN_SEL", 0)
+
+            def get_preparation_commands():
+                commands = []
+                commands.append(conf_mode_command)
+                if self.digital_injection is True:
+                    # turn off all injection capacitors by default
+                    register.set_pixel_register_value("C_High", 0)
+                    register.set_pixel_register_value("C_Low", 0)
+                    commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=["C_Low", "C_High"], joint_write=True))
+                    register.set_global_register_value("DIGHITIN_SEL", 1)
+                else:
+                    register.set_global_register_value("DIGHITIN_SEL", 0)
+                    # setting EnableDigInj to 0 not necessary since DIGHITIN_SEL is turned off
+                commands.extend(register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+                return commands
+
+            # preparing for scan
+            register_utils.send_prepared_commands(self._get_command_data(run, 'preparation', get_preparation_commands, set_preparation_registers, concatenate=True))
+
+            for mask_step in self.enable_mask_steps:
+                if run.abort_run.is_set():
+                    break
+                if self.same_mask_for_all_dc:  # generate and write first mask step
+                    register_utils.send_prepared_commands(self._get_command_data(run, ('shift_masks', mask_step, get_loop_state()), lambda: get_shift_mask_commands(mask_step), lambda: set_shift_mask_registers(mask_step), concatenate=True))
+                else:  # set masks to default values
+                    register_utils.send_prepared_commands(self._get_command_data(run, ('default_masks', get_loop_state()), get_default_mask_commands, set_default_mask_registers, concatenate=True))
+                logging.info('%d injection(s): mask step %d %s', self.repeat_command, mask_step, ('[%d - %d]' % (self.enable_mask_steps[0], self.enable_mask_steps[-1])) if len(self.enable_mask_steps) > 1 else ('[%d]' % self.enable_mask_steps[0]))
+
+                if self.same_mask_for_all_dc:
+                    if self.fast_dc_loop:  # fast DC loop with optimized pixel register writing
+                        # set repeat, should be 1 by default when arriving here
+                        dut['TX']['CMD_REPEAT'] = self.repeat_command
+
+                        # get DC command for the first DC in the list, DC command is byte padded
+                        # fill CMD memory with DC command and scan loop command, inside the loop only overwrite DC command
+                        dc_address_command_data, dc_address_command_length = get_dc_address_command_data(self.enable_double_columns[0])
+                        dut['TX']['START_SEQUENCE_LENGTH'] = dc_address_command_length
+                        register_utils.set_command_data(*get_dc_address_scan_loop_command_data(self.enable_double_columns[0]))
+
+                        for index, dc in enumerate(self.enable_double_columns):
+                            if run.abort_run.is_set():
+                                break
+                            if index != 0:  # full command is already set before loop
+                                # get DC command before wait to save some time
+                                dc_address_command_data, dc_address_command_length = get_dc_address_command_data(dc)
+                                register_utils.wait_for_command()
+                                if eol_function:
+                                    eol_function()  # do this after command has finished
+                                # only set command after FPGA is ready
+                                # overwrite only the DC command in CMD memory
+                                register_utils.set_command_data(dc_address_command_data, dc_address_command_length, set_length=False)  # do not set length here, because it was already set up before the loop
+
+                            if bol_function:
+                                bol_function()
+
+                            dut['TX']['START']
+
+                        # wait here before we go on because we just jumped out of the loop
+                        register_utils.wait_for_command()
+                        if eol_function:
+                            eol_function()
+                        dut['TX']['START_SEQUENCE_LENGTH'] = 0
 
-                        self.dut['TX']['START']
+                    else:  # the slow DC loop allows writing commands inside bol and eol functions
+                        for index, dc in enumerate(self.enable_double_columns):
+                            if run.abort_run.is_set():
+                                break
+                            register_utils.send_command_data(*get_dc_address_command_data(dc))
 
-                    # wait here before we go on because we just jumped out of the loop
-                    self.register_utils.wait_for_command()
-                    if eol_function:
-                        eol_function()
-                    self.dut['TX']['START_SEQUENCE_LENGTH'] = 0
+                            if bol_function:
+                                bol_function()
 
-                else:  # the slow DC loop allows writing commands inside bol and eol functions
-                    for index, dc in enumerate(enable_double_columns):
-                        if self.abort_run.is_set():
-                            break
-                        dc_address_command = get_dc_address_command(dc)
-                        self.register_utils.send_command(dc_address_command)
+                            register_utils.send_command_data(*self._get_command_data(run, 'scan_loop', lambda: [scan_loop_command])[0], repeat=self.repeat_command)
 
-                        if bol_function:
-                            bol_function()
+                            if eol_function:
+                                eol_function()
 
-                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                else:
+                    if self.fast_dc_loop:  # fast DC loop with optimized pixel register writing
+                        register_utils.send_prepared_commands(get_dc_shift_mask_command_data(mask_step, 0))
 
-                        if eol_function:
-                            eol_function()
+                        dc_address_command_data, dc_address_command_length = get_dc_address_command_data(self.enable_double_columns[0])
+                        dut['TX']['START_SEQUENCE_LENGTH'] = dc_address_command_length
+                        dut['TX']['CMD_REPEAT'] = self.repeat_command
+                        register_utils.set_command_data(*get_dc_address_scan_loop_command_data(self.enable_double_columns[0]))
 
-            else:
-                if fast_dc_loop:  # fast DC loop with optimized pixel register writing
-                    dc = enable_double_columns[0]
-                    ec = enable_columns(dc)
-                    dcs = write_double_columns(dc)
-                    commands = []
-                    commands.append(conf_mode_command)
-                    if disable_shift_masks:
-                        curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                        map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                    if enable_shift_masks:
-                        curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                        map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                    if digital_injection is True:
-                        self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                    self.register_utils.send_commands(commands)
+                        for index, dc in enumerate(self.enable_double_columns):
+                            if run.abort_run.is_set():
+                                break
+                            if index != 0:  # full command is already set before loop
+                                shift_mask_command_data = get_dc_shift_mask_command_data(mask_step, index)
+                                dc_address_command_data, dc_address_command_length = get_dc_address_command_data(dc)
 
-                    dc_address_command = get_dc_address_command(dc)
-                    self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                    self.dut['TX']['CMD_REPEAT'] = repeat_command
-                    self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
-
-                    for index, dc in enumerate(enable_double_columns):
-                        if self.abort_run.is_set():
-                            break
-                        if index != 0:  # full command is already set before loop
-                            ec = enable_columns(dc)
-                            dcs = write_double_columns(dc)
-                            dcs.extend(write_double_columns(enable_double_columns[index - 1]))
-                            commands = []
-                            commands.append(conf_mode_command)
-                            if disable_shift_masks:
-                                curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                            if enable_shift_masks:
-                                curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                            if digital_injection is True:
-                                self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                                commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                            dc_address_command = get_dc_address_command(dc)
-
-                            self.register_utils.wait_for_command()
-                            if eol_function:
-                                eol_function()  # do this after command has finished
-                            self.register_utils.send_commands(commands)
+                                register_utils.wait_for_command()
+                                if eol_function:
+                                    eol_function()  # do this after command has finished
+                                register_utils.send_prepared_commands(shift_mask_command_data)
 
-                            self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
-                            self.dut['TX']['CMD_REPEAT'] = repeat_command
-                            self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
+                                dut['TX']['START_SEQUENCE_LENGTH'] = dc_address_command_length
+                                dut['TX']['CMD_REPEAT'] = self.repeat_command
+                                register_utils.set_command_data(*get_dc_address_scan_loop_command_data(dc))
 
-                        if bol_function:
-                            bol_function()
+                            if bol_function:
+                                bol_function()
 
-                        self.dut['TX']['START']
+                            dut['TX']['START']
 
-                    self.register_utils.wait_for_command()
-                    if eol_function:
-                        eol_function()
-                    self.dut['TX']['START_SEQUENCE_LENGTH'] = 0
+                        register_utils.wait_for_command()
+                        if eol_function:
+                            eol_function()
+                        dut['TX']['START_SEQUENCE_LENGTH'] = 0
 
-                else:
-                    for index, dc in enumerate(enable_double_columns):
-                        if self.abort_run.is_set():
-                            break
-                        ec = enable_columns(dc)
-                        dcs = write_double_columns(dc)
-                        if index != 0:
-                            dcs.extend(write_double_columns(enable_double_columns[index - 1]))
-                        commands = []
-                        commands.append(conf_mode_command)
-                        if disable_shift_masks:
-                            curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
-                            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
-                            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
-                        if enable_shift_masks:
-                            curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
-                            map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
-                            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
-                        if digital_injection is True:
-                            self.register.set_global_register_value("DIGHITIN_SEL", 1)
-                            commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
-                        self.register_utils.send_commands(commands)
+                    else:
+                        for index, dc in enumerate(self.enable_double_columns):
+                            if run.abort_run.is_set():
+                                break
+                            register_utils.send_prepared_commands(get_dc_shift_mask_command_data(mask_step, index))
 
-                        dc_address_command = get_dc_address_command(dc)
-                        self.register_utils.send_command(dc_address_command)
+                            register_utils.send_command_data(*get_dc_address_command_data(dc))
 
-                        if bol_function:
-                            bol_function()
+                            if bol_function:
+                                bol_function()
 
-                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                            register_utils.send_command_data(*self._get_command_data(run, 'scan_loop', lambda: [scan_loop_command])[0], repeat=self.repeat_command)
 
-                        if eol_function:
-                            eol_function()
+                            if eol_function:
+                                eol_function()
 
-    commands = []
-    commands.extend(self.register.get_commands("ConfMode"))
-    # write registers that were changed in scan_loop()
-    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL", "Colpr_Addr", "PlsrDAC"]))
-    if restore_shift_masks:
-        commands = []
-        commands.extend(self.register.get_commands("ConfMode"))
-        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL", "Colpr_Addr", "PlsrDAC"]))
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=disable_shift_masks))
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=enable_shift_masks))
-        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name="EnableDigInj"))
-#     commands.extend(self.register.get_commands("RunMode"))
-    self.register_utils.send_commands(commands)
+        def get_restore_commands():
+            commands = []
+            commands.extend(register.get_commands("ConfMode"))
+            # write registers that were changed in scan_loop()
+            commands.extend(register.get_commands("WrRegister", name=["DIGHITIN_SEL", "Colpr_Addr", "PlsrDAC"]))
+            if restore_shift_masks:
+                commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=self.disable_shift_masks))
+                commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=self.enable_shift_masks))
+                commands.extend(register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name="EnableDigInj"))
+            return commands
+
+        register_utils.send_prepared_commands(self._get_command_data(run, 'restore_shift_masks' if restore_shift_masks else 'restore', get_restore_commands, concatenate=True))
@@ -7,7 +7,8 @@ import struct
 import smtplib
 from socket import gethostname
 from functools import wraps
-from threading import Event, Thread, current_thread, Lock, RLock
+from threading import Event, Thread, current_thread, Lock, RLock, Condition
+from multiprocessing import cpu_count
 from Queue import Queue
 from collections import namedtuple, Mapping, Iterable
 from contextlib import contextmanager
@@ -16,6 +17,13 @@ import abc
 import ast
 import inspect
 import sys
+import traceback
+import pickle
+import imp
+import shutil
+import subprocess
+import tempfile
+from importlib import import_module
 
 from contextlib2 import ExitStack
 import numpy as np
@@ -29,8 +37,8 @@ from pybar.fei4.register import FEI4Register
 from pybar.fei4.register import flavors as fe_flavors
 from pybar.fei4.register_utils import FEI4RegisterUtils, is_fe_ready
 from pybar.daq.fifo_readout import FifoReadout, RxSyncError, EightbTenbError, FifoError, NoDataTimeout, StopTimeout
-from pybar.daq.readout_utils import save_configuration_dict
-from pybar.daq.fei4_raw_data import open_raw_data_file, send_meta_data
+from pybar.daq.readout_utils import save_configuration_dict, OccupancyAccumulator
+from pybar.daq.fei4_raw_data import open_raw_data_file
 from pybar.analysis.analysis_utils import AnalysisError
 from pybar.daq.readout_utils import logical_or, logical_and, is_trigger_word, is_fe_word, is_data_from_channel, is_tdc_word, is_tdc_from_channel, convert_tdc_to_channel, false
 
@@ -38,6 +46,68 @@ from pybar.daq.readout_utils import logical_or, logical_and, is_trigger_word, is
 _reserved_driver_names = ["FIFO", "TX", "RX", "TLU", "TDC"]
 
 
+class LogRecordCollector(logging.Handler):
+    '''Collecting log records, which can be sent to another process.
+    '''
+    def __init__(self, records):
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def analysis_process(state_file_name, result_file_name):
+    ''' Analyzing the data of a module in a new Python interpreter (see Fei4RunBase._analyze_in_processes()).
+
+    The run object is restored from the state file without accessing the hardware.
+    The log records, the register configuration and the exception (if any) are written to the result file.
+    '''
+    records = []
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(LogRecordCollector(records))
+    register_configuration = None
+    exc = None
+    try:
+        with open(state_file_name, 'rb') as state_file:
+            state = pickle.load(state_file)
+        logger.setLevel(state['log_level'])
+        module_name, file_name, class_name = state['run_class']
+        if module_name == '__main__':  # run class defined in a script, load script without executing the main block
+            sys.modules['__main__'] = imp.load_source('pybar_analysis_main', file_name)
+        run_class = getattr(sys.modules['__main__'] if module_name == '__main__' else import_module(module_name), class_name)
+        run = run_class.__new__(run_class)
+        run.__dict__.update({'stop_run': Event(), 'abort_run': Event(), 'err_queue': Queue(), 'global_lock': RLock()})
+        for name, value in state['attributes'].iteritems():
+            run.__dict__[name] = pickle.loads(value)
+        module_id = state['module_id']
+        run.__dict__['_current_module_handle'] = module_id  # select module without enabling the TX channels
+        run.__dict__['_register_utils'] = {module_id: FEI4RegisterUtils(None, run._registers[module_id])}  # without hardware access
+        current_thread().name = module_id
+        run.analyze()
+        register_configuration = (run.register.global_registers, run.register.pixel_registers, run.register.calibration_parameters, run.register.miscellaneous)
+    except Exception:
+        exc_value = sys.exc_info()[1]
+        try:
+            pickle.dumps(exc_value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            exc_value = RuntimeError(exc_value.__class__.__name__ + ": " + str(exc_value))
+        exc = (exc_value, traceback.format_exc())
+    try:
+        result = pickle.dumps((records, register_configuration, exc), pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        result = pickle.dumps(([], None, (RuntimeError('Cannot transfer result of the analysis process'), traceback.format_exc())), pickle.HIGHEST_PROTOCOL)
+    with open(result_file_name, 'wb') as result_file:
+        result_file.write(result)
+
+
 class Fei4RunBase(RunBase):
     '''Basic FEI4 run meta class.
 
@@ -106,16 +176,13 @@ class Fei4RunBase(RunBase):
         self._scan_threads = []  # list of currently running scan threads
         self._curr_readout_threads = []  # list of currently running threads awaiting start of FIFO readout
         self._readout_lock = Lock()
-        self._starting_readout_event = Event()
-        self._starting_readout_event.clear()
-        self._stopping_readout_event = Event()
-        self._stopping_readout_event.clear()
+        self._occupancy_accumulator = None  # histograms of the last readout
+        self._readout_barrier = ThreadBarrier()  # synchronizing start and stop of FIFO readout
         self._curr_sync_threads = []
         self._sync_lock = Lock()
-        self._enter_sync_event = Event()
-        self._enter_sync_event.clear()
-        self._exit_sync_event = Event()
-        self._exit_sync_event.clear()
+        self._sync_barrier = ThreadBarrier()  # synchronizing sections of code
+        self._scan_threads_condition = Condition(Lock())
+        self._finished_scan_threads = []  # list of scan threads which finished executing scan()
         self._parse_module_cfgs()
         self._init_default_run_conf()
         # after initialized is set to True, all new attributes are belonging to selected mudule
@@ -181,6 +248,16 @@ class Fei4RunBase(RunBase):
         if "dut_configuration" not in self._conf or self._conf["dut_configuration"] is None:
             raise ValueError('Parameter "dut_configuration" not defined.')
         self._conf.setdefault('working_dir', None)  # string, if None, absolute path of configuration.yaml file will be used
+        # flush policy of the raw data files, data is written to file when one of the limits is reached, None disables the limit
+        self._conf.setdefault('raw_data_flush_bytes', 2**24)  # size of buffered raw data in bytes
+        self._conf.setdefault('raw_data_flush_rows', None)  # number of buffered readouts
+        self._conf.setdefault('raw_data_flush_interval', 5.0)  # seconds since last flush
+        # sending of the raw data to the address given by send_data of the modules
+        self._conf.setdefault('send_data_mode', 'pub')  # 'pub' (data is dropped if the receiver is too slow) or 'push' (lossless)
+        self._conf.setdefault('send_data_queue_size', 1000)  # number of read outs in the send queue
+        self._conf.setdefault('send_data_hwm', None)  # high water mark of the socket, if None the ZeroMQ default is used
+        # number of processes analyzing the data of the modules in parallel after the run, 1: one after another, None: number of CPUs
+        self._conf.setdefault('analysis_processes', 1)
 
         if 'modules' in self._conf and self._conf['modules']:
             for module_id, module_cfg in [(key, value) for key, value in self._conf['modules'].items() if ("activate" not in value or ("activate" in value and value["activate"] is True))]:
@@ -690,24 +767,10 @@ class Fei4RunBase(RunBase):
                             for module_id in self._tx_module_groups:
                                 if self.abort_run.is_set():
                                     break
-                                t = ExcThread(target=self.scan, name=module_id)
+                                t = ExcThread(target=self._scan_thread_target, name=module_id)
                                 t.daemon = True  # exiting program even when thread is alive
                                 self._scan_threads.append(t)
-                            for t in self._scan_threads:
-                                t.start()
-                            while any([t.is_alive() for t in self._scan_threads]):
-#                                 if self.abort_run.is_set():
-#                                     break
-                                for t in self._scan_threads:
-                                    try:
-                                        t.join(0.01)
-                                    except Exception:
-                                        self._scan_threads.remove(t)
-                                        self.handle_err(sys.exc_info())
-#                             alive_threads = [t.name for t in self._scan_threads if (not t.join(10.0) and t.is_alive())]
-#                             if alive_threads:
-#                                 raise RuntimeError("Scan thread(s) not finished: %s" % ", ".join(alive_threads))
-                            self._scan_threads = []
+                            self._run_scan_threads()
                 for module_id in self._tx_module_groups:
                     if self.abort_run.is_set():
                         break
@@ -761,7 +824,7 @@ class Fei4RunBase(RunBase):
                                 self.configure()
                                 # set modules to run mode by before entering scan()
                                 self.register_utils.set_run_mode()
-                            t = ExcThread(target=self.scan, name=module_id)
+                            t = ExcThread(target=self._scan_thread_target, name=module_id)
                             t.daemon = True  # exiting program even when thread is alive
                             self._scan_threads.append(t)
                         with self.access_module(module_id=tx_module_ids):
@@ -772,21 +835,7 @@ class Fei4RunBase(RunBase):
                             with self.access_files():
                                 # some scans use this event to stop scan loop, clear event here to make another scan possible
                                 self.stop_run.clear()
-                                for t in self._scan_threads:
-                                    t.start()
-                                while any([t.is_alive() for t in self._scan_threads]):
-#                                     if self.abort_run.is_set():
-#                                         break
-                                    for t in self._scan_threads:
-                                        try:
-                                            t.join(0.01)
-                                        except Exception:
-                                            self._scan_threads.remove(t)
-                                            self.handle_err(sys.exc_info())
-#                                 alive_threads = [t.name for t in self._scan_threads if (not t.join(10.0) and t.is_alive())]
-#                                 if alive_threads:
-#                                     raise RuntimeError("Scan thread(s) not finished: %s" % ", ".join(alive_threads))
-                                self._scan_threads = []
+                                self._run_scan_threads()
 
                     for module_id in tx_module_ids:
                         if self.abort_run.is_set():
@@ -821,14 +870,73 @@ class Fei4RunBase(RunBase):
         if self._modules:
             self.fifo_readout.print_readout_status()
 
+    def _scan_thread_target(self):
+        ''' Executing scan() inside a scan thread.
+
+        Finished threads, also those which are raising an exception, are removed from the synchronization barriers so that the remaining threads are not blocked.
+        '''
+        try:
+            self.scan()
+        finally:
+            name = current_thread().name
+            self._sync_barrier.remove_party(name)
+            self._readout_barrier.remove_party(name)
+            with self._scan_threads_condition:
+                self._finished_scan_threads.append(name)
+                self._scan_threads_condition.notify_all()
+
+    def _run_scan_threads(self):
+        ''' Starting the scan threads and waiting for the scan threads to finish.
+
+        Exceptions from the scan threads are handled by handle_err().
+        '''
+        thread_names = [t.name for t in self._scan_threads]
+        self._sync_barrier.reset(parties=thread_names)
+        self._readout_barrier.reset(parties=thread_names)
+        self._finished_scan_threads = []
+        for t in self._scan_threads:
+            t.start()
+        scan_threads = {t.name: t for t in self._scan_threads}
+        while scan_threads:
+            with self._scan_threads_condition:
+                if not self._finished_scan_threads:
+                    # waiting with timeout, otherwise the main thread does not receive signals (e.g., Ctrl-C)
+                    self._scan_threads_condition.wait(1.0)
+                finished_scan_threads, self._finished_scan_threads = self._finished_scan_threads, []
+            for name in finished_scan_threads:
+                try:
+                    scan_threads.pop(name).join()
+                except Exception:
+                    self.handle_err(sys.exc_info())
+        self._scan_threads = []
+        self._sync_barrier.reset()
+        self._readout_barrier.reset()
+
+    def abort(self, msg=None):
+        super(Fei4RunBase, self).abort(msg=msg)
+        # wake up threads waiting at synchronization points
+        self._sync_barrier.wake()
+        self._readout_barrier.wake()
+
     def post_run(self):
         # analyzing data and store register cfg per front end one by one
-        for module_id in [name for name in self._modules if self._module_cfgs[name]["activate"] is True]:
-            if self.abort_run.is_set():
-                    break
+        module_ids = [name for name in self._modules if self._module_cfgs[name]["activate"] is True]
+        n_processes = self._conf['analysis_processes']
+        if n_processes is None:
+            n_processes = cpu_count()
+        if n_processes > 1 and len(module_ids) > 1:
+            results = self._analyze_in_processes(module_ids=module_ids, n_processes=n_processes)
+        else:
+            results = {}
+        for module_id in module_ids:
+            if module_id not in results and self.abort_run.is_set():
+                break
             with self.access_module(module_id=module_id):
                 try:
-                    self.analyze()
+                    if module_id in results:
+                        self._apply_analysis_result(results[module_id])
+                    else:
+                        self.analyze()
                 except Exception:  # analysis errors
                     exc = sys.exc_info()
                     self.err_queue.put(sys.exc_info())
@@ -844,6 +952,113 @@ class Fei4RunBase(RunBase):
             else:
                 raise exc[0], exc[1], exc[2]
 
+    def _analyze_in_processes(self, module_ids, n_processes):
+        ''' Analyzing the data of the modules in parallel processes.
+
+        The analysis of every module is executed in a new Python interpreter (see analysis_process()), the process is not forked from the
+        multithreaded run process. Not more than n_processes are running at the same time.
+        Returns a dict with the results of the analysis processes (see _apply_analysis_result()).
+        Modules whose state cannot be transferred to another process are not in the dict and have to be analyzed in this process.
+        '''
+        results = {}
+        pending = []
+        for module_id in module_ids:
+            state = self._get_analysis_state(module_id)
+            if state is None:
+                logging.info('Analyzing data of module %s in the run process', module_id)
+            else:
+                pending.append((module_id, state))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])  # same modules as the run process
+        running = {}  # module ID: (process, temporary directory)
+        try:
+            while pending or running:
+                while pending and len(running) < n_processes and not self.abort_run.is_set():
+                    module_id, state = pending.pop(0)
+                    tmp_dir = tempfile.mkdtemp(prefix='pybar_analysis_')
+                    with open(os.path.join(tmp_dir, 'state.pickle'), 'wb') as state_file:
+                        state_file.write(state)
+                    process = subprocess.Popen([sys.executable, '-c', 'import sys; from pybar.fei4_run_base import analysis_process; analysis_process(*sys.argv[1:])', os.path.join(tmp_dir, 'state.pickle'), os.path.join(tmp_dir, 'result.pickle')], env=env)
+                    running[module_id] = (process, tmp_dir)
+                    logging.info('Analyzing data of module %s in process %d', module_id, process.pid)
+                if self.abort_run.is_set():
+                    pending = []
+                finished = False
+                for module_id, (process, tmp_dir) in running.items():
+                    if process.poll() is None:
+                        continue
+                    try:
+                        with open(os.path.join(tmp_dir, 'result.pickle'), 'rb') as result_file:
+                            results[module_id] = pickle.load(result_file)
+                    except Exception:  # process crashed or result cannot be unpickled
+                        results[module_id] = ([], None, (RuntimeError('Analysis process of module %s exited with code %s' % (module_id, process.returncode)), traceback.format_exc()))
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    del running[module_id]
+                    finished = True
+                if not finished:
+                    time.sleep(0.05)
+        finally:
+            for process, tmp_dir in running.itervalues():  # in case of an exception (e.g. Ctrl-C)
+                process.kill()
+                process.wait()
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return results
+
+    def _get_analysis_state(self, module_id):
+        ''' Returns the pickled state of the run, which is needed for analyzing the data of a module in another process.
+
+        Attributes that cannot be pickled (hardware, threads, locks) are not available in the analysis process.
+        Returns None if the module specific attributes or the run class cannot be transferred.
+        '''
+        run_class = self.__class__
+        if run_class.__module__ == '__main__':  # run class defined in a script
+            main_file = getattr(sys.modules['__main__'], '__file__', None)
+            if main_file is None:
+                return None
+            run_class_location = ('__main__', os.path.abspath(main_file), run_class.__name__)
+        else:
+            run_class_location = (run_class.__module__, None, run_class.__name__)
+        module_attributes = ('_module_run_conf', '_module_cfgs', '_registers', '_scan_parameters', '_module_attr')
+        attributes = {}
+        for name, value in self.__dict__.iteritems():
+            if name in module_attributes:
+                value = {module_id: value[module_id]} if module_id in value else {}
+            try:
+                attributes[name] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                if name in module_attributes:
+                    logging.debug('Cannot transfer attribute %s of module %s to the analysis process', name, module_id)
+                    return None
+                if isinstance(value, dict):  # e.g. configuration with the DUT object, transfer all other items
+                    items = {}
+                    for key, item in value.iteritems():
+                        try:
+                            pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+                        except Exception:
+                            continue
+                        items[key] = item
+                    attributes[name] = pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+        return pickle.dumps({'module_id': module_id, 'run_class': run_class_location, 'log_level': logging.getLogger().getEffectiveLevel(), 'attributes': attributes}, pickle.HIGHEST_PROTOCOL)
+
+    def _apply_analysis_result(self, result):
+        ''' Applying the result of an analysis process to the currently selected module.
+
+        The log records are passed to the logging handlers and the register configuration is updated.
+        The exception of the analysis is raised again, the traceback of the analysis process is stored in the attribute remote_traceback.
+        '''
+        records, register_configuration, exc = result
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        if exc is not None:
+            exc_value, remote_traceback = exc
+            logging.error('Analysis process of module %s failed:\n%s', self.current_module_handle, remote_traceback)
+            try:
+                exc_value.remote_traceback = remote_traceback
+            except AttributeError:  # read-only exception
+                pass
+            raise exc_value
+        self.register.global_registers, self.register.pixel_registers, self.register.calibration_parameters, self.register.miscellaneous = register_configuration
+
     def cleanup_run(self):
         pass
 
@@ -857,7 +1072,7 @@ class Fei4RunBase(RunBase):
         else:
             logging.debug('Closed DUT')
 
-    def handle_data(self, data, new_file=False, flush=True):
+    def handle_data(self, data, new_file=False, flush=False):
         '''Handling of the data.
 
         Parameters
@@ -868,7 +1083,7 @@ class Fei4RunBase(RunBase):
         for i, module_id in enumerate(self._selected_modules):
             if data[i] is None:
                 continue
-            self._raw_data_files[module_id].append(data_iterable=data[i], scan_parameters=self._scan_parameters[module_id]._asdict(), new_file=new_file, flush=True)
+            self._raw_data_files[module_id].append(data_iterable=data[i], scan_parameters=self._scan_parameters[module_id]._asdict(), new_file=new_file, flush=flush)
 
     def handle_err(self, exc):
         '''Handling of Exceptions.
@@ -1083,10 +1298,10 @@ class Fei4RunBase(RunBase):
         try:
             self.open_files()
             yield
-            self.close_files()
         finally:
             # in case something fails, call this on last resort
-            self._raw_data_files.clear()
+            # closing files writes the buffered data
+            self.close_files()
 
     def open_files(self):
         for selected_module_id in self._selected_modules:
@@ -1094,26 +1309,35 @@ class Fei4RunBase(RunBase):
                                                                           mode='w',
                                                                           title=self.run_id,
                                                                           scan_parameters=self._scan_parameters[selected_module_id]._asdict(),
-                                                                          socket_address=self._module_cfgs[selected_module_id]['send_data'])
+                                                                          socket_address=self._module_cfgs[selected_module_id]['send_data'],
+                                                                          flush_bytes=self._conf['raw_data_flush_bytes'],
+                                                                          flush_rows=self._conf['raw_data_flush_rows'],
+                                                                          flush_interval=self._conf['raw_data_flush_interval'],
+                                                                          send_mode=self._conf['send_data_mode'],
+                                                                          send_queue_size=self._conf['send_data_queue_size'],
+                                                                          send_hwm=self._conf['send_data_hwm'])
             # save configuration data to raw data file
             self._registers[selected_module_id].save_configuration(self._raw_data_files[selected_module_id].h5_file)
             save_configuration_dict(self._raw_data_files[selected_module_id].h5_file, 'conf', self._conf)
             save_configuration_dict(self._raw_data_files[selected_module_id].h5_file, 'run_conf', self._module_run_conf[selected_module_id])
             # send configuration data to online monitor
-            if self._raw_data_files[selected_module_id].socket:
-                send_meta_data(self._raw_data_files[selected_module_id].socket, selected_module_id, name='Filename')
+            if self._raw_data_files[selected_module_id].data_sender:
+                self._raw_data_files[selected_module_id].data_sender.send_meta_data(selected_module_id, name='Filename')
                 global_register_config = {}
                 for global_reg in sorted(self._registers[selected_module_id].get_global_register_objects(readonly=False), key=itemgetter('name')):
                     global_register_config[global_reg['name']] = global_reg['value']
-                send_meta_data(self._raw_data_files[selected_module_id].socket, global_register_config, name='GlobalRegisterConf')
-                send_meta_data(self._raw_data_files[selected_module_id].socket, self._run_conf, name='RunConf')
+                self._raw_data_files[selected_module_id].data_sender.send_meta_data(global_register_config, name='GlobalRegisterConf')
+                self._raw_data_files[selected_module_id].data_sender.send_meta_data(self._run_conf, name='RunConf')
 
     def close_files(self):
         # close all file objects
-        for f in self._raw_data_files.values():
-            f.close()
-        # delete all file objects
-        self._raw_data_files.clear()
+        try:
+            for f in self._raw_data_files.values():
+                if f.h5_file is not None:
+                    f.close()
+        finally:
+            # delete all file objects
+            self._raw_data_files.clear()
 
     def get_output_filename(self, module_id):
         if module_id not in self._modules:
@@ -1131,9 +1355,22 @@ class Fei4RunBase(RunBase):
     def get_raw_data_from_buffer(self, filter_func=None, converter_func=None):
         return self.fifo_readout.get_raw_data_from_buffer(filter_func=filter_func, converter_func=converter_func)
 
+    def consume_data_from_buffer(self, filter_func=None, converter_func=None):
+        return self.fifo_readout.consume_data_from_buffer(index=self._selected_modules.index(self.current_module_handle), filter_func=filter_func, converter_func=converter_func)
+
     def read_raw_data_from_fifo(self, filter_func=None, converter_func=None):
         return self.fifo_readout.read_raw_data_from_fifo(filter_func=filter_func, converter_func=converter_func)
 
+    def get_occupancy(self):
+        '''Returns the occupancy histogram of the current module from the last readout started with histogram_occupancy=True.
+        '''
+        return self._occupancy_accumulator.get_occupancy(index=self._selected_modules.index(self.current_module_handle))
+
+    def get_tot_hist(self):
+        '''Returns the ToT histogram of each pixel of the current module from the last readout started with histogram_tot=True.
+        '''
+        return self._occupancy_accumulator.get_tot_hist(index=self._selected_modules.index(self.current_module_handle))
+
     def data_words_per_second(self):
         if self.current_module_handle is None:
             return sum(self.fifo_readout.data_words_per_second())
@@ -1145,18 +1382,18 @@ class Fei4RunBase(RunBase):
             RuntimeError('Module handle "%s" is not valid.' % self.current_module_handle)
 
     @contextmanager
-    def synchronized(self):
+    def synchronized(self, timeout=None):
         ''' Synchronize the execution of a section of code between threads.
         '''
-        self.enter_sync()
+        self.enter_sync(timeout=timeout)
         try:
             yield
-            self.exit_sync()
+            self.exit_sync(timeout=timeout)
         finally:
             # in case something fails, call this on last resort
             pass
 
-    def enter_sync(self):
+    def enter_sync(self, timeout=None):
         ''' Waiting for all threads to appear, then continue.
         '''
         if self._scan_threads and self.current_module_handle not in [t.name for t in self._scan_threads]:
@@ -1165,15 +1402,14 @@ class Fei4RunBase(RunBase):
             raise RuntimeError('Thread "%s" is already actively reading FIFO.')
         with self._sync_lock:
             self._curr_sync_threads.append(self.current_module_handle)
-        self._enter_sync_event.clear()
-        while not self._enter_sync_event.wait(0.01):
-            if self.abort_run.is_set():
-                break
+        try:
+            self._sync_barrier.wait(name=self.current_module_handle, timeout=timeout, abort=self.abort_run)
+        except Exception:
             with self._sync_lock:
-                if len(set(self._curr_sync_threads) & set([t.name for t in self._scan_threads if t.is_alive()])) == len(set([t.name for t in self._scan_threads if t.is_alive()])) or not self._scan_threads:
-                    self._enter_sync_event.set()
+                self._curr_sync_threads.remove(self.current_module_handle)
+            raise
 
-    def exit_sync(self):
+    def exit_sync(self, timeout=None):
         ''' Waiting for all threads to appear, then continue.
         '''
         if self._scan_threads and self.current_module_handle not in [t.name for t in self._scan_threads]:
@@ -1182,13 +1418,7 @@ class Fei4RunBase(RunBase):
             raise RuntimeError('Thread "%s" is not reading FIFO.')
         with self._sync_lock:
             self._curr_sync_threads.remove(self.current_module_handle)
-        self._exit_sync_event.clear()
-        while not self._exit_sync_event.wait(0.01):
-            if self.abort_run.is_set():
-                break
-            with self._sync_lock:
-                if len(set(self._curr_sync_threads) & set([t.name for t in self._scan_threads if t.is_alive()])) == 0 or not self._scan_threads:
-                    self._exit_sync_event.set()
+        self._sync_barrier.wait(name=self.current_module_handle, timeout=timeout, abort=self.abort_run)
 
     @contextmanager
     def readout(self, *args, **kwargs):
@@ -1197,12 +1427,13 @@ class Fei4RunBase(RunBase):
         Starting and stopping of the FIFO readout is synchronized between the threads.
         '''
         timeout = kwargs.pop('timeout', 10.0)
-        self.start_readout(*args, **kwargs)
+        sync_timeout = kwargs.pop('sync_timeout', None)
+        self.start_readout(*args, sync_timeout=sync_timeout, **kwargs)
         try:
             yield
         finally:
             try:
-                self.stop_readout(timeout=timeout)
+                self.stop_readout(timeout=timeout, sync_timeout=sync_timeout)
             except Exception:
                 # in case something fails, call this on last resort
                 # if run was aborted, immediately stop readout
@@ -1225,6 +1456,11 @@ class Fei4RunBase(RunBase):
         fill_buffer = kwargs.pop('fill_buffer', False)
         no_data_timeout = kwargs.pop('no_data_timeout', None)
         enabled_fe_channels = kwargs.pop('enabled_fe_channels', self._enabled_fe_channels)
+        buffer_size = kwargs.pop('buffer_size', None)
+        buffer_policy = kwargs.pop('buffer_policy', None)
+        histogram_occupancy = kwargs.pop('histogram_occupancy', False)  # histogramming hits while reading out, see get_occupancy()
+        histogram_tot = kwargs.pop('histogram_tot', False)  # see get_tot_hist()
+        sync_timeout = kwargs.pop('sync_timeout', None)
         if args or kwargs:
             self.set_scan_parameters(*args, **kwargs)
         if self._scan_threads and self.current_module_handle not in [t.name for t in self._scan_threads]:
@@ -1233,17 +1469,21 @@ class Fei4RunBase(RunBase):
             raise RuntimeError('Thread "%s" is already actively reading FIFO.')
         with self._readout_lock:
             self._curr_readout_threads.append(self.current_module_handle)
-        self._starting_readout_event.clear()
-        while not self._starting_readout_event.wait(0.01):
-            if self.abort_run.is_set():
-                break
+        try:
+            released = self._readout_barrier.wait(name=self.current_module_handle, timeout=sync_timeout, abort=self.abort_run)
+        except Exception:
+            with self._readout_lock:
+                self._curr_readout_threads.remove(self.current_module_handle)
+            raise
+        if released:
             with self._readout_lock:
-                if len(set(self._curr_readout_threads) & set([t.name for t in self._scan_threads if t.is_alive()])) == len(set([t.name for t in self._scan_threads if t.is_alive()])) or not self._scan_threads:
-                    if not self.fifo_readout.is_running:
-                        self.fifo_readout.start(fifos=self._selected_fifos, callback=callback, errback=errback, reset_rx=reset_rx, reset_fifo=reset_fifo, fill_buffer=fill_buffer, no_data_timeout=no_data_timeout, filter_func=self._filter, converter_func=self._converter, fifo_select=self._readout_fifos, enabled_fe_channels=enabled_fe_channels)
-                        self._starting_readout_event.set()
+                if not self.fifo_readout.is_running:
+                    if histogram_occupancy or histogram_tot:
+                        self._occupancy_accumulator = OccupancyAccumulator(n_modules=len(self._selected_modules), tot=histogram_tot, callback=callback)
+                        callback = self._occupancy_accumulator
+                    self.fifo_readout.start(fifos=self._selected_fifos, callback=callback, errback=errback, reset_rx=reset_rx, reset_fifo=reset_fifo, fill_buffer=fill_buffer, no_data_timeout=no_data_timeout, filter_func=self._filter, converter_func=self._converter, fifo_select=self._readout_fifos, enabled_fe_channels=enabled_fe_channels, buffer_size=buffer_size, buffer_policy=buffer_policy)
 
-    def stop_readout(self, timeout=10.0):
+    def stop_readout(self, timeout=10.0, sync_timeout=None):
         ''' Stopping the FIFO readout.
 
         Stopping of the FIFO readout is executed only once by a random thread.
@@ -1255,13 +1495,11 @@ class Fei4RunBase(RunBase):
             raise RuntimeError('Thread "%s" is not reading FIFO.')
         with self._readout_lock:
             self._curr_readout_threads.remove(self.current_module_handle)
-        self._stopping_readout_event.clear()
-        while not self._stopping_readout_event.wait(0.01):
-            with self._readout_lock:
-                if len(set(self._curr_readout_threads) & set([t.name for t in self._scan_threads if t.is_alive()])) == 0 or not self._scan_threads or self.abort_run.is_set():
-                    if self.fifo_readout.is_running:
-                        self.fifo_readout.stop(timeout=timeout)
-                    self._stopping_readout_event.set()
+        # if run was aborted, immediately stop readout
+        self._readout_barrier.wait(name=self.current_module_handle, timeout=sync_timeout, abort=self.abort_run)
+        with self._readout_lock:
+            if self.fifo_readout.is_running:
+                self.fifo_readout.stop(timeout=timeout)
 
     def _cleanup(self):  # called in run base after exception handling
         super(Fei4RunBase, self)._cleanup()
@@ -1295,6 +1533,91 @@ class Fei4RunBase(RunBase):
         pass
 
 
+class ThreadBarrier(object):
+    ''' Reusable barrier for a changing group of threads.
+
+    Waiting threads are released as soon as all parties have arrived. Parties can be removed at any time (e.g., threads that have finished or raised an exception),
+    which releases the waiting threads if all remaining parties have arrived. Without parties, the barrier does not block.
+    '''
+    def __init__(self):
+        self._condition = Condition(RLock())  # reentrant lock, wake() can be called from a signal handler
+        self._parties = set()
+        self._arrived = set()
+        self._generation = 0
+
+    def reset(self, parties=()):
+        ''' Setting the parties and releasing all waiting threads.
+        '''
+        with self._condition:
+            self._parties = set(parties)
+            self._release()
+
+    def remove_party(self, name):
+        ''' Removing a party and releasing the waiting threads if all remaining parties have arrived.
+        '''
+        with self._condition:
+            self._parties.discard(name)
+            self._arrived.discard(name)
+            if self._arrived >= self._parties:
+                self._release()
+
+    def wake(self):
+        ''' Waking up all waiting threads, e.g., to check the abort condition.
+        '''
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, name, timeout=None, abort=None):
+        ''' Waiting for all parties to arrive.
+
+        Parameters
+        ----------
+        name : string
+            Name of the party.
+        timeout : float
+            Timeout in seconds. If None, wait until all parties have arrived.
+        abort : threading.Event
+            Return immediately when the event is set.
+
+        Returns
+        -------
+        True if all parties have arrived, False if aborted.
+        '''
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self._condition:
+            if abort is not None and abort.is_set():
+                return False
+            if not self._parties:
+                return True
+            if name not in self._parties:
+                raise RuntimeError('Thread "%s" is not a party of the barrier.' % name)
+            if name in self._arrived:
+                raise RuntimeError('Thread "%s" is already waiting.' % name)
+            generation = self._generation
+            self._arrived.add(name)
+            if self._arrived >= self._parties:
+                self._release()
+            while generation == self._generation:
+                if abort is not None and abort.is_set():
+                    self._arrived.discard(name)
+                    return False
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0.0:
+                        self._arrived.discard(name)
+                        raise RuntimeError('Thread "%s": timeout while waiting for thread(s) %s.' % (name, ", ".join(sorted(self._parties - self._arrived))))
+                    self._condition.wait(remaining)
+            return True
+
+    def _release(self):
+        self._arrived.clear()
+        self._generation += 1
+        self._condition.notify_all()
+
+
 class ExcThread(Thread):
     def run(self):
         self.exc = None
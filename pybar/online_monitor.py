@@ -11,8 +11,20 @@ from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea, Dock
 import pyqtgraph.ptime as ptime
 
-from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
-from pybar_fei4_interpreter.data_histograming import PyDataHistograming
+from pybar.online_monitor_service import RawDataMonitor, OnlineMonitorClient
+
+
+def get_changed_region(old, new):
+    '''Returns the smallest region (tuple of slices) that contains all changed values. Returns None if nothing changed.
+    '''
+    changed = (old != new)
+    if not np.any(changed):
+        return None
+    region = []
+    for axis in range(changed.ndim):
+        indices = np.where(np.any(changed, axis=tuple(i for i in range(changed.ndim) if i != axis)))[0]
+        region.append(slice(indices[0], indices[-1] + 1))
+    return tuple(region)
 
 
 class DataWorker(QtCore.QObject):
@@ -24,101 +36,141 @@ class DataWorker(QtCore.QObject):
     meta_data = QtCore.pyqtSignal(dict)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, max_refresh_rate=10.0):
         QtCore.QObject.__init__(self)
-        self.integrate_readouts = 1
-        self.n_readout = 0
+        self.max_refresh_rate = max_refresh_rate  # maximum number of updates per second
         self._stop_readout = Event()
-        self.setup_raw_data_analysis()
+        self.monitor = RawDataMonitor()
         self.reset_lock = Lock()
+        self.reset_update()
 
-    def setup_raw_data_analysis(self):
-        self.interpreter = PyDataInterpreter()
-        self.histogram = PyDataHistograming()
-        self.interpreter.set_warning_output(False)
-        self.histogram.set_no_scan_parameter()
-        self.histogram.create_occupancy_hist(True)
-        self.histogram.create_rel_bcid_hist(True)
-        self.histogram.create_tot_hist(True)
-        self.histogram.create_tdc_hist(True)
-        try:
-            self.histogram.create_tdc_distance_hist(True)
-            self.interpreter.use_tdc_trigger_time_stamp(True)
-        except AttributeError:
-            self.has_tdc_distance = False
-        else:
-            self.has_tdc_distance = True
-
-    def connect(self, socket_addr):
+    def connect(self, socket_addr, pull=False):
         self.socket_addr = socket_addr
         self.context = zmq.Context()
-        self.socket_pull = self.context.socket(zmq.SUB)  # subscriber
-        self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+        if pull:  # lossless mode, sender uses PUSH socket
+            self.socket_pull = self.context.socket(zmq.PULL)
+        else:
+            self.socket_pull = self.context.socket(zmq.SUB)  # subscriber
+            self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
         self.socket_pull.connect(self.socket_addr)
 
     def on_set_integrate_readouts(self, value):
-        self.integrate_readouts = value
+        self.monitor.integrate_readouts = value
 
     def reset(self):
         with self.reset_lock:
-            self.histogram.reset()
-            self.interpreter.reset()
-            self.n_readout = 0
-
-    def analyze_raw_data(self, raw_data):
-        self.interpreter.interpret_raw_data(raw_data)
-        self.histogram.add_hits(self.interpreter.get_hits())
+            self.monitor.reset()
+            self.reset_update()
+
+    def reset_update(self):
+        '''Resets the state of the updates. The next update contains the full histograms.
+        '''
+        self.last_histograms = {}  # last sent histograms to determine the changes
+        self.last_update = 0.0
+
+    def update_due(self):
+        '''Returns True if data is pending and the last update is older than the refresh interval.
+        '''
+        return self.monitor.update_pending and time.time() - self.last_update >= 1.0 / self.max_refresh_rate
+
+    def update(self):
+        '''Sends the changed regions of the histograms and the meta data of the last read out.
+        '''
+        if self.monitor.histograms_pending:
+            histograms = self.monitor.get_histograms()
+            changes = {}
+            for name, histogram in histograms.iteritems():
+                if name not in self.last_histograms or self.last_histograms[name].shape != histogram.shape:
+                    changes[name] = (None, histogram)  # full histogram
+                else:
+                    region = get_changed_region(self.last_histograms[name], histogram)
+                    if region is not None:
+                        changes[name] = (region, histogram[region])
+            self.last_histograms = histograms
+            if changes:
+                self.interpreted_data.emit(changes)
+        meta_data = self.monitor.get_meta_data()
+        if meta_data is not None:
+            self.meta_data.emit(meta_data)
+        self.last_update = time.time()
 
     def process_data(self):  # infinite loop via QObject.moveToThread(), does not block event loop
-        while(not self._stop_readout.wait(0.01)):  # use wait(), do not block here
-            with self.reset_lock:
-                try:
-                    meta_data = self.socket_pull.recv_json(flags=zmq.NOBLOCK)
-                except zmq.Again:
-                    pass
-                else:
-                    name = meta_data.pop('name')
-                    if name == 'ReadoutData':
-                        data = self.socket_pull.recv()
-                        # reconstruct numpy array
-                        buf = buffer(data)
-                        dtype = meta_data.pop('dtype')
-                        shape = meta_data.pop('shape')
-                        data_array = np.frombuffer(buf, dtype=dtype).reshape(shape)
-                        # count readouts and reset
-                        self.n_readout += 1
-                        if self.integrate_readouts != 0 and self.n_readout % self.integrate_readouts == 0:
-                            self.histogram.reset()
-                            # we do not want to reset interpreter to keep the error counters
-        #                         self.interpreter.reset()
-                            # interpreted data
-                        self.analyze_raw_data(data_array)
-                        if self.integrate_readouts == 0 or self.n_readout % self.integrate_readouts == self.integrate_readouts - 1:
-                            interpreted_data = {
-                                'occupancy': self.histogram.get_occupancy(),
-                                'tot_hist': self.histogram.get_tot_hist(),
-                                'tdc_counters': self.interpreter.get_tdc_counters(),
-                                'tdc_distance': self.interpreter.get_tdc_distance() if self.has_tdc_distance else np.zeros((256,), dtype=np.uint8),
-                                'error_counters': self.interpreter.get_error_counters(),
-                                'service_records_counters': self.interpreter.get_service_records_counters(),
-                                'trigger_error_counters': self.interpreter.get_trigger_error_counters(),
-                                'rel_bcid_hist': self.histogram.get_rel_bcid_hist()}
-                            self.interpreted_data.emit(interpreted_data)
-                        # meta data
-                        meta_data.update({'n_hits': self.interpreter.get_n_hits(), 'n_events': self.interpreter.get_n_events()})
-                        self.meta_data.emit(meta_data)
-                    elif name == 'RunConf':
+        while not self._stop_readout.is_set():
+            if self.monitor.update_pending:  # wait until the next update is allowed
+                timeout = max(self.last_update + 1.0 / self.max_refresh_rate - time.time(), 0.0)
+            else:
+                timeout = 0.1  # check stop condition
+            self.socket_pull.poll(int(timeout * 1000))  # blocking with timeout
+            while not self._stop_readout.is_set():  # process the available messages until the next update is due
+                with self.reset_lock:  # lock per message, reset() must not wait for the whole queue
+                    message = self.monitor.receive(self.socket_pull)
+                    if message is None:
+                        break
+                    name, meta_data = message
+                    if name == 'RunConf':
                         self.run_config_data.emit(meta_data)
                     elif name == 'GlobalRegisterConf':
-                        trig_count = int(meta_data['conf']['Trig_Count'])
-                        self.interpreter.set_trig_count(trig_count)
                         self.global_config_data.emit(meta_data)
                     elif name == 'Reset':
-                        self.histogram.reset()
-                        self.interpreter.reset()
+                        self.reset_update()
                         self.run_start.emit()
                     elif name == 'Filename':
                         self.filename.emit(meta_data)
+                if self.update_due():
+                    break
+            with self.reset_lock:
+                if self.update_due():
+                    self.update()
+        self.finished.emit()
+
+    def stop(self):
+        self._stop_readout.set()
+
+
+class ServiceWorker(QtCore.QObject):
+    '''Receives the histograms from the online monitor service. The raw data is interpreted by the service.
+    '''
+    run_start = QtCore.pyqtSignal()
+    run_config_data = QtCore.pyqtSignal(dict)
+    global_config_data = QtCore.pyqtSignal(dict)
+    filename = QtCore.pyqtSignal(dict)
+    interpreted_data = QtCore.pyqtSignal(dict)
+    meta_data = QtCore.pyqtSignal(dict)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self._stop_readout = Event()
+
+    def connect(self, socket_addr, pull=False):
+        self.client = OnlineMonitorClient(socket_addr)
+
+    def on_set_integrate_readouts(self, value):
+        pass  # set by the service
+
+    def reset(self):
+        pass  # the next update of the service contains all histograms
+
+    def process_data(self):  # infinite loop via QObject.moveToThread(), does not block event loop
+        while not self._stop_readout.is_set():
+            message = self.client.receive(timeout=0.1)  # check stop condition
+            if message is None:
+                continue
+            name, meta_data, histograms = message
+            if name == 'Histograms':
+                if histograms:
+                    self.interpreted_data.emit(dict((histogram_name, (None, histogram)) for histogram_name, histogram in histograms.iteritems()))
+                if meta_data is not None:
+                    self.meta_data.emit(meta_data)
+            elif name == 'RunConf':
+                self.run_config_data.emit(meta_data)
+            elif name == 'GlobalRegisterConf':
+                self.global_config_data.emit(meta_data)
+            elif name == 'Reset':
+                self.run_start.emit()
+            elif name == 'Filename':
+                self.filename.emit(meta_data)
+        self.client.close()
         self.finished.emit()
 
     def stop(self):
@@ -127,7 +179,7 @@ class DataWorker(QtCore.QObject):
 
 class OnlineMonitorApplication(QtGui.QMainWindow):
 
-    def __init__(self, socket_addr):
+    def __init__(self, socket_addr, pull=False, service=False):
         super(OnlineMonitorApplication, self).__init__()
         self.setup_plots()
         self.add_widgets()
@@ -138,7 +190,9 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.updateTime = ptime.time()
         self.total_hits = 0
         self.total_events = 0
-        self.setup_data_worker_and_start(socket_addr)
+        self.n_lost_readouts = 0  # read outs missing in the data stream
+        self.histograms = {}  # histograms shown in the plots
+        self.setup_data_worker_and_start(socket_addr, pull=pull, service=service)
         self.reset_plots()
 
     def closeEvent(self, event):
@@ -147,9 +201,13 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.worker.stop()
         self.thread.wait(2)  # fixes message: QThread: Destroyed while thread is still running
 
-    def setup_data_worker_and_start(self, socket_addr):
+    def setup_data_worker_and_start(self, socket_addr, pull=False, service=False):
         self.thread = QtCore.QThread()  # no parent
-        self.worker = DataWorker()  # no parent
+        if service:
+            self.worker = ServiceWorker()  # no parent
+            self.spin_box.setEnabled(False)  # integration is set by the service
+        else:
+            self.worker = DataWorker()  # no parent
         self.worker.meta_data.connect(self.on_meta_data)
         self.worker.interpreted_data.connect(self.on_interpreted_data)
         self.worker.run_start.connect(self.on_run_start)
@@ -159,7 +217,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.spin_box.valueChanged.connect(self.worker.on_set_integrate_readouts)
         self.reset_button.clicked.connect(self.on_reset)
         self.worker.moveToThread(self.thread)
-        self.worker.connect(socket_addr)
+        self.worker.connect(socket_addr, pull=pull)
 #         self.aboutToQuit.connect(self.worker.stop)  # QtGui.QApplication
         self.thread.started.connect(self.worker.process_data)
         self.worker.finished.connect(self.thread.quit)
@@ -210,6 +268,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.event_rate_label = QtGui.QLabel("Event Rate\n0 Hz")
         self.timestamp_label = QtGui.QLabel("Data Timestamp\n")
         self.plot_delay_label = QtGui.QLabel("Plot Delay\n")
+        self.processing_time_label = QtGui.QLabel("Processing Time\n")
         self.scan_parameter_label = QtGui.QLabel("Scan Parameters\n")
         self.spin_box = Qt.QSpinBox(value=1)
         self.spin_box.setMaximum(1000000)
@@ -217,12 +276,13 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.reset_button = QtGui.QPushButton('Reset')
         layout.addWidget(self.timestamp_label, 0, 0, 0, 1)
         layout.addWidget(self.plot_delay_label, 0, 1, 0, 1)
-        layout.addWidget(self.rate_label, 0, 2, 0, 1)
-        layout.addWidget(self.hit_rate_label, 0, 3, 0, 1)
-        layout.addWidget(self.event_rate_label, 0, 4, 0, 1)
-        layout.addWidget(self.scan_parameter_label, 0, 5, 0, 1)
-        layout.addWidget(self.spin_box, 0, 6, 0, 1)
-        layout.addWidget(self.reset_button, 0, 7, 0, 1)
+        layout.addWidget(self.processing_time_label, 0, 2, 0, 1)
+        layout.addWidget(self.rate_label, 0, 3, 0, 1)
+        layout.addWidget(self.hit_rate_label, 0, 4, 0, 1)
+        layout.addWidget(self.event_rate_label, 0, 5, 0, 1)
+        layout.addWidget(self.scan_parameter_label, 0, 6, 0, 1)
+        layout.addWidget(self.spin_box, 0, 7, 0, 1)
+        layout.addWidget(self.reset_button, 0, 8, 0, 1)
         dock_status.addWidget(cw)
 
         # Run config dock
@@ -287,6 +347,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.update_rate(0, 0, 0, 0, 0)
 
     def on_run_start(self):
+        self.n_lost_readouts = 0
         # clear config data widgets
         self.run_conf_list_widget.clear()
         self.global_conf_list_widget.clear()
@@ -315,25 +376,51 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.setWindowTitle('Online Monitor - %s' % conf)
 
     def on_interpreted_data(self, interpreted_data):
-        self.update_plots(**interpreted_data)
+        for name, (region, data) in interpreted_data.iteritems():  # apply the changes
+            if region is None:
+                self.histograms[name] = data
+            else:
+                self.histograms[name][region] = data
+        self.update_plots(**dict((name, self.histograms[name]) for name in interpreted_data))
 
     def reset_plots(self):
-        self.update_plots(np.zeros((80, 336, 1), dtype=np.uint8), np.zeros((16,), dtype=np.uint8), np.zeros((4096,), dtype=np.uint8), np.zeros((256,), dtype=np.uint8), np.zeros((16,), dtype=np.uint8), np.zeros((32,), dtype=np.uint8), np.zeros((8,), dtype=np.uint8), np.zeros((16,), dtype=np.uint8))
-
-    def update_plots(self, occupancy, tot_hist, tdc_counters, tdc_distance, error_counters, service_records_counters, trigger_error_counters, rel_bcid_hist):
-        self.occupancy_img.setImage(occupancy[:, ::-1, 0], autoDownsample=True)
-        self.tot_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=tot_hist, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.tdc_plot.setData(x=np.linspace(-0.5, 4095.5, 4097, endpoint=True), y=tdc_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.tdc_distance_plot.setData(x=np.linspace(-0.5, 255.5, 257, endpoint=True), y=tdc_distance, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.event_status_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=error_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.service_record_plot.setData(x=np.linspace(-0.5, 31.5, 33, endpoint=True), y=service_records_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.trigger_status_plot.setData(x=np.linspace(-0.5, 7.5, 9, endpoint=True), y=trigger_error_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
-        self.hit_timing_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=rel_bcid_hist[:16], fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        self.histograms = {
+            'occupancy': np.zeros((80, 336, 1), dtype=np.uint8),
+            'tot_hist': np.zeros((16,), dtype=np.uint8),
+            'tdc_counters': np.zeros((4096,), dtype=np.uint8),
+            'tdc_distance': np.zeros((256,), dtype=np.uint8),
+            'error_counters': np.zeros((16,), dtype=np.uint8),
+            'service_records_counters': np.zeros((32,), dtype=np.uint8),
+            'trigger_error_counters': np.zeros((8,), dtype=np.uint8),
+            'rel_bcid_hist': np.zeros((16,), dtype=np.uint8)}
+        self.update_plots(**self.histograms)
+
+    def update_plots(self, occupancy=None, tot_hist=None, tdc_counters=None, tdc_distance=None, error_counters=None, service_records_counters=None, trigger_error_counters=None, rel_bcid_hist=None):
+        '''Redraws the plots of the given histograms only.
+        '''
+        if occupancy is not None:
+            self.occupancy_img.setImage(occupancy[:, ::-1, 0], autoDownsample=True)
+        if tot_hist is not None:
+            self.tot_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=tot_hist, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if tdc_counters is not None:
+            self.tdc_plot.setData(x=np.linspace(-0.5, 4095.5, 4097, endpoint=True), y=tdc_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if tdc_distance is not None:
+            self.tdc_distance_plot.setData(x=np.linspace(-0.5, 255.5, 257, endpoint=True), y=tdc_distance, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if error_counters is not None:
+            self.event_status_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=error_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if service_records_counters is not None:
+            self.service_record_plot.setData(x=np.linspace(-0.5, 31.5, 33, endpoint=True), y=service_records_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if trigger_error_counters is not None:
+            self.trigger_status_plot.setData(x=np.linspace(-0.5, 7.5, 9, endpoint=True), y=trigger_error_counters, fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
+        if rel_bcid_hist is not None:
+            self.hit_timing_plot.setData(x=np.linspace(-0.5, 15.5, 17, endpoint=True), y=rel_bcid_hist[:16], fillLevel=0, brush=(0, 0, 255, 150), stepMode=True)
 
     def on_meta_data(self, meta_data):
         self.update_monitor(**meta_data)
 
-    def update_monitor(self, timestamp_start, timestamp_stop, readout_error, scan_parameters, n_hits, n_events):
+    def update_monitor(self, timestamp_start, timestamp_stop, readout_error, scan_parameters, n_hits, n_events, n_readouts=1, n_total_readouts=None, n_lost_readouts=0, processing_time=0.0, sequence_number=None, n_dropped=None):
+        self.n_lost_readouts = n_lost_readouts
+        self.processing_time_label.setText("Processing Time\n%1.2f ms" % (processing_time * 1.e3))
         self.timestamp_label.setText("Data Timestamp\n%s" % time.asctime(time.localtime(timestamp_stop)))
         self.scan_parameter_label.setText("Scan Parameters\n%s" % ', '.join('%s: %s' % (str(key), str(val)) for key, val in scan_parameters.iteritems()))
         now = ptime.time()
@@ -341,7 +428,7 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         recent_total_events = n_events
         self.plot_delay = self.plot_delay * 0.9 + (now - timestamp_stop) * 0.1
         self.plot_delay_label.setText("Plot Delay\n%s" % ((time.strftime('%H:%M:%S', time.gmtime(self.plot_delay))) if abs(self.plot_delay) > 5 else "%1.2f ms" % (self.plot_delay * 1.e3)))
-        recent_fps = 1.0 / (now - self.updateTime)  # calculate FPS
+        recent_fps = n_readouts / (now - self.updateTime)  # calculate FPS, the worker is combining read outs
         recent_hps = (recent_total_hits - self.total_hits) / (now - self.updateTime)
         recent_eps = (recent_total_events - self.total_events) / (now - self.updateTime)
         self.updateTime = now
@@ -353,7 +440,10 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
         self.update_rate(self.fps, self.hps, recent_total_hits, self.eps, recent_total_events)
 
     def update_rate(self, fps, hps, recent_total_hits, eps, recent_total_events):
-        self.rate_label.setText("Readout Rate\n%d Hz" % fps)
+        if self.n_lost_readouts:
+            self.rate_label.setText("Readout Rate\n%d Hz (%d lost)" % (fps, self.n_lost_readouts))
+        else:
+            self.rate_label.setText("Readout Rate\n%d Hz" % fps)
         if self.spin_box.value() == 0:  # show number of hits, all hits are integrated
             self.hit_rate_label.setText("Total Hits\n%d" % int(recent_total_hits))
         else:
@@ -366,8 +456,10 @@ class OnlineMonitorApplication(QtGui.QMainWindow):
 
 if __name__ == '__main__':
     usage = "Usage: %prog ADDRESS"
-    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5678)."
+    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5678) or of the online monitor service (--service)."
     parser = OptionParser(usage, description=description)
+    parser.add_option("--pull", action="store_true", dest="pull", default=False, help="Use a PULL socket to receive data from a lossless sender (send_data_mode 'push').")
+    parser.add_option("--service", action="store_true", dest="service", default=False, help="Receive the histograms from the online monitor service (pybar/online_monitor_service.py).")
     options, args = parser.parse_args()
     if len(args) == 0:
         socket_addr = 'tcp://127.0.0.1:5678'
@@ -378,7 +470,7 @@ if __name__ == '__main__':
 
     app = Qt.QApplication(sys.argv)
 #     app.aboutToQuit.connect(myExitHandler)
-    win = OnlineMonitorApplication(socket_addr=socket_addr)  # enter remote IP to connect to the other side listening
+    win = OnlineMonitorApplication(socket_addr=socket_addr, pull=options.pull, service=options.service)  # enter remote IP to connect to the other side listening
     win.resize(800, 840)
     win.setWindowTitle('Online Monitor')
     win.show()
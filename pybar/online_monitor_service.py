@@ -0,0 +1,349 @@
+''' Headless online monitor. The service receives the raw data stream (ZeroMQ), interprets the raw data and publishes
+snapshots of the histograms to any number of clients (e.g. the online monitor GUI, scripts). The clients do not need to interpret the raw data.
+'''
+import logging
+import json
+import time
+from threading import Event, Lock, Thread
+from optparse import OptionParser
+
+import zmq
+import numpy as np
+
+from pybar_fei4_interpreter.data_interpreter import PyDataInterpreter
+from pybar_fei4_interpreter.data_histograming import PyDataHistograming
+
+
+class RawDataMonitor(object):
+    '''Interprets the raw data of the read outs and accumulates the histograms of the online monitor.
+
+    Parameters
+    ----------
+    integrate_readouts : int
+        Number of read outs the histograms are integrated over. If 0, the histograms are never reset.
+    '''
+    def __init__(self, integrate_readouts=1):
+        self.integrate_readouts = integrate_readouts
+        self.n_readout = 0
+        self.setup_raw_data_analysis()
+        self.reset_statistics()
+
+    def setup_raw_data_analysis(self):
+        self.interpreter = PyDataInterpreter()
+        self.histogram = PyDataHistograming()
+        self.interpreter.set_warning_output(False)
+        self.histogram.set_no_scan_parameter()
+        self.histogram.create_occupancy_hist(True)
+        self.histogram.create_rel_bcid_hist(True)
+        self.histogram.create_tot_hist(True)
+        self.histogram.create_tdc_hist(True)
+        try:
+            self.histogram.create_tdc_distance_hist(True)
+            self.interpreter.use_tdc_trigger_time_stamp(True)
+        except AttributeError:
+            self.has_tdc_distance = False
+        else:
+            self.has_tdc_distance = True
+
+    def reset(self):
+        self.histogram.reset()
+        self.interpreter.reset()
+        self.n_readout = 0
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.histograms_pending = False  # histograms are ready to be sent
+        self.last_meta_data = None  # meta data of the last read out
+        self.last_sequence_number = None
+        self.n_lost_readouts = 0  # read outs missing in the data stream
+        self.n_readouts_since_update = 0
+        self.processing_time_since_update = 0.0
+
+    @property
+    def update_pending(self):
+        return self.histograms_pending or self.last_meta_data is not None
+
+    def analyze_raw_data(self, raw_data):
+        self.interpreter.interpret_raw_data(raw_data)
+        self.histogram.add_hits(self.interpreter.get_hits())
+
+    def add_readout(self, meta_data, data):
+        '''Interprets the raw data of one read out. The meta data is the header of the read out (see fei4_raw_data.send_data()).
+        '''
+        start_time = time.time()
+        dtype = meta_data.pop('dtype')
+        shape = meta_data.pop('shape')
+        data_array = np.frombuffer(buffer(data), dtype=dtype).reshape(shape)  # reconstruct numpy array without copying
+        sequence_number = meta_data.get('sequence_number')
+        if sequence_number is not None:
+            if self.last_sequence_number is not None and sequence_number > self.last_sequence_number + 1:
+                self.n_lost_readouts += sequence_number - self.last_sequence_number - 1
+            self.last_sequence_number = sequence_number
+        # count readouts and reset
+        self.n_readout += 1
+        if self.integrate_readouts != 0 and self.n_readout % self.integrate_readouts == 0:
+            self.histogram.reset()
+            self.histograms_pending = False  # not sent in time, skip
+            # we do not want to reset interpreter to keep the error counters
+        self.analyze_raw_data(data_array)
+        if self.integrate_readouts == 0 or self.n_readout % self.integrate_readouts == self.integrate_readouts - 1:
+            self.histograms_pending = True
+        self.last_meta_data = meta_data
+        self.n_readouts_since_update += 1
+        self.processing_time_since_update += time.time() - start_time
+
+    def receive(self, socket):
+        '''Receives and handles one message from the raw data socket without blocking.
+
+        Read outs, the trigger count of the global register configuration and resets are handled by the monitor.
+        Returns the name and the content of the message, None if there is no message.
+        '''
+        try:
+            meta_data = socket.recv_json(flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return None
+        name = meta_data.pop('name')
+        if name == 'ReadoutData':
+            self.add_readout(meta_data, socket.recv())
+        elif name == 'GlobalRegisterConf':
+            trig_count = int(meta_data['conf']['Trig_Count'])
+            self.interpreter.set_trig_count(trig_count)
+        elif name == 'Reset':
+            self.reset()
+        return name, meta_data
+
+    def get_histograms(self):
+        '''Returns a copy of the histograms.
+        '''
+        self.histograms_pending = False
+        histograms = {
+            'occupancy': self.histogram.get_occupancy(),
+            'tot_hist': self.histogram.get_tot_hist(),
+            'tdc_counters': self.interpreter.get_tdc_counters(),
+            'tdc_distance': self.interpreter.get_tdc_distance() if self.has_tdc_distance else np.zeros((256,), dtype=np.uint8),
+            'error_counters': self.interpreter.get_error_counters(),
+            'service_records_counters': self.interpreter.get_service_records_counters(),
+            'trigger_error_counters': self.interpreter.get_trigger_error_counters(),
+            'rel_bcid_hist': self.histogram.get_rel_bcid_hist()}
+        return dict((name, np.array(histogram)) for name, histogram in histograms.iteritems())  # copy, the histograms are changed in place
+
+    def get_meta_data(self):
+        '''Returns the meta data of the last read out and the statistics since the last call. Returns None if there was no read out.
+        '''
+        if self.last_meta_data is None:
+            return None
+        meta_data = self.last_meta_data
+        meta_data.update({
+            'n_hits': self.interpreter.get_n_hits(),
+            'n_events': self.interpreter.get_n_events(),
+            'n_readouts': self.n_readouts_since_update,
+            'n_total_readouts': self.n_readout,
+            'n_lost_readouts': self.n_lost_readouts,
+            'processing_time': self.processing_time_since_update / self.n_readouts_since_update})
+        self.last_meta_data = None
+        self.n_readouts_since_update = 0
+        self.processing_time_since_update = 0.0
+        return meta_data
+
+
+def send_histograms(socket, histograms, meta_data=None):
+    '''Sends the histograms and the meta data of the last read out via ZeroMQ. The histograms are sent without copying.
+    '''
+    names = sorted(histograms.keys())
+    header = dict(
+        name='Histograms',
+        meta_data=meta_data,
+        histograms=[(name, str(histograms[name].dtype), histograms[name].shape) for name in names]
+    )
+    socket.send_multipart([json.dumps(header)] + [histograms[name] for name in names])
+
+
+class OnlineMonitorService(object):
+    '''Online monitor service. Interprets the raw data stream and publishes the histograms.
+
+    The histograms are published at most max_refresh_rate times per second. Histograms that did not change since the last update are not sent
+    except every snapshot_interval seconds, when all histograms are sent for clients that connected later. All other messages
+    of the raw data stream (e.g. run configuration) are forwarded.
+
+    Parameters
+    ----------
+    socket_addr : string
+        Address of the raw data sender.
+    service_addr : string
+        Address the service socket (PUB) is bound to.
+    pull : bool
+        If True, use a PULL socket to receive data from a lossless sender (send_data_mode 'push').
+    integrate_readouts : int
+        Number of read outs the histograms are integrated over. If 0, the histograms are never reset.
+    max_refresh_rate : float
+        Maximum number of updates per second.
+    snapshot_interval : float
+        Time in seconds between two updates with all histograms.
+    '''
+    def __init__(self, socket_addr, service_addr, pull=False, integrate_readouts=1, max_refresh_rate=10.0, snapshot_interval=1.0):
+        self.socket_addr = socket_addr
+        self.service_addr = service_addr
+        self.max_refresh_rate = max_refresh_rate
+        self.snapshot_interval = snapshot_interval
+        self.monitor = RawDataMonitor(integrate_readouts=integrate_readouts)
+        context = zmq.Context.instance()
+        if pull:  # lossless mode, sender uses PUSH socket
+            self.socket_pull = context.socket(zmq.PULL)
+        else:
+            self.socket_pull = context.socket(zmq.SUB)  # subscriber
+            self.socket_pull.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+        self.socket_pull.connect(socket_addr)
+        self.socket_pub = context.socket(zmq.PUB)
+        self.socket_pub.bind(service_addr)
+        self.last_histograms = {}  # last sent histograms
+        self.last_update = 0.0
+        self.last_snapshot = 0.0
+        self._stop = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self):
+        '''Runs the service in a thread.
+        '''
+        self._stop.clear()
+        self._thread = Thread(target=self.run, name='OnlineMonitorService %s' % self.service_addr)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.socket_pull.close()
+        self.socket_pub.close()
+
+    def reset(self):
+        with self._lock:
+            self.monitor.reset()
+            self.last_histograms = {}
+
+    def run(self):
+        logging.info('Online monitor service: receiving from %s, publishing on %s', self.socket_addr, self.service_addr)
+        while not self._stop.is_set():
+            now = time.time()
+            next_update = self.last_snapshot + self.snapshot_interval
+            if self.monitor.update_pending:
+                next_update = min(next_update, self.last_update + 1.0 / self.max_refresh_rate)
+            timeout = min(max(next_update - now, 0.0), 0.1)  # check stop condition
+            self.socket_pull.poll(int(timeout * 1000))  # blocking with timeout
+            while not self._stop.is_set():  # process the available messages until the next update is due
+                with self._lock:  # lock per message, reset() must not wait for the whole queue
+                    message = self.monitor.receive(self.socket_pull)
+                    if message is None:
+                        break
+                    name, meta_data = message
+                    if name == 'Reset':
+                        self.last_histograms = {}
+                    if name != 'ReadoutData':  # forward all other messages
+                        meta_data['name'] = name
+                        self.socket_pub.send_multipart([json.dumps(meta_data)])
+                if self.snapshot_due() or self.update_due():
+                    break
+            with self._lock:
+                if self.snapshot_due():
+                    self.update(snapshot=True)
+                elif self.update_due():
+                    self.update()
+
+    def snapshot_due(self):
+        return time.time() - self.last_snapshot >= self.snapshot_interval
+
+    def update_due(self):
+        return self.monitor.update_pending and time.time() - self.last_update >= 1.0 / self.max_refresh_rate
+
+    def update(self, snapshot=False):
+        '''Publishes the changed histograms and the meta data of the last read out. If snapshot is True, all histograms are published.
+        '''
+        now = time.time()
+        if self.monitor.histograms_pending or snapshot:
+            histograms = self.monitor.get_histograms()
+            if snapshot:
+                changed_histograms = histograms
+                self.last_snapshot = now
+            else:
+                changed_histograms = dict((name, histogram) for name, histogram in histograms.iteritems() if name not in self.last_histograms or not np.array_equal(self.last_histograms[name], histogram))
+            self.last_histograms = histograms
+        else:
+            changed_histograms = {}
+        meta_data = self.monitor.get_meta_data()
+        if changed_histograms or meta_data is not None:
+            send_histograms(self.socket_pub, changed_histograms, meta_data)
+        self.last_update = now
+
+
+class OnlineMonitorClient(object):
+    '''Client of the online monitor service.
+
+    Parameters
+    ----------
+    service_addr : string
+        Address of the online monitor service.
+    '''
+    def __init__(self, service_addr):
+        self.service_addr = service_addr
+        self.socket = zmq.Context.instance().socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, '')  # do not filter any data
+        self.socket.connect(service_addr)
+
+    def receive(self, timeout=None):
+        '''Receives one message from the service.
+
+        Parameters
+        ----------
+        timeout : float
+            Timeout in seconds. If None, wait until a message is received.
+
+        Returns
+        -------
+        Tuple with name, meta data and histograms (dict of arrays, None if not a histogram update) of the message. None, if the timeout was reached.
+        The meta data of a histogram update is None, if there was no read out since the last update.
+        '''
+        if not self.socket.poll(None if timeout is None else int(timeout * 1000)):
+            return None
+        frames = self.socket.recv_multipart()
+        header = json.loads(frames[0])
+        name = header.pop('name')
+        if name != 'Histograms':
+            return name, header, None
+        histograms = {}
+        for (histogram_name, dtype, shape), frame in zip(header['histograms'], frames[1:]):
+            histograms[histogram_name] = np.frombuffer(frame, dtype=dtype).reshape(shape)
+        return name, header['meta_data'], histograms
+
+    def close(self):
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    usage = "Usage: %prog ADDRESS"
+    description = "ADDRESS: Remote address of the sender (default: tcp://127.0.0.1:5678)."
+    parser = OptionParser(usage, description=description)
+    parser.add_option("--pull", action="store_true", dest="pull", default=False, help="Use a PULL socket to receive data from a lossless sender (send_data_mode 'push').")
+    parser.add_option("--service", dest="service_addr", default='tcp://127.0.0.1:5680', help="Address the service is publishing the histograms on (default: tcp://127.0.0.1:5680).")
+    parser.add_option("--integrate", type="int", dest="integrate_readouts", default=1, help="Number of read outs the histograms are integrated over, 0 to integrate all read outs (default: 1).")
+    parser.add_option("--refresh_rate", type="float", dest="max_refresh_rate", default=10.0, help="Maximum number of updates per second (default: 10).")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        socket_addr = 'tcp://127.0.0.1:5678'
+    elif len(args) == 1:
+        socket_addr = args[0]
+    else:
+        parser.error("incorrect number of arguments")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    service = OnlineMonitorService(socket_addr=socket_addr, service_addr=options.service_addr, pull=options.pull, integrate_readouts=options.integrate_readouts, max_refresh_rate=options.max_refresh_rate)
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -3,7 +3,7 @@ import datetime
 import os
 import re
 from collections import namedtuple
-from threading import Lock, Thread, Event
+from threading import Thread, Event
 import sys
 import functools
 import traceback
@@ -21,6 +21,7 @@ from functools import wraps
 from yaml import safe_load
 
 from pybar.utils.utils import find_file_dir_up
+from pybar.run_registry import open_run_registry
 
 
 punctuation = '!,.:;?'
@@ -29,6 +30,9 @@ punctuation = '!,.:;?'
 _RunStatus = namedtuple('RunStatus', ['running', 'finished', 'stopped', 'aborted', 'crashed'])
 run_status = _RunStatus(running='RUNNING', finished='FINISHED', stopped='STOPPED', aborted='ABORTED', crashed='CRASHED')
 
+# Entry of a primlist. The scheduling annotations are described in RunManager.run_primlist().
+PrimlistEntry = namedtuple('PrimlistEntry', ['index', 'run_cls', 'run_conf', 'name', 'dut', 'after', 'analysis_only', 'conf'])
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
 
 
@@ -47,6 +51,8 @@ class RunBase(object):
     '''
     __metaclass__ = abc.ABCMeta
 
+    hardware_access = True  # set to False in run classes which do not access the hardware (required for @analysis_only in primlists)
+
     def __init__(self, conf):
         '''Initialize object.
 
@@ -61,7 +67,7 @@ class RunBase(object):
         self._run_conf = None
         self._run_number = None
         self._run_status = None
-        self.file_lock = Lock()
+        self._run_registry = None
         self.stop_run = Event()  # abort condition for loops
         self.abort_run = Event()
         self._last_traceback = None
@@ -296,62 +302,25 @@ class RunBase(object):
         '''
         pass
 
+    @property
+    def run_registry(self):
+        '''Run registry of the working directory. The type of the registry is given by the configuration parameter run_registry ('text' (default) or 'sqlite').
+        '''
+        if self._run_registry is None:
+            self._run_registry = open_run_registry(self.working_dir, self._conf.get('run_registry') or 'text')
+        return self._run_registry
+
     def _get_run_numbers(self, status=None):
-        run_numbers = {}
-        with self.file_lock:
-            if not os.path.exists(self.working_dir):
-                os.makedirs(self.working_dir)
-            # In Python 2.x, open on all POSIX systems ultimately just depends on fopen.
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), 'a+') as f:
-                f.seek(0)
-                for line in f.readlines():
-                    try:
-                        number_parts = re.findall('\d+\s+', line)
-                        parts = re.split('\s+', line)
-                        if status:
-                            if parts[2] in status:
-                                run_number = int(number_parts[0])
-                            else:
-                                continue
-                        else:
-                            run_number = int(number_parts[0])
-                    except IndexError:
-                        continue
-                    if line[-1] != '\n':
-                        line = line + '\n'
-                    run_numbers[run_number] = line
-        return run_numbers
+        return self.run_registry.get_runs(status=status)
 
     def _write_run_number(self, run_number=None):
         self._run_start_time = datetime.datetime.now()
-        run_numbers = self._get_run_numbers()
-        if run_number:
-            self._run_number = run_number
-        else:
-            if not run_numbers:
-                self._run_number = 1
-            else:
-                self._run_number = max(dict.iterkeys(run_numbers)) + 1
-        run_numbers[self.run_number] = str(self.run_number) + ' ' + self.__class__.__name__ + ' ' + 'RUNNING' + ' ' + str(self._run_start_time) + '\n'
-        with self.file_lock:
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), "w") as f:
-                for value in dict.itervalues(run_numbers):
-                    f.write(value)
+        self._run_number = self.run_registry.add_run(self.__class__.__name__, self._run_start_time, run_number=run_number)  # runs in other threads and processes do not get the same run number
 
     def _write_run_status(self, status_msg):
         self._run_stop_time = datetime.datetime.now()
         self._total_run_time = self._run_stop_time - self._run_start_time
-        run_numbers = self._get_run_numbers()
-        if not run_numbers:
-            run_numbers[self.run_number] = str(self.run_number) + ' ' + self.__class__.__name__ + ' ' + status_msg + ' ' + str(self._run_stop_time) + ' ' + str(self._total_run_time) + '\n'
-        else:
-            parts = re.split('\s+', run_numbers[self.run_number])
-            parts[2] = status_msg
-            run_numbers[self.run_number] = ' '.join(parts[:-1]) + ' ' + str(self._run_stop_time) + ' ' + str(self._total_run_time) + '\n'
-        with self.file_lock:
-            with open(os.path.join(self.working_dir, "run" + ".cfg"), "w") as f:
-                for value in dict.itervalues(run_numbers):
-                    f.write(value)
+        self.run_registry.set_run_status(self.run_number, status_msg, self._run_stop_time, self._total_run_time)
 
     def _signal_handler(self, signum, frame):
         signal.signal(signal.SIGINT, signal.SIG_DFL)  # setting default handler... pressing Ctrl-C a second time will kill application
@@ -429,6 +398,8 @@ class RunManager(object):
 
         self._conf = None  # configuration dictionary
         self.current_run = None  # current run number
+        self._active_runs = []  # runs executed by the primlist scheduler
+        self._cancel_primlist = Event()
         self._conf_path = None  # absolute path of the configuation file
         self.init(conf)
 
@@ -502,10 +473,36 @@ class RunManager(object):
             conf_dict.update(conf)
         return conf_dict
 
+    @property
+    def run_registry(self):
+        '''Run registry of the working directory.
+        '''
+        return open_run_registry(self._conf['working_dir'], self._conf.get('run_registry') or 'text')
+
+    def get_run_numbers(self, status=None):
+        '''Returns a sorted list of the run numbers in the working directory.
+
+        Parameters
+        ----------
+        status : string, list
+            If given, returns only runs with the given status or list of status, e.g. run_status.finished.
+        '''
+        return sorted(self.run_registry.get_runs(status=status).iterkeys())
+
+    def get_run_status(self, run_number):
+        '''Returns the status of a run. Returns None if the run does not exist.
+        '''
+        run_record = self.run_registry.get_run(run_number)
+        return run_record.status if run_record else None
+
     def cancel_current_run(self, msg=None):
-        '''Control for runs.
+        '''Control for runs. Cancels all runs executed by the primlist scheduler.
         '''
-        self.current_run.handle_cancel(msg=msg)
+        if self._active_runs:
+            for run in list(self._active_runs):
+                run.handle_cancel(msg=msg)
+        else:
+            self.current_run.handle_cancel(msg=msg)
 
     def run_run(self, run, conf=None, run_conf=None, use_thread=False, catch_exception=True):
         '''Runs a run in another thread. Non-blocking.
@@ -535,26 +532,7 @@ class RunManager(object):
             # instantiate the class
             run = run(conf=self._conf)
 
-        local_run_conf = {}
-        # general parameters from conf
-        if 'run_conf' in self._conf:
-            logging.info('Updating run configuration using run_conf key from configuration')
-            local_run_conf.update(self._conf['run_conf'])
-        # check for class name, scan specific parameters from conf
-        if run.__class__.__name__ in self._conf:
-            logging.info('Updating run configuration using %s key from configuration' % (run.__class__.__name__,))
-            local_run_conf.update(self._conf[run.__class__.__name__])
-
-        if isinstance(run_conf, basestring) and os.path.isfile(run_conf):
-            logging.info('Updating run configuration from file %s', os.path.abspath(run_conf))
-        elif run_conf is not None:
-            logging.info('Updating run configuration')
-        run_conf = self.open_conf(run_conf)
-        # check for class name, scan specific parameters from conf
-        if run.__class__.__name__ in run_conf:
-            run_conf = run_conf[run.__class__.__name__]
-        # run_conf parameter has highest priority, updated last
-        local_run_conf.update(run_conf)
+        local_run_conf = self._get_run_conf(run, conf=self._conf, run_conf=run_conf)
 
         if use_thread:
             @thunkify('RunThread')
@@ -574,29 +552,170 @@ class RunManager(object):
                 raise RuntimeError('Exception occurred. Please read the log.')
             return status
 
-    def run_primlist(self, primlist, skip_remaining=False):
+    def _get_run_conf(self, run, conf, run_conf=None):
+        '''Returns the run configuration (dict) of a run object from the configuration and the run specific configuration.
+        '''
+        local_run_conf = {}
+        # general parameters from conf
+        if 'run_conf' in conf:
+            logging.info('Updating run configuration using run_conf key from configuration')
+            local_run_conf.update(conf['run_conf'])
+        # check for class name, scan specific parameters from conf
+        if run.__class__.__name__ in conf:
+            logging.info('Updating run configuration using %s key from configuration' % (run.__class__.__name__,))
+            local_run_conf.update(conf[run.__class__.__name__])
+
+        if isinstance(run_conf, basestring) and os.path.isfile(run_conf):
+            logging.info('Updating run configuration from file %s', os.path.abspath(run_conf))
+        elif run_conf is not None:
+            logging.info('Updating run configuration')
+        run_conf = self.open_conf(run_conf)
+        # check for class name, scan specific parameters from conf
+        if run.__class__.__name__ in run_conf:
+            run_conf = run_conf[run.__class__.__name__]
+        # run_conf parameter has highest priority, updated last
+        local_run_conf.update(run_conf)
+        return local_run_conf
+
+    def run_primlist(self, primlist, skip_remaining=False, max_concurrent_runs=1):
         '''Runs runs from a primlist.
 
+        Runs are started in the order of the primlist as soon as their dependencies are fulfilled. Runs accessing the same DUT
+        are executed one after another in the order of the primlist. Other runs can be executed at the same time.
+
         Parameters
         ----------
         primlist : string
             Filename of primlist.
         skip_remaining : bool
             If True, skip remaining runs, if a run does not exit with status FINISHED.
+        max_concurrent_runs : int
+            Maximum number of runs executed at the same time. If 1, runs are executed one after another in the order of the primlist.
+            If None, the number of runs is not limited.
+
+        Returns
+        -------
+        List of dicts with name, class name, run number, status, start time (seconds after start of the primlist) and run time of each run.
 
         Note
         ----
         Primlist is a text file of the following format (comment line by adding '#'):
         <module name (containing class) or class (in either case use dot notation)>; <scan parameter>=<value>; <another scan parameter>=<another value>
+
+        The scheduling of a run is set by the following annotations, which are added like scan parameters:
+        @name=<name> : Name of the run, used by @after. By default the line number of the run (first run is 1).
+        @after=<name>[,<name>...] : Run is started after the given runs. The run is skipped if one of the given runs does not exit with status FINISHED.
+        @dut=<name> : Name of the DUT accessed by the run. Runs with the same DUT name are executed one after another (default DUT name: 'default').
+        @conf=<file> : Configuration file updating the configuration of the runs with the same DUT name.
+        @analysis_only : The run does not access the hardware and can be executed in parallel to other runs. By default, the run is started after the previous run.
+                         Only allowed for run classes with hardware_access set to False.
+        '''
+        entries = self.open_primlist(primlist)
+        names = dict((entry.name, entry.index) for entry in entries)
+        dependencies = {}  # implicit (order of the primlist) and explicit (@after) dependencies
+        explicit_dependencies = {}
+        for entry in entries:
+            try:
+                explicit_dependencies[entry.index] = set(names[name] for name in entry.after)
+            except KeyError as e:
+                raise ValueError('Run %s: unknown run name in @after: %s' % (entry.name, e))
+            dependencies[entry.index] = set(explicit_dependencies[entry.index])
+            if entry.analysis_only and entry.run_cls.hardware_access:
+                raise ValueError('Run %s: %s accesses the hardware and cannot be executed with @analysis_only' % (entry.name, entry.run_cls.__name__))
+            if entry.analysis_only:
+                if entry.index > 0:
+                    dependencies[entry.index].add(entry.index - 1)
+            else:
+                previous_entries = [other.index for other in entries[:entry.index] if other.dut == entry.dut and not other.analysis_only]
+                if previous_entries:
+                    dependencies[entry.index].add(previous_entries[-1])
+        # configuration for each DUT, runs of the same DUT are sharing the configuration (e.g. initialized DUT)
+        dut_confs = {}
+        for entry in entries:
+            if entry.dut not in dut_confs:
+                dut_confs[entry.dut] = self._conf if entry.dut == 'default' else dict(self._conf)
+            if entry.conf:
+                dut_confs[entry.dut].update(self.open_conf(entry.conf))
+
+        results = {}  # index: result dict
+        running = {}  # index: (thread, run, result)
+        stop_scheduling = False
+        self._cancel_primlist.clear()
+        primlist_start_time = time()
+        if current_thread().name == 'MainThread':
+            signal.signal(signal.SIGINT, self._signal_handler)
+            logging.info('Press Ctrl-C to stop runs')
+        try:
+            while len(results) < len(entries):
+                n_results = len(results)
+                if self._cancel_primlist.is_set():
+                    stop_scheduling = True
+                for entry in entries:
+                    if entry.index in results or entry.index in running:
+                        continue
+                    if stop_scheduling:
+                        results[entry.index] = {'name': entry.name, 'run': entry.run_cls.__name__, 'run_number': None, 'status': 'SKIPPED', 'start_time': None, 'run_time': None}
+                        continue
+                    if max_concurrent_runs and len(running) >= max_concurrent_runs:
+                        break
+                    if not dependencies[entry.index].issubset(results):
+                        continue
+                    failed_dependencies = [entries[index].name for index in explicit_dependencies[entry.index] if results[index]['status'] != run_status.finished]
+                    if failed_dependencies:
+                        logging.warning('Skipping run %s (%s): run(s) %s did not finish', entry.name, entry.run_cls.__name__, ', '.join(failed_dependencies))
+                        results[entry.index] = {'name': entry.name, 'run': entry.run_cls.__name__, 'run_number': None, 'status': 'SKIPPED', 'start_time': None, 'run_time': None}
+                        continue
+                    if not entry.analysis_only and any((not entries[index].analysis_only and entries[index].dut == entry.dut) for index in running):
+                        continue  # DUT is busy
+                    logging.info('Progressing with run %s (%s), %i out of %i...', entry.name, entry.run_cls.__name__, entry.index + 1, len(entries))
+                    running[entry.index] = self._start_primlist_run(entry, dut_confs[entry.dut] if not entry.analysis_only else dict(dut_confs[entry.dut]), start_time=time() - primlist_start_time)
+                for index, (thread, run, result) in running.items():
+                    if thread.is_alive():
+                        continue
+                    del running[index]
+                    self._active_runs.remove(run)
+                    results[index] = result
+                    if skip_remaining and result['status'] != run_status.finished:
+                        logging.error('Exited run %s with status %s: Skipping all remaining runs.', run.run_number, result['status'])
+                        stop_scheduling = True
+                if running:
+                    running.values()[0][0].join(0.1)  # wait, do not block signals in MainThread
+                elif len(results) == n_results:
+                    raise ValueError('Circular dependencies in primlist: %s' % ', '.join(entry.name for entry in entries if entry.index not in results))
+        finally:
+            if current_thread().name == 'MainThread':
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+        summary = [results[entry.index] for entry in entries]
+        logging.info('Primlist summary (total time: %s):', str(datetime.timedelta(seconds=int(time() - primlist_start_time))))
+        for result in summary:
+            logging.info('%s %s: run %s %s, started after %s, run time %s', result['name'], result['run'], result['run_number'], result['status'],
+                         str(datetime.timedelta(seconds=int(result['start_time']))) if result['start_time'] is not None else '-',
+                         str(datetime.timedelta(seconds=int(result['run_time']))) if result['run_time'] is not None else '-')
+        return summary
+
+    def _start_primlist_run(self, entry, conf, start_time):
+        '''Executes a run of a primlist in a thread.
         '''
-        runlist = self.open_primlist(primlist)
-        for index, run in enumerate(runlist):
-            logging.info('Progressing with run %i out of %i...', index + 1, len(runlist))
-            join = self.run_run(run, use_thread=True)
-            status = join()
-            if skip_remaining and not status == run_status.finished:
-                logging.error('Exited run %i with status %s: Skipping all remaining runs.', run.run_number, status)
-                break
+        run = entry.run_cls(conf=conf)
+        run_conf = self._get_run_conf(run, conf=conf, run_conf=entry.run_conf)
+        result = {'name': entry.name, 'run': entry.run_cls.__name__, 'run_number': None, 'status': None, 'start_time': start_time, 'run_time': None}
+
+        def run_in_thread():
+            run_start_time = time()
+            try:
+                result['status'] = run.run(run_conf=run_conf)
+            except Exception:
+                logging.error("Run %s has thrown an exception:\n%s", entry.name, traceback.format_exc())
+                result['status'] = run_status.crashed
+            result['run_number'] = run.run_number
+            result['run_time'] = time() - run_start_time
+
+        thread = Thread(target=run_in_thread, name='RunThread %s' % entry.name)
+        thread.daemon = True
+        self.current_run = run
+        self._active_runs.append(run)
+        thread.start()
+        return thread, run, result
 
     def open_primlist(self, primlist):
         def isrun(item, module):
@@ -615,7 +734,7 @@ class RunManager(object):
                         mod = import_module(parts[0])  # points to module
                     except ImportError:
                         mod = import_module(parts[0].rsplit('.', 1)[0])  # points to class
-                        islocalrun = partial(isrun, module=parts[0].split('.')[-2])
+                        islocalrun = partial(isrun, module=parts[0].rsplit('.', 1)[0])
                         clsmembers = getmembers(mod, islocalrun)
                         run_cls = None
                         for cls in clsmembers:
@@ -632,20 +751,31 @@ class RunManager(object):
                         elif not len(clsmembers):
                             raise ValueError('Found no matching class.')
                         run_cls = clsmembers[0][1]
-                    if run_cls.__class__.__name__ in self._conf:
-                        run_conf = self._conf[run_cls.__class__.__name__]
-                    else:
-                        run_conf = {}
+                    run_conf = {}
+                    annotations = {'name': str(len(run_list) + 1), 'dut': 'default', 'after': [], 'analysis_only': False, 'conf': None}
                     for param in parts[1:]:
+                        if param.startswith('@'):  # scheduling annotations
+                            match = re.match('@(\w+)\s*(?:[=:]\s*(.*))?$', param)
+                            key, value = (match.group(1), match.group(2) or '') if match else (param, '')
+                            if key not in annotations:
+                                raise ValueError('Unknown primlist annotation: @%s' % key)
+                            if key == 'analysis_only':
+                                annotations[key] = True
+                            elif key == 'after':
+                                annotations[key] = [name.strip() for name in value.split(',') if name.strip()]
+                            else:
+                                annotations[key] = value
+                            continue
                         key, value = re.split('\s*[=:]\s*', param, 1)
                         run_conf[key] = literal_eval(value)
-                    run_list.append(run_cls(conf=self._conf, run_conf=run_conf))
+                    run_list.append(PrimlistEntry(index=len(run_list), run_cls=run_cls, run_conf=run_conf, **annotations))
             return run_list
         else:
             AttributeError('Primlist format not supported.')
 
     def _signal_handler(self, signum, frame):
         signal.signal(signal.SIGINT, signal.SIG_DFL)  # setting default handler... pressing Ctrl-C a second time will kill application
+        self._cancel_primlist.set()
         self.cancel_current_run(msg='Pressed Ctrl-C')
 
 
@@ -0,0 +1,241 @@
+''' Run registry storing run number, run name and run status of the runs in a working directory.
+'''
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from threading import RLock
+
+
+RunRecord = namedtuple('RunRecord', ['run_number', 'run_name', 'status', 'start_time', 'stop_time', 'total_time'])
+
+registry_lock = RLock()  # runs in different threads are accessing the same registry
+
+
+def parse_run_cfg_line(line):
+    '''Returns the run record of a line of a run.cfg file. Returns None if the line is not valid.
+
+    Line format: <run number> <run name> <status> <start time> [<stop time> <total time>]
+    '''
+    parts = line.split()
+    try:
+        run_number = int(parts[0])
+        run_name = parts[1]
+        status = parts[2]
+    except (IndexError, ValueError):
+        return None
+    return RunRecord(run_number=run_number,
+                     run_name=run_name,
+                     status=status,
+                     start_time=' '.join(parts[3:5]) or None,
+                     stop_time=' '.join(parts[5:7]) or None,
+                     total_time=parts[7] if len(parts) > 7 else None)
+
+
+class RunRegistry(object):
+    '''Base class of run registries.
+
+    Parameters
+    ----------
+    working_dir : string
+        Directory of the runs.
+    '''
+    def __init__(self, working_dir):
+        self.working_dir = working_dir
+
+    def add_run(self, run_name, start_time, run_number=None):
+        '''Adds a run with status RUNNING and returns the run number. If run_number is None, the next run number is allocated.
+        '''
+        raise NotImplementedError
+
+    def set_run_status(self, run_number, status, stop_time, total_time):
+        '''Sets the status of a run at the end of a run.
+        '''
+        raise NotImplementedError
+
+    def get_runs(self, status=None):
+        '''Returns a dict with run number and run record of each run.
+
+        Parameters
+        ----------
+        status : string, list
+            If given, returns only runs with the given status or list of status.
+        '''
+        raise NotImplementedError
+
+    def get_run(self, run_number):
+        '''Returns the run record of a run. Returns None if the run does not exist.
+        '''
+        return self.get_runs().get(run_number)
+
+
+class TextRunRegistry(RunRegistry):
+    '''Run registry stored in the text file run.cfg. The whole file is rewritten at every change.
+    '''
+    def __init__(self, working_dir):
+        super(TextRunRegistry, self).__init__(working_dir)
+        self.filename = os.path.join(working_dir, "run" + ".cfg")
+
+    def _read(self):
+        run_numbers = {}
+        if not os.path.exists(self.working_dir):
+            os.makedirs(self.working_dir)
+        # In Python 2.x, open on all POSIX systems ultimately just depends on fopen.
+        with open(self.filename, 'a+') as f:
+            f.seek(0)
+            for line in f.readlines():
+                run_record = parse_run_cfg_line(line)
+                if run_record is not None:
+                    run_numbers[run_record.run_number] = run_record
+        return run_numbers
+
+    def _write(self, run_numbers):
+        with open(self.filename, "w") as f:
+            for run_number in sorted(run_numbers.iterkeys()):
+                f.write(' '.join(str(value) for value in run_numbers[run_number] if value is not None) + '\n')
+
+    def add_run(self, run_name, start_time, run_number=None):
+        with registry_lock:
+            run_numbers = self._read()
+            if not run_number:
+                run_number = max(run_numbers.iterkeys()) + 1 if run_numbers else 1
+            run_numbers[run_number] = RunRecord(run_number=run_number, run_name=run_name, status='RUNNING', start_time=str(start_time), stop_time=None, total_time=None)
+            self._write(run_numbers)
+        return run_number
+
+    def set_run_status(self, run_number, status, stop_time, total_time):
+        with registry_lock:
+            run_numbers = self._read()
+            if run_number in run_numbers:
+                run_numbers[run_number] = run_numbers[run_number]._replace(status=status, stop_time=str(stop_time), total_time=str(total_time))
+            else:
+                run_numbers[run_number] = RunRecord(run_number=run_number, run_name='', status=status, start_time=None, stop_time=str(stop_time), total_time=str(total_time))
+            self._write(run_numbers)
+
+    def get_runs(self, status=None):
+        if isinstance(status, basestring):
+            status = [status]
+        with registry_lock:
+            run_numbers = self._read()
+        if status:
+            return dict((run_number, run_record) for run_number, run_record in run_numbers.iteritems() if run_record.status in status)
+        return run_numbers
+
+
+class SqliteRunRegistry(RunRegistry):
+    '''Run registry stored in the SQLite database runs.db.
+
+    Adding a run and changing the status of a run are transactions, so several processes can use the same working directory.
+    The runs of an existing run.cfg are imported when the database is created. The run.cfg is not updated afterwards,
+    tools reading run.cfg have to use the text registry instead.
+    '''
+    def __init__(self, working_dir, timeout=60.0):
+        super(SqliteRunRegistry, self).__init__(working_dir)
+        self.filename = os.path.join(working_dir, "runs" + ".db")
+        self.timeout = timeout  # time in seconds to wait for other processes
+        if not os.path.exists(self.working_dir):
+            os.makedirs(self.working_dir)
+        with registry_lock:
+            connection = self._connect()
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                if not connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='runs'").fetchone():
+                    connection.execute('CREATE TABLE runs (run_number INTEGER PRIMARY KEY, run_name TEXT, status TEXT, start_time TEXT, stop_time TEXT, total_time TEXT)')
+                    connection.execute('CREATE INDEX runs_status ON runs (status)')
+                    self._migrate_run_cfg(connection)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)  # transactions are started explicitly
+
+    def _migrate_run_cfg(self, connection):
+        run_cfg_filename = os.path.join(self.working_dir, "run" + ".cfg")
+        if not os.path.isfile(run_cfg_filename):
+            return
+        run_records = []
+        with open(run_cfg_filename, 'r') as f:
+            for line in f.readlines():
+                run_record = parse_run_cfg_line(line)
+                if run_record is not None:
+                    run_records.append(run_record)
+        connection.executemany('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)', run_records)
+        logging.info('Imported %d run(s) from %s into %s', len(run_records), run_cfg_filename, self.filename)
+
+    def add_run(self, run_name, start_time, run_number=None):
+        with registry_lock:
+            connection = self._connect()
+            try:
+                connection.execute('BEGIN IMMEDIATE')  # lock the database for writing
+                if not run_number:
+                    run_number = (connection.execute('SELECT MAX(run_number) FROM runs').fetchone()[0] or 0) + 1
+                connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?)', (run_number, run_name, 'RUNNING', str(start_time), None, None))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                connection.close()
+        return run_number
+
+    def set_run_status(self, run_number, status, stop_time, total_time):
+        with registry_lock:
+            connection = self._connect()
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                if connection.execute('UPDATE runs SET status=?, stop_time=?, total_time=? WHERE run_number=?', (status, str(stop_time), str(total_time), run_number)).rowcount == 0:
+                    connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)', (run_number, '', status, None, str(stop_time), str(total_time)))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            finally:
+                connection.close()
+
+    def get_runs(self, status=None):
+        if isinstance(status, basestring):
+            status = [status]
+        with registry_lock:
+            connection = self._connect()
+            try:
+                if status:
+                    rows = connection.execute('SELECT * FROM runs WHERE status IN (%s)' % ', '.join('?' * len(status)), status).fetchall()
+                else:
+                    rows = connection.execute('SELECT * FROM runs').fetchall()
+            finally:
+                connection.close()
+        return dict((row[0], RunRecord(*row)) for row in rows)
+
+    def get_run(self, run_number):
+        with registry_lock:
+            connection = self._connect()
+            try:
+                row = connection.execute('SELECT * FROM runs WHERE run_number=?', (run_number,)).fetchone()
+            finally:
+                connection.close()
+        return RunRecord(*row) if row else None
+
+
+run_registries = {'sqlite': SqliteRunRegistry, 'text': TextRunRegistry}
+
+
+def open_run_registry(working_dir, registry='text'):
+    '''Returns the run registry of a working directory.
+
+    Parameters
+    ----------
+    working_dir : string
+        Directory of the runs.
+    registry : string, class
+        'text' (default, run.cfg) or 'sqlite' (runs.db) or a RunRegistry class.
+    '''
+    if isinstance(registry, basestring):
+        try:
+            registry = run_registries[registry]
+        except KeyError:
+            raise ValueError('Unknown run registry: %s' % registry)
+    return registry(working_dir)
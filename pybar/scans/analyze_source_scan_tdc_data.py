@@ -19,7 +19,6 @@ from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import tables as tb
 import numpy as np
-from scipy.interpolate import interp1d
 from scipy.ndimage.interpolation import shift
 
 import progressbar
@@ -90,18 +89,8 @@ def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_s
         logging.info('Histogram TDC hits with %s', condition)
 
     def get_charge(max_tdc, tdc_calibration_values, tdc_pixel_calibration):  # return the charge from calibration
-        charge_calibration = np.zeros(shape=(80, 336, max_tdc))
-        for column in range(80):
-            for row in range(336):
-                actual_pixel_calibration = tdc_pixel_calibration[column, row, :]
-                # Only take pixels with at least 3 valid calibration points
-                if np.count_nonzero(actual_pixel_calibration != 0) > 2 and np.count_nonzero(np.isfinite(actual_pixel_calibration)) > 2:
-                    selected_measurements = np.isfinite(actual_pixel_calibration)  # Select valid calibration steps
-                    selected_actual_pixel_calibration = actual_pixel_calibration[selected_measurements]
-                    selected_tdc_calibration_values = tdc_calibration_values[selected_measurements]
-                    interpolation = interp1d(x=selected_actual_pixel_calibration, y=selected_tdc_calibration_values, kind='slinear', bounds_error=False, fill_value=0)
-                    charge_calibration[column, row, :] = interpolation(np.arange(max_tdc))
-        return charge_calibration
+        # Only take pixels with at least 3 valid calibration points
+        return analysis_utils.TdcChargeCalibration(tdc_pixel_calibration, tdc_calibration_values, min_valid_points=3).get_charge_calibration(max_tdc)
 
     def plot_tdc_tot_correlation(data, condition, output_pdf):
         logging.info('Plot correlation histogram for %s', condition)
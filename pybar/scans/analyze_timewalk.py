@@ -7,7 +7,6 @@ from matplotlib import pyplot as plt
 from matplotlib import cm
 import tables as tb
 import numpy as np
-from scipy.interpolate import interp1d
 
 import progressbar
 
@@ -18,27 +17,22 @@ def plsr_dac_to_charge(plsr_dac):
     return 72.16 * plsr_dac + 2777.63
 
 
-def get_charge(max_tdc, tdc_calibration_values, tdc_pixel_calibration):  # Return the charge from calibration
+def get_charge(max_tdc, tdc_calibration_values, tdc_pixel_calibration, dtype=np.float64):  # Return the charge from calibration
     ''' Interpolatet the TDC calibration for each pixel from 0 to max_tdc'''
-    charge_calibration = np.zeros(shape=(80, 336, max_tdc))
-    for column in range(80):
-        for row in range(336):
-            actual_pixel_calibration = tdc_pixel_calibration[column, row, :]
-            if np.any(actual_pixel_calibration != 0) and np.any(np.isfinite(actual_pixel_calibration)):
-                selected_measurements = np.isfinite(actual_pixel_calibration)  # Select valid calibration steps
-                selected_actual_pixel_calibration = actual_pixel_calibration[selected_measurements]
-                selected_tdc_calibration_values = tdc_calibration_values[selected_measurements]
-                interpolation = interp1d(x=selected_actual_pixel_calibration, y=selected_tdc_calibration_values, kind='slinear', bounds_error=False, fill_value=0)
-                charge_calibration[column, row, :] = interpolation(np.arange(max_tdc))
-    return charge_calibration
-
-
-def get_charge_calibration(calibation_file, max_tdc):
-    ''' Open the hit or calibration file and return the calibration per pixel'''
+    return analysis_utils.TdcChargeCalibration(tdc_pixel_calibration, tdc_calibration_values).get_charge_calibration(max_tdc, dtype=dtype)
+
+
+def get_tdc_charge_calibration(calibation_file):
+    ''' Open the hit or calibration file and return the charge calibration object for the lookup of the charge of each hit'''
     with tb.open_file(calibation_file, mode="r") as in_file_calibration_h5:
         tdc_calibration = in_file_calibration_h5.root.HitOrCalibration[:, :, :, 1]
         tdc_calibration_values = in_file_calibration_h5.root.HitOrCalibration.attrs.scan_parameter_values[:]
-    return get_charge(max_tdc, tdc_calibration_values, tdc_calibration)
+    return analysis_utils.TdcChargeCalibration(tdc_calibration, tdc_calibration_values)
+
+
+def get_charge_calibration(calibation_file, max_tdc, dtype=np.float64):
+    ''' Open the hit or calibration file and return the calibration per pixel'''
+    return get_tdc_charge_calibration(calibation_file).get_charge_calibration(max_tdc, dtype=dtype)
 
 
 def get_time_walk_hist(hit_file, charge_calibration, event_status_select_mask, event_status_condition, hit_selection_conditions, max_timesamp, max_tdc, max_charge):
@@ -60,7 +54,10 @@ def get_time_walk_hist(hit_file, charge_calibration, event_status_select_mask, e
 
                 # Charge values for each Col/Row/TDC tuple from per pixel charge calibration
                 # and PlsrDAC calibration in electrons
-                charge_values = plsr_dac_to_charge(charge_calibration[column_index, row_index, tdc]).astype(np.float32)
+                if isinstance(charge_calibration, analysis_utils.TdcChargeCalibration):  # lazy lookup
+                    charge_values = plsr_dac_to_charge(charge_calibration.get_charge(column_index, row_index, tdc)).astype(np.float32)
+                else:
+                    charge_values = plsr_dac_to_charge(charge_calibration[column_index, row_index, tdc]).astype(np.float32)
 
                 actual_timewalk, xedges, yedges = np.histogram2d(charge_values, tdc_timestamp, bins=timewalk.shape, range=((0, max_charge), (0, max_timesamp)))
                 timewalk += actual_timewalk
@@ -148,8 +145,8 @@ if __name__ == '__main__':
     hit_selection_conditions = ['(n_cluster==1) & (cluster_size == 1) & (relative_BCID >= 1) & (relative_BCID <= 3) & ((tot > 12) | ((TDC * 1.5625 - tot * 25 < 100) & (tot * 25 - TDC * 1.5625 < 100))) & %s' % hit_selection]
 
     # Create charge calibration from hit or calibration
-    charge_calibration = get_charge_calibration(calibation_file, max_tdc)
-    max_charge = plsr_dac_to_charge(np.amax(charge_calibration))  # Correspond to max TDC, just needed for plotting
+    charge_calibration = get_tdc_charge_calibration(calibation_file)
+    max_charge = plsr_dac_to_charge(charge_calibration.get_max_charge(max_tdc))  # Correspond to max TDC, just needed for plotting
 
     # Create and plot time walk histogram
     timewalk_hist, xedges, yedges = get_time_walk_hist(hit_file,
@@ -235,7 +235,7 @@ class HitOrCalibration(Fei4RunBase):
 
             self.dut['TDC']['ENABLE'] = False
 
-    def handle_data(self, data, new_file=['column'], flush=True):  # Create new file for each scan parameter change
+    def handle_data(self, data, new_file=['column'], flush=False):  # Create new file for each scan parameter change
         super(HitOrCalibration, self).handle_data(data=data, new_file=new_file, flush=flush)
 
     def analyze(self):
@@ -21,6 +21,38 @@ from pybar.analysis.plotting.plotting import plot_three_way, plot_scurves, plot_
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
 
 
+def store_calibration_data_as_table(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_values, chunk_size=1000000):
+    '''Storing the threshold calibration in the tables MeanThresholdCalibration and ThresholdCalibration.
+
+    The rows of the ThresholdCalibration table are ordered by column, row and parameter value. The table is written in chunks of chunk_size rows.
+    Columns which are not set (vthin_altfine, vthin_altcoarse) are zero like in a table written row by row.
+    '''
+    logging.info("Storing calibration data in a table...")
+    filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+    mean_threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='MeanThresholdCalibration', description=data_struct.MeanThresholdCalibrationTable, title='mean_threshold_calibration', filters=filter_table)
+    threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='ThresholdCalibration', description=data_struct.ThresholdCalibrationTable, title='threshold_calibration', filters=filter_table)
+    parameter_values = np.asarray(parameter_values)
+    threshold_calibration = np.asarray(threshold_calibration)[:, :, :parameter_values.shape[0]]
+    thresholds = threshold_calibration.reshape(-1)  # same order as the table rows
+    for start_index in range(0, thresholds.shape[0], chunk_size):
+        stop_index = min(start_index + chunk_size, thresholds.shape[0])
+        column, row, parameter_value_index = np.unravel_index(np.arange(start_index, stop_index), threshold_calibration.shape)
+        threshold_calib_data = np.zeros(shape=(stop_index - start_index,), dtype=threshold_calib_table.dtype)
+        threshold_calib_data['column'] = column
+        threshold_calib_data['row'] = row
+        threshold_calib_data['parameter_value'] = parameter_values[parameter_value_index]
+        threshold_calib_data['threshold'] = thresholds[start_index:stop_index]
+        threshold_calib_table.append(threshold_calib_data)
+    mean_threshold_calib_data = np.zeros(shape=(parameter_values.shape[0],), dtype=mean_threshold_calib_table.dtype)
+    mean_threshold_calib_data['parameter_value'] = parameter_values
+    mean_threshold_calib_data['mean_threshold'] = mean_threshold_calibration[:parameter_values.shape[0]]
+    mean_threshold_calib_data['threshold_rms'] = mean_threshold_rms_calibration[:parameter_values.shape[0]]
+    mean_threshold_calib_table.append(mean_threshold_calib_data)
+    threshold_calib_table.flush()
+    mean_threshold_calib_table.flush()
+    logging.info("done")
+
+
 def create_threshold_calibration(scan_base_file_name, create_plots=True):  # Create calibration function, can be called stand alone
     def analyze_raw_data_file(file_name):
         if os.path.isfile(os.path.splitext(file_name)[0] + '_interpreted.h5'):  # skip analysis if already done
@@ -34,28 +66,6 @@ def create_threshold_calibration(scan_base_file_name, create_plots=True):  # Cre
                 analyze_raw_data.interpreter.set_warning_output(False)  # RX errors would fill the console
                 analyze_raw_data.interpret_word_table()
 
-    def store_calibration_data_as_table(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_values):
-        logging.info("Storing calibration data in a table...")
-        filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
-        mean_threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='MeanThresholdCalibration', description=data_struct.MeanThresholdCalibrationTable, title='mean_threshold_calibration', filters=filter_table)
-        threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='ThresholdCalibration', description=data_struct.ThresholdCalibrationTable, title='threshold_calibration', filters=filter_table)
-        for column in range(80):
-            for row in range(336):
-                for parameter_value_index, parameter_value in enumerate(parameter_values):
-                    threshold_calib_table.row['column'] = column
-                    threshold_calib_table.row['row'] = row
-                    threshold_calib_table.row['parameter_value'] = parameter_value
-                    threshold_calib_table.row['threshold'] = threshold_calibration[column, row, parameter_value_index]
-                    threshold_calib_table.row.append()
-        for parameter_value_index, parameter_value in enumerate(parameter_values):
-            mean_threshold_calib_table.row['parameter_value'] = parameter_value
-            mean_threshold_calib_table.row['mean_threshold'] = mean_threshold_calibration[parameter_value_index]
-            mean_threshold_calib_table.row['threshold_rms'] = mean_threshold_rms_calibration[parameter_value_index]
-            mean_threshold_calib_table.row.append()
-        threshold_calib_table.flush()
-        mean_threshold_calib_table.flush()
-        logging.info("done")
-
     def store_calibration_data_as_array(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_name, parameter_values):
         logging.info("Storing calibration data in an array...")
         filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
@@ -164,7 +174,7 @@ class ThresholdCalibration(FastThresholdScan):
             super(ThresholdCalibration, self).scan()
         logging.info("Finished!")
 
-    def handle_data(self, data, new_file=['GDAC'], flush=True):  # Create new file for each scan parameter change
+    def handle_data(self, data, new_file=['GDAC'], flush=False):  # Create new file for each scan parameter change
         super(ThresholdCalibration, self).handle_data(data=data, new_file=new_file, flush=flush)
 
     def analyze(self):
@@ -75,7 +75,7 @@ class EudaqExtTriggerScan(ExtTriggerScan):
         super(EudaqExtTriggerScan, self).handle_err(exc=exc)
         self.data_error_occurred = True
 
-    def handle_data(self, data, new_file=False, flush=True):
+    def handle_data(self, data, new_file=False, flush=False):
         events = build_events_from_raw_data(data[0])
         for item in events:
             if item.shape[0] == 0:
@@ -48,7 +48,7 @@ class ExtTriggerGdacScan(ExtTriggerScan):
             ExtTriggerScan.scan(self)
             self.stop_run.clear()
 
-    def handle_data(self, data, new_file=True, flush=True):
+    def handle_data(self, data, new_file=True, flush=False):
         super(ExtTriggerGdacScan, self).handle_data(data=data, new_file=new_file, flush=flush)
 
     def get_gdacs_from_interpolated_calibration(self, calibration_file, thresholds):
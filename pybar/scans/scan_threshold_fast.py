@@ -1,20 +1,38 @@
 import logging
+from collections import OrderedDict
 
 import numpy as np
+import tables as tb
 
-from pybar_fei4_interpreter.analysis_utils import hist_2d_index
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
-from pybar.fei4.register_utils import invert_pixel_mask
+from pybar.fei4.register_utils import invert_pixel_mask, make_pixel_mask
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.register_utils import ScanLoopSequence
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import get_col_row_array_from_data_record_array, convert_data_array, is_data_record, data_array_from_data_iterable, logical_and
+
+
+def get_injected_columns(double_column):
+    '''Returns the columns (counted from zero) injected at a double column during analog injection, see scan_loop().
+    '''
+    if double_column == 0:
+        return [0]
+    elif double_column == 39:
+        return [77, 78, 79]
+    else:
+        return [double_column * 2 - 1, double_column * 2]
 
 
 class FastThresholdScan(Fei4RunBase):
     '''Fast threshold scan
 
     Implementation of a fast threshold scan checking for start and end of s-curve.
+
+    In the adaptive mode the occupancy of each pixel is checked after each PlsrDAC step. Pixels which see all injections for saturated_steps
+    PlsrDAC steps are completed. Mask steps and double columns with only completed pixels are not injected anymore. The PlsrDAC value from which on
+    a pixel was not injected is stored in the raw data file (node saturated_pixels) and the occupancy of these pixels is set to n_injections during analysis.
+    The PlsrDAC step size is coarse_step_size as long as no pixel is inside the S-curve. If a coarse step reaches the S-curve of a pixel,
+    the PlsrDAC interval of the coarse step is scanned again with step_size. The data of the adaptive mode has to be analyzed
+    with fitted threshold histograms (create_fitted_threshold_hists), the threshold histograms of the interpreter are not supported.
     '''
     _default_run_conf = {
         "broadcast_commands": True,
@@ -30,7 +48,10 @@ class FastThresholdScan(Fei4RunBase):
         "use_enable_mask": False,  # if True, use Enable mask during scan, if False, all pixels will be enabled
         "enable_shift_masks": ["Enable", "C_High", "C_Low"],  # enable masks shifted during scan
         "disable_shift_masks": [],  # disable masks shifted during scan
-        "pulser_dac_correction": False  # PlsrDAC correction for each double column
+        "pulser_dac_correction": False,  # PlsrDAC correction for each double column
+        "adaptive": False,  # if True, skip mask steps and double columns with completed pixels and use coarse PlsrDAC steps outside of the S-curves
+        "saturated_steps": 2,  # adaptive mode: number of consecutive PlsrDAC steps with all injections seen until a pixel is completed
+        "coarse_step_size": 6  # adaptive mode: step size of the PlsrDAC as long as no pixel is inside the S-curve
     }
     scan_parameter_start = 0  # holding last start value (e.g. used in GDAC threshold scan)
 
@@ -88,6 +109,11 @@ class FastThresholdScan(Fei4RunBase):
         for column in self.ignore_columns:
             self.select_arr_columns.remove(column - 1)
 
+        scan_groups = [(self.enable_mask_steps, enable_double_columns)]  # list of mask steps and double columns injected at each PlsrDAC step
+        if self.adaptive:
+            self.init_adaptive_scan(enable_double_columns)
+        scan_loop_sequences = {}  # commands of each scan group are created only once for all PlsrDAC steps
+
         while self.scan_parameter_value <= scan_parameter_range[1]:  # scan as long as scan parameter is smaller than defined maximum
             if self.stop_run.is_set():
                 break
@@ -98,22 +124,30 @@ class FastThresholdScan(Fei4RunBase):
             commands.extend(self.register.get_commands("WrRegister", name=['PlsrDAC']))
             self.register_utils.send_commands(commands)
 
-            with self.readout(PlsrDAC=self.scan_parameter_value, fill_buffer=True, callback=self.handle_data if self.record_data else None):
+            if self.adaptive and self.record_data:
+                scan_groups = self.get_adaptive_scan_groups()
+                if not scan_groups:
+                    logging.info('Stopping threshold scan at %s %d: all pixels completed', 'PlsrDAC', self.scan_parameter_value)
+                    break
+
+            with self.readout(PlsrDAC=self.scan_parameter_value, histogram_occupancy=True, callback=self.handle_data if self.record_data else None):
                 cal_lvl1_command = self.register.get_commands("CAL")[0] + self.register.get_commands("zeros", length=40)[0] + self.register.get_commands("LV1")[0]
-                scan_loop(self, cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=self.enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=True, eol_function=None, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, restore_shift_masks=False, mask=invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None, double_column_correction=self.pulser_dac_correction)
+                for enable_mask_steps, enable_double_columns in scan_groups:
+                    scan_group = (tuple(enable_mask_steps) if enable_mask_steps else None, tuple(enable_double_columns))
+                    if scan_group not in scan_loop_sequences:
+                        scan_loop_sequences[scan_group] = ScanLoopSequence(cal_lvl1_command, repeat_command=self.n_injections, use_delay=True, mask_steps=self.mask_steps, enable_mask_steps=enable_mask_steps, enable_double_columns=enable_double_columns, same_mask_for_all_dc=True, digital_injection=False, enable_shift_masks=self.enable_shift_masks, disable_shift_masks=self.disable_shift_masks, mask=invert_pixel_mask(self.register.get_pixel_register_value('Enable')) if self.use_enable_mask else None, double_column_correction=self.pulser_dac_correction)
+                    scan_loop_sequences[scan_group].run(self, eol_function=None, restore_shift_masks=False)
 
-            if not self.start_condition_triggered or self.data_points > self.minimum_data_points:  # speed up, only create histograms when needed. Python is much too slow here.
+            if self.adaptive and self.record_data:  # the completed pixels are updated at every PlsrDAC step
+                occupancy_array = self.get_occupancy()
+                next_scan_parameter_value = self.update_adaptive_scan(occupancy_array, max_scan_parameter_value=scan_parameter_range[1])
+                occupancy_array[self.saturated_pixels >= 0] = self.n_injections  # pixels which are not injected anymore
+            if not self.start_condition_triggered or self.data_points > self.minimum_data_points:  # speed up, only check conditions when needed
                 if not self.start_condition_triggered and not self.record_data:
                     logging.info('Testing for start condition: %s %d', 'PlsrDAC', self.scan_parameter_value)
                 if not self.stop_condition_triggered and self.record_data:
                     logging.info('Testing for stop condition: %s %d', 'PlsrDAC', self.scan_parameter_value)
-
-                col, row = convert_data_array(array=self.read_data(), filter_func=is_data_record, converter_func=get_col_row_array_from_data_record_array)
-                if np.any(np.logical_and(col < 1, col > 80)) or np.any(np.logical_and(row < 1, row > 336)):  # filter bad data records that can happen
-                    logging.warning('There are undefined %d data records (e.g. random data)', np.count_nonzero(np.logical_and(col < 1, col > 80)) + np.count_nonzero(np.logical_and(row < 1, row > 336)))
-                    col, row = col[np.logical_and(col > 0, col <= 80)], row[np.logical_and(row > 0, row <= 336)]
-                occupancy_array = hist_2d_index(col - 1, row - 1, shape=(80, 336))
-                self.scan_condition(occupancy_array)
+                self.scan_condition(occupancy_array if self.adaptive and self.record_data else self.get_occupancy())
 
             # start condition is met for the first time
             if self.start_condition_triggered and not self.record_data:
@@ -129,20 +163,109 @@ class FastThresholdScan(Fei4RunBase):
             if self.record_data:
                 self.data_points = self.data_points + 1
 
-            # stop condition is met for the first time
-            if self.stop_condition_triggered and self.record_data:
+            # stop condition is met for the first time, the interval of a coarse step is scanned again before
+            if self.stop_condition_triggered and self.record_data and (not self.adaptive or self.rescan_stop is None):
                 logging.info('Stopping threshold scan at %s %d', 'PlsrDAC', self.scan_parameter_value)
                 break
 
             # increase scan parameter value
             if not self.start_condition_triggered:
                 self.scan_parameter_value = self.scan_parameter_value + self.search_distance
+            elif self.adaptive:
+                self.scan_parameter_value = next_scan_parameter_value
             else:
                 self.scan_parameter_value = self.scan_parameter_value + self.step_size
 
         if self.scan_parameter_value >= scan_parameter_range[1]:
             logging.warning("Reached maximum of PlsrDAC range... stopping scan")
 
+        if self.adaptive:
+            saturated_pixels_array = self.raw_data_file.h5_file.create_carray(self.raw_data_file.h5_file.root, name='saturated_pixels', title='PlsrDAC value from which on the pixel was not injected anymore (-1: always injected)', atom=tb.Atom.from_dtype(self.saturated_pixels.dtype), shape=self.saturated_pixels.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            saturated_pixels_array.attrs.dimensions = 'column, row'
+            saturated_pixels_array[:] = self.saturated_pixels
+            logging.info('Adaptive threshold scan: %d of %d pixel(s) not injected until the end of the scan', np.count_nonzero(self.saturated_pixels >= 0), np.count_nonzero(self.adaptive_scan_pixels))
+
+    def init_adaptive_scan(self, enable_double_columns):
+        '''Initializes the tracking of the pixels in the adaptive mode.
+        '''
+        self.saturated_pixels = np.full(shape=(80, 336), fill_value=-1, dtype=np.int32)  # PlsrDAC value from which on the pixel is not injected anymore
+        self.completed_pixels = np.zeros(shape=(80, 336), dtype=np.bool_)
+        self.n_saturated_steps = np.zeros(shape=(80, 336), dtype=np.uint32)  # number of consecutive PlsrDAC steps with all injections seen
+        self.coarse_step_start = None  # PlsrDAC value before the last step, if the last step was a coarse step
+        self.rescan_stop = None  # PlsrDAC value of the coarse step whose interval is scanned again
+        self.mask_step_pixels = [(mask_step, make_pixel_mask(steps=self.mask_steps, shift=mask_step).astype(np.bool_)) for mask_step in (self.enable_mask_steps if self.enable_mask_steps else range(self.mask_steps))]
+        self.double_column_columns = [(double_column, get_injected_columns(double_column)) for double_column in enable_double_columns]
+        # pixels injected during the scan
+        self.adaptive_scan_pixels = np.zeros(shape=(80, 336), dtype=np.bool_)
+        for _, pixels in self.mask_step_pixels:
+            for _, columns in self.double_column_columns:
+                self.adaptive_scan_pixels[columns] |= pixels[columns]
+        ignored_pixels = np.ones(shape=(80, 336), dtype=np.bool_)
+        ignored_pixels[self.select_arr_columns] = False
+        self.adaptive_scan_pixels[ignored_pixels] = False
+        if self.use_enable_mask:
+            self.adaptive_scan_pixels &= self.register.get_pixel_register_value('Enable').astype(np.bool_)
+
+    def get_adaptive_scan_groups(self):
+        '''Returns the mask steps and double columns with not completed pixels. Mask steps with the same double columns are grouped.
+
+        The PlsrDAC value is stored for the pixels which are not injected anymore. If the pixels are not injected at a smaller PlsrDAC value
+        while the interval of a coarse step is scanned again, the smaller value is stored.
+        '''
+        not_completed_pixels = np.logical_and(self.adaptive_scan_pixels, ~self.completed_pixels)
+        injected_pixels = np.zeros(shape=(80, 336), dtype=np.bool_)
+        scan_groups = OrderedDict()  # double columns with list of mask steps
+        for mask_step, pixels in self.mask_step_pixels:
+            not_completed_columns = np.any(np.logical_and(not_completed_pixels, pixels), axis=1)
+            double_columns = tuple(double_column for double_column, columns in self.double_column_columns if np.any(not_completed_columns[columns]))
+            if double_columns:
+                scan_groups.setdefault(double_columns, []).append(mask_step)
+                for double_column, columns in self.double_column_columns:
+                    if double_column in double_columns:
+                        injected_pixels[columns] |= pixels[columns]
+        not_injected_pixels = np.logical_and(self.adaptive_scan_pixels, ~injected_pixels)
+        self.saturated_pixels[np.logical_and(not_injected_pixels, np.logical_or(self.saturated_pixels < 0, self.saturated_pixels > self.scan_parameter_value))] = self.scan_parameter_value
+        if scan_groups:
+            logging.info('Adaptive threshold scan: %d of %d pixel(s) completed, injecting %d pixel(s)', np.count_nonzero(np.logical_and(self.adaptive_scan_pixels, self.completed_pixels)), np.count_nonzero(self.adaptive_scan_pixels), np.count_nonzero(np.logical_and(self.adaptive_scan_pixels, injected_pixels)))
+        return [(mask_steps, list(double_columns)) for double_columns, mask_steps in scan_groups.iteritems()]
+
+    def update_completed_pixels(self, occupancy_array):
+        '''Counts the consecutive PlsrDAC steps with all injections seen and marks pixels as completed.
+        '''
+        saturated = occupancy_array >= self.n_injections
+        self.n_saturated_steps[saturated] += 1
+        self.n_saturated_steps[np.logical_and(~saturated, ~self.completed_pixels)] = 0
+        self.completed_pixels |= np.logical_and(self.adaptive_scan_pixels, self.n_saturated_steps >= self.saturated_steps)
+
+    def update_adaptive_scan(self, occupancy_array, max_scan_parameter_value):
+        '''Updates the completed pixels with the occupancy of the current PlsrDAC step and returns the next PlsrDAC value.
+
+        The step size is coarse_step_size as long as no pixel is inside the S-curve, coarse steps do not go beyond max_scan_parameter_value.
+        If a pixel has seen injections for the first time after a coarse step (also if all injections were seen), the interval of the
+        coarse step is scanned again with step_size. The PlsrDAC value of the coarse step is not scanned again.
+        '''
+        if self.coarse_step_start is not None and self.coarse_step_start + self.step_size < self.scan_parameter_value and self.is_in_scurve(occupancy_array):  # pixels which are not completed had no hits before the coarse step
+            logging.info('Adaptive threshold scan: coarse step reached S-curve at %s %d, scanning again from %s %d', 'PlsrDAC', self.scan_parameter_value, 'PlsrDAC', self.coarse_step_start + self.step_size)
+            self.rescan_stop = self.scan_parameter_value
+            next_scan_parameter_value = self.coarse_step_start + self.step_size
+            self.coarse_step_start = None
+            return next_scan_parameter_value  # the pixels are not completed at this step, so they are injected during the scan of the interval
+        self.update_completed_pixels(occupancy_array)
+        if self.rescan_stop is None and self.scan_parameter_value < max_scan_parameter_value and not self.is_in_scurve(occupancy_array):
+            self.coarse_step_start = self.scan_parameter_value
+            return min(self.scan_parameter_value + self.coarse_step_size, max_scan_parameter_value)
+        self.coarse_step_start = None
+        next_scan_parameter_value = self.scan_parameter_value + self.step_size
+        if self.rescan_stop is not None and next_scan_parameter_value >= self.rescan_stop:  # interval scanned, continue after the coarse step
+            next_scan_parameter_value = self.rescan_stop + self.step_size
+            self.rescan_stop = None
+        return next_scan_parameter_value
+
+    def is_in_scurve(self, occupancy_array):
+        '''Returns True if any pixel has seen injections and is not completed (the PlsrDAC value is around the threshold of the pixel).
+        '''
+        return np.any(np.logical_and(np.logical_and(self.adaptive_scan_pixels, ~self.completed_pixels), occupancy_array > 0))
+
     def analyze(self):
         with AnalyzeRawData(raw_data_file=self.output_filename, create_pdf=True) as analyze_raw_data:
             analyze_raw_data.create_tot_hist = False
@@ -4,9 +4,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.register_utils import ScanLoopSequence
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, logical_and, data_array_from_data_iterable, get_col_row_tot_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -74,6 +73,17 @@ class FdacTuning(Fei4RunBase):
         self.tot_mean_best = np.full(shape=(80, 336), fill_value=0)  # array to store the best occupancy (closest to Ninjections/2) of the pixel
         self.fdac_mask_best = self.register.get_pixel_register_value("FDAC")
         fdac_tune_bits = self.fdac_tune_bits[:]
+        scan_loop_sequence = ScanLoopSequence(command=cal_lvl1_command,
+                                              repeat_command=self.n_injections_fdac,
+                                              mask_steps=self.mask_steps,
+                                              enable_mask_steps=enable_mask_steps,
+                                              enable_double_columns=None,
+                                              same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                              digital_injection=False,
+                                              enable_shift_masks=self.enable_shift_masks,
+                                              disable_shift_masks=self.disable_shift_masks,
+                                              mask=None,
+                                              double_column_correction=self.pulser_dac_correction)  # commands are created only once for all tuning steps
         for scan_parameter_value, fdac_bit in enumerate(fdac_tune_bits):
             if self.stop_run.is_set():
                 break
@@ -86,25 +96,10 @@ class FdacTuning(Fei4RunBase):
 
             self.write_fdac_config()
 
-            with self.readout(FDAC=scan_parameter_value, fill_buffer=True):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_fdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=enable_mask_steps,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            data = convert_data_array(array=self.read_data(), filter_func=is_data_record, converter_func=get_col_row_tot_array_from_data_record_array)
-            col_row_tot = np.column_stack(data)
-            tot_array = np.histogramdd(col_row_tot, bins=(80, 336, 16), range=[[1, 80], [1, 336], [0, 15]])[0]
+            with self.readout(FDAC=scan_parameter_value, histogram_tot=True):
+                scan_loop_sequence.run(self, eol_function=None, restore_shift_masks=True)
+
+            tot_array = self.get_tot_hist()
             tot_mean_array = np.average(tot_array, axis=2, weights=range(0, 16)) * sum(range(0, 16)) / self.n_injections_fdac
             select_better_pixel_mask = abs(tot_mean_array - self.target_tot) <= abs(self.tot_mean_best - self.target_tot)
             pixel_with_too_small_mean_tot_mask = tot_mean_array < self.target_tot
@@ -4,9 +4,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop, make_pixel_mask
+from pybar.fei4.register_utils import ScanLoopSequence, make_pixel_mask
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, logical_and, data_array_from_data_iterable, get_col_row_tot_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_tot
 
 
@@ -94,6 +93,17 @@ class FeedbackTuning(Fei4RunBase):
         tot_mean_best = 0.0
         feedback_best = self.register.get_global_register_value("PrmpVbpf")
         feedback_tune_bits = self.feedback_tune_bits[:]
+        scan_loop_sequence = ScanLoopSequence(command=cal_lvl1_command,
+                                              repeat_command=self.n_injections_feedback,
+                                              mask_steps=self.mask_steps,
+                                              enable_mask_steps=self.enable_mask_steps_feedback,
+                                              enable_double_columns=None,
+                                              same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                              digital_injection=False,
+                                              enable_shift_masks=self.enable_shift_masks,
+                                              disable_shift_masks=self.disable_shift_masks,
+                                              mask=None,
+                                              double_column_correction=self.pulser_dac_correction)  # commands are created only once for all tuning steps
         for feedback_bit in feedback_tune_bits:
             if self.stop_run.is_set():
                 break
@@ -106,28 +116,13 @@ class FeedbackTuning(Fei4RunBase):
 
             scan_parameter_value = self.register.get_global_register_value("PrmpVbpf")
 
-            with self.readout(PrmpVbpf=scan_parameter_value, fill_buffer=True):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_feedback,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=self.enable_mask_steps_feedback,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            data = convert_data_array(array=self.read_data(), filter_func=is_data_record, converter_func=get_col_row_tot_array_from_data_record_array)
-            col_row_tot_array = np.column_stack(data)
-            occupancy_array, _, _ = np.histogram2d(col_row_tot_array[:, 0], col_row_tot_array[:, 1], bins=(80, 336), range=[[1, 80], [1, 336]])
+            with self.readout(PrmpVbpf=scan_parameter_value, histogram_occupancy=True, histogram_tot=True):
+                scan_loop_sequence.run(self, eol_function=None, restore_shift_masks=True)
+
+            occupancy_array = self.get_occupancy()
             occupancy_array = np.ma.array(occupancy_array, mask=np.logical_not(np.ma.make_mask(select_mask_array)))  # take only selected pixel into account by creating a mask
             occupancy_array = np.ma.masked_where(occupancy_array > self.n_injections_feedback, occupancy_array)
-            col_row_tot_hist = np.histogramdd(col_row_tot_array, bins=(80, 336, 16), range=[[1, 80], [1, 336], [0, 15]])[0]
+            col_row_tot_hist = self.get_tot_hist()
             tot_mean_array = np.average(col_row_tot_hist, axis=2, weights=range(0, 16)) * sum(range(0, 16)) / self.n_injections_feedback
             tot_mean_array = np.ma.array(tot_mean_array, mask=occupancy_array.mask)
             # keep noisy pixels out
@@ -138,8 +133,7 @@ class FeedbackTuning(Fei4RunBase):
                 feedback_best = self.register.get_global_register_value("PrmpVbpf")
 
             logging.info('Mean ToT = %.2f', mean_tot)
-            tot_array = col_row_tot_array[:, 2]
-            self.tot_hist, _ = np.histogram(a=tot_array, range=(0, 16), bins=16)
+            self.tot_hist = col_row_tot_hist.sum(axis=(0, 1))
             if self.plot_intermediate_steps:
                 plot_tot(hist=self.tot_hist, title='ToT distribution (PrmpVbpf ' + str(scan_parameter_value) + ')', filename=self.plots_filename)
 
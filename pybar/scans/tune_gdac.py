@@ -4,9 +4,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop, make_pixel_mask
+from pybar.fei4.register_utils import ScanLoopSequence, make_pixel_mask
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, logical_and, data_array_from_data_iterable, get_col_row_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -101,6 +100,17 @@ class GdacTuning(Fei4RunBase):
         gdac_occ_array_desel_pixels = []
         gdac_tune_bits = self.gdac_tune_bits[:]
         min_gdac_with_occupancy = None
+        scan_loop_sequence = ScanLoopSequence(command=cal_lvl1_command,
+                                              repeat_command=self.n_injections_gdac,
+                                              mask_steps=self.mask_steps,
+                                              enable_mask_steps=self.enable_mask_steps_gdac,
+                                              enable_double_columns=None,
+                                              same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                              digital_injection=False,
+                                              enable_shift_masks=self.enable_shift_masks,
+                                              disable_shift_masks=self.disable_shift_masks,
+                                              mask=None,
+                                              double_column_correction=self.pulser_dac_correction)  # commands are created only once for all tuning steps
         for gdac_scan_step, gdac_bit in enumerate(gdac_tune_bits):
             if self.stop_run.is_set():
                 break
@@ -113,24 +123,10 @@ class GdacTuning(Fei4RunBase):
                 scan_parameter_value = (self.register.get_global_register_value("Vthin_AltCoarse") << 8) + self.register.get_global_register_value("Vthin_AltFine")
                 logging.info('GDAC setting: %d, set bit %d = 0', scan_parameter_value, gdac_bit)
 
-            with self.readout(GDAC=scan_parameter_value, fill_buffer=True):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_gdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=self.enable_mask_steps_gdac,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
+            with self.readout(GDAC=scan_parameter_value, histogram_occupancy=True):
+                scan_loop_sequence.run(self, eol_function=None, restore_shift_masks=True)
 
-            data = convert_data_array(array=self.read_data(), filter_func=is_data_record, converter_func=get_col_row_array_from_data_record_array)
-            occupancy_array, _, _ = np.histogram2d(*data, bins=(80, 336), range=[[1, 80], [1, 336]])
+            occupancy_array = self.get_occupancy()
             occ_array_sel_pixels = np.ma.array(occupancy_array, mask=np.logical_not(np.ma.make_mask(select_mask_array)))  # take only selected pixel into account by using the mask
             occ_array_desel_pixels = np.ma.array(occupancy_array, mask=np.ma.make_mask(select_mask_array))  # take only de-selected pixel into account by using the inverted mask
             median_occupancy = np.ma.median(occ_array_sel_pixels)
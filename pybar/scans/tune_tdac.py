@@ -4,9 +4,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 
 from pybar.fei4_run_base import Fei4RunBase
-from pybar.fei4.register_utils import scan_loop
+from pybar.fei4.register_utils import ScanLoopSequence
 from pybar.run_manager import RunManager
-from pybar.daq.readout_utils import convert_data_array, is_data_record, logical_and, data_array_from_data_iterable, get_col_row_array_from_data_record_array
 from pybar.analysis.plotting.plotting import plot_three_way
 
 
@@ -70,6 +69,17 @@ class TdacTuning(Fei4RunBase):
         self.occupancy_best = np.full(shape=(80, 336), fill_value=self.n_injections_tdac)  # array to store the best occupancy (closest to Ninjections/2) of the pixel
         self.tdac_mask_best = self.register.get_pixel_register_value("TDAC")
         tdac_tune_bits = self.tdac_tune_bits[:]
+        scan_loop_sequence = ScanLoopSequence(command=cal_lvl1_command,
+                                              repeat_command=self.n_injections_tdac,
+                                              mask_steps=self.mask_steps,
+                                              enable_mask_steps=enable_mask_steps,
+                                              enable_double_columns=None,
+                                              same_mask_for_all_dc=self.same_mask_for_all_dc,
+                                              digital_injection=False,
+                                              enable_shift_masks=self.enable_shift_masks,
+                                              disable_shift_masks=self.disable_shift_masks,
+                                              mask=None,
+                                              double_column_correction=self.pulser_dac_correction)  # commands are created only once for all tuning steps
         for scan_parameter_value, tdac_bit in enumerate(tdac_tune_bits):
             if self.stop_run.is_set():
                 break
@@ -82,24 +92,10 @@ class TdacTuning(Fei4RunBase):
 
             self.write_tdac_config()
 
-            with self.readout(TDAC=scan_parameter_value, fill_buffer=True):
-                scan_loop(self,
-                          command=cal_lvl1_command,
-                          repeat_command=self.n_injections_tdac,
-                          mask_steps=self.mask_steps,
-                          enable_mask_steps=enable_mask_steps,
-                          enable_double_columns=None,
-                          same_mask_for_all_dc=self.same_mask_for_all_dc,
-                          eol_function=None,
-                          digital_injection=False,
-                          enable_shift_masks=self.enable_shift_masks,
-                          disable_shift_masks=self.disable_shift_masks,
-                          restore_shift_masks=True,
-                          mask=None,
-                          double_column_correction=self.pulser_dac_correction)
-
-            data = convert_data_array(array=self.read_data(), filter_func=is_data_record, converter_func=get_col_row_array_from_data_record_array)
-            occupancy_array, _, _ = np.histogram2d(*data, bins=(80, 336), range=[[1, 80], [1, 336]])
+            with self.readout(TDAC=scan_parameter_value, histogram_occupancy=True):
+                scan_loop_sequence.run(self, eol_function=None, restore_shift_masks=True)
+
+            occupancy_array = self.get_occupancy()
             select_better_pixel_mask = abs(occupancy_array - self.n_injections_tdac / 2) <= abs(self.occupancy_best - self.n_injections_tdac / 2)
             pixel_with_too_high_occupancy_mask = occupancy_array > self.n_injections_tdac / 2
             self.occupancy_best[select_better_pixel_mask] = occupancy_array[select_better_pixel_mask]
@@ -2,10 +2,12 @@
 '''
 import unittest
 import os
+import json
 
 import progressbar
 import tables as tb
 import numpy as np
+from scipy.interpolate import interp1d
 
 from pixel_clusterizer.clusterizer import HitClusterizer
 
@@ -14,11 +16,13 @@ from pybar_fei4_interpreter.data_histograming import PyDataHistograming
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 from pybar_fei4_interpreter import data_struct
 
-from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.analysis.analyze_raw_data import AnalyzeRawData, fit_scurve, fit_scurves_vectorized
 from pybar.testing.tools import test_tools
 from pybar.scans.calibrate_hit_or import create_hitor_calibration
+from pybar.scans.calibrate_threshold import store_calibration_data_as_table
 from pybar.daq.readout_utils import get_col_row_array_from_data_record_array, convert_data_array, is_data_record
-from pybar.analysis.analysis_utils import data_aligned_at_events, InvalidInputError
+from pybar.daq.fei4_record import FEI4Record, decode_fei4_records, get_record_string
+from pybar.analysis.analysis_utils import TdcChargeCalibration, data_aligned_at_events, InvalidInputError, fix_raw_data, fix_raw_data_chunk, get_bad_word_ranges, create_event_index, get_event_index, get_event_index_row, get_file_info, file_info_cache_file_name
 import pybar.scans.analyze_source_scan_tdc_data as tdc_analysis
 
 
@@ -80,7 +84,12 @@ class TestAnalysis(unittest.TestCase):
             analyze_raw_data.chunk_size = 2999999
             analyze_raw_data.create_hit_table = True
             analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)  # the actual start conversion command
-        with AnalyzeRawData(raw_data_file=[os.path.join(tests_data_folder, 'unit_test_data_4_parameter_128.h5'), os.path.join(tests_data_folder, 'unit_test_data_4_parameter_256.h5')], analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'), scan_parameter_name='parameter', create_pdf=False) as analyze_raw_data:
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_4.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_parallel.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 10007  # small chunks to have several tasks
+            analyze_raw_data.n_workers = 2
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)  # the actual start conversion command
+        with AnalyzeRawData(raw_data_file=[os.path.join(tests_data_folder, 'unit_test_data_4_parameter_128.h5'), os.path.join(tests_data_folder, 'unit_test_data_4_parameter_256.h5')], analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'), scan_parameter_name='parameter', create_pdf=False, use_file_info_cache=True) as analyze_raw_data:  # file info from the cache, result has to be the same
             analyze_raw_data.chunk_size = 2999999
             analyze_raw_data.create_hit_table = True
             analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)  # the actual start conversion command
@@ -104,16 +113,20 @@ class TestAnalysis(unittest.TestCase):
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_3_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_parallel.h5'))
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_5_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration.pdf'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration_calibration.h5'))
+        os.remove(os.path.join(tests_data_folder, 'threshold_calibration_table.h5'))
+        os.remove(os.path.join(tests_data_folder, 'threshold_calibration_table_result.h5'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tdc_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tdc_interpreted_calibrated_tdc_hists.pdf'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tdc_interpreted_tdc_hists.h5'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tdc.pdf'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tlu.pdf'))
         os.remove(os.path.join(tests_data_folder, 'ext_trigger_scan_tlu_interpreted.h5'))
+        os.remove(os.path.join(tests_data_folder, file_info_cache_file_name))
 
     def test_libraries_stability(self):  # calls 50 times the constructor and destructor to check the libraries
         progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=50, term_width=80)
@@ -178,6 +191,72 @@ class TestAnalysis(unittest.TestCase):
                                                             node_names=["HistThreshold", "HistNoise", "HistTotPixel", "HistOcc", "HistRelBcid", "HistTot"])
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_vectorized_scurve_fit(self):  # check the vectorized S-curve fit against the single pixel fit
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_2_result.h5'), mode="r") as in_file_h5:
+            occupancy = in_file_h5.root.HistOcc[:]
+            plsr_dac = np.unique(in_file_h5.root.meta_data.col('PlsrDAC'))
+        scurve_data = occupancy.reshape(occupancy.shape[0] * occupancy.shape[1], occupancy.shape[2])[:2000]
+        result = fit_scurves_vectorized(scurve_data, PlsrDAC=plsr_dac)
+        result_single_pixel = np.array([fit_scurve(pixel_scurve_data, PlsrDAC=plsr_dac) for pixel_scurve_data in scurve_data.tolist()])
+        self.assertTrue(np.allclose(result, result_single_pixel, rtol=1e-3, atol=1e-3))
+
+    def test_parallel_interpretation(self):  # check if the parallel interpretation gives the same result as the serial interpretation
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_parallel.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_fix_raw_data(self):  # check the chunked fixing of bad data words against fixing all bad data words at once
+        raw_data = np.random.RandomState(0).randint(0, 2 ** 32, size=1000).astype(np.uint32)
+        bad_word_ranges = get_bad_word_ranges([(100, 150), (140, 330), (500, 501), (990, 1000), (0, 3)])
+        self.assertListEqual([[0, 3], [100, 330], [500, 501], [990, 1000]], bad_word_ranges.tolist())
+        fixed_raw_data = []
+        previous_stop = 0
+        for start, stop in bad_word_ranges:
+            fixed_raw_data.extend([raw_data[previous_stop:start], fix_raw_data(raw_data[start:stop].copy())[0]])
+            previous_stop = stop
+        fixed_raw_data = np.concatenate(fixed_raw_data + [raw_data[previous_stop:]])
+        for chunk_size in [1, 7, 100, 1000]:
+            fixed_raw_data_chunks = []
+            lsb_byte = None
+            for word_index in range(0, raw_data.shape[0], chunk_size):
+                fixed_raw_data_chunk, lsb_byte = fix_raw_data_chunk(raw_data[word_index:word_index + chunk_size], word_index, bad_word_ranges, lsb_byte=lsb_byte)
+                fixed_raw_data_chunks.append(fixed_raw_data_chunk)
+            self.assertTrue(np.array_equal(fixed_raw_data, np.concatenate(fixed_raw_data_chunks)))
+
+    def test_file_info_cache(self):  # check that the cached file info is the same as the file info read from the files
+        files = [os.path.join(tests_data_folder, 'unit_test_data_4_parameter_128.h5'), os.path.join(tests_data_folder, 'unit_test_data_4_parameter_256.h5')]
+        cache_file_name = os.path.join(tests_data_folder, file_info_cache_file_name)
+        if os.path.isfile(cache_file_name):
+            os.remove(cache_file_name)
+        files_info = get_file_info(files)
+        self.assertFalse(os.path.isfile(cache_file_name))  # the cache is opt-in
+        for _ in range(2):  # first call fills the cache, second call reads the cache
+            files_info_cached = get_file_info(files, use_cache=True)
+            self.assertListEqual(files_info.keys(), files_info_cached.keys())
+            for file_name, file_info in files_info.iteritems():
+                for key, value in file_info.iteritems():
+                    self.assertEqual(value, files_info_cached[file_name][key])
+        self.assertTrue(os.path.isfile(cache_file_name))
+        with open(cache_file_name, 'r') as cache_file:
+            cache = json.load(cache_file)
+        cache['not_existing.h5'] = cache.values()[0]
+        with open(cache_file_name, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        get_file_info(files, use_cache=True)
+        with open(cache_file_name, 'r') as cache_file:
+            self.assertNotIn('not_existing.h5', json.load(cache_file))  # entries of missing files are removed
+        self.assertListEqual([file_info_cache_file_name], [file_name for file_name in os.listdir(tests_data_folder) if file_name.startswith(file_info_cache_file_name)])  # no temporary files left
+
+    def test_decode_fei4_records(self):  # check the vectorized raw data decoding against FEI4Record
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), mode="r") as in_file_h5:
+            raw_data = in_file_h5.root.raw_data[:10000]
+        service_records = np.array([0x00EF0000 | (code << 10) | 0x2AB for code in range(64)], dtype=np.uint32)
+        raw_data = np.concatenate([raw_data, service_records, np.random.RandomState(0).randint(0, 2 ** 32, size=1000).astype(np.uint32)])
+        for chip_flavor in ['fei4a', 'fei4b']:
+            for tdc_trig_dist, trigger_data_mode in [(False, 0), (True, 1), (False, 2)]:
+                records = decode_fei4_records(raw_data, chip_flavor=chip_flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode)
+                for word, record in zip(raw_data, records):
+                    self.assertEqual(str(FEI4Record(word, chip_flavor=chip_flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode)), get_record_string(record, chip_flavor=chip_flavor, tdc_trig_dist=tdc_trig_dist, trigger_data_mode=trigger_data_mode))
 
     def test_analysis_utils_get_n_cluster_in_events(self):  # check compiled get_n_cluster_in_events function
         event_numbers = np.array([[0, 0, 1, 2, 2, 2, 4, 4000000000, 4000000000, 40000000000, 40000000000], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int64)  # use data format with non linear memory alignment
@@ -287,6 +366,63 @@ class TestAnalysis(unittest.TestCase):
                                                             exact=False)
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_threshold_calibration_table(self):  # check the chunked writing of the threshold calibration table against writing row by row
+        parameter_values = [10, 20, 40, 80, 160]
+        threshold_calibration = np.random.RandomState(0).normal(loc=50.0, scale=5.0, size=(80, 336, len(parameter_values)))
+        mean_threshold_calibration = np.mean(threshold_calibration, axis=(0, 1))
+        mean_threshold_rms_calibration = np.std(threshold_calibration, axis=(0, 1))
+        with tb.open_file(os.path.join(tests_data_folder, 'threshold_calibration_table.h5'), mode='w') as out_file_h5:
+            store_calibration_data_as_table(out_file_h5=out_file_h5, mean_threshold_calibration=mean_threshold_calibration, mean_threshold_rms_calibration=mean_threshold_rms_calibration, threshold_calibration=threshold_calibration, parameter_values=parameter_values, chunk_size=50000)
+        with tb.open_file(os.path.join(tests_data_folder, 'threshold_calibration_table_result.h5'), mode='w') as out_file_h5:
+            filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+            mean_threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='MeanThresholdCalibration', description=data_struct.MeanThresholdCalibrationTable, title='mean_threshold_calibration', filters=filter_table)
+            threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='ThresholdCalibration', description=data_struct.ThresholdCalibrationTable, title='threshold_calibration', filters=filter_table)
+            for column in range(80):
+                for row in range(336):
+                    for parameter_value_index, parameter_value in enumerate(parameter_values):
+                        threshold_calib_table.row['column'] = column
+                        threshold_calib_table.row['row'] = row
+                        threshold_calib_table.row['parameter_value'] = parameter_value
+                        threshold_calib_table.row['threshold'] = threshold_calibration[column, row, parameter_value_index]
+                        threshold_calib_table.row.append()
+            for parameter_value_index, parameter_value in enumerate(parameter_values):
+                mean_threshold_calib_table.row['parameter_value'] = parameter_value
+                mean_threshold_calib_table.row['mean_threshold'] = mean_threshold_calibration[parameter_value_index]
+                mean_threshold_calib_table.row['threshold_rms'] = mean_threshold_rms_calibration[parameter_value_index]
+                mean_threshold_calib_table.row.append()
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'threshold_calibration_table_result.h5'),
+                                                            os.path.join(tests_data_folder, 'threshold_calibration_table.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_tdc_charge_calibration(self):  # check the vectorized TDC charge calibration against the single pixel interpolation
+        def get_charge_single_pixel(max_tdc, tdc_calibration_values, tdc_pixel_calibration, min_valid_points):
+            charge_calibration = np.zeros(shape=(80, 336, max_tdc))
+            for column in range(80):
+                for row in range(336):
+                    actual_pixel_calibration = tdc_pixel_calibration[column, row, :]
+                    if np.count_nonzero(actual_pixel_calibration != 0) >= min_valid_points and np.count_nonzero(np.isfinite(actual_pixel_calibration)) >= max(2, min_valid_points):  # at least 2 points needed for the interpolation, charge 0 otherwise
+                        selected_measurements = np.isfinite(actual_pixel_calibration)
+                        interpolation = interp1d(x=actual_pixel_calibration[selected_measurements], y=tdc_calibration_values[selected_measurements], kind='slinear', bounds_error=False, fill_value=0)
+                        charge_calibration[column, row, :] = interpolation(np.arange(max_tdc))
+            return charge_calibration
+
+        random_state = np.random.RandomState(0)
+        tdc_calibration_values = np.arange(20, 420, 50)
+        tdc_calibration = tdc_calibration_values * random_state.uniform(0.5, 1.0, size=(80, 336, 1)) + random_state.normal(scale=2.0, size=(80, 336, tdc_calibration_values.shape[0]))
+        tdc_calibration[random_state.randint(0, 80, size=2000), random_state.randint(0, 336, size=2000), random_state.randint(0, tdc_calibration_values.shape[0], size=2000)] = np.nan  # missing calibration points
+        tdc_calibration[:, :, 1:7][random_state.uniform(size=(80, 336)) < 0.01] = np.nan  # pixels with few calibration points
+        tdc_calibration[10:12] = 0  # pixels without calibration
+        max_tdc = 500
+        for min_valid_points in (1, 3):
+            charge_calibration = TdcChargeCalibration(tdc_calibration, tdc_calibration_values, min_valid_points=min_valid_points)
+            charge_calibration_single_pixel = get_charge_single_pixel(max_tdc, tdc_calibration_values, tdc_calibration, min_valid_points)
+            self.assertTrue(np.allclose(charge_calibration.get_charge_calibration(max_tdc), charge_calibration_single_pixel))
+            self.assertTrue(np.allclose(charge_calibration.get_charge_calibration(max_tdc, dtype=np.float32), charge_calibration_single_pixel, rtol=1e-5, atol=1e-3))
+            self.assertAlmostEqual(charge_calibration.get_max_charge(max_tdc), np.amax(charge_calibration_single_pixel))
+            # lazy lookup of the charge of single hits
+            column, row, tdc = random_state.randint(0, 80, size=100000), random_state.randint(0, 336, size=100000), random_state.randint(0, max_tdc, size=100000)
+            self.assertTrue(np.allclose(charge_calibration.get_charge(column, row, tdc), charge_calibration_single_pixel[column, row, tdc]))
+
     def test_stop_mode_analysis(self):
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_5_interpreted.h5'),
                                                             os.path.join(tests_data_folder, 'unit_test_data_5_result.h5'))
@@ -583,6 +719,28 @@ class TestAnalysis(unittest.TestCase):
             gen = data_aligned_at_events(h5_file.root.Hits, start_event_number=3800, stop_event_number=239500, start_index=None, stop_index=None, first_event_aligned=True, try_speedup=False, chunk_size=100000)
             test_gen(generator=gen, table=h5_file.root.Hits, start=224, stop=None, size=100000)
 
+    def test_data_aligned_at_events_event_index(self):  # check that the event number index gives the same result as the chunk wise search
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_2_hits.h5'), 'r') as in_file_h5:
+            hits = in_file_h5.root.Hits[:]
+        with tb.open_file('event_index.h5', 'w', driver='H5FD_CORE', driver_core_backing_store=0) as h5_file:  # in memory file only
+            hit_table = h5_file.create_table(h5_file.root, name='Hits', description=hits.dtype)
+            hit_table.append(hits)
+            self.assertIsNone(get_event_index(hit_table))
+            parameters = [(None, None, None, None, 10000), (3800, None, 100, None, 225), (3800, 110200, 100, 15000, 10000), (0, 239500, None, None, 100000), (110200, 239500, 1000, None, 1000)]
+            results = [[(data.copy(), index) for data, index in data_aligned_at_events(hit_table, start_event_number=start_event_number, stop_event_number=stop_event_number, start_index=start_index, stop_index=stop_index, chunk_size=chunk_size, try_speedup=try_speedup)] for start_event_number, stop_event_number, start_index, stop_index, chunk_size in parameters for try_speedup in (False, True)]
+            create_event_index(hit_table, step=113)
+            self.assertIsNotNone(get_event_index(hit_table))
+            results_event_index = [[(data.copy(), index) for data, index in data_aligned_at_events(hit_table, start_event_number=start_event_number, stop_event_number=stop_event_number, start_index=start_index, stop_index=stop_index, chunk_size=chunk_size, try_speedup=try_speedup)] for start_event_number, stop_event_number, start_index, stop_index, chunk_size in parameters for try_speedup in (False, True)]
+            for result, result_event_index in zip(results, results_event_index):
+                self.assertEqual(len(result), len(result_event_index))
+                for (data, index), (data_event_index, index_event_index) in zip(result, result_event_index):
+                    self.assertEqual(index, index_event_index)
+                    np.testing.assert_array_equal(data, data_event_index)
+            for event_number in [0, 3800, 3801, 110200, 239500, 10 ** 9]:
+                self.assertEqual(np.searchsorted(hits['event_number'], event_number, side='left'), get_event_index_row(hit_table, event_number))
+            hit_table.append(hits[:1])  # index becomes outdated
+            self.assertIsNone(get_event_index(hit_table))
+
     def test_tdc_analysis(self):
         def analyze_tdc(source_scan_filename, calibration_filename, col_span, row_span):
             # Data files
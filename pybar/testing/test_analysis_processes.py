@@ -0,0 +1,113 @@
+''' Script to check the analysis of the modules in parallel processes. The analysis results, log records and exceptions have to be transferred to the run process.
+'''
+import logging
+import tempfile
+import unittest
+from threading import Event, Lock
+from Queue import Queue
+
+from pybar.fei4_run_base import Fei4RunBase, LogRecordCollector
+from pybar.fei4.register import FEI4Register
+from pybar.analysis.analysis_utils import AnalysisError
+
+
+class UnpicklableError(Exception):
+    pass
+
+
+class AnalysisRun(Fei4RunBase):
+    '''Run with analysis only.
+    '''
+    _default_run_conf = {
+        "vthin_alt_fine": 0,
+        "fail": None
+    }
+
+    def configure(self):
+        pass
+
+    def scan(self):
+        pass
+
+    def analyze(self):
+        logging.info('Analyzing module %s', self.current_module_handle)
+        if self.fail == 'error':
+            raise AnalysisError('Analysis of module %s failed' % self.current_module_handle)
+        elif self.fail == 'unpicklable':
+            raise UnpicklableError(lambda: None)
+        self.register.set_global_register_value('Vthin_AltFine', self.vthin_alt_fine)
+
+
+def create_run(module_run_confs, module_attrs=None):
+    '''Creates the run object without hardware initialization.
+    '''
+    run = AnalysisRun.__new__(AnalysisRun)
+    run.__dict__.update({
+        '_conf': {'working_dir': tempfile.gettempdir(), 'analysis_processes': 2},
+        '_run_conf': {},
+        '_run_number': 1,
+        'stop_run': Event(),
+        'abort_run': Event(),
+        'err_queue': Queue(),
+        '_modules': dict((module_id, [module_id]) for module_id in module_run_confs),
+        '_module_cfgs': dict((module_id, {'activate': True}) for module_id in module_run_confs),
+        '_module_run_conf': module_run_confs,
+        '_module_attr': dict((module_id, (module_attrs or {}).get(module_id, {})) for module_id in module_run_confs),
+        '_registers': dict((module_id, FEI4Register(fe_type='fei4b')) for module_id in module_run_confs),
+        '_register_utils': {},
+        '_scan_parameters': {},
+        '_current_module_handle': None,
+        '_initialized': True})
+    return run
+
+
+class TestAnalysisProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.handler = LogRecordCollector(self.records)
+        self.logger = logging.getLogger()
+        self.log_level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.log_level)
+
+    def apply_result(self, run, results, module_id):
+        run._current_module_handle = module_id
+        try:
+            run._apply_analysis_result(results[module_id])
+        finally:
+            run._current_module_handle = None
+
+    def test_analyze_in_processes(self):
+        run = create_run({
+            'a': {'vthin_alt_fine': 10, 'fail': None},
+            'b': {'vthin_alt_fine': 20, 'fail': 'error'},
+            'c': {'vthin_alt_fine': 30, 'fail': 'unpicklable'},
+            'd': {'vthin_alt_fine': 40, 'fail': None}},
+            module_attrs={'d': {'lock': Lock()}})  # cannot be transferred to another process
+        vthin_alt_fine = run._registers['b'].get_global_register_value('Vthin_AltFine')
+        results = run._analyze_in_processes(module_ids=['a', 'b', 'c', 'd'], n_processes=2)
+        self.assertListEqual(['a', 'b', 'c'], sorted(results.keys()))  # module d has to be analyzed in the run process
+
+        self.apply_result(run, results, 'a')
+        self.assertEqual(10, run._registers['a'].get_global_register_value('Vthin_AltFine'))
+        self.assertIn('Analyzing module a', [record.getMessage() for record in self.records])
+
+        with self.assertRaises(AnalysisError) as context:
+            self.apply_result(run, results, 'b')
+        self.assertIn('Analysis of module b failed', context.exception.remote_traceback)
+        self.assertIn('in analyze', context.exception.remote_traceback)
+        self.assertEqual(vthin_alt_fine, run._registers['b'].get_global_register_value('Vthin_AltFine'))  # register configuration not changed
+        self.assertTrue(any(record.levelno == logging.ERROR and 'module b' in record.getMessage() for record in self.records))
+
+        with self.assertRaises(RuntimeError) as context:
+            self.apply_result(run, results, 'c')
+        self.assertIn('UnpicklableError', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+''' Script to check the size limit policies of the data buffer of the FIFO readout and the buffered writing of the raw data file.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables as tb
+
+from pybar.daq.fifo_readout import DataBuffer, DataBufferFull
+from pybar.daq.fei4_raw_data import RawDataFile
+
+
+def get_data_tuple(index, n_words=100):
+    return (np.full(shape=(n_words,), fill_value=index, dtype=np.uint32), float(index), float(index) + 0.5, 0)
+
+
+class TestDataBuffer(unittest.TestCase):
+
+    def test_error(self):
+        data_buffer = DataBuffer(max_size=1000, policy='error')  # two read outs fit into the buffer
+        data_buffer.append(get_data_tuple(0))
+        data_buffer.append(get_data_tuple(1))
+        self.assertRaises(DataBufferFull, data_buffer.append, get_data_tuple(2))
+        data_buffer.append(get_data_tuple(3))  # raised only once
+        self.assertEqual(2, len(data_buffer))
+        self.assertEqual(2, data_buffer.n_dropped)
+        self.assertListEqual([0, 1], [data_tuple[0][0] for data_tuple in data_buffer])
+
+    def test_drop_oldest(self):
+        data_buffer = DataBuffer(max_size=1000, policy='drop_oldest')
+        for index in range(10):
+            data_buffer.append(get_data_tuple(index))
+        self.assertEqual(8, data_buffer.n_dropped)
+        self.assertEqual(800, data_buffer.size)
+        self.assertListEqual([8, 9], [data_tuple[0][0] for data_tuple in data_buffer])
+
+    def test_spill(self):
+        data_buffer = DataBuffer(max_size=1000, policy='spill')
+        for index in range(10):
+            data_buffer.append(get_data_tuple(index, n_words=100 + index))
+        self.assertEqual(8, data_buffer.n_spilled)
+        self.assertEqual(0, data_buffer.n_dropped)
+        self.assertEqual(10, len(data_buffer))
+        for index, data_tuple in enumerate(data_buffer):  # iterating does not remove data
+            self.assertTrue(np.array_equal(get_data_tuple(index, n_words=100 + index)[0], data_tuple[0]))
+            self.assertEqual(float(index), data_tuple[1])
+        for index in range(10):  # consuming the data frees memory
+            data_tuple = data_buffer.popleft()
+            self.assertTrue(np.array_equal(get_data_tuple(index, n_words=100 + index)[0], data_tuple[0]))
+        self.assertEqual(0, data_buffer.size)
+        self.assertRaises(IndexError, data_buffer.popleft)
+        data_buffer.close()
+
+    def test_iterate_while_consuming(self):  # iterating over a snapshot, items are neither skipped nor repeated
+        data_buffer = DataBuffer(max_size=1000, policy='spill')
+        for index in range(10):
+            data_buffer.append(get_data_tuple(index))
+        indices = []
+        for data_tuple in data_buffer:
+            indices.append(data_tuple[0][0])
+            data_buffer.popleft()  # consumed concurrently
+            data_buffer.append(get_data_tuple(10 + len(indices)))
+        self.assertListEqual(range(10), indices)
+        self.assertListEqual(range(11, 21), [data_tuple[0][0] for data_tuple in data_buffer])
+        data_buffer.close()
+
+
+class TestRawDataFileBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_flush_rows(self):
+        filename = os.path.join(self.folder, 'raw_data.h5')
+        data_tuples = [get_data_tuple(index, n_words=10 * index) for index in range(10)]
+        raw_data_file = RawDataFile(filename, flush_rows=3)
+        for data_tuple in data_tuples:
+            raw_data_file.append((data_tuple,), flush=False)
+        raw_data_file.close()
+        self.assertEqual(10 * (6 + 7 + 8), raw_data_file.buffer_high_water_mark)  # largest flush of three read outs
+        with tb.open_file(filename, mode='r') as in_file_h5:
+            self.assertTrue(np.array_equal(np.concatenate([data_tuple[0] for data_tuple in data_tuples]), in_file_h5.root.raw_data[:]))
+            self.assertListEqual([10 * index for index in range(10)], in_file_h5.root.meta_data[:]['data_length'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+''' Script to check the sending of raw data via ZeroMQ. The lossless mode must deliver every read out in order, the publisher mode has to count dropped read outs.
+'''
+import os
+import unittest
+import time
+from threading import Thread
+
+import numpy as np
+import tables as tb
+import zmq
+
+from pybar.daq.fei4_raw_data import DataSender
+from pybar.daq.replay_raw_data import replay_raw_data
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_analysis_data')
+
+
+class TestDataSender(unittest.TestCase):
+
+    def receive_data(self, socket, n_readouts, timeout=10.0, data_list=None):
+        headers = []
+        start = time.time()
+        while len(headers) < n_readouts and time.time() - start < timeout:
+            if not socket.poll(100):
+                continue
+            header = socket.recv_json()
+            if header['name'] != 'ReadoutData':
+                continue
+            data = np.frombuffer(buffer(socket.recv()), dtype=header['dtype']).reshape(header['shape'])
+            if data_list is None:
+                self.assertEqual(header['sequence_number'], data[0])
+            else:
+                data_list.append(data)
+            headers.append(header)
+        return headers
+
+    def test_lossless_mode(self):  # small queue and high water mark to force backpressure
+        n_readouts = 1000
+        sender = DataSender('inproc://test_lossless_mode', mode='push', queue_size=5, hwm=2)
+        receiver = zmq.Context.instance().socket(zmq.PULL)
+        receiver.connect('inproc://test_lossless_mode')
+
+        def send_all():  # blocks when the send queue is full
+            sender.send_meta_data(None, name='Reset')
+            for index in range(n_readouts):
+                sender.send_data((np.full(shape=(100,), fill_value=index, dtype=np.uint32), time.time(), time.time(), 0), scan_parameters={'PlsrDAC': index})
+
+        sender_thread = Thread(target=send_all)
+        sender_thread.daemon = True
+        sender_thread.start()
+        time.sleep(0.1)  # let the sender wait for the receiver
+        headers = self.receive_data(receiver, n_readouts)
+        sender_thread.join()
+        sender.close()
+        receiver.close()
+        self.assertEqual(0, sender.n_dropped)
+        self.assertListEqual(range(n_readouts), [header['sequence_number'] for header in headers])
+        self.assertListEqual(range(n_readouts), [header['scan_parameters']['PlsrDAC'] for header in headers])
+
+    def test_drop_count(self):  # no receiver, all read outs that do not fit into the send queue are dropped
+        sender = DataSender('inproc://test_drop_count', mode='pub', queue_size=10)
+        sender._closing.set()  # stop the sender thread to fill up the send queue
+        sender._sender_thread.join()
+        for index in range(100):
+            sender.send_data((np.full(shape=(100,), fill_value=index, dtype=np.uint32), time.time(), time.time(), 0))
+        self.assertEqual(100, sender.sequence_number)
+        self.assertEqual(90, sender.n_dropped)
+        sender.socket.close()
+
+    def test_close_full_queue(self):  # no receiver in lossless mode, closing must not block on the full send queue
+        sender = DataSender('inproc://test_close_full_queue', mode='push', queue_size=5, hwm=1)
+        for index in range(6):  # sender thread waits for the receiver with one read out, the send queue is full
+            sender.send_data((np.full(shape=(100,), fill_value=index, dtype=np.uint32), time.time(), time.time(), 0))
+        self.assertTrue(sender._queue.full())
+        start = time.time()
+        sender.close(timeout=0.5)
+        self.assertLess(time.time() - start, 5.0)
+        self.assertFalse(sender._sender_thread.is_alive())
+        self.assertGreater(sender.n_dropped, 0)
+
+    def test_replay_raw_data(self):  # replay in small chunks as fast as possible
+        raw_data_file = os.path.join(tests_data_folder, 'unit_test_data_1.h5')
+        with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+            raw_data = in_file_h5.root.raw_data[:]
+            n_readouts = in_file_h5.root.meta_data.shape[0]
+        receiver = zmq.Context.instance().socket(zmq.PULL)
+        receiver.connect('inproc://test_replay_raw_data')
+        results = {}
+
+        def replay():
+            results.update(replay_raw_data(raw_data_file, 'inproc://test_replay_raw_data', speed=0, mode='push', chunk_size=7, send_queue_size=5))
+
+        replay_thread = Thread(target=replay)
+        replay_thread.daemon = True
+        replay_thread.start()
+        data_list = []
+        headers = self.receive_data(receiver, n_readouts, data_list=data_list)
+        replay_thread.join()
+        receiver.close()
+        self.assertEqual(n_readouts, results['n_readouts'])
+        self.assertEqual(raw_data.shape[0], results['n_words'])
+        self.assertEqual(0, results['n_dropped'])
+        self.assertListEqual(range(n_readouts), [header['sequence_number'] for header in headers])
+        self.assertTrue(np.array_equal(raw_data, np.concatenate(data_list)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+''' Script to check the online monitor service. Raw data is replayed from a file and the histograms of the service are compared to the histograms of a local interpretation.
+'''
+import os
+import unittest
+import time
+
+import numpy as np
+import tables as tb
+
+from pybar.daq.fei4_raw_data import DataSender
+from pybar.online_monitor_service import RawDataMonitor, OnlineMonitorService, OnlineMonitorClient
+
+tests_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_analysis_data')
+
+
+class TestOnlineMonitorService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), mode="r") as in_file_h5:
+            raw_data = in_file_h5.root.raw_data[:]
+        cls.readouts = np.array_split(raw_data, 100)
+
+    def test_service(self):
+        service = OnlineMonitorService(socket_addr='inproc://test_online_monitor_service_data', service_addr='inproc://test_online_monitor_service', pull=True, integrate_readouts=0, max_refresh_rate=100.0, snapshot_interval=0.2)
+        self.addCleanup(service.close)
+        client = OnlineMonitorClient('inproc://test_online_monitor_service')
+        self.addCleanup(client.close)
+        service.start()
+        time.sleep(0.2)  # let the client subscribe
+        sender = DataSender('inproc://test_online_monitor_service_data', mode='push')
+        try:
+            sender.send_meta_data({'Trig_Count': 0}, name='RunConf')
+            for readout in self.readouts:
+                sender.send_data((readout, time.time(), time.time(), 0))
+        finally:
+            sender.close()  # stops the sender thread
+
+        names = []
+        histograms = None
+        n_total_readouts = 0
+        start = time.time()
+        while time.time() - start < 10.0:
+            message = client.receive(timeout=0.1)
+            if message is None:
+                continue
+            name, meta_data, message_histograms = message
+            names.append(name)
+            if name != 'Histograms':
+                continue
+            if meta_data is not None:
+                n_total_readouts = meta_data['n_total_readouts']
+                self.assertEqual(0, meta_data['n_lost_readouts'])
+            elif n_total_readouts == len(self.readouts) and len(message_histograms) == 8:  # snapshot after all read outs
+                histograms = message_histograms
+                break
+
+        self.assertIn('RunConf', names)
+        self.assertEqual(len(self.readouts), n_total_readouts)
+        self.assertIsNotNone(histograms)
+        # interpret the same data locally
+        monitor = RawDataMonitor(integrate_readouts=0)
+        for readout in self.readouts:
+            monitor.add_readout({'dtype': str(readout.dtype), 'shape': readout.shape}, readout)
+        for name, histogram in monitor.get_histograms().iteritems():
+            self.assertTrue(np.array_equal(histogram, histograms[name]), msg=name)
+        self.assertGreater(np.sum(histograms['occupancy']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+''' Script to check the histogramming of the FE-I4 data records while reading out. The histograms are compared to the histograms of the buffered data.
+'''
+import unittest
+
+import numpy as np
+
+from pybar.daq.readout_utils import OccupancyAccumulator, convert_data_array, is_data_record, get_col_row_tot_array_from_data_record_array
+
+
+def get_data_records(n_words, seed):
+    random_state = np.random.RandomState(seed)
+    col = random_state.randint(1, 81, size=n_words).astype(np.uint32)
+    row = random_state.randint(1, 337, size=n_words).astype(np.uint32)
+    tot_1 = random_state.randint(0, 16, size=n_words).astype(np.uint32)
+    tot_2 = random_state.randint(0, 16, size=n_words).astype(np.uint32)  # second hit in row + 1
+    data = (col << 17) | (row << 8) | (tot_1 << 4) | tot_2
+    data[::10] = 0x80000000 | np.arange(data[::10].shape[0], dtype=np.uint32)  # trigger words
+    return data
+
+
+class TestOccupancyAccumulator(unittest.TestCase):
+
+    def test_histograms(self):
+        data_chunks = [get_data_records(n_words=10000, seed=seed) for seed in range(10)]
+        other_module_data_chunks = [get_data_records(n_words=100, seed=seed) for seed in range(10, 20)]
+        written_data = []
+        occupancy_accumulator = OccupancyAccumulator(n_modules=3, tot=True, callback=written_data.append)
+        for data, other_module_data in zip(data_chunks, other_module_data_chunks):
+            occupancy_accumulator([[(data, 0.0, 0.0, 0)], None, [(other_module_data, 0.0, 0.0, 0)]])
+        self.assertEqual(len(data_chunks), len(written_data))  # data is passed to the callback
+        col_row_tot = np.column_stack(convert_data_array(np.concatenate(data_chunks), filter_func=is_data_record, converter_func=get_col_row_tot_array_from_data_record_array))
+        occupancy, _, _ = np.histogram2d(col_row_tot[:, 0], col_row_tot[:, 1], bins=(80, 336), range=[[1, 80], [1, 336]])
+        tot_hist = np.histogramdd(col_row_tot, bins=(80, 336, 16), range=[[1, 80], [1, 336], [0, 15]])[0]
+        self.assertTrue(np.array_equal(occupancy, occupancy_accumulator.get_occupancy(index=0)))
+        self.assertTrue(np.array_equal(tot_hist, occupancy_accumulator.get_tot_hist(index=0)))
+        self.assertEqual(0, np.count_nonzero(occupancy_accumulator.get_occupancy(index=1)))
+        self.assertTrue(np.any(occupancy_accumulator.get_occupancy(index=2)))
+        occupancy_accumulator.reset()
+        self.assertEqual(0, np.count_nonzero(occupancy_accumulator.get_occupancy(index=0)))
+        self.assertRaises(ValueError, OccupancyAccumulator(tot=False).get_tot_hist)
+
+
+if __name__ == '__main__':
+    unittest.main()
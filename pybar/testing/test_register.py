@@ -0,0 +1,101 @@
+''' Script to check the FE-I4 register commands. The commands built from the precompiled command templates are compared to commands assembled bit by bit.
+'''
+import unittest
+import time
+import logging
+
+import numpy as np
+from bitarray import bitarray
+
+from pybar.fei4.register import FEI4Register, bitarray_from_value
+
+
+class TestRegister(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.register = FEI4Register(fe_type='fei4b', chip_address=3)
+
+    def test_build_command(self):
+        slow = bitarray('101101000', endian='little')
+        chip_id = bitarray_from_value(value=3, size=4, fmt='I')
+        global_data = bitarray('0110100111001010', endian='little')
+        self.assertEqual(self.register.build_command('WrRegister', ChipID=3, Address=22, GlobalData=global_data), slow + bitarray('0010') + chip_id + bitarray_from_value(value=22, size=6, fmt='I') + global_data)
+        self.assertEqual(self.register.build_command('RdRegister', ChipID='0011', Address=5), slow + bitarray('0001') + chip_id + bitarray_from_value(value=5, size=6, fmt='I'))
+        self.assertEqual(self.register.build_command('GlobalPulse', ChipID=chip_id, Width=7), slow + bitarray('1001') + chip_id + bitarray_from_value(value=7, size=6, fmt='I'))
+        self.assertEqual(self.register.build_command('RunMode', ChipID=3), slow + bitarray('1010') + chip_id + bitarray('111000'))
+        # templates are copied, commands must not share memory
+        self.assertFalse(self.register.build_command('RunMode', ChipID=3) is self.register.build_command('RunMode', ChipID=3))
+        self.assertRaises(ValueError, self.register.build_command, 'WrRegister', ChipID=3, Address=22)  # missing GlobalData
+        self.assertRaises(ValueError, self.register.build_command, 'WrRegister', ChipID=3, Address=22, GlobalData=bitarray(15))
+        self.assertRaises(ValueError, self.register.build_command, 'UnknownCommand')
+        self.assertRaises(TypeError, self.register.build_command, 'GlobalPulse', ChipID=3, Width=-1)
+
+    def test_write_front_end(self):  # benchmark writing all pixel registers to all 40 double columns
+        start_time = time.time()
+        commands = self.register.get_commands('WrFrontEnd', same_mask_for_all_dc=False, name=['Imon', 'Enable', 'C_High', 'C_Low', 'EnableDigInj', 'TDAC', 'FDAC'])
+        logging.info('Writing all pixel registers: %d commands in %.3f s', len(commands), time.time() - start_time)
+        wr_front_end = [command for command in commands if command.length() == self.register.commands['WrFrontEnd']['bitlength']]
+        self.assertEqual(len(wr_front_end), 40 * (5 + 5 + 4))  # 5 single bit registers, TDAC (5 bits), FDAC (4 bits)
+        self.assertTrue(all(command[:13] == bitarray('1011010000100') for command in wr_front_end))
+        self.assertTrue(all(command[13:17] == bitarray('1000') for command in wr_front_end))  # broadcast
+
+    def test_restore_point(self):  # compare register values to full copies of the registers
+        register = FEI4Register(fe_type='fei4b', chip_address=3)
+
+        def get_state():
+            return dict((name, reg['value']) for name, reg in register.global_registers.iteritems()), dict((name, reg['value'].copy()) for name, reg in register.pixel_registers.iteritems())
+
+        def check_state(state):
+            self.assertDictEqual(state[0], get_state()[0])
+            for name, value in state[1].iteritems():
+                self.assertTrue(np.array_equal(value, register.pixel_registers[name]['value']), msg=name)
+
+        initial_state = get_state()
+        with register.restored():
+            register.set_global_register_value('Vthin_AltFine', 100)
+            register.set_pixel_register_value('TDAC', 15)
+            state = get_state()
+            register.create_restore_point(name='nested')
+            register.set_global_register_value('Vthin_AltFine', 200)
+            register.set_global_register_value('PlsrDAC', 300)
+            register.set_pixel_register_value('Enable', 0)
+            register.restore(name='nested', keep=True)
+            check_state(state)
+            register.set_pixel_register_value('TDAC', 5)
+            register.restore(name='nested')
+            check_state(state)
+        check_state(initial_state)
+        self.assertFalse(register.can_restore)
+        # restoring global registers only
+        register.create_restore_point()
+        register.set_global_register_value('PlsrDAC', 100)
+        register.set_pixel_register_value('FDAC', 1)
+        register.restore(pixel_register=False)
+        self.assertEqual(initial_state[0]['PlsrDAC'], register.get_global_register_value('PlsrDAC'))
+        self.assertTrue(np.all(register.get_pixel_register_value('FDAC') == 1))
+        # restoring an older restore point changes the registers stored by the newer restore point
+        state = get_state()
+        first = register.create_restore_point()
+        register.set_global_register_value('PlsrDAC', 1)
+        register.set_pixel_register_value('TDAC', 1)
+        second = register.create_restore_point()
+        register.restore(name=first)
+        check_state(state)
+        register.restore(name=second)
+        self.assertEqual(1, register.get_global_register_value('PlsrDAC'))
+        self.assertTrue(np.all(register.get_pixel_register_value('TDAC') == 1))
+
+    def test_restore_point_benchmark(self):
+        register = FEI4Register(fe_type='fei4b', chip_address=3)
+        start_time = time.time()
+        for value in range(1000):
+            with register.restored():
+                register.set_global_register_value('Vthin_AltFine', value % 256)
+                register.set_pixel_register_value('TDAC', value % 32)
+        logging.info('Creating and restoring 1000 restore points in %.3f s', time.time() - start_time)
+        self.assertEqual(80, register.get_global_register_value('Vthin_AltFine'))  # default value
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRegister)
+    unittest.TextTestRunner(verbosity=2).run(suite)
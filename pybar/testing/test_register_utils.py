@@ -0,0 +1,96 @@
+''' Script to check the generation of the pixel masks. The masks are compared to masks generated pixel by pixel.
+'''
+import unittest
+import itertools
+import time
+import logging
+
+import numpy as np
+
+from pybar.fei4.register_utils import make_pixel_mask, make_xtalk_mask, make_checkerboard_mask, make_pixel_mask_from_col_row, clear_mask_cache
+
+
+def make_pixel_mask_slow(steps, shift, default=0, value=1, enable_columns=None, mask=None):
+    mask_array = np.full((80, 336), default, dtype=np.uint8)
+    if enable_columns:
+        odd_columns = [odd - 1 for odd in enable_columns if odd % 2 != 0]
+        even_columns = [even - 1 for even in enable_columns if even % 2 == 0]
+    else:
+        odd_columns = range(0, 80, 2)
+        even_columns = range(1, 80, 2)
+    odd_rows = np.arange(shift % steps, 336, steps)
+    even_rows = np.arange(((steps // 2) + shift) % steps, 336, steps)
+    for column, row in itertools.product(odd_columns, odd_rows):
+        mask_array[column, row] = value
+    for column, row in itertools.product(even_columns, even_rows):
+        mask_array[column, row] = value
+    if mask is not None:
+        mask_array = np.ma.array(mask_array, mask=mask, fill_value=default).filled()
+    return mask_array
+
+
+def make_xtalk_mask_slow(mask):
+    col, row = mask.nonzero()
+    row_plus_one = row + 1
+    del_index = np.where(row_plus_one > 335)
+    row_plus_one = np.delete(row_plus_one, del_index)
+    col_plus_one = np.delete(col.copy(), del_index)
+    row_minus_one = row - 1
+    del_index = np.where(row_minus_one > 335)
+    row_minus_one = np.delete(row_minus_one, del_index)
+    col_minus_one = np.delete(col.copy(), del_index)
+    col = np.concatenate((col_plus_one, col_minus_one))
+    row = np.concatenate((row_plus_one, row_minus_one))
+    return make_pixel_mask_from_col_row(col + 1, row + 1)
+
+
+class TestPixelMask(unittest.TestCase):
+
+    def setUp(self):
+        clear_mask_cache()
+
+    def test_pixel_mask(self):
+        masked_pixels = np.zeros(shape=(80, 336), dtype=np.bool_)
+        masked_pixels[10:20, 100:200] = True
+        for steps in (1, 3, 6, 25, 336, 672):
+            for shift in sorted(set((0, 1, steps // 2, steps - 1))):
+                for default, value in ((0, 1), (1, 0)):
+                    for enable_columns in (None, [1, 2, 3], range(10, 30), [80]):
+                        for mask in (None, masked_pixels):
+                            mask_array = make_pixel_mask(steps=steps, shift=shift, default=default, value=value, enable_columns=enable_columns, mask=mask)
+                            self.assertEqual(mask_array.dtype, np.uint8)
+                            self.assertTrue(np.array_equal(mask_array, make_pixel_mask_slow(steps=steps, shift=shift, default=default, value=value, enable_columns=enable_columns, mask=mask)))
+
+    def test_mask_cache(self):
+        mask_array = make_pixel_mask(steps=3, shift=1)
+        self.assertTrue(mask_array is make_pixel_mask(steps=3, shift=1))
+        self.assertFalse(mask_array.flags.writeable)
+        self.assertFalse(mask_array is make_pixel_mask(steps=3, shift=1, default=1, value=0))
+        self.assertTrue(make_pixel_mask(steps=3, shift=1, mask=np.zeros(shape=(80, 336))).flags.writeable)  # additional mask, new array
+        self.assertTrue(make_checkerboard_mask(6, 2) is make_checkerboard_mask(6, 2))
+        start_time = time.time()
+        for _ in range(10):
+            for mask_step in range(672):
+                make_pixel_mask(steps=672, shift=mask_step)
+        logging.info('Generating 10 x 672 masks in %.3f s', time.time() - start_time)
+
+    def test_xtalk_mask(self):
+        for steps in (3, 6, 336):
+            for shift in range(3):
+                mask_array = make_pixel_mask(steps=steps, shift=shift)
+                self.assertTrue(np.array_equal(make_xtalk_mask(mask_array), make_xtalk_mask_slow(mask_array)))
+        mask_array = np.zeros(shape=(80, 336), dtype=np.uint8)
+        mask_array[5, [0, 335]] = 1  # first and last row
+        self.assertTrue(np.array_equal(make_xtalk_mask(mask_array), make_xtalk_mask_slow(mask_array)))
+
+    def test_checkerboard_mask(self):
+        mask_array = make_checkerboard_mask(column_distance=6, row_distance=2)
+        self.assertEqual(mask_array.dtype, np.uint8)
+        self.assertTrue(np.array_equal(np.nonzero(mask_array[0])[0], np.arange(0, 336, 2)))
+        self.assertTrue(np.array_equal(np.nonzero(mask_array[6])[0], np.arange(1, 336, 2)))
+        self.assertEqual(0, np.count_nonzero(mask_array[1:6]))
+
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPixelMask)
+    unittest.TextTestRunner(verbosity=2).run(suite)
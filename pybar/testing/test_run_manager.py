@@ -0,0 +1,111 @@
+''' Script to check the scheduling of the runs of a primlist and the run registry of the run manager.
+'''
+import os
+import unittest
+import time
+import shutil
+import tempfile
+
+from pybar.run_manager import RunManager, RunBase, run_status
+
+
+class SleepRun(RunBase):
+    '''Run without hardware access.
+    '''
+    hardware_access = False
+
+    _default_run_conf = {
+        "duration": 0.5,
+        "fail": False
+    }
+
+    def pre_run(self):
+        pass
+
+    def do_run(self):
+        time.sleep(self.duration)
+        if self.fail:
+            raise RuntimeError('Run failed')
+
+    def post_run(self):
+        pass
+
+    def cleanup_run(self):
+        pass
+
+
+class HardwareRun(SleepRun):
+    '''Run with hardware access.
+    '''
+    hardware_access = True
+
+
+class TestRunManager(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.run_manager = RunManager(conf={'working_dir': self.working_dir})
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def run_primlist(self, lines, **kwargs):
+        primlist = os.path.join(self.working_dir, 'test.plst')
+        with open(primlist, 'w') as f:
+            f.write('\n'.join(lines))
+        start_time = time.time()
+        summary = self.run_manager.run_primlist(primlist, **kwargs)
+        return summary, time.time() - start_time
+
+    def test_concurrent_runs(self):  # different DUTs
+        summary, run_time = self.run_primlist(['pybar.testing.test_run_manager.SleepRun; @dut=a', 'pybar.testing.test_run_manager.SleepRun; @dut=b'], max_concurrent_runs=None)
+        self.assertListEqual([run_status.finished] * 2, [result['status'] for result in summary])
+        self.assertEqual(2, len(set(result['run_number'] for result in summary)))
+        self.assertLess(run_time, 0.9)
+
+    def test_same_dut(self):  # runs are executed one after another
+        summary, run_time = self.run_primlist(['pybar.testing.test_run_manager.SleepRun', 'pybar.testing.test_run_manager.SleepRun; duration=0.1'], max_concurrent_runs=None)
+        self.assertListEqual([run_status.finished] * 2, [result['status'] for result in summary])
+        self.assertGreaterEqual(summary[1]['start_time'], summary[0]['run_time'])
+        self.assertGreaterEqual(run_time, 0.6)
+
+    def test_dependencies(self):
+        summary, _ = self.run_primlist([
+            'pybar.testing.test_run_manager.SleepRun; fail=True; @name=first',
+            'pybar.testing.test_run_manager.SleepRun; @after=first; @analysis_only',
+            'pybar.testing.test_run_manager.SleepRun; duration=0.1; @dut=b'], max_concurrent_runs=None)
+        self.assertListEqual([run_status.crashed, 'SKIPPED', run_status.finished], [result['status'] for result in summary])
+        self.assertListEqual(['first', '2', '3'], [result['name'] for result in summary])
+
+    def test_analysis_only_hardware_access(self):  # runs accessing the hardware cannot be executed with @analysis_only
+        self.assertRaises(ValueError, self.run_primlist, ['pybar.testing.test_run_manager.SleepRun', 'pybar.testing.test_run_manager.HardwareRun; @analysis_only'])
+
+    def test_run_registry(self):
+        self.check_run_registry()
+        self.assertTrue(os.path.isfile(os.path.join(self.working_dir, 'run.cfg')))
+
+    def test_sqlite_run_registry(self):
+        self.run_manager = RunManager(conf={'working_dir': self.working_dir, 'run_registry': 'sqlite'})
+        self.check_run_registry()
+        self.assertTrue(os.path.isfile(os.path.join(self.working_dir, 'runs.db')))
+
+    def check_run_registry(self):
+        summary, _ = self.run_primlist(['pybar.testing.test_run_manager.SleepRun; duration=0.0', 'pybar.testing.test_run_manager.SleepRun; duration=0.0; fail=True'])
+        self.assertListEqual([1, 2], self.run_manager.get_run_numbers())
+        self.assertListEqual([1], self.run_manager.get_run_numbers(status=run_status.finished))
+        self.assertEqual(run_status.crashed, self.run_manager.get_run_status(2))
+        self.assertIsNone(self.run_manager.get_run_status(3))
+
+    def test_run_cfg_migration(self):
+        with open(os.path.join(self.working_dir, 'run.cfg'), 'w') as f:
+            f.write('1 SleepRun FINISHED 2016-01-01 10:00:00.000000 2016-01-01 10:00:01.000000 0:00:01\n')
+            f.write('5 SleepRun ABORTED 2016-01-01 10:00:02.000000 2016-01-01 10:00:03.000000 0:00:01\n')
+        self.run_manager = RunManager(conf={'working_dir': self.working_dir, 'run_registry': 'sqlite'})
+        self.run_manager.run_run(SleepRun, run_conf={'duration': 0.0})
+        self.assertListEqual([1, 5, 6], self.run_manager.get_run_numbers())
+        self.assertEqual(run_status.aborted, self.run_manager.get_run_status(5))
+        self.assertEqual(run_status.finished, self.run_manager.get_run_status(6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,358 @@
+''' Script to check the command stream of the scan loop. The commands sent by ScanLoopSequence are compared to the commands sent by the previous
+implementation of scan_loop() which created all commands at every call. A mocked command sequencer records the command data.
+'''
+import unittest
+import itertools
+from threading import Event
+
+import numpy as np
+from bitarray import bitarray
+
+from pybar.fei4.register import FEI4Register
+from pybar.fei4.register_utils import FEI4RegisterUtils, ScanLoopSequence, make_pixel_mask, make_checkerboard_mask, calculate_wait_cycles
+
+
+class MockTx(object):
+    '''Command sequencer recording the command data and the register writes.
+    '''
+    name = 'TX'
+
+    def __init__(self):
+        self.records = []
+        self.registers = {'CMD_SIZE': 0, 'CMD_REPEAT': 1, 'START_SEQUENCE_LENGTH': 0, 'STOP_SEQUENCE_LENGTH': 0, 'READY': 1}
+
+    def __getitem__(self, name):
+        if name == 'START':
+            self.records.append(('START',))
+            return 0
+        return self.registers[name]
+
+    def __setitem__(self, name, value):
+        self.records.append((name, value))
+        self.registers[name] = value
+
+    def set_data(self, data, addr=0):
+        self.records.append(('set_data', addr, str(data)))
+
+    def wait_for_ready(self, timeout=None, times=None, delay=None, abort=None):
+        self.records.append(('wait_for_ready',))
+        return True
+
+
+class MockRun(object):
+    '''Run with the attributes used by the scan loop.
+    '''
+    def __init__(self):
+        self.dut = {'TX': MockTx()}
+        self.register = FEI4Register(fe_type='fei4b')
+        self.register.set_global_register_value("PlsrDAC", 50)  # the PlsrDAC correction is added to this value
+        self.register.calibration_parameters['Pulser_Corr_C_Inj_High'] = [(dc % 5) - 2.4 for dc in range(40)]
+        self.register_utils = FEI4RegisterUtils(self.dut, self.register, abort=Event())
+        self.abort_run = Event()
+        self.run_number = 1
+        self.run_id = 'mock_run'
+
+    @property
+    def records(self):
+        return self.dut['TX'].records
+
+    def eol_function(self):
+        self.records.append(('eol_function',))
+
+
+def scan_loop_reference(self, command, repeat_command=100, use_delay=True, additional_delay=0, mask_steps=3, enable_mask_steps=None, enable_double_columns=None, same_mask_for_all_dc=False, fast_dc_loop=True, bol_function=None, eol_function=None, digital_injection=False, enable_shift_masks=None, disable_shift_masks=None, restore_shift_masks=True, mask=None, double_column_correction=False):
+    '''Previous implementation of scan_loop() creating all commands at every call.
+    '''
+    if not isinstance(command, bitarray):
+        raise TypeError
+    if enable_shift_masks is None:
+        enable_shift_masks = ["Enable", "C_High", "C_Low"]
+    if disable_shift_masks is None:
+        disable_shift_masks = []
+    # get PlsrDAC correction
+    if isinstance(double_column_correction, (list, tuple)):  # from list/tuple
+        plsr_dac_correction = list(double_column_correction)
+    else:  # default
+        if "C_High".lower() in map(lambda x: x.lower(), enable_shift_masks) and "C_Low".lower() in map(lambda x: x.lower(), enable_shift_masks):
+            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_High']
+        elif "C_High".lower() in map(lambda x: x.lower(), enable_shift_masks):
+            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_Med']
+        elif "C_Low".lower() in map(lambda x: x.lower(), enable_shift_masks):
+            plsr_dac_correction = self.register.calibration_parameters['Pulser_Corr_C_Inj_Low']
+    initial_plsr_dac = self.register.get_global_register_value("PlsrDAC")
+    restore_point_name = str(self.run_number) + '_' + self.run_id + '_scan_loop'
+    with self.register.restored(name=restore_point_name):
+        conf_mode_command = self.register.get_commands("ConfMode")[0]
+        run_mode_command = self.register.get_commands("RunMode")[0]
+        if use_delay:
+            delay = self.register.get_commands("zeros", length=additional_delay + calculate_wait_cycles(mask_steps))[0]
+            scan_loop_command = command + delay
+        else:
+            scan_loop_command = command
+
+        def enable_columns(dc):
+            if digital_injection:
+                return [dc * 2 + 1, dc * 2 + 2]
+            else:  # analog injection
+                if dc == 0:
+                    return [1]
+                elif dc == 39:
+                    return [78, 79, 80]
+                else:
+                    return [dc * 2, dc * 2 + 1]
+
+        def write_double_columns(dc):
+            if digital_injection:
+                return [dc]
+            else:  # analog injection
+                if dc == 0:
+                    return [0]
+                elif dc == 39:
+                    return [38, 39]
+                else:
+                    return [dc - 1, dc]
+
+        def get_dc_address_command(dc):
+            commands = []
+            commands.append(conf_mode_command)
+            self.register.set_global_register_value("Colpr_Addr", dc)
+            commands.append(self.register.get_commands("WrRegister", name=["Colpr_Addr"])[0])
+            if double_column_correction:
+                self.register.set_global_register_value("PlsrDAC", initial_plsr_dac + int(round(plsr_dac_correction[dc])))
+                commands.append(self.register.get_commands("WrRegister", name=["PlsrDAC"])[0])
+            commands.append(run_mode_command)
+            return self.register_utils.concatenate_commands(commands, byte_padding=True)
+
+        def get_dc_shift_mask_commands(mask_step, ec, dcs):
+            commands = []
+            commands.append(conf_mode_command)
+            if disable_shift_masks:
+                curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, enable_columns=ec, mask=mask)
+                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
+                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=disable_shift_masks, joint_write=True))
+            if enable_shift_masks:
+                curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, enable_columns=ec, mask=mask)
+                map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
+                commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, dcs=dcs, name=enable_shift_masks, joint_write=True))
+            if digital_injection is True:
+                self.register.set_global_register_value("DIGHITIN_SEL", 1)
+                commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+            return commands
+
+        if not enable_mask_steps:
+            enable_mask_steps = range(mask_steps)
+        if not enable_double_columns:
+            enable_double_columns = range(40)
+
+        # preparing for scan
+        commands = []
+        commands.append(conf_mode_command)
+        if digital_injection is True:
+            self.register.set_pixel_register_value("C_High", 0)
+            self.register.set_pixel_register_value("C_Low", 0)
+            commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=["C_Low", "C_High"], joint_write=True))
+            self.register.set_global_register_value("DIGHITIN_SEL", 1)
+        else:
+            self.register.set_global_register_value("DIGHITIN_SEL", 0)
+        commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+        self.register_utils.send_commands(commands)
+
+        for mask_step in enable_mask_steps:
+            if self.abort_run.is_set():
+                break
+            commands = []
+            commands.append(conf_mode_command)
+            if same_mask_for_all_dc:  # generate and write first mask step
+                if disable_shift_masks:
+                    curr_dis_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, default=1, value=0, mask=mask)
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_dis_mask), disable_shift_masks)
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=disable_shift_masks, joint_write=True))
+                if enable_shift_masks:
+                    curr_en_mask = make_pixel_mask(steps=mask_steps, shift=mask_step, mask=mask)
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, curr_en_mask), enable_shift_masks)
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False if mask is not None else True, name=enable_shift_masks, joint_write=True))
+                if digital_injection is True:
+                    self.register.set_global_register_value("DIGHITIN_SEL", 1)
+                    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+            else:  # set masks to default values
+                if disable_shift_masks:
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 1), disable_shift_masks)
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=disable_shift_masks, joint_write=True))
+                if enable_shift_masks:
+                    map(lambda mask_name: self.register.set_pixel_register_value(mask_name, 0), enable_shift_masks)
+                    commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=True, name=enable_shift_masks, joint_write=True))
+                if digital_injection is True:
+                    self.register.set_global_register_value("DIGHITIN_SEL", 1)
+                    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL"]))
+            self.register_utils.send_commands(commands)
+
+            if same_mask_for_all_dc:
+                if fast_dc_loop:
+                    self.dut['TX']['CMD_REPEAT'] = repeat_command
+                    dc_address_command = get_dc_address_command(enable_double_columns[0])
+                    self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
+                    self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.abort_run.is_set():
+                            break
+                        if index != 0:
+                            dc_address_command = get_dc_address_command(dc)
+                            self.register_utils.wait_for_command()
+                            if eol_function:
+                                eol_function()
+                            self.register_utils.set_command(dc_address_command, set_length=False)
+                        if bol_function:
+                            bol_function()
+                        self.dut['TX']['START']
+                    self.register_utils.wait_for_command()
+                    if eol_function:
+                        eol_function()
+                    self.dut['TX']['START_SEQUENCE_LENGTH'] = 0
+                else:
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.abort_run.is_set():
+                            break
+                        dc_address_command = get_dc_address_command(dc)
+                        self.register_utils.send_command(dc_address_command)
+                        if bol_function:
+                            bol_function()
+                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                        if eol_function:
+                            eol_function()
+            else:
+                if fast_dc_loop:
+                    dc = enable_double_columns[0]
+                    self.register_utils.send_commands(get_dc_shift_mask_commands(mask_step, ec=enable_columns(dc), dcs=write_double_columns(dc)))
+                    dc_address_command = get_dc_address_command(dc)
+                    self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
+                    self.dut['TX']['CMD_REPEAT'] = repeat_command
+                    self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.abort_run.is_set():
+                            break
+                        if index != 0:
+                            dcs = write_double_columns(dc)
+                            dcs.extend(write_double_columns(enable_double_columns[index - 1]))
+                            commands = get_dc_shift_mask_commands(mask_step, ec=enable_columns(dc), dcs=dcs)
+                            dc_address_command = get_dc_address_command(dc)
+                            self.register_utils.wait_for_command()
+                            if eol_function:
+                                eol_function()
+                            self.register_utils.send_commands(commands)
+                            self.dut['TX']['START_SEQUENCE_LENGTH'] = len(dc_address_command)
+                            self.dut['TX']['CMD_REPEAT'] = repeat_command
+                            self.register_utils.set_command(command=self.register_utils.concatenate_commands((dc_address_command, scan_loop_command), byte_padding=False))
+                        if bol_function:
+                            bol_function()
+                        self.dut['TX']['START']
+                    self.register_utils.wait_for_command()
+                    if eol_function:
+                        eol_function()
+                    self.dut['TX']['START_SEQUENCE_LENGTH'] = 0
+                else:
+                    for index, dc in enumerate(enable_double_columns):
+                        if self.abort_run.is_set():
+                            break
+                        dcs = write_double_columns(dc)
+                        if index != 0:
+                            dcs.extend(write_double_columns(enable_double_columns[index - 1]))
+                        self.register_utils.send_commands(get_dc_shift_mask_commands(mask_step, ec=enable_columns(dc), dcs=dcs))
+                        dc_address_command = get_dc_address_command(dc)
+                        self.register_utils.send_command(dc_address_command)
+                        if bol_function:
+                            bol_function()
+                        self.register_utils.send_command(scan_loop_command, repeat=repeat_command)
+                        if eol_function:
+                            eol_function()
+
+    commands = []
+    commands.extend(self.register.get_commands("ConfMode"))
+    commands.extend(self.register.get_commands("WrRegister", name=["DIGHITIN_SEL", "Colpr_Addr", "PlsrDAC"]))
+    if restore_shift_masks:
+        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=disable_shift_masks))
+        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name=enable_shift_masks))
+        commands.extend(self.register.get_commands("WrFrontEnd", same_mask_for_all_dc=False, name="EnableDigInj"))
+    self.register_utils.send_commands(commands)
+
+
+class TestScanLoop(unittest.TestCase):
+
+    def get_scan_loop_kwargs(self, digital_injection, **kwargs):
+        run = MockRun()
+        scan_loop_kwargs = dict(command=run.register.get_commands("CAL")[0] + run.register.get_commands("zeros", length=40)[0] + run.register.get_commands("LV1")[0], repeat_command=10, mask_steps=3, enable_mask_steps=[0, 2], enable_double_columns=[0, 1, 20, 39], digital_injection=digital_injection, enable_shift_masks=["Enable", "EnableDigInj"] if digital_injection else ["Enable", "C_High", "C_Low"], disable_shift_masks=["Imon"])
+        scan_loop_kwargs.update(kwargs)
+        return scan_loop_kwargs
+
+    def assert_same_commands(self, reference_run, run, scan_loop_sequence, restore_shift_masks=True, **kwargs):
+        del reference_run.records[:]
+        del run.records[:]
+        scan_loop_reference(reference_run, eol_function=reference_run.eol_function, restore_shift_masks=restore_shift_masks, **kwargs)
+        scan_loop_sequence.run(run, eol_function=run.eol_function, restore_shift_masks=restore_shift_masks)
+        self.assertTrue(reference_run.records)
+        self.assertListEqual(reference_run.records, run.records)
+        for name in reference_run.register.global_registers:
+            self.assertEqual(reference_run.register.get_global_register_value(name), run.register.get_global_register_value(name))
+        for name in reference_run.register.pixel_registers:
+            self.assertTrue(np.array_equal(reference_run.register.get_pixel_register_value(name), run.register.get_pixel_register_value(name)))
+        return list(run.records)
+
+    def test_scan_loop(self):
+        for same_mask_for_all_dc, fast_dc_loop, digital_injection, double_column_correction in itertools.product((True, False), repeat=4):
+            kwargs = self.get_scan_loop_kwargs(digital_injection=digital_injection, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop, double_column_correction=[(dc % 7) - 3.4 for dc in range(40)] if double_column_correction and digital_injection else double_column_correction)
+            reference_run, run = MockRun(), MockRun()
+            scan_loop_sequence = ScanLoopSequence(**kwargs)
+            records = self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+            # commands are replayed from the stored command data
+            self.assertListEqual(records, self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs))
+            self.assert_same_commands(reference_run, run, scan_loop_sequence, restore_shift_masks=False, **kwargs)
+
+    def test_mask(self):
+        for same_mask_for_all_dc, fast_dc_loop in itertools.product((True, False), repeat=2):
+            kwargs = self.get_scan_loop_kwargs(digital_injection=False, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop, mask=make_checkerboard_mask(column_distance=3, row_distance=5))
+            reference_run, run = MockRun(), MockRun()
+            scan_loop_sequence = ScanLoopSequence(**kwargs)
+            self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+            self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+
+    def test_plsr_dac_change(self):  # the PlsrDAC is written at every double column if the double column correction is enabled
+        for same_mask_for_all_dc, fast_dc_loop in itertools.product((True, False), repeat=2):
+            kwargs = self.get_scan_loop_kwargs(digital_injection=False, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop, double_column_correction=True)
+            reference_run, run = MockRun(), MockRun()
+            scan_loop_sequence = ScanLoopSequence(**kwargs)
+            records = self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+            for plsr_dac in (100, 101, 100):
+                for mock_run in (reference_run, run):
+                    mock_run.register.set_global_register_value("PlsrDAC", plsr_dac)
+                self.assertNotEqual(records, self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs))
+            # register change not affecting the scan loop commands
+            for mock_run in (reference_run, run):
+                mock_run.register.set_global_register_value("Vthin_AltFine", 100)
+            self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+
+    def test_shift_mask_change(self):  # the shift masks are restored after the scan loop
+        for same_mask_for_all_dc, fast_dc_loop in itertools.product((True, False), repeat=2):
+            kwargs = self.get_scan_loop_kwargs(digital_injection=False, same_mask_for_all_dc=same_mask_for_all_dc, fast_dc_loop=fast_dc_loop)
+            reference_run, run = MockRun(), MockRun()
+            scan_loop_sequence = ScanLoopSequence(**kwargs)
+            records = self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+            for name in ("Enable", "C_High", "Imon", "EnableDigInj"):
+                for mock_run in (reference_run, run):
+                    mock_run.register.set_pixel_register_value(name, make_checkerboard_mask(column_distance=2, row_distance=3))
+                self.assertNotEqual(records, self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs))
+            # register not restored by the scan loop
+            for mock_run in (reference_run, run):
+                mock_run.register.set_pixel_register_value("TDAC", 5)
+            self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+
+    def test_chip_address_change(self):
+        kwargs = self.get_scan_loop_kwargs(digital_injection=False, same_mask_for_all_dc=True)
+        reference_run, run = MockRun(), MockRun()
+        scan_loop_sequence = ScanLoopSequence(**kwargs)
+        records = self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs)
+        for mock_run in (reference_run, run):
+            mock_run.register.set_chip_address(chip_address=3, broadcast=False)
+        self.assertNotEqual(records, self.assert_same_commands(reference_run, run, scan_loop_sequence, **kwargs))
+
+
+if __name__ == '__main__':
+    unittest.main()
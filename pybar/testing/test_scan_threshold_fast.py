@@ -0,0 +1,126 @@
+''' Script to check the adaptive mode of the fast threshold scan without hardware. The skipped mask steps and double columns, the PlsrDAC steps
+and the occupancy of the pixels which were not injected anymore are checked.
+'''
+import unittest
+
+import numpy as np
+
+from pybar.analysis.analyze_raw_data import set_saturated_pixels_occupancy
+from pybar.fei4.register_utils import make_pixel_mask
+from pybar.scans.scan_threshold_fast import FastThresholdScan, get_injected_columns
+
+
+def create_scan(**run_conf):
+    '''Creates the scan object without hardware initialization.
+    '''
+    scan = FastThresholdScan.__new__(FastThresholdScan)
+    module_run_conf = dict(FastThresholdScan._default_run_conf)
+    module_run_conf.update(run_conf)
+    scan.__dict__.update({
+        '_module_cfgs': {'module_0': {'activate': True}},
+        '_module_run_conf': {'module_0': module_run_conf},
+        '_module_attr': {'module_0': {}},
+        '_tx_module_groups': {},
+        '_current_module_handle': 'module_0',
+        '_initialized': True})
+    return scan
+
+
+class TestScanThresholdFast(unittest.TestCase):
+
+    def setUp(self):
+        self.scan = create_scan(mask_steps=3, n_injections=100, saturated_steps=2)
+        self.scan.select_arr_columns = [column for column in range(0, 80) if column + 1 not in self.scan.ignore_columns]
+        self.scan.scan_parameter_value = 20
+        self.scan.init_adaptive_scan(enable_double_columns=range(1, 39))
+        self.mask_step_pixels = [make_pixel_mask(steps=3, shift=mask_step).astype(np.bool_) for mask_step in range(3)]
+
+    def test_scan_groups(self):
+        self.assertListEqual([([0, 1, 2], range(1, 39))], self.scan.get_adaptive_scan_groups())
+        self.assertTrue(np.all(self.scan.saturated_pixels == -1))
+        self.assertFalse(np.any(self.scan.adaptive_scan_pixels[[0, 77, 78, 79]]))  # ignored columns
+
+        occupancy_array = np.zeros(shape=(80, 336), dtype=np.uint32)
+        occupancy_array[self.mask_step_pixels[0]] = 100
+        self.scan.update_completed_pixels(occupancy_array)
+        self.assertFalse(np.any(self.scan.completed_pixels))  # saturated_steps not reached
+        self.scan.update_completed_pixels(occupancy_array)
+        self.assertTrue(np.all(self.scan.completed_pixels[np.logical_and(self.scan.adaptive_scan_pixels, self.mask_step_pixels[0])]))
+        self.assertFalse(np.any(self.scan.completed_pixels[np.logical_and(self.scan.adaptive_scan_pixels, ~self.mask_step_pixels[0])]))
+
+        self.scan.scan_parameter_value = 30
+        self.assertListEqual([([1, 2], range(1, 39))], self.scan.get_adaptive_scan_groups())
+        self.assertTrue(np.all(self.scan.saturated_pixels[np.logical_and(self.scan.adaptive_scan_pixels, self.mask_step_pixels[0])] == 30))
+        self.assertTrue(np.all(self.scan.saturated_pixels[~np.logical_and(self.scan.adaptive_scan_pixels, self.mask_step_pixels[0])] == -1))
+
+        occupancy_array[:] = 100
+        occupancy_array[get_injected_columns(5)] = 50  # double column 5 is not completed
+        self.scan.update_completed_pixels(occupancy_array)
+        self.scan.update_completed_pixels(occupancy_array)
+        self.scan.scan_parameter_value = 32
+        self.assertListEqual([([1, 2], [5])], self.scan.get_adaptive_scan_groups())
+        self.assertTrue(np.all(self.scan.saturated_pixels[get_injected_columns(5)][self.mask_step_pixels[0][get_injected_columns(5)]] == 30))  # value of the first skipped step is kept
+        self.assertTrue(np.all(self.scan.saturated_pixels[[1, 2]][self.mask_step_pixels[1][[1, 2]]] == 32))
+        self.assertTrue(self.scan.is_in_scurve(occupancy_array))
+
+        occupancy_array[:] = 100
+        self.scan.update_completed_pixels(occupancy_array)
+        self.scan.update_completed_pixels(occupancy_array)
+        self.assertFalse(self.scan.is_in_scurve(occupancy_array))
+        self.assertListEqual([], self.scan.get_adaptive_scan_groups())
+
+    def test_interrupted_saturation(self):  # consecutive PlsrDAC steps with all injections seen are needed
+        occupancy_array = np.full(shape=(80, 336), fill_value=100, dtype=np.uint32)
+        self.scan.update_completed_pixels(occupancy_array)
+        occupancy_array[:] = 99
+        self.scan.update_completed_pixels(occupancy_array)
+        occupancy_array[:] = 100
+        self.scan.update_completed_pixels(occupancy_array)
+        self.assertFalse(np.any(self.scan.completed_pixels))
+        self.scan.update_completed_pixels(occupancy_array)
+        self.assertTrue(np.all(self.scan.completed_pixels[self.scan.adaptive_scan_pixels]))
+        self.assertFalse(np.any(self.scan.completed_pixels[~self.scan.adaptive_scan_pixels]))
+
+    def test_step_sequence(self):  # coarse steps reaching an S-curve are scanned again with step_size
+        thresholds = np.full(shape=(80, 336), fill_value=31, dtype=np.int32)
+        thresholds[get_injected_columns(5)] = 40  # double column 5 has a higher threshold
+
+        def get_occupancy(plsr_dac):  # S-curve from threshold - 2 (no hits) to threshold + 2 (all injections seen)
+            return np.clip((plsr_dac - thresholds + 2) * 25, 0, self.scan.n_injections).astype(np.uint32)
+
+        scan_parameter_values = []
+        while self.scan.scan_parameter_value <= 100 and self.scan.get_adaptive_scan_groups():
+            scan_parameter_values.append(self.scan.scan_parameter_value)
+            self.scan.scan_parameter_value = self.scan.update_adaptive_scan(get_occupancy(self.scan.scan_parameter_value), max_scan_parameter_value=100)
+        self.assertListEqual([20, 26, 32, 28, 30, 34, 36, 42, 38, 40, 44, 46], scan_parameter_values)
+        self.assertListEqual(range(28, 48, 2), sorted(scan_parameter_values)[2:])  # no PlsrDAC gap at the S-curves
+        other_pixels = self.scan.adaptive_scan_pixels.copy()
+        other_pixels[get_injected_columns(5)] = False
+        self.assertTrue(np.all(self.scan.saturated_pixels[other_pixels] == 38))  # not injected during the second scan of the interval
+        self.assertTrue(np.all(self.scan.saturated_pixels[get_injected_columns(5)][self.scan.adaptive_scan_pixels[get_injected_columns(5)]] == 52))
+
+    def test_coarse_step_at_range_end(self):
+        self.scan.completed_pixels[:] = True
+        self.scan.completed_pixels[10, 10] = False  # only one pixel left, without hits
+        occupancy_array = np.zeros(shape=(80, 336), dtype=np.uint32)
+        self.scan.scan_parameter_value = 250
+        self.assertEqual(255, self.scan.update_adaptive_scan(occupancy_array, max_scan_parameter_value=255))  # the last PlsrDAC value is scanned
+        self.scan.scan_parameter_value = 255
+        self.assertEqual(257, self.scan.update_adaptive_scan(occupancy_array, max_scan_parameter_value=255))
+
+    def test_saturated_pixels_occupancy(self):
+        occupancy_array = np.zeros(shape=(336, 80, 4), dtype=np.uint32)
+        occupancy_array[20, 10] = [0, 10, 60, 0]  # not injected from PlsrDAC 36 on
+        occupancy_array[21, 10] = [0, 30, 0, 0]  # not injected from PlsrDAC 30 on
+        saturated_pixels = np.full(shape=(80, 336), fill_value=-1, dtype=np.int32)
+        saturated_pixels[10, 20] = 36
+        saturated_pixels[10, 21] = 30
+        set_saturated_pixels_occupancy(occupancy_array, saturated_pixels, np.array([20, 26, 30, 36]), 100)
+        self.assertListEqual([0, 10, 60, 100], occupancy_array[20, 10].tolist())
+        self.assertListEqual([0, 30, 100, 100], occupancy_array[21, 10].tolist())
+        occupancy_array[20:22, 10] = 0
+        self.assertFalse(np.any(occupancy_array))  # other pixels are not changed
+
+
+if __name__ == '__main__':
+    unittest.main()
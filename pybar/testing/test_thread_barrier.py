@@ -0,0 +1,104 @@
+''' Script to check the synchronization of scan threads. Many module threads are simulated and the latency of the synchronization points is measured.
+'''
+import unittest
+import time
+import logging
+from threading import Thread, Event, current_thread
+
+import numpy as np
+
+from pybar.fei4_run_base import ThreadBarrier
+
+
+class TestThreadBarrier(unittest.TestCase):
+
+    def run_threads(self, target, n_threads):
+        threads = [Thread(target=target, name='module_%d' % i) for i in range(n_threads)]
+        for t in threads:
+            t.daemon = True
+        barrier = ThreadBarrier()
+        barrier.reset(parties=[t.name for t in threads])
+        return barrier, threads
+
+    def test_sync_latency(self):  # stress test with many module threads
+        n_threads = 32
+        n_sync_points = 200
+        arrival_times = np.zeros(shape=(n_sync_points, n_threads), dtype=np.float64)
+        release_times = np.zeros(shape=(n_sync_points, n_threads), dtype=np.float64)
+
+        def target():
+            name = current_thread().name
+            index = thread_index[name]
+            for sync_point in range(n_sync_points):
+                arrival_times[sync_point, index] = time.time()
+                released.append(barrier.wait(name=name))
+                release_times[sync_point, index] = time.time()
+
+        released = []
+        barrier, threads = self.run_threads(target, n_threads)
+        thread_index = {t.name: i for i, t in enumerate(threads)}
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10.0)
+            self.assertFalse(t.is_alive())
+        self.assertTrue(all(released))
+        self.assertEqual(len(released), n_sync_points * n_threads)
+        # no thread is released before all threads arrived
+        self.assertTrue(np.all(release_times.min(axis=1) >= arrival_times.max(axis=1)))
+        latency = release_times.max(axis=1) - arrival_times.max(axis=1)
+        logging.info('Sync point latency for %d threads: mean %.3f ms, max %.3f ms', n_threads, latency.mean() * 1000.0, latency.max() * 1000.0)
+        self.assertLess(np.median(latency), 0.01)
+
+    def test_finished_thread(self):  # threads which are raising an exception are not blocking the others
+        released = []
+
+        def target():
+            name = current_thread().name
+            try:
+                if name == 'module_0':
+                    raise RuntimeError('Module failed')
+                released.append(barrier.wait(name=name, timeout=10.0))
+            except RuntimeError:
+                pass
+            finally:
+                barrier.remove_party(name)
+
+        barrier, threads = self.run_threads(target, 8)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10.0)
+        self.assertEqual(released, [True] * 7)
+
+    def test_abort(self):
+        abort = Event()
+        released = []
+
+        def target():
+            released.append(barrier.wait(name=current_thread().name, abort=abort))
+
+        barrier, threads = self.run_threads(target, 4)
+        for t in threads[:-1]:  # last thread never arrives
+            t.start()
+        time.sleep(0.1)
+        abort.set()
+        barrier.wake()
+        for t in threads[:-1]:
+            t.join(10.0)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(released, [False] * 3)
+
+    def test_timeout(self):
+        barrier = ThreadBarrier()
+        barrier.reset(parties=['module_0', 'module_1'])
+        start_time = time.time()
+        self.assertRaises(RuntimeError, barrier.wait, name='module_0', timeout=0.1)
+        self.assertGreaterEqual(time.time() - start_time, 0.1)
+        self.assertRaises(RuntimeError, barrier.wait, name='module_2')  # unknown party
+        barrier.reset()
+        self.assertTrue(barrier.wait(name='module_0'))  # no parties, not blocking
+
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestThreadBarrier)
+    unittest.TextTestRunner(verbosity=2).run(suite)